@@ -1,12 +1,48 @@
+import uuid
+
 from redis import Redis
 
 from app.config import settings
 
 _client: Redis | None = None
 
+# Deletes KEYS[1] only while it still holds ARGV[1]: a holder whose lock
+# expired must not free the lock another worker has taken since.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Extends KEYS[1] to ARGV[2] seconds only while it still holds ARGV[1].
+_RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
 
 def get_redis_client() -> Redis:
     global _client
     if _client is None:
         _client = Redis.from_url(settings.redis_url, decode_responses=True)
     return _client
+
+
+def acquire_lock(key: str, ttl_seconds: int) -> str | None:
+    """Takes the lock and returns its owner token, or None if it is held."""
+    token = uuid.uuid4().hex
+    if get_redis_client().set(key, token, nx=True, ex=ttl_seconds):
+        return token
+    return None
+
+
+def release_lock(key: str, token: str) -> bool:
+    return bool(get_redis_client().eval(_RELEASE_LOCK_SCRIPT, 1, key, token))
+
+
+def renew_lock(key: str, token: str, ttl_seconds: int) -> bool:
+    """Extends the lock if the token still owns it; False means it was lost."""
+    return bool(get_redis_client().eval(_RENEW_LOCK_SCRIPT, 1, key, token, ttl_seconds))
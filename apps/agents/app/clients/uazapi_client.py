@@ -1,10 +1,18 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import logging
 import re
+import threading
+import time
 from urllib.parse import urlparse
 
 import httpx
 
 from app.config import settings
 
+logger = logging.getLogger("uvicorn.error")
+
 DEFAULT_PATH_SUFFIXES = (
     "",
     "/api/v2",
@@ -22,8 +30,8 @@ def _build_base_urls(raw_value: str) -> list[str]:
     if not raw:
         return []
 
-    values = [value for value in re.split(r"[\\s,]+", raw) if value]
-    is_explicit_list = bool(re.search(r"[\\s,]", raw))
+    values = [value for value in re.split(r"[\s,]+", raw) if value]
+    is_explicit_list = bool(re.search(r"[\s,]", raw))
     unique: list[str] = []
     seen: set[str] = set()
 
@@ -55,6 +63,177 @@ def _build_base_urls(raw_value: str) -> list[str]:
     return unique
 
 
+# Failures that prove the request never reached a working UAZAPI route, so
+# it is safe to try the next base URL even for a send.
+ROUTE_MISS_STATUS = frozenset({404, 405})
+MAX_COOLDOWN_SECONDS = 600
+LATENCY_WEIGHT = 0.3
+PROBE_PATH = "/instance/status"
+# Tokens come and go with instances: the resolver forgets a token unused for
+# IDLE_KEY_SECONDS and keeps at most MAX_TRACKED_KEYS, least recently used
+# first out.
+IDLE_KEY_SECONDS = 3600
+MAX_TRACKED_KEYS = 1024
+
+_http_client: httpx.Client | None = None
+_http_client_lock = threading.Lock()
+
+
+def _get_http_client() -> httpx.Client:
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(timeout=25)
+    return _http_client
+
+
+@dataclass
+class EndpointStats:
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    latency_ms: float | None = None
+    retry_at: float = 0.0
+
+    def cooling(self, now: float) -> bool:
+        return self.consecutive_failures > 0 and self.retry_at > now
+
+
+class EndpointResolver:
+    """Process-wide memory of which UAZAPI base URL works for each token.
+
+    Candidates are ranked by recent failures, then by latency (EWMA), then
+    by configured order, so a request normally goes straight to the base URL
+    that answered last time. A failing base URL cools down with exponential
+    backoff and is left off the hot path; a background thread re-probes it
+    with an instance status call and brings it back once it answers. The
+    probe needs the token's headers, so they are only kept while one of its
+    base URLs is failing."""
+
+    def __init__(self) -> None:
+        self._stats: OrderedDict[tuple, dict[str, EndpointStats]] = OrderedDict()
+        self._used_at: dict[tuple, float] = {}
+        self._headers: dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+        self._prober: threading.Thread | None = None
+
+    def _touch(self, key: tuple, now: float, used: bool = True) -> dict[str, EndpointStats] | None:
+        """Stats for key, marked as just used. Probe results are not a use:
+        they only update a key still tracked. Caller holds the lock."""
+        if not used:
+            return self._stats.get(key)
+        stats = self._stats.setdefault(key, {})
+        self._stats.move_to_end(key)
+        self._used_at[key] = now
+        while self._stats:
+            oldest = next(iter(self._stats))
+            if len(self._stats) <= MAX_TRACKED_KEYS and self._used_at[oldest] > now - IDLE_KEY_SECONDS:
+                break
+            self._forget(oldest)
+        return stats
+
+    def _forget(self, key: tuple) -> None:
+        self._stats.pop(key, None)
+        self._used_at.pop(key, None)
+        self._headers.pop(key, None)
+
+    def ranked(self, key: tuple, base_urls: list[str]) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            stats = self._touch(key, now)
+            order = []
+            for index, base_url in enumerate(base_urls):
+                item = stats.setdefault(base_url, EndpointStats())
+                order.append(
+                    (
+                        item.cooling(now),
+                        item.consecutive_failures,
+                        item.latency_ms is None,
+                        item.latency_ms or 0.0,
+                        index,
+                        base_url,
+                    )
+                )
+        return [entry[-1] for entry in sorted(order)]
+
+    def record_success(self, key: tuple, base_url: str, latency_ms: float, used: bool = True) -> None:
+        with self._lock:
+            stats = self._touch(key, time.monotonic(), used)
+            if stats is None:
+                return
+            item = stats.setdefault(base_url, EndpointStats())
+            item.successes += 1
+            item.consecutive_failures = 0
+            item.retry_at = 0.0
+            item.latency_ms = (
+                latency_ms
+                if item.latency_ms is None
+                else item.latency_ms * (1 - LATENCY_WEIGHT) + latency_ms * LATENCY_WEIGHT
+            )
+            if not any(other.consecutive_failures for other in stats.values()):
+                self._headers.pop(key, None)
+
+    def record_failure(self, key: tuple, base_url: str, headers: dict, used: bool = True) -> None:
+        interval = settings.uazapi_endpoint_probe_interval_seconds
+        with self._lock:
+            now = time.monotonic()
+            stats = self._touch(key, now, used)
+            if stats is None:
+                return
+            item = stats.setdefault(base_url, EndpointStats())
+            item.failures += 1
+            item.consecutive_failures += 1
+            item.retry_at = now + min(interval * 2 ** (item.consecutive_failures - 1), MAX_COOLDOWN_SECONDS)
+            self._headers[key] = headers
+        self._ensure_prober()
+
+    def _ensure_prober(self) -> None:
+        with self._lock:
+            if self._prober is not None and self._prober.is_alive():
+                return
+            self._prober = threading.Thread(target=self._probe_loop, name="uazapi-endpoint-probe", daemon=True)
+            self._prober.start()
+
+    def _due_probes(self) -> list[tuple[tuple, str, dict]]:
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, used_at in self._used_at.items() if used_at <= now - IDLE_KEY_SECONDS]:
+                self._forget(key)
+            return [
+                (key, base_url, self._headers.get(key) or {})
+                for key, stats in self._stats.items()
+                for base_url, item in stats.items()
+                if item.consecutive_failures > 0 and item.retry_at <= now
+            ]
+
+    def _probe_loop(self) -> None:
+        while True:
+            time.sleep(settings.uazapi_endpoint_probe_interval_seconds)
+            due = self._due_probes()
+            if not due:
+                with self._lock:
+                    if not any(
+                        item.consecutive_failures > 0 for stats in self._stats.values() for item in stats.values()
+                    ):
+                        self._prober = None
+                        return
+                continue
+            for key, base_url, headers in due:
+                started = time.monotonic()
+                try:
+                    response = _get_http_client().get(f"{base_url}{PROBE_PATH}", headers=headers, timeout=10)
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    self.record_failure(key, base_url, headers, used=False)
+                    continue
+                self.record_success(key, base_url, (time.monotonic() - started) * 1000, used=False)
+                logger.info("uazapi_endpoint_recovered base_url=%s", base_url)
+
+
+_resolver = EndpointResolver()
+
+
 class UazapiClient:
     def __init__(self, token: str) -> None:
         self.token = (token or "").strip()
@@ -107,27 +286,45 @@ class UazapiClient:
     def _post(self, path: str, payload: dict) -> dict:
         return self._request("POST", path, payload=payload, timeout=25)
 
+    def _resolver_key(self, base_urls: list[str]) -> tuple:
+        token_hash = hashlib.sha1(self.token.encode("utf-8")).hexdigest()[:16]
+        return (tuple(base_urls), token_hash)
+
     def _request(self, method: str, path: str, payload: dict | None = None, timeout: int = 25) -> dict:
         base_urls = self._base_urls()
         if not base_urls:
             raise httpx.HTTPError("UAZAPI base URL not configured")
+        key = self._resolver_key(base_urls)
+        # Sends are not idempotent: after a timeout or server error the
+        # message may have gone out, so only route misses move on to the
+        # next base URL.
+        idempotent = not path.startswith("/send/")
         last_error: Exception | None = None
         headers = self._headers()
-        for base_url in base_urls:
-            url = f"{base_url}{path}"
+        for base_url in _resolver.ranked(key, base_urls):
+            started = time.monotonic()
             try:
-                with httpx.Client(timeout=timeout) as client:
-                    response = client.request(
-                        method,
-                        url,
-                        headers=headers,
-                        json=payload,
-                    )
+                response = _get_http_client().request(
+                    method,
+                    f"{base_url}{path}",
+                    headers=headers,
+                    json=payload,
+                    timeout=timeout,
+                )
                 response.raise_for_status()
-                return response.json()
+                data = response.json()
             except httpx.HTTPError as exc:
                 last_error = exc
-                continue
+                route_miss = isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout)) or (
+                    isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code in ROUTE_MISS_STATUS
+                )
+                if route_miss or (isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code >= 500):
+                    _resolver.record_failure(key, base_url, headers)
+                if idempotent or route_miss:
+                    continue
+                raise
+            _resolver.record_success(key, base_url, (time.monotonic() - started) * 1000)
+            return data
         if last_error:
             raise last_error
         raise httpx.HTTPError("UAZAPI request failed")
@@ -74,6 +74,84 @@ class Settings(BaseSettings):
     google_client_id: str | None = None
     google_client_secret: str | None = None
 
+    followup_batch_enabled: bool = False
+    followup_batch_size: int = 200
+    followup_batch_interval_seconds: int = 30
+    followup_claim_visibility_seconds: int = 600
+    followup_max_attempts: int = 5
+    followup_history_limit: int = 20
+    followup_send_concurrency: int = 16
+    followup_account_concurrency: int = 4
+
+    credits_cache_ttl_seconds: int = 300
+    credits_settle_batch_size: int = 500
+    credits_settle_interval_seconds: int = 5
+
+    metrics_flush_batch_size: int = 1000
+    metrics_flush_interval_seconds: int = 15
+
+    realtime_async_enabled: bool = True
+    realtime_flush_interval_ms: int = 50
+    realtime_max_pending: int = 5000
+    realtime_transport: str = "pusher"
+    realtime_stream_key: str = "realtime:events"
+    realtime_stream_maxlen: int = 100000
+    realtime_redis_publish: bool = True
+
+    agent_streaming_enabled: bool = False
+    agent_stream_min_segment_chars: int = 120
+    agent_tool_concurrency: int = 4
+
+    llm_request_timeout_seconds: float = 60.0
+    llm_http_max_connections: int = 100
+    llm_http_max_keepalive: int = 20
+    llm_hedge_after_ms: int = 0
+    llm_attempt_deadline_ms: int = 60000
+
+    circuit_failure_threshold: int = 5
+    circuit_failure_window_seconds: int = 60
+    circuit_open_seconds: int = 30
+    provider_error_rate_threshold: float = 0.5
+    provider_error_rate_min_calls: int = 10
+    provider_rate_limit_per_second: float = 50.0
+    provider_rate_limit_min_per_second: float = 1.0
+    provider_rate_limit_burst: int = 20
+    provider_rate_limit_max_wait_ms: int = 2000
+
+    agent_context_token_budget: int = 12000
+    agent_context_min_recent_messages: int = 6
+    agent_context_knowledge_share: float = 0.3
+    agent_context_lookup_share: float = 0.15
+    agent_history_window_messages: int = 40
+    agent_summary_batch_size: int = 200
+
+    membership_cache_ttl_seconds: int = 300
+
+    calendar_token_refresh_ahead_seconds: int = 300
+    calendar_token_refresh_interval_seconds: int = 600
+    calendar_busy_cache_ttl_seconds: int = 120
+    calendar_freebusy_concurrency: int = 8
+
+    whatsapp_template_sync_concurrency: int = 4
+    whatsapp_template_sync_interval_seconds: int = 3600
+    whatsapp_template_waba_interval_seconds: int = 300
+    template_catalog_ttl_seconds: int = 7200
+    template_catalog_memory_ttl_seconds: int = 60
+
+    uazapi_sync_concurrency: int = 4
+    uazapi_sync_max_chats: int = 100
+    uazapi_sync_messages_per_chat: int = 50
+    uazapi_endpoint_probe_interval_seconds: int = 30
+
+    ingestion_media_concurrency: int = 4
+    whatsapp_webhook_intake: str = "inline"
+    webhook_intake_partitions: int = 16
+    webhook_intake_workers: int = 4
+    webhook_intake_batch_size: int = 50
+    webhook_intake_max_attempts: int = 3
+    webhook_intake_retry_seconds: int = 5
+    webhook_intake_stream_maxlen: int = 100000
+
     @field_validator("redis_url", mode="before")
     @classmethod
     def ensure_redis_ssl_options(cls, value: str) -> str:
@@ -13,6 +13,7 @@ from app.schemas import (
     BaileysNotifyRequest,
     BaileysNotifyResponse,
     BaileysGroupsResponse,
+    CreditsInvalidateResponse,
     KnowledgeProcessRequest,
     KnowledgeProcessResponse,
     WhatsappTemplateSyncRequest,
@@ -23,15 +24,16 @@ from app.schemas import (
     WebhookProcessResponse,
 )
 from app.services.agent_runner import run_agent, run_agent_sandbox
+from app.services.credits import invalidate_balance
 from app.services.media import extract_upload_text_bytes
 from app.services.knowledge import process_knowledge_file
-from app.services.whatsapp_ingestion import process_whatsapp_event
+from app.services.webhook_intake import enqueue_event, ingest_whatsapp_event
 from app.services.whatsapp_templates import sync_whatsapp_templates
 from app.workers.tasks import (
     process_knowledge_task,
+    process_whatsapp_event_media_task,
     process_whatsapp_event_task,
     process_instagram_event_task,
-    process_whatsapp_event_media_task,
     run_agent_buffered_task,
     run_agent_task,
     sync_whatsapp_templates_task,
@@ -68,31 +70,6 @@ def _require_api_key(x_agents_key: str | None) -> None:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
-def _find_active_agent(workspace_id: str, integration_account_id: str) -> str | None:
-    supabase = get_supabase_client()
-    response = (
-        supabase.table("agents")
-        .select("id")
-        .eq("workspace_id", workspace_id)
-        .eq("integration_account_id", integration_account_id)
-        .eq("status", "ativo")
-        .limit(1)
-        .execute()
-    )
-    data = response.data or []
-    return data[0]["id"] if data else None
-
-
-def _enqueue_agents(workspace_id: str | None, integration_account_id: str | None, conversation_ids: list[str]) -> None:
-    if not workspace_id or not integration_account_id or not conversation_ids:
-        return
-    agent_id = _find_active_agent(workspace_id, integration_account_id)
-    if not agent_id:
-        return
-    for conversation_id in conversation_ids:
-        run_agent_task.delay(agent_id, conversation_id)
-
-
 def _load_agent_dispatch_config(workspace_id: str, integration_account_id: str) -> dict | None:
     supabase = get_supabase_client()
     response = (
@@ -494,8 +471,19 @@ def process_whatsapp_webhook(
     x_agents_key: str | None = Header(default=None, alias="X-Agents-Key"),
 ):
     _require_api_key(x_agents_key)
+    if settings.whatsapp_webhook_intake == "stream":
+        # Ack right away; app.workers.webhook_intake ingests in order per
+        # conversation. If Redis is unreachable the event is ingested inline.
+        try:
+            enqueue_event(body.event_id)
+            return {"event_id": body.event_id, "status": "accepted"}
+        except Exception:
+            logger.warning("webhook_whatsapp_intake_unavailable event_id=%s", body.event_id)
+
     logger.info("webhook_whatsapp_process event_id=%s", body.event_id)
-    result = process_whatsapp_event(body.event_id, process_media=False)
+    result = ingest_whatsapp_event(
+        body.event_id, run_agent_task.delay, process_whatsapp_event_media_task.delay
+    )
     conversation_ids = result.get("conversation_ids") or []
     logger.info(
         "webhook_whatsapp_processed event_id=%s workspace_id=%s integration_account_id=%s conversations=%s blocked=%s",
@@ -505,12 +493,6 @@ def process_whatsapp_webhook(
         len(conversation_ids),
         len(conversation_ids) == 0,
     )
-    _enqueue_agents(
-        result.get("workspace_id"),
-        result.get("integration_account_id"),
-        conversation_ids,
-    )
-    process_whatsapp_event_media_task.delay(body.event_id)
     return {"event_id": body.event_id, "status": "processed_inline"}
 
 
@@ -533,6 +515,19 @@ def process_uazapi_webhook(
     raise HTTPException(status_code=410, detail="UAZAPI desativado.")
 
 
+@app.post(
+    "/workspaces/{workspace_id}/credits/invalidate",
+    response_model=CreditsInvalidateResponse,
+)
+def invalidate_credits_endpoint(
+    workspace_id: str,
+    x_agents_key: str | None = Header(default=None, alias="X-Agents-Key"),
+):
+    _require_api_key(x_agents_key)
+    invalidate_balance(workspace_id)
+    return {"workspace_id": workspace_id, "status": "invalidated"}
+
+
 @app.post(
     "/integrations/whatsapp/templates/sync",
     response_model=WhatsappTemplateSyncResponse,
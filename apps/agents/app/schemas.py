@@ -47,6 +47,11 @@ class WebhookProcessResponse(BaseModel):
     status: str
 
 
+class CreditsInvalidateResponse(BaseModel):
+    workspace_id: str
+    status: str
+
+
 class WhatsappTemplateSyncRequest(BaseModel):
     workspace_id: str
     integration_account_id: str | None = None
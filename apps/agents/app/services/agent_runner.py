@@ -1,26 +1,51 @@
+from collections import OrderedDict
 from dataclasses import dataclass, field
+import hashlib
 import json
 import logging
+import threading
 from datetime import datetime, timedelta, timezone
+from functools import partial
 
 from langdetect import detect
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import get_executor_for_config
 from langchain_core.tools import tool
-from langgraph.prebuilt import create_react_agent
+from langgraph.graph import END, StateGraph
+from langgraph.prebuilt.chat_agent_executor import AgentState
 
 from app.clients.supabase import get_supabase_client
+from app.config import settings
 from app.services.conversation import (
     get_conversation,
+    get_last_message,
     get_messages,
     should_pause,
     update_conversation_state,
 )
 from app.services.consent import has_agent_consent
-from app.services.credits import consume_credits, get_remaining_credits
+from app.services.context_budget import (
+    context_budget,
+    count_tokens,
+    message_tokens,
+    split_history,
+    trim_knowledge,
+    trim_lookups,
+)
+from app.services.conversation_summary import get_conversation_summary
+from app.services.credits import (
+    consume_credits,
+    get_remaining_credits,
+    release_credits,
+    reserve_credits,
+)
 from app.services.knowledge import ingest_conversation_text, retrieve_knowledge
 from app.services.metrics import increment_agent_metrics
 from app.services.llm import get_last_fallback_llm, get_primary_llm, get_secondary_llm
+from app.services.model_fallback import AttemptCancelled, ModelAttempt, run_with_fallback
 from app.services.media import extract_message_media_text
+from app.services.template_catalog import get_template_catalog, template_problem
 from app.services.workspaces import is_workspace_not_expired
 from app.tools.calendar import (
     create_calendar_event,
@@ -28,6 +53,7 @@ from app.tools.calendar import (
     get_calendar_availability,
     get_calendar_event,
     update_calendar_event,
+    working_hours_for,
 )
 from app.tools.crm import (
     apply_tag,
@@ -62,6 +88,9 @@ class AgentContext:
     canal: str
     provider: str
     timezone: str | None = None
+    horario: str | None = None
+    calendar_buffer_minutes: int = 0
+    calendar_notice_minutes: int = 0
     sent_by_tool: bool = False
     outside_window: bool = False
     default_pipeline_id: str | None = None
@@ -69,17 +98,34 @@ class AgentContext:
     blocked_fields: set[str] = field(default_factory=set)
     tool_calls: list[dict] = field(default_factory=list)
     credits_used: int = 0
+    first_send_at: datetime | None = None
+    streamed_segments: int = 0
+    attempt_owner: str | None = None
+    claim_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def claim(self, attempt: ModelAttempt | None) -> bool:
+        """Binds the run's side effects to one model attempt; attempts that
+        lose the race (hedging or deadlines) can no longer act."""
+        if attempt is None:
+            return True
+        with self.claim_lock:
+            if self.attempt_owner is None and not attempt.cancel_event.is_set():
+                self.attempt_owner = attempt.id
+            return self.attempt_owner == attempt.id
+
+
+AGENT_COLUMNS = (
+    "id, workspace_id, nome, tipo, status, detectar_idioma, idioma_padrao, configuracao, "
+    "integration_account_id, pipeline_id, etapa_inicial_id, pausar_em_tags, pausar_em_etapas, "
+    "pausar_ao_responder_humano, campos_bloqueados, timezone, tempo_resposta_segundos"
+)
 
 
 def load_agent(agent_id: str) -> dict:
     supabase = get_supabase_client()
     response = (
         supabase.table("agents")
-        .select(
-            "id, workspace_id, nome, tipo, status, detectar_idioma, idioma_padrao, configuracao, "
-            "integration_account_id, pipeline_id, etapa_inicial_id, pausar_em_tags, pausar_em_etapas, "
-            "pausar_ao_responder_humano, campos_bloqueados, timezone, tempo_resposta_segundos"
-        )
+        .select(AGENT_COLUMNS)
         .eq("id", agent_id)
         .single()
         .execute()
@@ -87,6 +133,15 @@ def load_agent(agent_id: str) -> dict:
     return response.data
 
 
+def load_agents(agent_ids: list[str]) -> dict[str, dict]:
+    ids = sorted({agent_id for agent_id in agent_ids if agent_id})
+    if not ids:
+        return {}
+    supabase = get_supabase_client()
+    rows = supabase.table("agents").select(AGENT_COLUMNS).in_("id", ids).execute().data or []
+    return {row["id"]: row for row in rows}
+
+
 def _resolve_provider(agent: dict) -> str:
     integration_account_id = agent.get("integration_account_id")
     if not integration_account_id:
@@ -103,6 +158,13 @@ def _resolve_provider(agent: dict) -> str:
     return account.get("provider") if account and account.get("provider") else "whatsapp_oficial"
 
 
+def _config_minutes(agent: dict, key: str) -> int:
+    try:
+        return max(int((agent.get("configuracao") or {}).get(key) or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
 def _agent_allows_groups(agent: dict) -> bool:
     cfg = agent.get("configuracao") or {}
     try:
@@ -128,43 +190,6 @@ def _is_group_chat(phone: str | None) -> bool:
     return phone.endswith("@g.us")
 
 
-def _get_default_template(workspace_id: str) -> dict | None:
-    supabase = get_supabase_client()
-    response = (
-        supabase.table("whatsapp_templates")
-        .select("nome, idioma, categoria, status")
-        .eq("workspace_id", workspace_id)
-        .execute()
-    )
-    templates = response.data or []
-    approved = [
-        item
-        for item in templates
-        if (item.get("status") or "").lower() == "approved"
-    ]
-    if not approved:
-        return None
-    prioridades = [
-        "utility",
-        "transactional",
-        "authentication",
-        "marketing",
-        "service",
-    ]
-    for categoria in prioridades:
-        match = next(
-            (
-                item
-                for item in approved
-                if (item.get("categoria") or "").lower() == categoria
-            ),
-            None,
-        )
-        if match:
-            return match
-    return approved[0]
-
-
 def _load_permissions(agent_id: str) -> set[str] | None:
     supabase = get_supabase_client()
     response = (
@@ -445,6 +470,138 @@ def _log_tool_call(ctx: AgentContext, action: str, payload: dict, result: str |
     )
 
 
+def _mark_sent(ctx: AgentContext) -> None:
+    if ctx.first_send_at is None:
+        ctx.first_send_at = datetime.now(timezone.utc)
+
+
+def _send_agent_text(ctx: AgentContext, text: str) -> bool:
+    if not reserve_credits(ctx.workspace_id, 1):
+        _log_tool_call(ctx, "enviar_mensagem", {"texto": text}, "sem_creditos")
+        return False
+    try:
+        if ctx.canal == "instagram":
+            response = send_instagram_text(ctx.agent_id, ctx.phone, text)
+            message_id = response.get("message_id") or response.get("id")
+        else:
+            response = send_whatsapp_text(ctx.agent_id, ctx.phone, text)
+            message_id = None
+            messages = response.get("messages") or []
+            if messages:
+                message_id = messages[0].get("id")
+            elif response.get("messageId"):
+                message_id = response.get("messageId")
+        create_agent_message(
+            ctx.workspace_id,
+            ctx.conversation_id,
+            text,
+            "texto",
+            message_id,
+        )
+    except Exception as error:
+        release_credits(ctx.workspace_id, 1)
+        _log_tool_call(ctx, "enviar_mensagem", {"texto": text}, f"erro:{error}")
+        return False
+    consume_credits(ctx.workspace_id, ctx.agent_id, ctx.conversation_id, None, 1, reserved=True)
+    ctx.credits_used += 1
+    _mark_sent(ctx)
+    _log_tool_call(ctx, "enviar_mensagem", {"texto": text}, "enviado")
+    return True
+
+
+def _content_text(content) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            part if isinstance(part, str) else str(part.get("text") or "")
+            for part in content
+            if isinstance(part, (str, dict))
+        )
+    return ""
+
+
+class _ParagraphSegmenter:
+    """Cuts streamed text into paragraph-sized messages. Paragraphs shorter
+    than min_chars are held and joined with the next one."""
+
+    def __init__(self, min_chars: int) -> None:
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> list[str]:
+        self.buffer += text
+        segments: list[str] = []
+        search_from = 0
+        while True:
+            cut = self.buffer.find("\n\n", search_from)
+            if cut < 0:
+                return segments
+            segment = self.buffer[:cut].strip()
+            if len(segment) < self.min_chars:
+                search_from = cut + 2
+                continue
+            segments.append(segment)
+            self.buffer = self.buffer[cut + 2 :].lstrip("\n")
+            search_from = 0
+
+    def finish(self) -> str:
+        remainder = self.buffer.strip()
+        self.buffer = ""
+        return remainder
+
+
+def _invoke_streaming(
+    graph,
+    inputs: dict,
+    ctx: AgentContext,
+    attempt: ModelAttempt | None = None,
+    send_segments: bool = True,
+) -> tuple[dict, bool]:
+    """Runs the graph with token streaming, so first tokens reach the hedging
+    decision, and when send_segments is set sends the final answer in
+    paragraphs. Text is only sent once its turn ended without tool calls:
+    until then it may be the preamble to a tool call, not the answer.
+    Returns the final state and whether the answer was sent this way."""
+    final_state: dict = {}
+    config = _run_config(ctx, attempt)
+    for mode, chunk in graph.stream(inputs, config, stream_mode=["messages", "values"]):
+        if attempt is not None:
+            attempt.check_cancelled()
+        if mode == "values":
+            final_state = chunk
+            continue
+        message, metadata = chunk
+        if metadata.get("langgraph_node") != "agent" or not isinstance(message, AIMessageChunk):
+            continue
+        if attempt is not None and (message.content or message.tool_call_chunks):
+            attempt.mark_first_token()
+
+    messages = final_state.get("messages") or []
+    final_message = messages[-1] if messages else None
+    if not send_segments or ctx.sent_by_tool:
+        return final_state, False
+    if not isinstance(final_message, AIMessage) or final_message.tool_calls:
+        return final_state, False
+    segmenter = _ParagraphSegmenter(settings.agent_stream_min_segment_chars)
+    segments = segmenter.feed(_content_text(final_message.content))
+    remainder = segmenter.finish()
+    if remainder:
+        segments.append(remainder)
+    if not segments:
+        return final_state, False
+    if not ctx.claim(attempt):
+        raise AttemptCancelled("superseded")
+    for index, segment in enumerate(segments):
+        if not _send_agent_text(ctx, segment):
+            # What is left goes out as one message, like an unsegmented
+            # answer; the paragraphs already sent are not repeated.
+            _send_agent_text(ctx, "\n\n".join(segments[index:]))
+            break
+        ctx.streamed_segments += 1
+    return final_state, True
+
+
 def _ensure_contact_and_deal(
     agent: dict,
     conversation: dict,
@@ -528,13 +685,25 @@ def _ensure_contact_and_deal(
     return conversation, lead_convertido
 
 
-def _build_system_prompt(
+# Rendered static prompt prefixes keyed by (agent_id, fingerprint). The
+# fingerprint covers every input of the prefix, so editing the agent, its
+# permissions or the workspace lookups yields a new version automatically.
+_STATIC_PROMPT_CACHE_SIZE = 512
+_static_prompts: "OrderedDict[tuple[str, str], str]" = OrderedDict()
+_static_prompts_lock = threading.Lock()
+
+
+def _sorted_lookup(items: list[dict]) -> list[dict]:
+    return sorted(items, key=lambda item: (str(item.get("nome") or ""), str(item.get("id") or "")))
+
+
+def _render_static_prompt(
     agent: dict,
-    knowledge: list[dict],
     workspace_context: dict,
     allowed_actions: set[str] | None,
-    language: str | None,
-    ctx: AgentContext,
+    provider: str,
+    default_pipeline_id: str | None,
+    default_stage_id: str | None,
 ) -> str:
     configuracao = agent.get("configuracao") or {}
     tom = configuracao.get("tom") or "consultivo"
@@ -544,7 +713,6 @@ def _build_system_prompt(
     canais = configuracao.get("canais") or []
     faq = configuracao.get("faq") or ""
     prompt_extra = configuracao.get("prompt") or ""
-    knowledge_text = "\n".join([item.get("content", "") for item in knowledge if item.get("content")])
 
     actions_text = (
         ", ".join(sorted(allowed_actions)) if allowed_actions is not None else "todas"
@@ -581,11 +749,11 @@ def _build_system_prompt(
         )
     )
     if not canais or "whatsapp" in canais:
-        if ctx.provider == "whatsapp_oficial":
+        if provider == "whatsapp_oficial":
             prompt_lines.append(
                 "Regra WhatsApp: se a janela de 24h expirou, use template para responder."
             )
-        elif ctx.provider == "whatsapp_baileys":
+        elif provider == "whatsapp_baileys":
             prompt_lines.append(
                 "Regra WhatsApp Baileys: sem janela de 24h."
             )
@@ -593,16 +761,9 @@ def _build_system_prompt(
             prompt_lines.append("Regra WhatsApp: provider desativado.")
     if "instagram" in canais:
         prompt_lines.append("Regra Instagram: respeite a janela de 24h para respostas.")
-    if ctx.lead_id:
-        prompt_lines.append(f"Lead atual: {ctx.lead_id}")
-    if ctx.contact_id:
-        prompt_lines.append(f"Contato atual: {ctx.contact_id}")
-
-    if ctx.outside_window:
-        prompt_lines.append("ATENCAO: a janela de 24h para respostas expirou nesta conversa.")
-    if ctx.default_pipeline_id:
+    if default_pipeline_id:
         prompt_lines.append(
-            f"Pipeline padrao: {ctx.default_pipeline_id} (etapa inicial {ctx.default_stage_id})"
+            f"Pipeline padrao: {default_pipeline_id} (etapa inicial {default_stage_id})"
         )
     if horario_customizado:
         prompt_lines.append(f"Horario personalizado: {horario_customizado}")
@@ -616,10 +777,8 @@ def _build_system_prompt(
         )
     if faq:
         prompt_lines.append(f"faq:\n{faq}")
-    if knowledge_text:
-        prompt_lines.append(f"conhecimento:\n{knowledge_text}")
 
-    tags = _format_lookup(workspace_context.get("tags") or [])
+    tags = _format_lookup(_sorted_lookup(workspace_context.get("tags") or []))
     if tags:
         prompt_lines.append(f"tags_disponiveis:\n{tags}")
 
@@ -627,17 +786,100 @@ def _build_system_prompt(
     if stages:
         prompt_lines.append(f"etapas_pipeline:\n{stages}")
 
-    lead_fields = _format_lookup(workspace_context.get("lead_fields") or [])
+    lead_fields = _format_lookup(_sorted_lookup(workspace_context.get("lead_fields") or []))
     if lead_fields:
         prompt_lines.append(f"campos_customizados_lead:\n{lead_fields}")
 
-    deal_fields = _format_lookup(workspace_context.get("deal_fields") or [])
+    deal_fields = _format_lookup(_sorted_lookup(workspace_context.get("deal_fields") or []))
     if deal_fields:
         prompt_lines.append(f"campos_customizados_deal:\n{deal_fields}")
 
     return "\n".join(prompt_lines) + "\n"
 
 
+def _static_prompt(
+    agent: dict,
+    workspace_context: dict,
+    allowed_actions: set[str] | None,
+    ctx: AgentContext,
+) -> str:
+    fingerprint_source = json.dumps(
+        {
+            "agent": {key: agent.get(key) for key in sorted(agent) if key != "provider"},
+            "workspace": workspace_context,
+            "actions": sorted(allowed_actions) if allowed_actions is not None else None,
+            "provider": ctx.provider,
+            "pipeline": [ctx.default_pipeline_id, ctx.default_stage_id],
+        },
+        sort_keys=True,
+        default=str,
+    )
+    key = (str(agent.get("id")), hashlib.sha1(fingerprint_source.encode("utf-8")).hexdigest())
+    with _static_prompts_lock:
+        cached = _static_prompts.get(key)
+        if cached is not None:
+            _static_prompts.move_to_end(key)
+            return cached
+    rendered = _render_static_prompt(
+        agent,
+        workspace_context,
+        allowed_actions,
+        ctx.provider,
+        ctx.default_pipeline_id,
+        ctx.default_stage_id,
+    )
+    with _static_prompts_lock:
+        _static_prompts[key] = rendered
+        while len(_static_prompts) > _STATIC_PROMPT_CACHE_SIZE:
+            _static_prompts.popitem(last=False)
+    return rendered
+
+
+def _build_system_prompt(
+    agent: dict,
+    knowledge: list[dict],
+    workspace_context: dict,
+    allowed_actions: set[str] | None,
+    language: str | None,
+    ctx: AgentContext,
+    summary: str | None = None,
+) -> str:
+    # Static prefix first, per-conversation facts last: providers cache the
+    # longest identical prompt prefix, so nothing run-specific may precede it.
+    prompt_lines = [_static_prompt(agent, workspace_context, allowed_actions, ctx).rstrip("\n")]
+    if ctx.lead_id:
+        prompt_lines.append(f"Lead atual: {ctx.lead_id}")
+    if ctx.contact_id:
+        prompt_lines.append(f"Contato atual: {ctx.contact_id}")
+    if ctx.outside_window:
+        prompt_lines.append("ATENCAO: a janela de 24h para respostas expirou nesta conversa.")
+    if summary:
+        prompt_lines.append(f"resumo_conversa_anterior:\n{summary}")
+    knowledge_text = "\n".join([item.get("content", "") for item in knowledge if item.get("content")])
+    if knowledge_text:
+        prompt_lines.append(f"conhecimento:\n{knowledge_text}")
+    return "\n".join(prompt_lines) + "\n"
+
+
+def _usage_totals(messages: list) -> dict:
+    totals = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+    for message in messages:
+        if not isinstance(message, AIMessage):
+            continue
+        usage = getattr(message, "usage_metadata", None) or {}
+        metadata = message.response_metadata or {}
+        totals["input_tokens"] += int(usage.get("input_tokens") or 0)
+        totals["output_tokens"] += int(usage.get("output_tokens") or 0)
+        cached = (usage.get("input_token_details") or {}).get("cache_read")
+        if cached is None:
+            token_usage = metadata.get("token_usage") or {}
+            cached = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached is None:
+            cached = (metadata.get("usage_metadata") or {}).get("cached_content_token_count")
+        totals["cached_tokens"] += int(cached or 0)
+    return totals
+
+
 def _build_messages(messages: list[dict]) -> list:
     output = []
     for msg in messages:
@@ -664,308 +906,506 @@ def _build_sandbox_messages(messages: list[dict]) -> list:
     return output
 
 
-def _build_tools(ctx: AgentContext, allowed_actions: set[str] | None):
-    def is_allowed(action: str) -> bool:
-        return allowed_actions is None or action in allowed_actions
+def _run_context(config: RunnableConfig) -> AgentContext:
+    ctx = config["configurable"]["agent_ctx"]
+    if not ctx.claim(config["configurable"].get("model_attempt")):
+        raise AttemptCancelled("superseded")
+    return ctx
 
-    @tool
-    def enviar_mensagem(texto: str) -> str:
-        """Envia uma mensagem de texto para o contato atual."""
-        if not ctx.phone:
-            result = "Telefone nao encontrado"
-            _log_tool_call(ctx, "enviar_mensagem", {"texto": texto}, result)
-            return result
-        if ctx.outside_window:
-            result = (
-                "Janela de 24h expirada. Use um template."
-                if ctx.canal == "whatsapp"
-                else "Janela de 24h expirada."
-            )
-            _log_tool_call(ctx, "enviar_mensagem", {"texto": texto}, result)
-            return result
-        try:
-            if ctx.canal == "instagram":
-                response = send_instagram_text(ctx.agent_id, ctx.phone, texto)
-                message_id = response.get("message_id") or response.get("id")
-            else:
-                response = send_whatsapp_text(ctx.agent_id, ctx.phone, texto)
-                message_id = None
-                messages = response.get("messages") or []
-                if messages:
-                    message_id = messages[0].get("id")
-            create_agent_message(
-                ctx.workspace_id,
-                ctx.conversation_id,
-                texto,
-                "texto",
-                message_id,
-            )
-            consume_credits(ctx.workspace_id, ctx.agent_id, ctx.conversation_id, None, 1)
-            ctx.credits_used += 1
-            ctx.sent_by_tool = True
-            _log_tool_call(
-                ctx,
-                "enviar_mensagem",
-                {"texto": texto},
-                f"enviado:{response.get('messages', []) or response}",
-            )
-            sent_ref = response.get("messages") or response.get("message_id") or response.get("id") or response
-            return f"Mensagem enviada: {sent_ref}"
-        except Exception as error:
-            result = f"Erro ao enviar mensagem: {error}"
-            _log_tool_call(ctx, "enviar_mensagem", {"texto": texto}, result)
-            return result
-
-    @tool
-    def enviar_template(nome_template: str, idioma: str) -> str:
-        """Envia um template WhatsApp para o contato atual."""
-        if ctx.canal != "whatsapp":
-            result = "Templates sao exclusivos do WhatsApp."
-            _log_tool_call(ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result)
-            return result
-        if not ctx.phone:
-            result = "Telefone nao encontrado"
-            _log_tool_call(ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result)
-            return result
-        try:
-            response = send_whatsapp_template(ctx.agent_id, ctx.phone, nome_template, idioma)
+
+def _run_config(ctx: AgentContext, attempt: ModelAttempt | None = None) -> RunnableConfig:
+    return {"configurable": {"agent_ctx": ctx, "model_attempt": attempt}}
+
+
+# Tool calls the model emits in one step run concurrently, capped per run.
+# Serial tools have effects the contact sees or that close the conversation,
+# so they run one at a time, in the order the model asked for them, once the
+# concurrent calls are done. Results keep the order of the calls.
+SERIAL_TOOLS = frozenset({"enviar_mensagem", "enviar_template", "resolver_conversa", "marcar_spam"})
+
+
+def _tool_message_content(output) -> str:
+    if isinstance(output, str):
+        return output
+    try:
+        return json.dumps(output, ensure_ascii=False, default=str)
+    except Exception:
+        return str(output)
+
+
+def _run_tool_call(tools_by_name: dict, call: dict, config: RunnableConfig) -> ToolMessage:
+    selected = tools_by_name.get(call["name"])
+    if selected is None:
+        content = f"Error: {call['name']} is not a valid tool, try one of [{', '.join(tools_by_name)}]."
+        return ToolMessage(content=content, name=call["name"], tool_call_id=call["id"])
+    try:
+        output = selected.invoke(call["args"], config)
+    except AttemptCancelled:
+        raise
+    except Exception as error:
+        content = f"Error: {error!r}\n Please fix your mistakes."
+        return ToolMessage(content=content, name=call["name"], tool_call_id=call["id"])
+    return ToolMessage(content=_tool_message_content(output), name=call["name"], tool_call_id=call["id"])
+
+
+def _execute_tool_calls(tools_by_name: dict, state: dict, config: RunnableConfig) -> dict:
+    calls = state["messages"][-1].tool_calls
+    results: list[ToolMessage | None] = [None] * len(calls)
+
+    def run(indexes: list[int]) -> None:
+        for index in indexes:
+            results[index] = _run_tool_call(tools_by_name, calls[index], config)
+
+    serial = [index for index, call in enumerate(calls) if call["name"] in SERIAL_TOOLS]
+    parallel = [index for index, call in enumerate(calls) if call["name"] not in SERIAL_TOOLS]
+    if len(parallel) <= 1:
+        run(parallel)
+    else:
+        workers = max(min(settings.agent_tool_concurrency, len(parallel)), 1)
+        # Copies the caller's context into the workers so callbacks and
+        # tracing see the tool runs as children of this step.
+        with get_executor_for_config({**config, "max_concurrency": workers}) as executor:
+            list(executor.map(run, [[index] for index in parallel]))
+    # Serial tools go last: a message or a resolved conversation must not
+    # overlap the lookups and writes the model asked for in the same step.
+    run(serial)
+    return {"messages": results}
+
+
+def _build_agent_graph(llm, tools: list):
+    """ReAct loop equivalent to langgraph's create_react_agent, with the tool
+    node replaced by _execute_tool_calls."""
+    model = llm.bind_tools(tools)
+    tools_by_name = {item.name: item for item in tools}
+
+    def call_model(state: AgentState, config: RunnableConfig) -> dict:
+        response = model.invoke(state["messages"], config)
+        if state["is_last_step"] and getattr(response, "tool_calls", None):
+            return {
+                "messages": [
+                    AIMessage(id=response.id, content="Sorry, need more steps to process this request.")
+                ]
+            }
+        return {"messages": [response]}
+
+    def should_continue(state: AgentState) -> str:
+        last_message = state["messages"][-1]
+        return "tools" if getattr(last_message, "tool_calls", None) else END
+
+    workflow = StateGraph(AgentState)
+    workflow.add_node("agent", call_model)
+    workflow.add_node("tools", partial(_execute_tool_calls, tools_by_name))
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges("agent", should_continue, {"tools": "tools", END: END})
+    workflow.add_edge("tools", "agent")
+    return workflow.compile()
+
+
+# Tools are module-level and read the run's AgentContext from the config, so
+# a compiled graph only depends on the model and the set of tools offered.
+_graphs: dict[tuple, object] = {}
+_graphs_lock = threading.Lock()
+
+
+def _get_agent_graph(llm, tools: list):
+    model_name = getattr(llm, "model_name", None) or getattr(llm, "model", None)
+    key = (type(llm).__name__, model_name, tuple(item.name for item in tools))
+    graph = _graphs.get(key)
+    if graph is None:
+        with _graphs_lock:
+            graph = _graphs.get(key)
+            if graph is None:
+                graph = _build_agent_graph(llm, tools)
+                _graphs[key] = graph
+    return graph
+
+
+@tool
+def enviar_mensagem(texto: str, config: RunnableConfig) -> str:
+    """Envia uma mensagem de texto para o contato atual."""
+    ctx = _run_context(config)
+    if not ctx.phone:
+        result = "Telefone nao encontrado"
+        _log_tool_call(ctx, "enviar_mensagem", {"texto": texto}, result)
+        return result
+    if ctx.outside_window:
+        result = (
+            "Janela de 24h expirada. Use um template."
+            if ctx.canal == "whatsapp"
+            else "Janela de 24h expirada."
+        )
+        _log_tool_call(ctx, "enviar_mensagem", {"texto": texto}, result)
+        return result
+    if not reserve_credits(ctx.workspace_id, 1):
+        result = "Creditos insuficientes"
+        _log_tool_call(ctx, "enviar_mensagem", {"texto": texto}, result)
+        return result
+    try:
+        if ctx.canal == "instagram":
+            response = send_instagram_text(ctx.agent_id, ctx.phone, texto)
+            message_id = response.get("message_id") or response.get("id")
+        else:
+            response = send_whatsapp_text(ctx.agent_id, ctx.phone, texto)
             message_id = None
             messages = response.get("messages") or []
             if messages:
                 message_id = messages[0].get("id")
-            create_agent_message(
-                ctx.workspace_id,
-                ctx.conversation_id,
-                f"Template enviado: {nome_template}",
-                "texto",
-                message_id,
-            )
-            consume_credits(ctx.workspace_id, ctx.agent_id, ctx.conversation_id, None, 1)
-            ctx.credits_used += 1
-            ctx.sent_by_tool = True
-            _log_tool_call(
-                ctx,
-                "enviar_template",
-                {"nome_template": nome_template, "idioma": idioma},
-                f"enviado:{response.get('messages', [])}",
-            )
-            return f"Template enviado: {response.get('messages', [])}"
-        except Exception as error:
-            result = f"Erro ao enviar template: {error}"
-            _log_tool_call(
-                ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result
-            )
-            return result
-
-    @tool
-    def criar_lead(nome: str | None, telefone: str | None, email: str | None) -> str:
-        """Cria um lead no CRM."""
-        lead = create_lead(ctx.workspace_id, nome, telefone, email)
-        _log_tool_call(ctx, "criar_lead", {"nome": nome, "telefone": telefone, "email": email}, lead.get("id"))
-        return f"Lead criado: {lead.get('id')}"
-
-    @tool
-    def editar_lead(lead_id: str, valores: dict) -> str:
-        """Atualiza campos de um lead."""
-        update_lead(lead_id, valores)
-        _log_tool_call(ctx, "editar_lead", {"lead_id": lead_id, "valores": valores}, "ok")
-        return "Lead atualizado"
-
-    @tool
-    def criar_contato(nome: str | None, telefone: str | None, email: str | None) -> str:
-        """Cria um contato no CRM."""
-        contato = create_contact(
+        create_agent_message(
+            ctx.workspace_id,
+            ctx.conversation_id,
+            texto,
+            "texto",
+            message_id,
+        )
+    except Exception as error:
+        release_credits(ctx.workspace_id, 1)
+        result = f"Erro ao enviar mensagem: {error}"
+        _log_tool_call(ctx, "enviar_mensagem", {"texto": texto}, result)
+        return result
+    consume_credits(ctx.workspace_id, ctx.agent_id, ctx.conversation_id, None, 1, reserved=True)
+    ctx.credits_used += 1
+    ctx.sent_by_tool = True
+    _mark_sent(ctx)
+    _log_tool_call(
+        ctx,
+        "enviar_mensagem",
+        {"texto": texto},
+        f"enviado:{response.get('messages', []) or response}",
+    )
+    sent_ref = response.get("messages") or response.get("message_id") or response.get("id") or response
+    return f"Mensagem enviada: {sent_ref}"
+
+
+@tool
+def enviar_template(nome_template: str, idioma: str, config: RunnableConfig) -> str:
+    """Envia um template WhatsApp para o contato atual."""
+    ctx = _run_context(config)
+    if ctx.canal != "whatsapp":
+        result = "Templates sao exclusivos do WhatsApp."
+        _log_tool_call(ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result)
+        return result
+    if not ctx.phone:
+        result = "Telefone nao encontrado"
+        _log_tool_call(ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result)
+        return result
+    template = get_template_catalog(ctx.workspace_id).find(nome_template, idioma)
+    problem = template_problem(template)
+    if problem:
+        result = f"Template indisponivel: {problem}"
+        _log_tool_call(ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result)
+        return result
+    if not reserve_credits(ctx.workspace_id, 1):
+        result = "Creditos insuficientes"
+        _log_tool_call(ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result)
+        return result
+    try:
+        response = send_whatsapp_template(ctx.agent_id, ctx.phone, template["nome"], template["idioma"])
+        message_id = None
+        messages = response.get("messages") or []
+        if messages:
+            message_id = messages[0].get("id")
+        create_agent_message(
             ctx.workspace_id,
-            nome,
-            telefone,
-            email,
-            pipeline_id=ctx.default_pipeline_id,
-            pipeline_stage_id=ctx.default_stage_id,
+            ctx.conversation_id,
+            f"Template enviado: {nome_template}",
+            "texto",
+            message_id,
+        )
+    except Exception as error:
+        release_credits(ctx.workspace_id, 1)
+        result = f"Erro ao enviar template: {error}"
+        _log_tool_call(
+            ctx, "enviar_template", {"nome_template": nome_template, "idioma": idioma}, result
         )
+        return result
+    consume_credits(ctx.workspace_id, ctx.agent_id, ctx.conversation_id, None, 1, reserved=True)
+    ctx.credits_used += 1
+    ctx.sent_by_tool = True
+    _mark_sent(ctx)
+    _log_tool_call(
+        ctx,
+        "enviar_template",
+        {"nome_template": nome_template, "idioma": idioma},
+        f"enviado:{response.get('messages', [])}",
+    )
+    return f"Template enviado: {response.get('messages', [])}"
+
+
+@tool
+def criar_lead(
+    nome: str | None,
+    telefone: str | None,
+    email: str | None,
+    config: RunnableConfig,
+) -> str:
+    """Cria um lead no CRM."""
+    ctx = _run_context(config)
+    lead = create_lead(ctx.workspace_id, nome, telefone, email)
+    _log_tool_call(ctx, "criar_lead", {"nome": nome, "telefone": telefone, "email": email}, lead.get("id"))
+    return f"Lead criado: {lead.get('id')}"
+
+
+@tool
+def editar_lead(lead_id: str, valores: dict, config: RunnableConfig) -> str:
+    """Atualiza campos de um lead."""
+    ctx = _run_context(config)
+    update_lead(lead_id, valores)
+    _log_tool_call(ctx, "editar_lead", {"lead_id": lead_id, "valores": valores}, "ok")
+    return "Lead atualizado"
+
+
+@tool
+def criar_contato(
+    nome: str | None,
+    telefone: str | None,
+    email: str | None,
+    config: RunnableConfig,
+) -> str:
+    """Cria um contato no CRM."""
+    ctx = _run_context(config)
+    contato = create_contact(
+        ctx.workspace_id,
+        nome,
+        telefone,
+        email,
+        pipeline_id=ctx.default_pipeline_id,
+        pipeline_stage_id=ctx.default_stage_id,
+    )
+    _log_tool_call(
+        ctx,
+        "criar_contato",
+        {"nome": nome, "telefone": telefone, "email": email},
+        contato.get("id"),
+    )
+    return f"Contato criado: {contato.get('id')}"
+
+
+@tool
+def editar_contato(contato_id: str, valores: dict, config: RunnableConfig) -> str:
+    """Atualiza campos de um contato."""
+    ctx = _run_context(config)
+    update_contact(contato_id, valores)
+    _log_tool_call(ctx, "editar_contato", {"contato_id": contato_id, "valores": valores}, "ok")
+    return "Contato atualizado"
+
+
+@tool
+def criar_deal(
+    contato_id: str | None,
+    pipeline_id: str | None,
+    stage_id: str | None,
+    config: RunnableConfig,
+) -> str:
+    """Cria um deal na pipeline informada."""
+    ctx = _run_context(config)
+    deal = create_deal(
+        ctx.workspace_id,
+        contato_id,
+        pipeline_id or ctx.default_pipeline_id,
+        stage_id or ctx.default_stage_id,
+    )
+    _log_tool_call(
+        ctx,
+        "criar_deal",
+        {"contato_id": contato_id, "pipeline_id": pipeline_id, "stage_id": stage_id},
+        deal.get("id"),
+    )
+    return f"Deal criado: {deal.get('id')}"
+
+
+@tool
+def editar_deal(deal_id: str, valores: dict, config: RunnableConfig) -> str:
+    """Atualiza campos de um deal."""
+    ctx = _run_context(config)
+    update_deal(deal_id, valores)
+    _log_tool_call(ctx, "editar_deal", {"deal_id": deal_id, "valores": valores}, "ok")
+    return "Deal atualizado"
+
+
+@tool
+def mover_etapa(deal_id: str, stage_id: str, config: RunnableConfig) -> str:
+    """Move um deal para outra etapa."""
+    ctx = _run_context(config)
+    move_deal_stage(deal_id, stage_id)
+    _log_tool_call(ctx, "mover_etapa", {"deal_id": deal_id, "stage_id": stage_id}, "ok")
+    return "Etapa atualizada"
+
+
+@tool
+def aplicar_tag(tipo: str, entidade_id: str, tag_id: str, config: RunnableConfig) -> str:
+    """Aplica uma tag em lead ou contato."""
+    ctx = _run_context(config)
+    apply_tag(tipo, entidade_id, tag_id, ctx.workspace_id)
+    _log_tool_call(
+        ctx, "aplicar_tag", {"tipo": tipo, "entidade_id": entidade_id, "tag_id": tag_id}, "ok"
+    )
+    return "Tag aplicada"
+
+
+@tool
+def atualizar_campo_customizado(
+    tipo: str,
+    entidade_id: str,
+    field_id: str,
+    valor: dict,
+    config: RunnableConfig,
+) -> str:
+    """Atualiza um campo customizado em lead ou deal."""
+    ctx = _run_context(config)
+    if field_id in ctx.blocked_fields:
+        result = "Campo bloqueado nas configuracoes do agente"
         _log_tool_call(
             ctx,
-            "criar_contato",
-            {"nome": nome, "telefone": telefone, "email": email},
-            contato.get("id"),
+            "alterar_campo_customizado",
+            {"tipo": tipo, "entidade_id": entidade_id, "field_id": field_id},
+            result,
         )
-        return f"Contato criado: {contato.get('id')}"
-
-    @tool
-    def editar_contato(contato_id: str, valores: dict) -> str:
-        """Atualiza campos de um contato."""
-        update_contact(contato_id, valores)
-        _log_tool_call(ctx, "editar_contato", {"contato_id": contato_id, "valores": valores}, "ok")
-        return "Contato atualizado"
-
-    @tool
-    def criar_deal(contato_id: str | None, pipeline_id: str | None, stage_id: str | None) -> str:
-        """Cria um deal na pipeline informada."""
-        deal = create_deal(
+        return result
+    set_custom_field_value(tipo, entidade_id, field_id, ctx.workspace_id, valor)
+    _log_tool_call(
+        ctx,
+        "alterar_campo_customizado",
+        {"tipo": tipo, "entidade_id": entidade_id, "field_id": field_id, "valor": valor},
+        "ok",
+    )
+    return "Campo atualizado"
+
+
+@tool
+def resolver_conversa(status: str, config: RunnableConfig) -> str:
+    """Atualiza o status da conversa."""
+    ctx = _run_context(config)
+    update_conversation_status(ctx.conversation_id, status)
+    _log_tool_call(ctx, "resolver_conversa", {"status": status}, "ok")
+    if status == "resolvida":
+        increment_agent_metrics(
+            ctx.agent_id,
             ctx.workspace_id,
-            contato_id,
-            pipeline_id or ctx.default_pipeline_id,
-            stage_id or ctx.default_stage_id,
+            {"conversas_resolvidas": 1},
         )
-        _log_tool_call(
-            ctx,
-            "criar_deal",
-            {"contato_id": contato_id, "pipeline_id": pipeline_id, "stage_id": stage_id},
-            deal.get("id"),
+    return "Status atualizado"
+
+
+@tool
+def marcar_spam(config: RunnableConfig) -> str:
+    """Marca a conversa atual como spam."""
+    ctx = _run_context(config)
+    update_conversation_status(ctx.conversation_id, "spam")
+    _log_tool_call(ctx, "marcar_spam", {}, "ok")
+    return "Conversa marcada como spam"
+
+
+@tool
+def criar_evento_calendar(payload: dict, config: RunnableConfig) -> str:
+    """Cria um evento no Google Calendar."""
+    ctx = _run_context(config)
+    try:
+        evento = create_calendar_event(ctx.agent_id, payload)
+        _log_tool_call(ctx, "calendar_criar", {"payload": payload}, evento.get("id"))
+        return f"Evento criado: {evento.get('id')}"
+    except Exception as error:
+        result = f"Erro ao criar evento: {error}"
+        _log_tool_call(ctx, "calendar_criar", {"payload": payload}, result)
+        return result
+
+
+@tool
+def editar_evento_calendar(event_id: str, payload: dict, config: RunnableConfig) -> str:
+    """Edita um evento no Google Calendar."""
+    ctx = _run_context(config)
+    try:
+        evento = update_calendar_event(ctx.agent_id, event_id, payload)
+        _log_tool_call(ctx, "calendar_editar", {"event_id": event_id, "payload": payload}, "ok")
+        return f"Evento atualizado: {evento.get('id')}"
+    except Exception as error:
+        result = f"Erro ao editar evento: {error}"
+        _log_tool_call(ctx, "calendar_editar", {"event_id": event_id, "payload": payload}, result)
+        return result
+
+
+@tool
+def cancelar_evento_calendar(event_id: str, config: RunnableConfig) -> str:
+    """Cancela um evento no Google Calendar."""
+    ctx = _run_context(config)
+    try:
+        delete_calendar_event(ctx.agent_id, event_id)
+        _log_tool_call(ctx, "calendar_cancelar", {"event_id": event_id}, "ok")
+        return "Evento cancelado"
+    except Exception as error:
+        result = f"Erro ao cancelar evento: {error}"
+        _log_tool_call(ctx, "calendar_cancelar", {"event_id": event_id}, result)
+        return result
+
+
+@tool
+def consultar_evento_calendar(event_id: str, config: RunnableConfig) -> str:
+    """Consulta detalhes de um evento no Google Calendar."""
+    ctx = _run_context(config)
+    try:
+        evento = get_calendar_event(ctx.agent_id, event_id)
+        _log_tool_call(ctx, "calendar_consultar", {"event_id": event_id}, "ok")
+        return f"Evento: {evento.get('summary') or evento.get('id')}"
+    except Exception as error:
+        result = f"Erro ao consultar evento: {error}"
+        _log_tool_call(ctx, "calendar_consultar", {"event_id": event_id}, result)
+        return result
+
+
+@tool
+def consultar_disponibilidade_calendar(
+    inicio: str,
+    fim: str,
+    duracao_minutos: int | None = None,
+    calendar_ids: list[str] | None = None,
+    timezone: str | None = None,
+    qualquer_calendario: bool = False,
+    config: RunnableConfig = None,
+) -> str:
+    """Consulta disponibilidade em uma janela de tempo no Google Calendar.
+    Com qualquer_calendario, basta um calendario livre e cada sugestao indica
+    o calendar_id a usar ao criar o evento (rodizio entre a equipe)."""
+    ctx = _run_context(config)
+    try:
+        response = get_calendar_availability(
+            ctx.agent_id,
+            inicio,
+            fim,
+            calendar_ids=calendar_ids,
+            time_zone=timezone or ctx.timezone,
+            duration_minutes=duracao_minutos,
+            working_hours=working_hours_for(ctx.horario),
+            buffer_minutes=ctx.calendar_buffer_minutes,
+            minimum_notice_minutes=ctx.calendar_notice_minutes,
+            any_calendar=qualquer_calendario,
         )
-        return f"Deal criado: {deal.get('id')}"
-
-    @tool
-    def editar_deal(deal_id: str, valores: dict) -> str:
-        """Atualiza campos de um deal."""
-        update_deal(deal_id, valores)
-        _log_tool_call(ctx, "editar_deal", {"deal_id": deal_id, "valores": valores}, "ok")
-        return "Deal atualizado"
-
-    @tool
-    def mover_etapa(deal_id: str, stage_id: str) -> str:
-        """Move um deal para outra etapa."""
-        move_deal_stage(deal_id, stage_id)
-        _log_tool_call(ctx, "mover_etapa", {"deal_id": deal_id, "stage_id": stage_id}, "ok")
-        return "Etapa atualizada"
-
-    @tool
-    def aplicar_tag(tipo: str, entidade_id: str, tag_id: str) -> str:
-        """Aplica uma tag em lead ou contato."""
-        apply_tag(tipo, entidade_id, tag_id, ctx.workspace_id)
         _log_tool_call(
-            ctx, "aplicar_tag", {"tipo": tipo, "entidade_id": entidade_id, "tag_id": tag_id}, "ok"
+            ctx,
+            "calendar_disponibilidade",
+            {
+                "inicio": inicio,
+                "fim": fim,
+                "duracao_minutos": duracao_minutos,
+                "calendar_ids": calendar_ids,
+                "timezone": timezone,
+                "qualquer_calendario": qualquer_calendario,
+            },
+            "ok",
         )
-        return "Tag aplicada"
-
-    @tool
-    def atualizar_campo_customizado(tipo: str, entidade_id: str, field_id: str, valor: dict) -> str:
-        """Atualiza um campo customizado em lead ou deal."""
-        if field_id in ctx.blocked_fields:
-            result = "Campo bloqueado nas configuracoes do agente"
-            _log_tool_call(
-                ctx,
-                "alterar_campo_customizado",
-                {"tipo": tipo, "entidade_id": entidade_id, "field_id": field_id},
-                result,
-            )
-            return result
-        set_custom_field_value(tipo, entidade_id, field_id, ctx.workspace_id, valor)
+        return json.dumps(response, ensure_ascii=False)
+    except Exception as error:
+        result = f"Erro ao consultar disponibilidade: {error}"
         _log_tool_call(
             ctx,
-            "alterar_campo_customizado",
-            {"tipo": tipo, "entidade_id": entidade_id, "field_id": field_id, "valor": valor},
-            "ok",
+            "calendar_disponibilidade",
+            {"inicio": inicio, "fim": fim, "duracao_minutos": duracao_minutos},
+            result,
         )
-        return "Campo atualizado"
-
-    @tool
-    def resolver_conversa(status: str) -> str:
-        """Atualiza o status da conversa."""
-        update_conversation_status(ctx.conversation_id, status)
-        _log_tool_call(ctx, "resolver_conversa", {"status": status}, "ok")
-        if status == "resolvida":
-            increment_agent_metrics(
-                ctx.agent_id,
-                ctx.workspace_id,
-                {"conversas_resolvidas": 1},
-            )
-        return "Status atualizado"
-
-    @tool
-    def marcar_spam() -> str:
-        """Marca a conversa atual como spam."""
-        update_conversation_status(ctx.conversation_id, "spam")
-        _log_tool_call(ctx, "marcar_spam", {}, "ok")
-        return "Conversa marcada como spam"
-
-    @tool
-    def criar_evento_calendar(payload: dict) -> str:
-        """Cria um evento no Google Calendar."""
-        try:
-            evento = create_calendar_event(ctx.agent_id, payload)
-            _log_tool_call(ctx, "calendar_criar", {"payload": payload}, evento.get("id"))
-            return f"Evento criado: {evento.get('id')}"
-        except Exception as error:
-            result = f"Erro ao criar evento: {error}"
-            _log_tool_call(ctx, "calendar_criar", {"payload": payload}, result)
-            return result
-
-    @tool
-    def editar_evento_calendar(event_id: str, payload: dict) -> str:
-        """Edita um evento no Google Calendar."""
-        try:
-            evento = update_calendar_event(ctx.agent_id, event_id, payload)
-            _log_tool_call(ctx, "calendar_editar", {"event_id": event_id, "payload": payload}, "ok")
-            return f"Evento atualizado: {evento.get('id')}"
-        except Exception as error:
-            result = f"Erro ao editar evento: {error}"
-            _log_tool_call(ctx, "calendar_editar", {"event_id": event_id, "payload": payload}, result)
-            return result
-
-    @tool
-    def cancelar_evento_calendar(event_id: str) -> str:
-        """Cancela um evento no Google Calendar."""
-        try:
-            delete_calendar_event(ctx.agent_id, event_id)
-            _log_tool_call(ctx, "calendar_cancelar", {"event_id": event_id}, "ok")
-            return "Evento cancelado"
-        except Exception as error:
-            result = f"Erro ao cancelar evento: {error}"
-            _log_tool_call(ctx, "calendar_cancelar", {"event_id": event_id}, result)
-            return result
-
-    @tool
-    def consultar_evento_calendar(event_id: str) -> str:
-        """Consulta detalhes de um evento no Google Calendar."""
-        try:
-            evento = get_calendar_event(ctx.agent_id, event_id)
-            _log_tool_call(ctx, "calendar_consultar", {"event_id": event_id}, "ok")
-            return f"Evento: {evento.get('summary') or evento.get('id')}"
-        except Exception as error:
-            result = f"Erro ao consultar evento: {error}"
-            _log_tool_call(ctx, "calendar_consultar", {"event_id": event_id}, result)
-            return result
-
-    @tool
-    def consultar_disponibilidade_calendar(
-        inicio: str,
-        fim: str,
-        duracao_minutos: int | None = None,
-        calendar_ids: list[str] | None = None,
-        timezone: str | None = None,
-    ) -> str:
-        """Consulta disponibilidade em uma janela de tempo no Google Calendar."""
-        try:
-            response = get_calendar_availability(
-                ctx.agent_id,
-                inicio,
-                fim,
-                calendar_ids=calendar_ids,
-                time_zone=timezone or ctx.timezone,
-                duration_minutes=duracao_minutos,
-            )
-            _log_tool_call(
-                ctx,
-                "calendar_disponibilidade",
-                {
-                    "inicio": inicio,
-                    "fim": fim,
-                    "duracao_minutos": duracao_minutos,
-                    "calendar_ids": calendar_ids,
-                    "timezone": timezone,
-                },
-                "ok",
-            )
-            return json.dumps(response, ensure_ascii=False)
-        except Exception as error:
-            result = f"Erro ao consultar disponibilidade: {error}"
-            _log_tool_call(
-                ctx,
-                "calendar_disponibilidade",
-                {"inicio": inicio, "fim": fim, "duracao_minutos": duracao_minutos},
-                result,
-            )
-            return result
+        return result
+
+
+def _build_tools(ctx: AgentContext, allowed_actions: set[str] | None):
+    def is_allowed(action: str) -> bool:
+        return allowed_actions is None or action in allowed_actions
 
     tools = []
     if is_allowed("enviar_mensagem"):
@@ -1050,7 +1490,8 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
         )
         return {"status": "paused", "reason": "channel_not_supported"}
 
-    messages = get_messages(conversation_id)
+    # Older history reaches the model through the rolling summary.
+    messages = get_messages(conversation_id, settings.agent_history_window_messages)
     logger.info(
         "agent_run_start agent_id=%s conversation_id=%s provider=%s messages=%s has_input=%s",
         agent_id,
@@ -1071,9 +1512,11 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
             {"leads_convertidos": 1},
         )
 
-    paused, reason = should_pause(agent, conversation, messages)
+    paused, reason = should_pause(agent, conversation, messages[-1].get("autor") if messages else None)
     language = agent.get("idioma_padrao")
     last_contact_message = _get_last_contact_message(messages)
+    if last_contact_message is None and len(messages) >= settings.agent_history_window_messages:
+        last_contact_message = get_last_message(conversation_id, "contato")
     if agent.get("detectar_idioma"):
         texto_base = last_contact_message.get("conteudo") if last_contact_message else input_text
         if texto_base:
@@ -1183,17 +1626,58 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
         canal=conversation.get("canal") or "whatsapp",
         provider=provider,
         timezone=agent.get("timezone"),
+        horario=(agent.get("configuracao") or {}).get("horario"),
+        calendar_buffer_minutes=_config_minutes(agent, "agenda_intervalo_minutos"),
+        calendar_notice_minutes=_config_minutes(agent, "agenda_antecedencia_minutos"),
         outside_window=outside_window,
         default_pipeline_id=default_pipeline_id,
         default_stage_id=default_stage_id,
         blocked_fields=set(agent.get("campos_bloqueados") or []),
     )
 
-    system_prompt = _build_system_prompt(agent, knowledge, workspace_context, allowed_actions, language, ctx)
     if not input_text and media_text:
         input_text = last_user_message
 
-    message_state = [SystemMessage(content=system_prompt), *_build_messages(messages)]
+    budget = context_budget(agent)
+    workspace_context, lookup_tokens = trim_lookups(
+        agent, workspace_context, int(budget * settings.agent_context_lookup_share)
+    )
+    knowledge, knowledge_tokens = trim_knowledge(
+        knowledge, int(budget * settings.agent_context_knowledge_share)
+    )
+    summary = get_conversation_summary(agent_id, conversation_id)
+    system_prompt = _build_system_prompt(
+        agent, knowledge, workspace_context, allowed_actions, language, ctx, summary["resumo"]
+    )
+    recent_messages, older_messages = split_history(
+        messages,
+        budget - count_tokens(system_prompt) - count_tokens(input_text or ""),
+        settings.agent_context_min_recent_messages,
+    )
+    # Messages the budget left out are handed to the background summarizer
+    # (up to the newest of them) unless the summary already covers them.
+    summarize_until = None
+    if older_messages:
+        newest_older = older_messages[-1].get("created_at")
+        if newest_older and (not summary["ate"] or newest_older > summary["ate"]):
+            summarize_until = newest_older
+    context_tokens = {
+        "orcamento": budget,
+        "sistema": count_tokens(system_prompt),
+        "historico": sum(message_tokens(message) for message in recent_messages),
+        "resumo": count_tokens(summary["resumo"]),
+        "conhecimento": knowledge_tokens,
+        "listas": lookup_tokens,
+        "mensagens_para_resumo": len(older_messages),
+    }
+    logger.info(
+        "agent_context_tokens agent_id=%s conversation_id=%s %s",
+        agent_id,
+        conversation_id,
+        " ".join(f"{key}={value}" for key, value in context_tokens.items()),
+    )
+
+    message_state = [SystemMessage(content=system_prompt), *_build_messages(recent_messages)]
     if input_text:
         message_state.append(HumanMessage(content=input_text))
 
@@ -1224,12 +1708,47 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
         model_sequence.append(("secondary", secondary_llm))
     model_sequence.append(("fallback", get_last_fallback_llm()))
 
-    for label, llm in model_sequence:
+    stream_answer = (
+        settings.agent_streaming_enabled
+        and bool(ctx.phone)
+        and can_send_message
+        and not ctx.outside_window
+    )
+
+    def run_attempt(attempt: ModelAttempt):
+        graph = _get_agent_graph(attempt.llm, tools)
+        return _invoke_streaming(
+            graph,
+            {"messages": message_state},
+            ctx,
+            attempt,
+            send_segments=stream_answer,
+        )
+
+    winner, outcome, attempts = run_with_fallback(
+        model_sequence,
+        run_attempt,
+        is_committed=lambda attempt: ctx.attempt_owner == attempt.id,
+        claim=ctx.claim,
+    )
+    attempt_records = [attempt.to_record() for attempt in attempts]
+    if winner is not None and not ctx.claim(winner):
+        # Another attempt owns the run's side effects; replying for this one
+        # would send the contact a second answer.
+        logger.warning(
+            "agent_run_winner_superseded agent_id=%s conversation_id=%s run_id=%s attempt=%s",
+            agent_id,
+            conversation_id,
+            run_id,
+            winner.label,
+        )
+        winner = None
+    if winner is not None:
         try:
-            graph = create_react_agent(llm, tools=tools)
-            result = graph.invoke({"messages": message_state})
+            label, llm = winner.label, winner.llm
+            result, streamed = outcome
             final_message = result["messages"][-1]
-            if isinstance(final_message, AIMessage) and final_message.content:
+            if isinstance(final_message, AIMessage) and final_message.content and not streamed:
                 if ctx.phone and not ctx.sent_by_tool:
                     if not can_send_message:
                         _log_tool_call(
@@ -1240,8 +1759,15 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
                         )
                     elif ctx.outside_window:
                         if ctx.provider == "whatsapp_oficial":
-                            template = _get_default_template(ctx.workspace_id)
-                            if template:
+                            template = get_template_catalog(ctx.workspace_id).default
+                            if template and not reserve_credits(ctx.workspace_id, 1):
+                                _log_tool_call(
+                                    ctx,
+                                    "enviar_template",
+                                    {"template": template["nome"], "idioma": template["idioma"]},
+                                    "sem_creditos",
+                                )
+                            elif template:
                                 try:
                                     response = send_whatsapp_template(
                                         agent_id,
@@ -1261,9 +1787,15 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
                                         message_id,
                                     )
                                     consume_credits(
-                                        ctx.workspace_id, ctx.agent_id, ctx.conversation_id, None, 1
+                                        ctx.workspace_id,
+                                        ctx.agent_id,
+                                        ctx.conversation_id,
+                                        None,
+                                        1,
+                                        reserved=True,
                                     )
                                     ctx.credits_used += 1
+                                    _mark_sent(ctx)
                                     _log_tool_call(
                                         ctx,
                                         "enviar_template",
@@ -1271,6 +1803,7 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
                                         "enviado",
                                     )
                                 except Exception as error:
+                                    release_credits(ctx.workspace_id, 1)
                                     _log_tool_call(
                                         ctx,
                                         "enviar_template",
@@ -1292,79 +1825,82 @@ def run_agent(agent_id: str, conversation_id: str, input_text: str | None = None
                                 "bloqueado_janela_24h",
                             )
                     else:
-                        try:
-                            if ctx.canal == "instagram":
-                                response = send_instagram_text(agent_id, ctx.phone, final_message.content)
-                                message_id = response.get("message_id") or response.get("id")
-                            else:
-                                response = send_whatsapp_text(agent_id, ctx.phone, final_message.content)
-                                message_id = None
-                                messages = response.get("messages") or []
-                                if messages:
-                                    message_id = messages[0].get("id")
-                                elif response.get("messageId"):
-                                    message_id = response.get("messageId")
-                            create_agent_message(
-                                ctx.workspace_id,
-                                ctx.conversation_id,
-                                final_message.content,
-                                "texto",
-                                message_id,
-                            )
-                            consume_credits(ctx.workspace_id, ctx.agent_id, ctx.conversation_id, None, 1)
-                            ctx.credits_used += 1
-                            _log_tool_call(
-                                ctx,
-                                "enviar_mensagem",
-                                {"texto": final_message.content},
-                                "enviado",
-                            )
-                        except Exception as error:
-                            _log_tool_call(
-                                ctx,
-                                "enviar_mensagem",
-                                {"texto": final_message.content},
-                                f"erro:{error}",
-                            )
-            model_name = getattr(llm, "model_name", None) or getattr(llm, "model", None) or label
-            duration_ms = int((datetime.now(timezone.utc) - start_time).total_seconds() * 1000)
-            update_payload = {
-                "status": "concluido",
-                "modelo": model_name,
-                "credits_usados": ctx.credits_used,
-                "resumo": final_message.content if isinstance(final_message, AIMessage) else "ok",
-                "latencia_ms": duration_ms,
-                "concluido_em": datetime.now(timezone.utc).isoformat(),
-            }
-            if label != "primary":
-                update_payload["fallback_modelo"] = model_name
-            supabase.table("agent_runs").update(update_payload).eq("id", run_id).execute()
-            supabase.table("agent_logs").insert(
-                {
-                    "agent_id": agent_id,
-                    "workspace_id": conversation["workspace_id"],
-                    "conversation_id": conversation_id,
+                        _send_agent_text(ctx, final_message.content)
+        except Exception:
+            logger.exception(
+                "agent_run_reply_failed agent_id=%s conversation_id=%s run_id=%s",
+                agent_id,
+                conversation_id,
+                run_id,
+            )
+        else:
+            # The reply is out: a failure to record the run is only logged, it
+            # must neither mark the run as failed nor lead to another send.
+            try:
+                model_name = getattr(llm, "model_name", None) or getattr(llm, "model", None) or label
+                duration_ms = int((datetime.now(timezone.utc) - start_time).total_seconds() * 1000)
+                update_payload = {
+                    "status": "concluido",
+                    "modelo": model_name,
+                    "credits_usados": ctx.credits_used,
                     "resumo": final_message.content if isinstance(final_message, AIMessage) else "ok",
-                    "tool_calls": ctx.tool_calls,
-                    "metrics": {
-                        "modelo": model_name,
-                        "idioma": language,
-                        "outside_window": ctx.outside_window,
-                        "credits_usados": ctx.credits_used,
-                    },
+                    "latencia_ms": duration_ms,
+                    "concluido_em": datetime.now(timezone.utc).isoformat(),
                 }
-            ).execute()
-            return {"status": "ok", "run_id": run_id}
-        except Exception:
-            continue
+                if label != "primary":
+                    update_payload["fallback_modelo"] = model_name
+                first_send_ms = None
+                if ctx.first_send_at:
+                    first_send_ms = int((ctx.first_send_at - start_time).total_seconds() * 1000)
+                usage = _usage_totals(result["messages"][len(message_state):])
+                logger.info(
+                    "agent_run_tokens run_id=%s model=%s input=%s cached=%s output=%s",
+                    run_id,
+                    model_name,
+                    usage["input_tokens"],
+                    usage["cached_tokens"],
+                    usage["output_tokens"],
+                )
+                supabase.table("agent_runs").update(update_payload).eq("id", run_id).execute()
+                supabase.table("agent_logs").insert(
+                    {
+                        "agent_id": agent_id,
+                        "workspace_id": conversation["workspace_id"],
+                        "conversation_id": conversation_id,
+                        "resumo": final_message.content if isinstance(final_message, AIMessage) else "ok",
+                        "tool_calls": ctx.tool_calls,
+                        "metrics": {
+                            "modelo": model_name,
+                            "idioma": language,
+                            "outside_window": ctx.outside_window,
+                            "credits_usados": ctx.credits_used,
+                            "primeiro_envio_ms": first_send_ms,
+                            "segmentos_enviados": ctx.streamed_segments,
+                            "tokens_entrada": usage["input_tokens"],
+                            "tokens_cache": usage["cached_tokens"],
+                            "tokens_saida": usage["output_tokens"],
+                            "tokens_contexto": context_tokens,
+                            "tentativas": attempt_records,
+                        },
+                    }
+                ).execute()
+            except Exception:
+                logger.exception(
+                    "agent_run_finalize_failed agent_id=%s conversation_id=%s run_id=%s",
+                    agent_id,
+                    conversation_id,
+                    run_id,
+                )
+            return {"status": "ok", "run_id": run_id, "summarize_until": summarize_until}
 
     duration_ms = int((datetime.now(timezone.utc) - start_time).total_seconds() * 1000)
     logger.info(
-        "agent_run_failed agent_id=%s conversation_id=%s run_id=%s duration_ms=%s",
+        "agent_run_failed agent_id=%s conversation_id=%s run_id=%s duration_ms=%s attempts=%s",
         agent_id,
         conversation_id,
         run_id,
         duration_ms,
+        json.dumps(attempt_records, ensure_ascii=False),
     )
     supabase.table("agent_runs").update(
         {
@@ -1407,6 +1943,9 @@ def run_agent_sandbox(agent_id: str, messages: list[dict]) -> dict:
         canal="whatsapp",
         provider=provider,
         timezone=agent.get("timezone"),
+        horario=(agent.get("configuracao") or {}).get("horario"),
+        calendar_buffer_minutes=_config_minutes(agent, "agenda_intervalo_minutos"),
+        calendar_notice_minutes=_config_minutes(agent, "agenda_antecedencia_minutos"),
         outside_window=False,
         default_pipeline_id=default_pipeline_id,
         default_stage_id=default_stage_id,
@@ -1414,6 +1953,11 @@ def run_agent_sandbox(agent_id: str, messages: list[dict]) -> dict:
     )
 
     allowed_actions = _load_permissions(agent_id)
+    budget = context_budget(agent)
+    workspace_context, _ = trim_lookups(
+        agent, workspace_context, int(budget * settings.agent_context_lookup_share)
+    )
+    knowledge, _ = trim_knowledge(knowledge, int(budget * settings.agent_context_knowledge_share))
     system_prompt = _build_system_prompt(agent, knowledge, workspace_context, allowed_actions, language, ctx)
     message_state = [SystemMessage(content=system_prompt), *_build_sandbox_messages(messages)]
 
@@ -1423,23 +1967,30 @@ def run_agent_sandbox(agent_id: str, messages: list[dict]) -> dict:
         model_sequence.append(("secondary", secondary_llm))
     model_sequence.append(("fallback", get_last_fallback_llm()))
 
-    for label, llm in model_sequence:
-        try:
-            response = llm.invoke(message_state)
-            content = response.content if hasattr(response, "content") else str(response)
-            model_name = getattr(llm, "model_name", None) or getattr(llm, "model", None) or label
-            supabase = get_supabase_client()
-            supabase.table("agent_logs").insert(
-                {
-                    "agent_id": agent_id,
-                    "workspace_id": agent["workspace_id"],
-                    "resumo": content or "ok",
-                    "tool_calls": [],
-                    "metrics": {"modelo": model_name, "sandbox": True},
-                }
-            ).execute()
-            return {"status": "ok", "output": content, "model": model_name}
-        except Exception:
-            continue
-
-    return {"status": "failed"}
+    winner, response, attempts = run_with_fallback(
+        model_sequence,
+        lambda attempt: attempt.llm.invoke(message_state),
+    )
+    if winner is None:
+        return {"status": "failed"}
+    content = response.content if hasattr(response, "content") else str(response)
+    model_name = winner.model
+    usage = _usage_totals([response])
+    supabase = get_supabase_client()
+    supabase.table("agent_logs").insert(
+        {
+            "agent_id": agent_id,
+            "workspace_id": agent["workspace_id"],
+            "resumo": content or "ok",
+            "tool_calls": [],
+            "metrics": {
+                "modelo": model_name,
+                "sandbox": True,
+                "tentativas": [attempt.to_record() for attempt in attempts],
+                "tokens_entrada": usage["input_tokens"],
+                "tokens_cache": usage["cached_tokens"],
+                "tokens_saida": usage["output_tokens"],
+            },
+        }
+    ).execute()
+    return {"status": "ok", "output": content, "model": model_name}
@@ -0,0 +1,183 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import math
+
+import numpy as np
+
+# Free-slot search over sorted interval arrays: busy intervals of N
+# calendars are flattened into one array of epoch minutes ordered by
+# (calendar, start), and every candidate start of every calendar is checked
+# with a single searchsorted call, so the cost grows with the number of
+# events and candidates rather than with Python loops over days.
+MINUTES_PER_DAY = 24 * 60
+
+
+@dataclass(frozen=True)
+class SlotOptions:
+    duration_minutes: int
+    step_minutes: int | None = None
+    buffer_before_minutes: int = 0
+    buffer_after_minutes: int = 0
+    minimum_notice_minutes: int = 0
+    # "all": every calendar must be free (meeting with everyone).
+    # "any": one free calendar is enough (team scheduling).
+    mode: str = "all"
+    round_robin: bool = False
+    rotation: int = 0
+    limit: int = 5
+
+
+@dataclass(frozen=True)
+class Slot:
+    start: datetime
+    end: datetime
+    calendar_ids: tuple[str, ...]
+    assigned_calendar_id: str | None = None
+
+
+def working_windows(
+    window_start: datetime,
+    window_end: datetime,
+    working_hours: dict[int, list[tuple[int, int]]] | None,
+    zone,
+) -> list[tuple[datetime, datetime]]:
+    """Working periods inside the window, in UTC. working_hours maps a
+    weekday (0 = Monday) to (start, end) minutes since local midnight."""
+    if not working_hours:
+        return [(window_start, window_end)]
+    windows: list[tuple[datetime, datetime]] = []
+    day = window_start.astimezone(zone).date()
+    last_day = window_end.astimezone(zone).date()
+    while day <= last_day:
+        midnight = datetime.combine(day, datetime.min.time(), tzinfo=zone)
+        for start_minute, end_minute in working_hours.get(day.weekday(), []):
+            start = max((midnight + timedelta(minutes=start_minute)).astimezone(timezone.utc), window_start)
+            end = min((midnight + timedelta(minutes=end_minute)).astimezone(timezone.utc), window_end)
+            if start < end:
+                windows.append((start, end))
+        day += timedelta(days=1)
+    return windows
+
+
+def _epoch_minutes(values: list[datetime], ceil: bool = False) -> np.ndarray:
+    seconds = np.array([value.timestamp() for value in values], dtype=np.float64)
+    return (np.ceil(seconds / 60) if ceil else np.floor(seconds / 60)).astype(np.int64)
+
+
+def _offset_change(start: datetime, end: datetime, zone) -> datetime:
+    """First UTC hour in (start, end) where the zone's offset changes, or end."""
+    offset = start.astimezone(zone).utcoffset()
+    if (end - timedelta(microseconds=1)).astimezone(zone).utcoffset() == offset:
+        return end
+    tick = start.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    while tick < end and tick.astimezone(zone).utcoffset() == offset:
+        tick += timedelta(hours=1)
+    return min(tick, end)
+
+
+def _candidate_starts(
+    windows: list[tuple[datetime, datetime]],
+    duration: int,
+    step: int,
+    zone,
+) -> np.ndarray:
+    """Slot starts inside the windows on a step grid anchored at each local
+    midnight, as epoch minutes. Windows are cut at local midnights and
+    offset changes so the grid stays on wall-clock time across DST."""
+    pieces = []
+    for window_start, window_end in windows:
+        last_start = math.floor(window_end.timestamp() / 60) - duration
+        cursor = window_start
+        while cursor < window_end:
+            local = cursor.astimezone(zone)
+            next_midnight = datetime.combine(local.date() + timedelta(days=1), datetime.min.time(), tzinfo=zone)
+            piece_end = _offset_change(cursor, min(window_end, next_midnight.astimezone(timezone.utc)), zone)
+            first = math.ceil(cursor.timestamp() / 60)
+            local_minute = (first + int(local.utcoffset().total_seconds() // 60)) % MINUTES_PER_DAY
+            first += -local_minute % step
+            stop = min(math.ceil(piece_end.timestamp() / 60) - 1, last_start)
+            if first <= stop:
+                pieces.append(np.arange(first, stop + 1, step, dtype=np.int64))
+            cursor = piece_end
+    if not pieces:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(pieces))
+
+
+def find_free_slots(
+    busy_by_calendar: dict[str, list[tuple[datetime, datetime]]],
+    windows: list[tuple[datetime, datetime]],
+    zone,
+    options: SlotOptions,
+    now: datetime | None = None,
+) -> list[Slot]:
+    """Slots of options.duration_minutes inside the working windows, starting
+    on the local step grid, with the buffers free around them and not before
+    the minimum notice. With round_robin, consecutive slots are assigned to
+    the free calendars in turn, starting at options.rotation."""
+    duration = int(options.duration_minutes)
+    if duration <= 0:
+        return []
+    step = int(options.step_minutes or min(duration, 30))
+    starts = _candidate_starts(windows, duration, step, zone)
+    earliest = (now or datetime.now(timezone.utc)) + timedelta(minutes=int(options.minimum_notice_minutes))
+    starts = starts[starts >= math.ceil(earliest.timestamp() / 60)]
+    if not starts.size:
+        return []
+
+    calendar_ids = list(busy_by_calendar)
+    rows_count = max(len(calendar_ids), 1)
+    rows = np.array(
+        [row for row, calendar_id in enumerate(calendar_ids) for _ in busy_by_calendar[calendar_id]],
+        dtype=np.int64,
+    )
+    intervals = [interval for calendar_id in calendar_ids for interval in busy_by_calendar[calendar_id]]
+    # A slot needs buffer_before free minutes before it and buffer_after
+    # after it, which is the same as widening every busy interval.
+    busy_starts = _epoch_minutes([start for start, _ in intervals]) - int(options.buffer_after_minutes)
+    busy_ends = _epoch_minutes([end for _, end in intervals], ceil=True) + int(options.buffer_before_minutes)
+    order = np.lexsort((busy_starts, rows))
+    rows, busy_starts, busy_ends = rows[order], busy_starts[order], busy_ends[order]
+
+    free = np.ones((rows_count, starts.size), dtype=bool)
+    if rows.size:
+        # Rows are laid end to end on one axis, `span` minutes apart, so one
+        # sorted array and one running maximum serve every calendar.
+        base = min(int(busy_starts.min()), int(starts[0]))
+        span = max(int(busy_ends.max()), int(starts[-1]) + duration) - base + 1
+        keyed_starts = rows * span + (busy_starts - base)
+        reach = np.maximum.accumulate(rows * span + (busy_ends - base))
+        row_offsets = np.arange(rows_count, dtype=np.int64)[:, None] * span
+        # Last interval of the row starting before the slot ends; the slot
+        # is busy if any interval up to it reaches past the slot start.
+        last = np.searchsorted(keyed_starts, row_offsets + (starts + duration - base)[None, :], side="left") - 1
+        first_of_row = np.searchsorted(rows, np.arange(rows_count), side="left")[:, None]
+        free = ~((last >= first_of_row) & (reach[np.maximum(last, 0)] > row_offsets + (starts - base)[None, :]))
+
+    candidates = free.any(axis=0) if options.mode == "any" else free.all(axis=0)
+    indexes = np.flatnonzero(candidates)[: max(int(options.limit), 0)]
+    if not indexes.size:
+        return []
+
+    free_at = free[:, indexes]
+    assigned = None
+    if options.round_robin and calendar_ids:
+        turn = (options.rotation + np.arange(indexes.size)) % rows_count
+        order = (np.arange(rows_count)[:, None] - turn[None, :]) % rows_count
+        assigned = np.where(free_at, order, rows_count).argmin(axis=0)
+
+    slots: list[Slot] = []
+    for position, minute in enumerate(starts[indexes].tolist()):
+        start = datetime.fromtimestamp(minute * 60, tz=timezone.utc)
+        free_calendars = tuple(
+            calendar_id for row, calendar_id in enumerate(calendar_ids) if free_at[row, position]
+        )
+        slots.append(
+            Slot(
+                start=start,
+                end=start + timedelta(minutes=duration),
+                calendar_ids=free_calendars,
+                assigned_calendar_id=calendar_ids[assigned[position]] if assigned is not None else None,
+            )
+        )
+    return slots
@@ -0,0 +1,239 @@
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+import httpx
+
+from app.clients.calendar_client import refresh_access_token
+from app.clients.redis_client import acquire_lock, get_redis_client, release_lock
+from app.clients.supabase import get_supabase_client
+from app.config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# Google access tokens per calendar integration, cached in process memory and
+# in Redis. A token close to expiry is still served while a background thread
+# renews it (refresh-ahead); only an expired or unknown token makes the caller
+# wait. Renewal is single-flight across processes through a Redis lock, and
+# the periodic refresher renews tokens of linked integrations before anyone
+# needs them.
+TOKEN_KEY = "calendar:token:{integration_id}"
+TOKEN_LOCK_KEY = "calendar:token:lock:{integration_id}"
+LOCK_SECONDS = 30
+LOCK_WAIT_SECONDS = 10
+# Tokens stored without an expiry are re-read from the database this often.
+UNKNOWN_EXPIRY_TTL_SECONDS = 60
+
+_memory: dict[str, tuple[str, float | None, float]] = {}
+_memory_lock = threading.Lock()
+_refreshing: set[str] = set()
+
+
+def _parse_expiry(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except Exception:
+        return None
+
+
+def _remember(integration_id: str, access_token: str, expires_at: float | None) -> None:
+    now = time.time()
+    cache_until = expires_at if expires_at else now + UNKNOWN_EXPIRY_TTL_SECONDS
+    with _memory_lock:
+        _memory[integration_id] = (access_token, expires_at, cache_until)
+    try:
+        ttl = int(cache_until - now)
+        if ttl > 0:
+            get_redis_client().set(
+                TOKEN_KEY.format(integration_id=integration_id),
+                json.dumps({"access_token": access_token, "expires_at": expires_at}),
+                ex=ttl,
+            )
+    except Exception:
+        pass
+
+
+def _cached(integration_id: str) -> tuple[str, float | None] | None:
+    now = time.time()
+    with _memory_lock:
+        entry = _memory.get(integration_id)
+    if entry and entry[2] > now:
+        return entry[0], entry[1]
+    try:
+        raw = get_redis_client().get(TOKEN_KEY.format(integration_id=integration_id))
+        data = json.loads(raw) if raw else None
+    except Exception:
+        data = None
+    if not isinstance(data, dict) or not data.get("access_token"):
+        return None
+    expires_at = data.get("expires_at")
+    cache_until = expires_at if expires_at else now + UNKNOWN_EXPIRY_TTL_SECONDS
+    with _memory_lock:
+        _memory[integration_id] = (data["access_token"], expires_at, cache_until)
+    return data["access_token"], expires_at
+
+
+def _load_row(integration_id: str) -> dict:
+    supabase = get_supabase_client()
+    rows = (
+        supabase.table("calendar_tokens")
+        .select("access_token, refresh_token, expires_at")
+        .eq("integration_id", integration_id)
+        .limit(1)
+        .execute()
+        .data
+        or []
+    )
+    if not rows:
+        raise ValueError("Calendar tokens not found")
+    return rows[0]
+
+
+def _needs_refresh(expires_at: float | None, margin: float) -> bool:
+    return expires_at is not None and expires_at - margin <= time.time()
+
+
+def _refresh(integration_id: str, margin: float | None = None, force: bool = False) -> str:
+    """Renews the token under the integration's lock unless it is still valid
+    for `margin` seconds. The row is re-read once the lock is held, so a
+    renewal finished by another worker is reused instead of repeated."""
+    lock_key = TOKEN_LOCK_KEY.format(integration_id=integration_id)
+    if margin is None:
+        margin = settings.calendar_token_refresh_ahead_seconds
+    deadline = time.monotonic() + LOCK_WAIT_SECONDS
+    lock_token = acquire_lock(lock_key, LOCK_SECONDS)
+    while not lock_token:
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"calendar token refresh busy integration_id={integration_id}")
+        time.sleep(0.2)
+        cached = _cached(integration_id)
+        if cached and not force and not _needs_refresh(cached[1], margin):
+            return cached[0]
+        lock_token = acquire_lock(lock_key, LOCK_SECONDS)
+    try:
+        row = _load_row(integration_id)
+        access_token = row.get("access_token")
+        expires_at = _parse_expiry(row.get("expires_at"))
+        if access_token and not force and not _needs_refresh(expires_at, margin):
+            _remember(integration_id, access_token, expires_at)
+            return access_token
+        if not row.get("refresh_token"):
+            if access_token and not _needs_refresh(expires_at, 0):
+                _remember(integration_id, access_token, expires_at)
+                return access_token
+            raise ValueError("Calendar access token missing")
+
+        refreshed = refresh_access_token(row["refresh_token"])
+        access_token = refreshed.get("access_token")
+        if not access_token:
+            raise ValueError("Calendar access token missing")
+        expires_in = refreshed.get("expires_in")
+        new_expires_at = None
+        if expires_in:
+            new_expires_at = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(seconds=int(expires_in))
+        update = {
+            "access_token": access_token,
+            "expires_at": new_expires_at.isoformat() if new_expires_at else None,
+        }
+        if refreshed.get("refresh_token"):
+            update["refresh_token"] = refreshed["refresh_token"]
+        get_supabase_client().table("calendar_tokens").update(update).eq(
+            "integration_id", integration_id
+        ).execute()
+        _remember(integration_id, access_token, new_expires_at.timestamp() if new_expires_at else None)
+        logger.info("calendar_token_refreshed integration_id=%s expires_in=%s", integration_id, expires_in)
+        return access_token
+    finally:
+        release_lock(lock_key, lock_token)
+
+
+def _refresh_in_background(integration_id: str) -> None:
+    with _memory_lock:
+        if integration_id in _refreshing:
+            return
+        _refreshing.add(integration_id)
+
+    def run() -> None:
+        try:
+            _refresh(integration_id)
+        except Exception:
+            logger.warning("calendar_token_refresh_ahead_failed integration_id=%s", integration_id)
+        finally:
+            with _memory_lock:
+                _refreshing.discard(integration_id)
+
+    threading.Thread(target=run, name="calendar-token-refresh", daemon=True).start()
+
+
+def get_access_token(integration_id: str) -> str:
+    margin = settings.calendar_token_refresh_ahead_seconds
+    cached = _cached(integration_id)
+    if cached is None:
+        row = _load_row(integration_id)
+        if row.get("access_token"):
+            cached = (row["access_token"], _parse_expiry(row.get("expires_at")))
+            if not _needs_refresh(cached[1], 0):
+                _remember(integration_id, *cached)
+    if cached is None or _needs_refresh(cached[1], 0):
+        return _refresh(integration_id)
+    if _needs_refresh(cached[1], margin):
+        _refresh_in_background(integration_id)
+    return cached[0]
+
+
+def invalidate_access_token(integration_id: str) -> None:
+    with _memory_lock:
+        _memory.pop(integration_id, None)
+    try:
+        get_redis_client().delete(TOKEN_KEY.format(integration_id=integration_id))
+    except Exception:
+        pass
+
+
+def call_with_token(integration_id: str, fn: Callable[[str], Any]) -> Any:
+    """Calls fn(access_token); on a 401 (token revoked or replaced by a
+    reconnect) the token is renewed once and the call retried."""
+    try:
+        return fn(get_access_token(integration_id))
+    except httpx.HTTPStatusError as error:
+        if error.response.status_code != 401:
+            raise
+    invalidate_access_token(integration_id)
+    return fn(_refresh(integration_id, force=True))
+
+
+def refresh_expiring_tokens() -> dict:
+    """Renews tokens of integrations linked to an agent that expire before
+    the next refresher tick plus the refresh-ahead margin."""
+    supabase = get_supabase_client()
+    links = supabase.table("agent_calendar_links").select("integration_id").execute().data or []
+    integration_ids = sorted({row["integration_id"] for row in links if row.get("integration_id")})
+    if not integration_ids:
+        return {"checked": 0, "refreshed": 0, "failed": 0}
+    margin = settings.calendar_token_refresh_ahead_seconds + settings.calendar_token_refresh_interval_seconds
+    horizon = datetime.now(timezone.utc) + timedelta(seconds=margin)
+    rows = (
+        supabase.table("calendar_tokens")
+        .select("integration_id, refresh_token, expires_at")
+        .in_("integration_id", integration_ids)
+        .lt("expires_at", horizon.isoformat())
+        .execute()
+        .data
+        or []
+    )
+    refreshed = failed = 0
+    for row in rows:
+        if not row.get("refresh_token"):
+            continue
+        try:
+            _refresh(row["integration_id"], margin=margin)
+            refreshed += 1
+        except Exception:
+            failed += 1
+            logger.warning("calendar_token_refresh_failed integration_id=%s", row["integration_id"])
+    return {"checked": len(integration_ids), "refreshed": refreshed, "failed": failed}
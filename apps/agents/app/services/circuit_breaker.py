@@ -0,0 +1,131 @@
+import logging
+import time
+
+from app.clients.redis_client import get_redis_client
+from app.config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# State is kept in Redis so every API and worker process sees the same
+# breaker: failures are counted in a short window and, past the threshold,
+# the provider is skipped until the open period ends. After that one probe
+# is let through; a success closes the breaker, a failure re-opens it.
+FAILURES_KEY = "circuit:{name}:failures"
+OPEN_UNTIL_KEY = "circuit:{name}:open_until"
+PROBE_KEY = "circuit:{name}:probe"
+
+# A failure while the breaker has been open recently (the half-open probe)
+# re-opens it straight away; otherwise failures are counted in the window.
+_RECORD_FAILURE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+  redis.call('SET', KEYS[2], ARGV[3], 'EX', tonumber(ARGV[4]) * 4)
+  return 1
+end
+local failures = redis.call('INCR', KEYS[1])
+if failures == 1 then
+  redis.call('EXPIRE', KEYS[1], tonumber(ARGV[1]))
+end
+if failures >= tonumber(ARGV[2]) then
+  redis.call('SET', KEYS[2], ARGV[3], 'EX', tonumber(ARGV[4]) * 4)
+  redis.call('DEL', KEYS[1])
+  return 1
+end
+return 0
+"""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int | None = None,
+        window_seconds: int | None = None,
+        open_seconds: int | None = None,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold or settings.circuit_failure_threshold
+        self.window_seconds = window_seconds or settings.circuit_failure_window_seconds
+        self.open_seconds = open_seconds or settings.circuit_open_seconds
+
+    def _key(self, template: str) -> str:
+        return template.format(name=self.name)
+
+    def allow(self) -> bool:
+        try:
+            redis = get_redis_client()
+            open_until = redis.get(self._key(OPEN_UNTIL_KEY))
+            if not open_until or float(open_until) <= time.time():
+                if open_until:
+                    # Half-open: a single caller probes the provider.
+                    return bool(
+                        redis.set(self._key(PROBE_KEY), "1", nx=True, ex=max(self.open_seconds, 1))
+                    )
+                return True
+            return False
+        except Exception:
+            return True
+
+    def is_open(self) -> bool:
+        try:
+            open_until = get_redis_client().get(self._key(OPEN_UNTIL_KEY))
+            return bool(open_until) and float(open_until) > time.time()
+        except Exception:
+            return False
+
+    def is_half_open(self) -> bool:
+        """Open period over but not closed by a success yet: the next
+        failure is the probe's and re-opens the breaker."""
+        try:
+            open_until = get_redis_client().get(self._key(OPEN_UNTIL_KEY))
+            return bool(open_until) and float(open_until) <= time.time()
+        except Exception:
+            return False
+
+    def trip(self) -> None:
+        try:
+            redis = get_redis_client()
+            redis.set(
+                self._key(OPEN_UNTIL_KEY),
+                time.time() + self.open_seconds,
+                ex=max(self.open_seconds, 1) * 4,
+            )
+            redis.delete(self._key(FAILURES_KEY), self._key(PROBE_KEY))
+            logger.warning("circuit_opened name=%s open_seconds=%s", self.name, self.open_seconds)
+        except Exception:
+            return
+
+    def record_success(self) -> None:
+        try:
+            redis = get_redis_client()
+            pipeline = redis.pipeline(transaction=True)
+            pipeline.delete(self._key(FAILURES_KEY), self._key(OPEN_UNTIL_KEY), self._key(PROBE_KEY))
+            pipeline.execute()
+        except Exception:
+            return
+
+    def release_probe(self) -> None:
+        """Lets another caller probe: the last probe said nothing about the
+        failure that opened the breaker."""
+        try:
+            get_redis_client().delete(self._key(PROBE_KEY))
+        except Exception:
+            return
+
+    def record_failure(self) -> None:
+        try:
+            redis = get_redis_client()
+            opened = redis.eval(
+                _RECORD_FAILURE_SCRIPT,
+                2,
+                self._key(FAILURES_KEY),
+                self._key(OPEN_UNTIL_KEY),
+                self.window_seconds,
+                self.failure_threshold,
+                time.time() + self.open_seconds,
+                self.open_seconds,
+            )
+            redis.delete(self._key(PROBE_KEY))
+            if opened:
+                logger.warning("circuit_opened name=%s open_seconds=%s", self.name, self.open_seconds)
+        except Exception:
+            return
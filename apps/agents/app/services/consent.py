@@ -11,3 +11,19 @@ def has_agent_consent(agent_id: str) -> bool:
         .execute()
     )
     return bool(response.data)
+
+
+def get_agents_with_consent(agent_ids: list[str]) -> set[str]:
+    ids = sorted({agent_id for agent_id in agent_ids if agent_id})
+    if not ids:
+        return set()
+    supabase = get_supabase_client()
+    rows = (
+        supabase.table("agent_consents")
+        .select("agent_id")
+        .in_("agent_id", ids)
+        .execute()
+        .data
+        or []
+    )
+    return {row["agent_id"] for row in rows if row.get("agent_id")}
@@ -0,0 +1,116 @@
+from functools import lru_cache
+import threading
+
+import tiktoken
+
+from app.config import settings
+
+# Rough per-message overhead of the chat format (role, separators).
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def _get_encoder():
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                _encoder = tiktoken.get_encoding("cl100k_base")
+    return _encoder
+
+
+@lru_cache(maxsize=20000)
+def count_tokens(text: str) -> int:
+    """cl100k_base token count. Messages, chunks and lookup lines repeat on
+    every run of a conversation, so counts are memoized per text."""
+    if not text:
+        return 0
+    return len(_get_encoder().encode(text))
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message.get("conteudo") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def context_budget(agent: dict) -> int:
+    configured = (agent.get("configuracao") or {}).get("limite_tokens_contexto")
+    try:
+        budget = int(configured)
+    except (TypeError, ValueError):
+        budget = 0
+    return budget if budget > 0 else settings.agent_context_token_budget
+
+
+def trim_knowledge(knowledge: list[dict], budget: int) -> tuple[list[dict], int]:
+    """Keeps the most relevant chunks that fit in the budget. Chunks come
+    ranked from retrieval; a similarity score, when every chunk has one,
+    takes precedence."""
+    ranked = knowledge
+    if knowledge and all(isinstance(item.get("similarity"), (int, float)) for item in knowledge):
+        ranked = sorted(knowledge, key=lambda item: item["similarity"], reverse=True)
+    kept: list[dict] = []
+    used = 0
+    for item in ranked:
+        tokens = count_tokens(item.get("content") or "")
+        if not tokens or used + tokens > budget:
+            continue
+        kept.append(item)
+        used += tokens
+    return kept, used
+
+
+def _lookup_line(item: dict) -> str:
+    return f"- {item.get('nome')} ({item.get('id')})"
+
+
+def trim_lookups(agent: dict, workspace_context: dict, budget: int) -> tuple[dict, int]:
+    """Trims tags and custom fields to the budget. Relevance is decided per
+    agent, not per message, so the trimmed lists stay identical across runs
+    and the static prompt prefix remains cacheable: items the agent config
+    references (pause tags, names cited in the prompt or FAQ) come first,
+    then the rest by name."""
+    configuracao = agent.get("configuracao") or {}
+    reference_text = " ".join(
+        [str(configuracao.get("prompt") or ""), str(configuracao.get("faq") or "")]
+    ).casefold()
+    pinned_ids = {str(item) for item in (agent.get("pausar_em_tags") or [])}
+
+    def is_pinned(item: dict) -> bool:
+        if str(item.get("id")) in pinned_ids:
+            return True
+        name = str(item.get("nome") or "").casefold()
+        return len(name) >= 3 and name in reference_text
+
+    candidates = []
+    for kind in ("tags", "lead_fields", "deal_fields"):
+        for item in workspace_context.get(kind) or []:
+            candidates.append(
+                (0 if is_pinned(item) else 1, str(item.get("nome") or ""), str(item.get("id") or ""), kind, item)
+            )
+    candidates.sort(key=lambda candidate: candidate[:4])
+
+    used = sum(count_tokens(_lookup_line(item)) for item in workspace_context.get("stages") or [])
+    kept: dict[str, list[dict]] = {"tags": [], "lead_fields": [], "deal_fields": []}
+    for priority, _, _, kind, item in candidates:
+        tokens = count_tokens(_lookup_line(item))
+        if priority > 0 and used + tokens > budget:
+            continue
+        kept[kind].append(item)
+        used += tokens
+    return {**workspace_context, **kept}, used
+
+
+def split_history(messages: list[dict], budget: int, min_recent: int) -> tuple[list[dict], list[dict]]:
+    """Splits messages into (recent, older): the newest messages that fit in
+    the budget, never fewer than min_recent, and everything before them."""
+    used = 0
+    cut = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        tokens = message_tokens(messages[index])
+        if len(messages) - index > min_recent and used + tokens > budget:
+            break
+        used += tokens
+        cut = index
+    return messages[cut:], messages[:cut]
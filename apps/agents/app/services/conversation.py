@@ -1,6 +1,17 @@
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import Iterator
 
 from app.clients.supabase import get_supabase_client
+from app.services.membership import Membership, get_membership, pause_rules
+
+MESSAGE_COLUMNS = "id, autor, tipo, conteudo, interno, created_at"
+# Last-message timestamps per author, as stored on agent_conversation_state.
+AUTHOR_STATE_COLUMNS = {
+    "contato": "ultimo_contato_em",
+    "agente": "ultimo_agente_em",
+    "equipe": "ultimo_humano_em",
+}
+AUTHOR_SCAN_LIMIT = 50
 
 
 def get_conversation(conversation_id: str) -> dict:
@@ -16,10 +27,11 @@ def get_conversation(conversation_id: str) -> dict:
 
 
 def get_messages(conversation_id: str, limit: int = 150) -> list[dict]:
+    """Last `limit` messages, oldest first: the history window for a prompt."""
     supabase = get_supabase_client()
     response = (
         supabase.table("messages")
-        .select("id, autor, tipo, conteudo, interno, created_at")
+        .select(MESSAGE_COLUMNS)
         .eq("conversation_id", conversation_id)
         .order("created_at", desc=True)
         .limit(limit)
@@ -29,78 +41,172 @@ def get_messages(conversation_id: str, limit: int = 150) -> list[dict]:
     return list(reversed(data))
 
 
-def get_contact_tags(contact_id: str) -> list[str]:
+def iter_message_batches(
+    conversation_id: str,
+    after: str | None = None,
+    until: str | None = None,
+    batch_size: int = 500,
+    columns: str = MESSAGE_COLUMNS,
+) -> Iterator[list[dict]]:
+    """Full history oldest first, created_at in (after, until], as a keyset
+    cursor: each batch starts past the last (created_at, id) seen, so deep
+    pages cost the same as the first and ties are never skipped."""
     supabase = get_supabase_client()
-    response = (
-        supabase.table("contact_tags")
-        .select("tag_id")
-        .eq("contact_id", contact_id)
-        .execute()
-    )
-    return [item["tag_id"] for item in (response.data or [])]
+    cursor: tuple[str, str] | None = None
+    while True:
+        query = supabase.table("messages").select(columns).eq("conversation_id", conversation_id)
+        if after:
+            query = query.gt("created_at", after)
+        if until:
+            query = query.lte("created_at", until)
+        if cursor:
+            created_at, message_id = cursor
+            query = query.or_(
+                f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{message_id})'
+            )
+        rows = (
+            query.order("created_at", desc=False)
+            .order("id", desc=False)
+            .limit(batch_size)
+            .execute()
+            .data
+            or []
+        )
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        cursor = (rows[-1]["created_at"], rows[-1]["id"])
 
 
-def get_lead_tags(lead_id: str) -> list[str]:
+def get_last_message(conversation_id: str, autor: str) -> dict | None:
     supabase = get_supabase_client()
-    response = (
-        supabase.table("lead_tags")
-        .select("tag_id")
-        .eq("lead_id", lead_id)
+    rows = (
+        supabase.table("messages")
+        .select(MESSAGE_COLUMNS)
+        .eq("conversation_id", conversation_id)
+        .eq("autor", autor)
+        .order("created_at", desc=True)
+        .limit(1)
         .execute()
+        .data
+        or []
     )
-    return [item["tag_id"] for item in (response.data or [])]
-
-
-def is_human_last(messages: list[dict]) -> bool:
-    if not messages:
-        return False
-    return messages[-1].get("autor") == "equipe"
+    return rows[0] if rows else None
+
+
+def _parse_timestamp(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except Exception:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _stored_author_timestamps(state: dict | None, conversation: dict) -> dict | None:
+    """Author timestamps from agent_conversation_state, or None when a message
+    newer than all of them has arrived (conversations.ultima_mensagem_em)."""
+    if not state:
+        return None
+    timestamps = {autor: state.get(column) for autor, column in AUTHOR_STATE_COLUMNS.items()}
+    parsed = {autor: _parse_timestamp(value) for autor, value in timestamps.items()}
+    known = [(moment, autor) for autor, moment in parsed.items() if moment]
+    if not known:
+        return None
+    newest_at, newest_author = max(known)
+    latest = _parse_timestamp(conversation.get("ultima_mensagem_em"))
+    if latest and latest > newest_at:
+        return None
+    return {**timestamps, "ultimo_autor": newest_author}
+
+
+def scan_author_timestamps(conversation_id: str, limit: int = AUTHOR_SCAN_LIMIT) -> dict:
+    supabase = get_supabase_client()
+    rows = (
+        supabase.table("messages")
+        .select("autor, created_at")
+        .eq("conversation_id", conversation_id)
+        .order("created_at", desc=True)
+        .limit(limit)
+        .execute()
+        .data
+        or []
+    )
+    timestamps: dict = {autor: None for autor in AUTHOR_STATE_COLUMNS}
+    for row in rows:
+        autor = row.get("autor") if row.get("autor") in AUTHOR_STATE_COLUMNS else "equipe"
+        if timestamps[autor] is None:
+            timestamps[autor] = row.get("created_at")
+    timestamps["ultimo_autor"] = rows[0].get("autor") if rows else None
+    return timestamps
 
 
-def should_pause(agent: dict, conversation: dict, messages: list[dict]) -> tuple[bool, str | None]:
+def get_author_timestamps(
+    agent_id: str,
+    conversation: dict,
+    state: dict | None = None,
+    scan_limit: int = AUTHOR_SCAN_LIMIT,
+) -> dict:
+    """Last message timestamp per author (contato/agente/equipe) plus the
+    author of the newest message. Served from the stored state columns when
+    they are current; otherwise a narrow (autor, created_at) scan fills them
+    and the result is written back so the next caller hits the fast path."""
+    supabase = get_supabase_client()
+    if state is None:
+        rows = (
+            supabase.table("agent_conversation_state")
+            .select(", ".join(AUTHOR_STATE_COLUMNS.values()))
+            .eq("agent_id", agent_id)
+            .eq("conversation_id", conversation["id"])
+            .limit(1)
+            .execute()
+            .data
+            or []
+        )
+        state = rows[0] if rows else None
+    stored = _stored_author_timestamps(state, conversation)
+    if stored is not None:
+        return stored
+
+    timestamps = scan_author_timestamps(conversation["id"], scan_limit)
+    update = {}
+    for autor, column in AUTHOR_STATE_COLUMNS.items():
+        if timestamps[autor]:
+            update[column] = timestamps[autor]
+        elif state:
+            timestamps[autor] = state.get(column)
+    if state and update:
+        supabase.table("agent_conversation_state").update(update).eq("agent_id", agent_id).eq(
+            "conversation_id", conversation["id"]
+        ).execute()
+    return timestamps
+
+
+def should_pause(
+    agent: dict,
+    conversation: dict,
+    last_author: str | None,
+    membership: Membership | None = None,
+) -> tuple[bool, str | None]:
     if conversation.get("modo_atendimento_humano"):
         return True, "modo_atendimento_humano"
 
-    if agent.get("pausar_ao_responder_humano") and is_human_last(messages):
+    rules = pause_rules(agent)
+    if rules.on_human_reply and last_author == "equipe":
         return True, "humano_respondeu"
-
-    pause_tags = agent.get("pausar_em_tags") or []
-    pause_stages = agent.get("pausar_em_etapas") or []
+    if not rules.needs_membership:
+        return False, None
 
     contact_id = conversation.get("contact_id")
     lead_id = conversation.get("lead_id")
-
-    if pause_tags:
-        tags = []
-        if contact_id:
-            tags.extend(get_contact_tags(contact_id))
-        if lead_id:
-            tags.extend(get_lead_tags(lead_id))
-        if any(tag in pause_tags for tag in tags):
-            return True, "tag_pause"
-
-    if pause_stages and contact_id:
-        supabase = get_supabase_client()
-        contact = (
-            supabase.table("contacts")
-            .select("pipeline_stage_id")
-            .eq("id", contact_id)
-            .single()
-            .execute()
-            .data
-        )
-        if contact and contact.get("pipeline_stage_id") in pause_stages:
-            return True, "stage_pause"
-        deals = (
-            supabase.table("deals")
-            .select("stage_id")
-            .eq("contact_id", contact_id)
-            .execute()
-            .data
-        )
-        if any(deal.get("stage_id") in pause_stages for deal in (deals or [])):
-            return True, "stage_pause"
-
+    if membership is None:
+        membership = get_membership(contact_id, lead_id)
+    if not rules.tags.isdisjoint(membership.tags):
+        return True, "tag_pause"
+    if contact_id and not rules.stages.isdisjoint(membership.stages):
+        return True, "stage_pause"
     return False, None
 
 
@@ -117,18 +223,24 @@ def update_conversation_state(
     last_agent = next((m for m in reversed(messages) if m.get("autor") == "agente"), None)
     last_human = next((m for m in reversed(messages) if m.get("autor") == "equipe"), None)
 
+    row = {
+        "agent_id": agent_id,
+        "conversation_id": conversation["id"],
+        "workspace_id": conversation["workspace_id"],
+        "idioma_detectado": language,
+        "pausado": paused,
+        "pausado_motivo": paused_reason,
+        "updated_at": datetime.utcnow().isoformat(),
+    }
+    # messages is only the recent window: an author missing from it keeps the
+    # timestamp already stored instead of being cleared.
+    if last_contact:
+        row["ultimo_contato_em"] = last_contact.get("created_at")
+    if last_agent:
+        row["ultimo_agente_em"] = last_agent.get("created_at")
+    if last_human:
+        row["ultimo_humano_em"] = last_human.get("created_at")
     supabase.table("agent_conversation_state").upsert(
-        {
-            "agent_id": agent_id,
-            "conversation_id": conversation["id"],
-            "workspace_id": conversation["workspace_id"],
-            "idioma_detectado": language,
-            "pausado": paused,
-            "pausado_motivo": paused_reason,
-            "ultimo_contato_em": last_contact.get("created_at") if last_contact else None,
-            "ultimo_agente_em": last_agent.get("created_at") if last_agent else None,
-            "ultimo_humano_em": last_human.get("created_at") if last_human else None,
-            "updated_at": datetime.utcnow().isoformat(),
-        },
+        row,
         on_conflict="agent_id,conversation_id",
     ).execute()
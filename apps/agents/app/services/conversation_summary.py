@@ -0,0 +1,209 @@
+import logging
+
+from app.clients.redis_client import acquire_lock, release_lock
+from app.clients.supabase import get_supabase_client
+from app.config import settings
+from app.services.conversation import iter_message_batches
+from app.services.llm import get_last_fallback_llm, get_primary_llm, get_secondary_llm
+
+logger = logging.getLogger("uvicorn.error")
+
+# The rolling summary lives on agent_conversation_state: resumo_conversa is
+# the text and resumo_ate_em the created_at of the newest message folded in.
+# Both columns are added by hand (see README); on a database without them
+# runs go on without a summary and nothing is summarized.
+AUTHOR_LABELS = {"contato": "Contato", "agente": "Agente", "equipe": "Equipe"}
+SUMMARY_LOCK_KEY = "summary:lock:{agent_id}:{conversation_id}"
+MAX_FOLD_BATCHES = 5
+
+
+def _missing_summary_columns(error: Exception) -> bool:
+    text = str(error)
+    return "resumo_conversa" in text or "resumo_ate_em" in text
+
+
+def get_conversation_summary(agent_id: str, conversation_id: str) -> dict:
+    """The stored summary; "disponivel" is False when the database has no
+    summary columns."""
+    supabase = get_supabase_client()
+    try:
+        rows = (
+            supabase.table("agent_conversation_state")
+            .select("resumo_conversa, resumo_ate_em")
+            .eq("agent_id", agent_id)
+            .eq("conversation_id", conversation_id)
+            .limit(1)
+            .execute()
+            .data
+            or []
+        )
+    except Exception as error:
+        if not _missing_summary_columns(error):
+            raise
+        return {"resumo": "", "ate": None, "disponivel": False}
+    row = rows[0] if rows else {}
+    return {"resumo": row.get("resumo_conversa") or "", "ate": row.get("resumo_ate_em"), "disponivel": True}
+
+
+def save_conversation_summary(agent_id: str, conversation_id: str, summary: dict) -> bool:
+    supabase = get_supabase_client()
+    try:
+        supabase.table("agent_conversation_state").update(
+            {"resumo_conversa": summary["resumo"], "resumo_ate_em": summary["ate"]}
+        ).eq("agent_id", agent_id).eq("conversation_id", conversation_id).execute()
+    except Exception as error:
+        if not _missing_summary_columns(error):
+            raise
+        logger.warning(
+            "conversation_summary_columns_missing agent_id=%s conversation_id=%s",
+            agent_id,
+            conversation_id,
+        )
+        return False
+    return True
+
+
+def _summarize(previous: str, messages: list[dict]) -> str | None:
+    lines = [
+        f"{AUTHOR_LABELS.get(message.get('autor'), 'Equipe')}: {message.get('conteudo') or ''}"
+        for message in messages
+        if message.get("conteudo")
+    ]
+    prompt = (
+        "Atualize o resumo de uma conversa de atendimento incorporando as novas mensagens. "
+        "Preserve dados do contato, interesses, objecoes, combinados, datas e pendencias. "
+        "Responda apenas com o resumo, em no maximo 200 palavras, no idioma da conversa.\n\n"
+        f"Resumo atual:\n{previous or '(vazio)'}\n\n"
+        "Novas mensagens:\n" + "\n".join(lines)
+    )
+    for llm in (get_primary_llm(), get_secondary_llm(), get_last_fallback_llm()):
+        if llm is None:
+            continue
+        try:
+            response = llm.invoke(prompt)
+            content = response.content if hasattr(response, "content") else str(response)
+            if content:
+                return content.strip()
+        except Exception:
+            continue
+    return None
+
+
+def fold_into_summary(
+    agent_id: str,
+    conversation_id: str,
+    summary: dict,
+    older_messages: list[dict],
+) -> dict:
+    """Folds messages newer than the watermark into the summary and persists
+    it. Returns the summary unchanged if there is nothing new, the
+    conversation is being summarized elsewhere or the models fail, so no
+    message is ever marked as summarized without being so."""
+    lock_key = SUMMARY_LOCK_KEY.format(agent_id=agent_id, conversation_id=conversation_id)
+    token = acquire_lock(lock_key, 120)
+    if not token:
+        return summary
+    try:
+        # Re-read under the lock: another worker may have moved the watermark.
+        current = get_conversation_summary(agent_id, conversation_id)
+        watermark = current.get("ate")
+        pending = [
+            message
+            for message in older_messages
+            if message.get("created_at") and (not watermark or message["created_at"] > watermark)
+        ]
+        if not pending:
+            return current
+        text = _summarize(current.get("resumo") or "", pending)
+        if text is None:
+            logger.warning(
+                "conversation_summary_failed agent_id=%s conversation_id=%s pending=%s",
+                agent_id,
+                conversation_id,
+                len(pending),
+            )
+            return summary
+        updated = {"resumo": text, "ate": pending[-1]["created_at"], "disponivel": True}
+        if not save_conversation_summary(agent_id, conversation_id, updated):
+            return current
+        logger.info(
+            "conversation_summary_folded agent_id=%s conversation_id=%s messages=%s",
+            agent_id,
+            conversation_id,
+            len(pending),
+        )
+        return updated
+    finally:
+        release_lock(lock_key, token)
+
+
+def _fold_batches(batches, batch_size: int):
+    """Re-cuts created_at-ordered batches so none ends inside a group of
+    messages sharing a created_at: the watermark is a timestamp, and a group
+    split across two folds would lose its second half."""
+    carry: list[dict] = []
+    for rows in batches:
+        rows = carry + rows
+        carry = []
+        if len(rows) >= batch_size:
+            last = rows[-1]["created_at"]
+            cut = len(rows)
+            while cut > 0 and rows[cut - 1]["created_at"] == last:
+                cut -= 1
+            if cut > 0:
+                rows, carry = rows[:cut], rows[cut:]
+        yield rows
+    if carry:
+        yield carry
+
+
+def summarize_aged_out_messages(
+    agent_id: str,
+    conversation_id: str,
+    until: str | None = None,
+) -> dict:
+    """Background step after a run: folds every message that fell out of the
+    history window run_agent loads, and up to `until` the ones the run left
+    out to fit its token budget, into the rolling summary, oldest first from
+    the watermark. Returns status "partial" when MAX_FOLD_BATCHES were
+    folded and more remain."""
+    supabase = get_supabase_client()
+    window = settings.agent_history_window_messages
+    boundary_rows = (
+        supabase.table("messages")
+        .select("created_at")
+        .eq("conversation_id", conversation_id)
+        .order("created_at", desc=True)
+        .range(window, window)
+        .execute()
+        .data
+        or []
+    )
+    boundary = boundary_rows[0]["created_at"] if boundary_rows else None
+    if until and (not boundary or until > boundary):
+        boundary = until
+    if not boundary:
+        return {"status": "skipped", "reason": "within_window"}
+
+    summary = get_conversation_summary(agent_id, conversation_id)
+    if not summary.get("disponivel", True):
+        return {"status": "skipped", "reason": "no_summary_columns"}
+    folded = 0
+    batches = _fold_batches(
+        iter_message_batches(
+            conversation_id,
+            after=summary.get("ate"),
+            until=boundary,
+            batch_size=settings.agent_summary_batch_size,
+        ),
+        settings.agent_summary_batch_size,
+    )
+    for index, rows in enumerate(batches):
+        if index == MAX_FOLD_BATCHES:
+            return {"status": "partial", "folded": folded, "watermark": summary.get("ate")}
+        updated = fold_into_summary(agent_id, conversation_id, summary, rows)
+        if updated.get("ate") == summary.get("ate"):
+            break
+        summary = updated
+        folded += len(rows)
+    return {"status": "ok", "folded": folded, "watermark": summary.get("ate")}
@@ -1,20 +1,168 @@
+from collections import defaultdict
+import json
+import logging
+from uuid import NAMESPACE_URL, uuid4, uuid5
+
+from app.clients.redis_client import acquire_lock, get_redis_client, release_lock, renew_lock
 from app.clients.supabase import get_supabase_client
+from app.config import settings
 from app.services.metrics import increment_agent_metrics
 
+logger = logging.getLogger("uvicorn.error")
 
-def get_remaining_credits(workspace_id: str) -> int:
+# Hot balance per workspace: credits_total - credits_used - pending. Every
+# reservation or debit moves the balance and the pending counter together in
+# one script, so parallel workers never lose an update. The ledger list holds
+# debits that still need to be written to Postgres by settle_credit_ledger.
+BALANCE_KEY = "credits:balance:{workspace_id}"
+PENDING_KEY = "credits:pending"
+LEDGER_KEY = "credits:ledger"
+SETTLE_LOCK_KEY = "credits:settle:lock"
+SETTLE_LOCK_SECONDS = 60
+CARRY_KEY = "credits:settle:carry"
+# The batch being settled. It is only dropped once every step is done, and
+# SETTLE_STATE_KEY records the batch id and the steps already done
+# ("inserted", "metrics", "applied:<workspace_id>"), so a settler that dies
+# midway is resumed by the next run. Each step is safe to repeat: event rows
+# get ids derived from the batch id, the metrics increments and their marker
+# are one transaction, and the credits_used compare-and-swap records the
+# value it writes ("cas:<workspace_id>"), so a resume that finds it in place
+# does not add it again. The one case left is a billing change landing on
+# that workspace between the crash and the resume: the delta is then applied
+# again on top of it. The lock is renewed before every step, and a settler
+# that lost it stops without writing.
+PROCESSING_KEY = "credits:ledger:processing"
+SETTLE_STATE_KEY = "credits:settle:state"
+
+# Returns the new balance, or nil when the balance is not cached yet.
+# ARGV[2] == "1" refuses to go below zero and returns -1 instead.
+_RESERVE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return nil
+end
+local credits = tonumber(ARGV[1])
+if ARGV[2] == '1' and tonumber(redis.call('GET', KEYS[1])) < credits then
+  return -1
+end
+redis.call('HINCRBY', KEYS[2], ARGV[3], credits)
+return redis.call('DECRBY', KEYS[1], credits)
+"""
+
+_RELEASE_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], ARGV[2], -tonumber(ARGV[1]))
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# Returns the unfinished batch if there is one, else moves up to ARGV[1]
+# events from the ledger to a new batch.
+_CLAIM_LEDGER_SCRIPT = """
+if redis.call('LLEN', KEYS[2]) == 0 then
+  for _ = 1, tonumber(ARGV[1]) do
+    if not redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT') then
+      break
+    end
+  end
+end
+return redis.call('LRANGE', KEYS[2], 0, -1)
+"""
+
+
+def _balance_key(workspace_id: str) -> str:
+    return BALANCE_KEY.format(workspace_id=workspace_id)
+
+
+def _load_balances_from_db(workspace_ids: list[str]) -> dict[str, int]:
+    redis = get_redis_client()
+    # Pending is read before the table so a settlement landing in between
+    # can only understate the balance, never overstate it.
+    pending_values = redis.hmget(PENDING_KEY, workspace_ids)
+    pending = {
+        workspace_id: int(value or 0) for workspace_id, value in zip(workspace_ids, pending_values)
+    }
     supabase = get_supabase_client()
-    result = (
+    rows = (
         supabase.table("workspace_credits")
-        .select("credits_total, credits_used")
-        .eq("workspace_id", workspace_id)
-        .single()
+        .select("workspace_id, credits_total, credits_used")
+        .in_("workspace_id", workspace_ids)
         .execute()
+        .data
+        or []
     )
-    data = result.data or {}
-    total = int(data.get("credits_total") or 0)
-    used = int(data.get("credits_used") or 0)
-    return max(total - used, 0)
+    balances = {workspace_id: -pending[workspace_id] for workspace_id in workspace_ids}
+    for row in rows:
+        total = int(row.get("credits_total") or 0)
+        used = int(row.get("credits_used") or 0)
+        balances[row["workspace_id"]] = total - used - pending[row["workspace_id"]]
+    return balances
+
+
+def invalidate_balance(workspace_id: str) -> None:
+    """Drops the cached balance after credits_total or credits_used change
+    outside the settler (plan changes, period resets); the next reservation
+    reloads it from the database."""
+    get_redis_client().delete(_balance_key(workspace_id))
+
+
+def _seed_balances(workspace_ids: list[str]) -> dict[str, int]:
+    balances = _load_balances_from_db(workspace_ids)
+    redis = get_redis_client()
+    pipeline = redis.pipeline()
+    for workspace_id, balance in balances.items():
+        pipeline.set(_balance_key(workspace_id), balance, nx=True, ex=settings.credits_cache_ttl_seconds)
+    pipeline.execute()
+    return balances
+
+
+def get_remaining_credits(workspace_id: str) -> int:
+    return get_remaining_credits_bulk([workspace_id]).get(workspace_id, 0)
+
+
+def get_remaining_credits_bulk(workspace_ids: list[str]) -> dict[str, int]:
+    ids = sorted({workspace_id for workspace_id in workspace_ids if workspace_id})
+    if not ids:
+        return {}
+    redis = get_redis_client()
+    cached = redis.mget([_balance_key(workspace_id) for workspace_id in ids])
+    balances: dict[str, int] = {}
+    missing: list[str] = []
+    for workspace_id, value in zip(ids, cached):
+        if value is None:
+            missing.append(workspace_id)
+        else:
+            balances[workspace_id] = int(value)
+    if missing:
+        balances.update(_seed_balances(missing))
+    return {workspace_id: max(balance, 0) for workspace_id, balance in balances.items()}
+
+
+def _run_reserve(workspace_id: str, credits: int, strict: bool) -> int:
+    redis = get_redis_client()
+    keys = [_balance_key(workspace_id), PENDING_KEY]
+    args = [credits, "1" if strict else "0", workspace_id]
+    result = redis.eval(_RESERVE_SCRIPT, len(keys), *keys, *args)
+    if result is None:
+        _seed_balances([workspace_id])
+        result = redis.eval(_RESERVE_SCRIPT, len(keys), *keys, *args)
+    if result is None:
+        raise RuntimeError("Credit balance unavailable")
+    return int(result)
+
+
+def reserve_credits(workspace_id: str, credits: int = 1) -> bool:
+    if credits <= 0:
+        return True
+    return _run_reserve(workspace_id, credits, strict=True) >= 0
+
+
+def release_credits(workspace_id: str, credits: int = 1) -> None:
+    if credits <= 0:
+        return
+    redis = get_redis_client()
+    keys = [_balance_key(workspace_id), PENDING_KEY]
+    redis.eval(_RELEASE_SCRIPT, len(keys), *keys, credits, workspace_id)
 
 
 def consume_credits(
@@ -23,36 +171,172 @@ def consume_credits(
     conversation_id: str | None,
     message_id: str | None,
     credits: int,
+    reserved: bool = False,
 ) -> None:
+    if not reserved:
+        _run_reserve(workspace_id, credits, strict=False)
+    event = {
+        "workspace_id": workspace_id,
+        "agent_id": agent_id,
+        "conversation_id": conversation_id,
+        "message_id": message_id,
+        "credits": credits,
+    }
+    get_redis_client().rpush(LEDGER_KEY, json.dumps(event))
+
+
+def _apply_credits_used(workspace_id: str, delta: int, attempts: int = 5) -> bool:
+    redis = get_redis_client()
     supabase = get_supabase_client()
-    supabase.table("agent_credit_events").insert(
-        {
-            "workspace_id": workspace_id,
-            "agent_id": agent_id,
-            "conversation_id": conversation_id,
-            "message_id": message_id,
-            "credits": credits,
-            "direction": "debit",
+    cas_field = f"cas:{workspace_id}"
+    # The value a settler that died mid-step was writing, if any.
+    written = redis.hget(SETTLE_STATE_KEY, cas_field)
+    for _ in range(attempts):
+        current = (
+            supabase.table("workspace_credits")
+            .select("credits_used")
+            .eq("workspace_id", workspace_id)
+            .limit(1)
+            .execute()
+            .data
+        )
+        if not current:
+            return True
+        used = int(current[0].get("credits_used") or 0)
+        if written is not None and used == int(written):
+            return True
+        written = None
+        redis.hset(SETTLE_STATE_KEY, cas_field, used + delta)
+        # Compare-and-swap on the previous value: a concurrent writer (settler
+        # or billing reset) makes this match zero rows and we retry.
+        updated = (
+            supabase.table("workspace_credits")
+            .update({"credits_used": used + delta})
+            .eq("workspace_id", workspace_id)
+            .eq("credits_used", used)
+            .execute()
+            .data
+        )
+        if updated:
+            return True
+    return False
+
+
+def settle_credit_ledger(batch_size: int | None = None) -> dict:
+    redis = get_redis_client()
+    token = acquire_lock(SETTLE_LOCK_KEY, SETTLE_LOCK_SECONDS)
+    if not token:
+        return {"status": "locked", "events": 0}
+
+    def owns_lock() -> bool:
+        if renew_lock(SETTLE_LOCK_KEY, token, SETTLE_LOCK_SECONDS):
+            return True
+        logger.warning("credits_settle_lock_lost")
+        return False
+
+    try:
+        limit = batch_size or settings.credits_settle_batch_size
+        raw_items = redis.eval(_CLAIM_LEDGER_SCRIPT, 2, LEDGER_KEY, PROCESSING_KEY, limit) or []
+        events: list[dict] = []
+        for raw in raw_items:
+            try:
+                events.append(json.loads(raw))
+            except Exception:
+                continue
+        carry = {
+            workspace_id: int(delta)
+            for workspace_id, delta in (redis.hgetall(CARRY_KEY) or {}).items()
+            if int(delta)
         }
-    ).execute()
+        if not raw_items and not carry:
+            return {"status": "idle", "events": 0}
+        state = redis.hgetall(SETTLE_STATE_KEY) or {}
+        batch_id = state.get("batch")
+        if not batch_id:
+            batch_id = uuid4().hex
+            redis.hset(SETTLE_STATE_KEY, "batch", batch_id)
 
-    current = (
-        supabase.table("workspace_credits")
-        .select("credits_used")
-        .eq("workspace_id", workspace_id)
-        .single()
-        .execute()
-    )
-    used = int(current.data.get("credits_used") or 0) if current.data else 0
-    supabase.table("workspace_credits").update({"credits_used": used + credits}).eq(
-        "workspace_id", workspace_id
-    ).execute()
-
-    increment_agent_metrics(
-        agent_id,
-        workspace_id,
-        {
-            "credits_consumidos": credits,
-            "mensagens_enviadas": credits,
-        },
-    )
+        if events and not state.get("inserted"):
+            if not owns_lock():
+                return {"status": "lock_lost", "events": 0}
+            # Ids derived from the batch make a repeated insert a no-op.
+            get_supabase_client().table("agent_credit_events").upsert(
+                [
+                    {
+                        "id": str(uuid5(NAMESPACE_URL, f"credits:{batch_id}:{index}")),
+                        "workspace_id": event["workspace_id"],
+                        "agent_id": event.get("agent_id"),
+                        "conversation_id": event.get("conversation_id"),
+                        "message_id": event.get("message_id"),
+                        "credits": event["credits"],
+                        "direction": "debit",
+                    }
+                    for index, event in enumerate(events)
+                ],
+                on_conflict="id",
+                ignore_duplicates=True,
+            ).execute()
+            redis.hset(SETTLE_STATE_KEY, "inserted", 1)
+
+        event_deltas: dict[str, int] = defaultdict(int)
+        by_agent: dict[tuple[str, str], int] = defaultdict(int)
+        for event in events:
+            event_deltas[event["workspace_id"]] += int(event["credits"])
+            if event.get("agent_id"):
+                by_agent[(event["agent_id"], event["workspace_id"])] += int(event["credits"])
+
+        settled = 0
+        for workspace_id in sorted(set(event_deltas) | set(carry)):
+            applied_field = f"applied:{workspace_id}"
+            if state.get(applied_field):
+                continue
+            if not owns_lock():
+                return {"status": "lock_lost", "events": 0}
+            event_delta = event_deltas.get(workspace_id, 0)
+            carry_delta = carry.get(workspace_id, 0)
+            pipeline = redis.pipeline(transaction=True)
+            if _apply_credits_used(workspace_id, event_delta + carry_delta):
+                pipeline.hincrby(PENDING_KEY, workspace_id, -(event_delta + carry_delta))
+                if carry_delta:
+                    pipeline.hincrby(CARRY_KEY, workspace_id, -carry_delta)
+                settled += 1
+            else:
+                # Retried by the next run, together with that run's batch.
+                if event_delta:
+                    pipeline.hincrby(CARRY_KEY, workspace_id, event_delta)
+                logger.warning(
+                    "credits_settle_conflict workspace_id=%s delta=%s",
+                    workspace_id,
+                    event_delta + carry_delta,
+                )
+            pipeline.hset(SETTLE_STATE_KEY, applied_field, 1)
+            pipeline.hdel(SETTLE_STATE_KEY, f"cas:{workspace_id}")
+            pipeline.execute()
+
+        if by_agent and not state.get("metrics"):
+            pipeline = redis.pipeline(transaction=True)
+            for (agent_id, workspace_id), credits in by_agent.items():
+                increment_agent_metrics(
+                    agent_id,
+                    workspace_id,
+                    {
+                        "credits_consumidos": credits,
+                        "mensagens_enviadas": credits,
+                    },
+                    pipeline=pipeline,
+                )
+            pipeline.hset(SETTLE_STATE_KEY, "metrics", 1)
+            pipeline.execute()
+
+        pipeline = redis.pipeline(transaction=True)
+        pipeline.delete(PROCESSING_KEY, SETTLE_STATE_KEY)
+        pipeline.execute()
+
+        logger.info(
+            "credits_settled events=%s workspaces=%s",
+            len(events),
+            settled,
+        )
+        return {"status": "settled", "events": len(events), "workspaces": settled}
+    finally:
+        release_lock(SETTLE_LOCK_KEY, token)
@@ -2,6 +2,7 @@ from langchain_openai import OpenAIEmbeddings
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
 from app.config import settings
+from app.services.provider_health import ProviderTarget, call_provider
 
 _openai: OpenAIEmbeddings | None = None
 _gemini: GoogleGenerativeAIEmbeddings | None = None
@@ -21,17 +22,25 @@ def get_gemini_embeddings() -> GoogleGenerativeAIEmbeddings:
     return _gemini
 
 
+def _openai_target() -> ProviderTarget:
+    return ProviderTarget("openai", getattr(get_openai_embeddings(), "model", None) or "default", "embeddings")
+
+
+def _gemini_target() -> ProviderTarget:
+    return ProviderTarget("gemini", getattr(get_gemini_embeddings(), "model", None) or "default", "embeddings")
+
+
 def embed_texts_openai(texts: list[str]) -> list[list[float]]:
-    return get_openai_embeddings().embed_documents(texts)
+    return call_provider(_openai_target(), get_openai_embeddings().embed_documents, texts)
 
 
 def embed_query_openai(text: str) -> list[float]:
-    return get_openai_embeddings().embed_query(text)
+    return call_provider(_openai_target(), get_openai_embeddings().embed_query, text)
 
 
 def embed_texts_gemini(texts: list[str]) -> list[list[float]]:
-    return get_gemini_embeddings().embed_documents(texts)
+    return call_provider(_gemini_target(), get_gemini_embeddings().embed_documents, texts)
 
 
 def embed_query_gemini(text: str) -> list[float]:
-    return get_gemini_embeddings().embed_query(text)
+    return call_provider(_gemini_target(), get_gemini_embeddings().embed_query, text)
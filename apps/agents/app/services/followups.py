@@ -1,31 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
+import json
 import logging
+import threading
+import time
 
+from app.clients.redis_client import get_redis_client
 from app.clients.supabase import get_supabase_client
-from app.services.agent_runner import load_agent
-from app.services.conversation import get_messages, should_pause
-from app.services.consent import has_agent_consent
-from app.services.credits import consume_credits, get_remaining_credits
-from app.tools.inbox import create_agent_message, send_instagram_text, send_whatsapp_template, send_whatsapp_text
-from app.services.workspaces import is_workspace_not_expired
+from app.config import settings
+from app.services.agent_runner import load_agents
+from app.services.conversation import (
+    AUTHOR_STATE_COLUMNS,
+    get_author_timestamps,
+    should_pause,
+)
+from app.services.membership import Membership, get_memberships, pause_rules
+from app.services.consent import get_agents_with_consent
+from app.services.template_catalog import TemplateCatalog, get_template_catalogs, template_problem
+from app.services.credits import (
+    consume_credits,
+    get_remaining_credits_bulk,
+    release_credits,
+    reserve_credits,
+)
+from app.tools.inbox import (
+    _get_agent_instagram_credentials,
+    _get_agent_whatsapp_credentials,
+    create_agent_message,
+    send_instagram_text,
+    send_whatsapp_template,
+    send_whatsapp_text,
+)
+from app.services.workspaces import get_active_workspaces
 
 logger = logging.getLogger("uvicorn.error")
 
-
-def _resolve_provider(agent: dict) -> str:
-    integration_account_id = agent.get("integration_account_id")
-    if not integration_account_id:
-        return "whatsapp_oficial"
-    supabase = get_supabase_client()
-    account = (
-        supabase.table("integration_accounts")
-        .select("provider")
-        .eq("id", integration_account_id)
-        .single()
-        .execute()
-        .data
+FOLLOWUP_QUEUE_KEY = "followups:due"
+# Claimed followups, scored by the deadline for their acknowledgement.
+FOLLOWUP_PROCESSING_KEY = "followups:processing"
+# Failed batch runs per claimed followup; past FOLLOWUP_MAX_ATTEMPTS the
+# followup leaves the processing set for FOLLOWUP_DEAD_KEY (scored by the
+# time it was given up on) instead of being claimed again.
+FOLLOWUP_ATTEMPTS_KEY = "followups:attempts"
+FOLLOWUP_DEAD_KEY = "followups:dead"
+
+# Claims up to ARGV[2] followups at time ARGV[1], so concurrent workers never
+# get the same one: first those whose claim expired unacknowledged (the
+# worker died), then due ones. Each is moved to the processing set with a
+# deadline of ARGV[1] + ARGV[3] and stays there until ack_followups.
+_CLAIM_DUE_SCRIPT = """
+local limit = tonumber(ARGV[2])
+local deadline = tonumber(ARGV[1]) + tonumber(ARGV[3])
+local items = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, limit)
+if #items < limit then
+  local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, limit - #items)
+  if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+    for _, item in ipairs(due) do
+      table.insert(items, item)
+    end
+  end
+end
+for _, item in ipairs(items) do
+  redis.call('ZADD', KEYS[2], deadline, item)
+end
+return items
+"""
+
+
+@dataclass
+class FollowupPrefetch:
+    conversations: dict[str, dict] = field(default_factory=dict)
+    active_workspaces: set[str] = field(default_factory=set)
+    agents: dict[str, dict] = field(default_factory=dict)
+    providers: dict[str, str] = field(default_factory=dict)
+    consented_agents: set[str] = field(default_factory=set)
+    followups: dict[str, dict] = field(default_factory=dict)
+    catalogs: dict[str, TemplateCatalog] = field(default_factory=dict)
+    credits: dict[str, int] = field(default_factory=dict)
+    steps: dict[tuple[str, str], int] = field(default_factory=dict)
+    contacts: dict[str, dict] = field(default_factory=dict)
+    leads: dict[str, dict] = field(default_factory=dict)
+    states: dict[tuple[str, str], dict] = field(default_factory=dict)
+    authors: dict[tuple[str, str], dict] = field(default_factory=dict)
+    memberships: dict[tuple, Membership] = field(default_factory=dict)
+
+
+def _resolve_providers(agents: dict[str, dict]) -> dict[str, str]:
+    account_ids = sorted(
+        {agent["integration_account_id"] for agent in agents.values() if agent.get("integration_account_id")}
     )
-    return account.get("provider") if account and account.get("provider") else "whatsapp_oficial"
+    accounts: dict[str, str | None] = {}
+    if account_ids:
+        supabase = get_supabase_client()
+        rows = (
+            supabase.table("integration_accounts")
+            .select("id, provider")
+            .in_("id", account_ids)
+            .execute()
+            .data
+            or []
+        )
+        accounts = {row["id"]: row.get("provider") for row in rows}
+    return {
+        agent_id: accounts.get(agent.get("integration_account_id")) or "whatsapp_oficial"
+        for agent_id, agent in agents.items()
+    }
 
 
 def _agent_allows_groups(agent: dict) -> bool:
@@ -91,9 +172,8 @@ def _parse_datetime(value: str | None) -> datetime | None:
         return None
 
 
-def _is_outside_window(messages: list[dict]) -> bool:
-    last_contact = next((m for m in reversed(messages) if m.get("autor") == "contato"), None)
-    last_at = _parse_datetime(last_contact.get("created_at")) if last_contact else None
+def _is_outside_window(last_contact_at: str | None) -> bool:
+    last_at = _parse_datetime(last_contact_at)
     if not last_at:
         return False
     return datetime.now(timezone.utc) - last_at > timedelta(hours=24)
@@ -149,191 +229,226 @@ def schedule_followups(agent_id: str, conversation_id: str) -> dict | None:
     return followups[next_step]
 
 
-def run_followup(agent_id: str, conversation_id: str, followup_id: str) -> dict:
+def _select_in(table: str, columns: str, column: str, values: list[str]) -> list[dict]:
+    ids = sorted({value for value in values if value})
+    if not ids:
+        return []
     supabase = get_supabase_client()
+    return supabase.table(table).select(columns).in_(column, ids).execute().data or []
+
+
+def prefetch_followups(jobs: list[dict]) -> FollowupPrefetch:
+    data = FollowupPrefetch()
+    conversation_ids = [job["conversation_id"] for job in jobs]
+    agent_ids = [job["agent_id"] for job in jobs]
+
+    data.conversations = {
+        row["id"]: row
+        for row in _select_in(
+            "conversations",
+            "id, workspace_id, lead_id, contact_id, canal, modo_atendimento_humano, ultima_mensagem_em",
+            "id",
+            conversation_ids,
+        )
+    }
+    workspace_ids = [row.get("workspace_id") for row in data.conversations.values()]
+    data.active_workspaces = get_active_workspaces(workspace_ids)
+    data.credits = get_remaining_credits_bulk(list(data.active_workspaces))
+    data.agents = load_agents(agent_ids)
+    data.providers = _resolve_providers(data.agents)
+    data.consented_agents = get_agents_with_consent(list(data.agents))
+
+    data.followups = {
+        row["id"]: row
+        for row in _select_in(
+            "agent_followups",
+            "id, usar_template, template_id, mensagem_texto, somente_fora_janela",
+            "id",
+            [job["followup_id"] for job in jobs],
+        )
+    }
+    data.catalogs = get_template_catalogs(
+        [
+            row.get("workspace_id")
+            for row in data.conversations.values()
+            if row.get("workspace_id") in data.active_workspaces
+        ]
+    )
+    for row in _select_in(
+        "agent_conversation_state",
+        "agent_id, conversation_id, followup_step, " + ", ".join(AUTHOR_STATE_COLUMNS.values()),
+        "conversation_id",
+        conversation_ids,
+    ):
+        data.states[(row["agent_id"], row["conversation_id"])] = row
+        data.steps[(row["agent_id"], row["conversation_id"])] = int(row.get("followup_step") or 0)
+
+    data.contacts = {
+        row["id"]: row
+        for row in _select_in(
+            "contacts",
+            "id, telefone",
+            "id",
+            [row.get("contact_id") for row in data.conversations.values()],
+        )
+    }
+    data.leads = {
+        row["id"]: row
+        for row in _select_in(
+            "leads",
+            "id, whatsapp_wa_id, telefone",
+            "id",
+            [row.get("lead_id") for row in data.conversations.values()],
+        )
+    }
+
+    # Author timestamps come from the prefetched state rows; only jobs that
+    # survive the cheap shared checks and whose state is stale pay for a
+    # (narrow) history scan.
+    eligible = sorted(
+        {
+            (job["agent_id"], job["conversation_id"])
+            for job in jobs
+            if job["conversation_id"] in data.conversations
+            and data.conversations[job["conversation_id"]].get("workspace_id") in data.active_workspaces
+            and job["agent_id"] in data.agents
+            and job["agent_id"] in data.consented_agents
+        }
+    )
+    data.memberships = get_memberships(
+        sorted(
+            {
+                (
+                    data.conversations[conversation_id].get("contact_id"),
+                    data.conversations[conversation_id].get("lead_id"),
+                )
+                for agent_id, conversation_id in eligible
+                if pause_rules(data.agents[agent_id]).needs_membership
+            },
+            key=str,
+        )
+    )
+    limit = settings.followup_history_limit
+
+    def load_authors(key: tuple[str, str]) -> dict:
+        agent_id, conversation_id = key
+        return get_author_timestamps(
+            agent_id, data.conversations[conversation_id], data.states.get(key) or {}, limit
+        )
+
+    if len(eligible) == 1:
+        data.authors[eligible[0]] = load_authors(eligible[0])
+    elif eligible:
+        workers = min(len(eligible), settings.followup_send_concurrency)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            data.authors = dict(zip(eligible, executor.map(load_authors, eligible)))
+    return data
+
+
+def _resolve_followup_phone(conversation: dict, data: FollowupPrefetch) -> str | None:
+    canal = conversation.get("canal") or "whatsapp"
+    if canal == "instagram":
+        lead = data.leads.get(conversation.get("lead_id") or "")
+        return lead.get("whatsapp_wa_id") if lead else None
+    if conversation.get("contact_id"):
+        contact = data.contacts.get(conversation["contact_id"])
+        return contact.get("telefone") if contact else None
+    if conversation.get("lead_id"):
+        lead = data.leads.get(conversation["lead_id"])
+        return lead.get("telefone") if lead else None
+    return None
+
+
+def _skip(agent_id: str, conversation_id: str, reason: str, result: dict) -> tuple[dict, None]:
+    logger.info(
+        "followup_run_skipped agent_id=%s conversation_id=%s reason=%s",
+        agent_id,
+        conversation_id,
+        reason,
+    )
+    return result, None
+
+
+def _plan_followup(job: dict, data: FollowupPrefetch) -> tuple[dict | None, dict | None]:
+    agent_id = job["agent_id"]
+    conversation_id = job["conversation_id"]
+    followup_id = job["followup_id"]
     logger.info(
         "followup_run_start agent_id=%s conversation_id=%s followup_id=%s",
         agent_id,
         conversation_id,
         followup_id,
     )
-    conversation = (
-        supabase.table("conversations")
-        .select("id, workspace_id, lead_id, contact_id, canal, modo_atendimento_humano")
-        .eq("id", conversation_id)
-        .single()
-        .execute()
-        .data
-    )
+    conversation = data.conversations.get(conversation_id)
     if not conversation:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=missing_conversation",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "missing_conversation"}
+        return _skip(agent_id, conversation_id, "missing_conversation", {"status": "missing_conversation"})
 
-    if not is_workspace_not_expired(conversation.get("workspace_id")):
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=trial_expired",
-            agent_id,
-            conversation_id,
+    if conversation.get("workspace_id") not in data.active_workspaces:
+        return _skip(
+            agent_id, conversation_id, "trial_expired", {"status": "blocked", "reason": "trial_expired"}
         )
-        return {"status": "blocked", "reason": "trial_expired"}
 
-    agent = load_agent(agent_id)
+    agent = data.agents.get(agent_id)
     if not agent:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=missing_agent",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "missing_agent"}
-    provider = _resolve_provider(agent)
-
-    if not has_agent_consent(agent_id):
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=no_consent",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "no_consent"}
-
-    messages = get_messages(conversation_id)
-    paused, _ = should_pause(agent, conversation, messages)
+        return _skip(agent_id, conversation_id, "missing_agent", {"status": "missing_agent"})
+    provider = data.providers.get(agent_id) or "whatsapp_oficial"
+
+    if agent_id not in data.consented_agents:
+        return _skip(agent_id, conversation_id, "no_consent", {"status": "no_consent"})
+
+    authors = data.authors.get((agent_id, conversation_id)) or {}
+    paused, _ = should_pause(
+        agent,
+        conversation,
+        authors.get("ultimo_autor"),
+        data.memberships.get((conversation.get("contact_id"), conversation.get("lead_id"))),
+    )
     if paused:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=paused",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "paused"}
+        return _skip(agent_id, conversation_id, "paused", {"status": "paused"})
 
-    if get_remaining_credits(conversation["workspace_id"]) <= 0:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=no_credits",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "no_credits"}
+    workspace_id = conversation["workspace_id"]
+    if data.credits.get(workspace_id, 0) <= 0:
+        return _skip(agent_id, conversation_id, "no_credits", {"status": "no_credits"})
 
-    outside_window = _is_outside_window(messages)
+    outside_window = _is_outside_window(authors.get("contato"))
     if provider == "whatsapp_baileys":
         outside_window = False
     elif provider == "whatsapp_nao_oficial":
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=provider_disabled",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "provider_disabled"}
+        return _skip(agent_id, conversation_id, "provider_disabled", {"status": "provider_disabled"})
 
-    last_user = next((m for m in reversed(messages) if m.get("autor") == "contato"), None)
-    last_agent = next((m for m in reversed(messages) if m.get("autor") == "agente"), None)
-    if last_user and last_agent:
-        try:
-            last_user_at = datetime.fromisoformat(last_user.get("created_at").replace("Z", "+00:00"))
-            last_agent_at = datetime.fromisoformat(last_agent.get("created_at").replace("Z", "+00:00"))
-            if last_user_at > last_agent_at:
-                logger.info(
-                    "followup_run_skipped agent_id=%s conversation_id=%s reason=new_user_message",
-                    agent_id,
-                    conversation_id,
-                )
-                return {"status": "skipped_human"}
-        except Exception:
-            pass
+    last_user_at = _parse_datetime(authors.get("contato"))
+    last_agent_at = _parse_datetime(authors.get("agente"))
+    if last_user_at and last_agent_at and last_user_at > last_agent_at:
+        return _skip(agent_id, conversation_id, "new_user_message", {"status": "skipped_human"})
 
-    followup = (
-        supabase.table("agent_followups")
-        .select("id, usar_template, template_id, mensagem_texto, somente_fora_janela")
-        .eq("id", followup_id)
-        .single()
-        .execute()
-        .data
-    )
+    followup = data.followups.get(followup_id)
     if not followup:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=missing_followup",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "missing_followup"}
+        return _skip(agent_id, conversation_id, "missing_followup", {"status": "missing_followup"})
 
     if followup.get("somente_fora_janela") and not outside_window:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=within_window",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "within_window"}
+        return _skip(agent_id, conversation_id, "within_window", {"status": "within_window"})
 
     canal = conversation.get("canal") or "whatsapp"
-    phone = None
-    if canal == "instagram":
-        if conversation.get("lead_id"):
-            lead = (
-                supabase.table("leads")
-                .select("whatsapp_wa_id, telefone")
-                .eq("id", conversation["lead_id"])
-                .single()
-                .execute()
-                .data
-            )
-            phone = lead.get("whatsapp_wa_id") if lead else None
-    else:
-        if conversation.get("contact_id"):
-            contact = (
-                supabase.table("contacts")
-                .select("telefone")
-                .eq("id", conversation["contact_id"])
-                .single()
-                .execute()
-                .data
-            )
-            phone = contact.get("telefone") if contact else None
-        elif conversation.get("lead_id"):
-            lead = (
-                supabase.table("leads")
-                .select("telefone")
-                .eq("id", conversation["lead_id"])
-                .single()
-                .execute()
-                .data
-            )
-            phone = lead.get("telefone") if lead else None
-
+    phone = _resolve_followup_phone(conversation, data)
     if not phone:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=missing_phone",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "missing_phone"}
+        return _skip(agent_id, conversation_id, "missing_phone", {"status": "missing_phone"})
 
     if canal == "whatsapp" and _is_group_chat(phone):
-        if provider != "whatsapp_baileys":
-            logger.info(
-                "followup_run_skipped agent_id=%s conversation_id=%s reason=group_disabled",
+        if provider != "whatsapp_baileys" or not _agent_allows_groups(agent):
+            return _skip(
                 agent_id,
                 conversation_id,
+                "group_disabled",
+                {"status": "skipped_group", "reason": "group_disabled"},
             )
-            return {"status": "skipped_group", "reason": "group_disabled"}
-        if not _agent_allows_groups(agent):
-            logger.info(
-                "followup_run_skipped agent_id=%s conversation_id=%s reason=group_disabled",
-                agent_id,
-                conversation_id,
-            )
-            return {"status": "skipped_group", "reason": "group_disabled"}
         allowlist = _agent_group_allowlist(agent)
         if allowlist is not None and phone not in allowlist:
-            logger.info(
-                "followup_run_skipped agent_id=%s conversation_id=%s reason=group_not_allowed",
+            return _skip(
                 agent_id,
                 conversation_id,
+                "group_not_allowed",
+                {"status": "skipped_group", "reason": "group_not_allowed"},
             )
-            return {"status": "skipped_group", "reason": "group_not_allowed"}
 
     if (
         canal == "whatsapp"
@@ -342,95 +457,98 @@ def run_followup(agent_id: str, conversation_id: str, followup_id: str) -> dict:
         and followup.get("usar_template")
         and provider == "whatsapp_oficial"
     ):
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=template_required",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "template_required"}
+        return _skip(agent_id, conversation_id, "template_required", {"status": "template_required"})
 
+    text = followup.get("mensagem_texto")
+    plan: dict = {"canal": canal, "phone": phone, "workspace_id": workspace_id}
     if canal == "instagram":
         if outside_window:
-            logger.info(
-                "followup_run_skipped agent_id=%s conversation_id=%s reason=window_expired_instagram",
-                agent_id,
-                conversation_id,
+            return _skip(
+                agent_id, conversation_id, "window_expired_instagram", {"status": "window_expired_no_template"}
             )
-            return {"status": "window_expired_no_template"}
-        if followup.get("mensagem_texto"):
-            send_instagram_text(agent_id, phone, followup["mensagem_texto"])
-            create_agent_message(
-                conversation["workspace_id"],
-                conversation_id,
-                followup["mensagem_texto"],
-                "texto",
-            )
-        else:
-            logger.info(
-                "followup_run_skipped agent_id=%s conversation_id=%s reason=missing_followup_text",
-                agent_id,
-                conversation_id,
-            )
-            return {"status": "missing_followup_text"}
+        if not text:
+            return _skip(agent_id, conversation_id, "missing_followup_text", {"status": "missing_followup_text"})
+        plan.update({"kind": "instagram_text", "text": text})
     elif provider == "whatsapp_baileys":
-        if followup.get("mensagem_texto"):
-            send_whatsapp_text(agent_id, phone, followup["mensagem_texto"])
-            create_agent_message(
-                conversation["workspace_id"],
-                conversation_id,
-                followup["mensagem_texto"],
-                "texto",
-            )
-        else:
-            logger.info(
-                "followup_run_skipped agent_id=%s conversation_id=%s reason=missing_followup_text",
-                agent_id,
-                conversation_id,
-            )
-            return {"status": "missing_followup_text"}
-    elif provider == "whatsapp_nao_oficial":
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=provider_disabled",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "provider_disabled"}
+        if not text:
+            return _skip(agent_id, conversation_id, "missing_followup_text", {"status": "missing_followup_text"})
+        plan.update({"kind": "whatsapp_text", "text": text})
     elif followup.get("usar_template") and followup.get("template_id"):
-        template = (
-            supabase.table("whatsapp_templates")
-            .select("nome, idioma")
-            .eq("id", followup["template_id"])
-            .single()
-            .execute()
-            .data
+        catalog = data.catalogs.get(workspace_id) or TemplateCatalog()
+        template = catalog.by_id.get(str(followup["template_id"]))
+        problem = template_problem(template)
+        if problem:
+            return _skip(agent_id, conversation_id, problem, {"status": "template_unavailable", "reason": problem})
+        plan.update({"kind": "template", "template": template})
+    elif text and not outside_window:
+        plan.update({"kind": "whatsapp_text", "text": text})
+    elif text and outside_window:
+        return _skip(
+            agent_id, conversation_id, "window_expired_no_template", {"status": "window_expired_no_template"}
         )
-        if template:
-            send_whatsapp_template(agent_id, phone, template["nome"], template["idioma"])
-            create_agent_message(conversation["workspace_id"], conversation_id, f"Template follow-up: {template['nome']}", "texto")
-    elif followup.get("mensagem_texto") and not outside_window:
-        send_whatsapp_text(agent_id, phone, followup["mensagem_texto"])
-        create_agent_message(conversation["workspace_id"], conversation_id, followup["mensagem_texto"], "texto")
-    elif followup.get("mensagem_texto") and outside_window:
-        logger.info(
-            "followup_run_skipped agent_id=%s conversation_id=%s reason=window_expired_no_template",
-            agent_id,
-            conversation_id,
-        )
-        return {"status": "window_expired_no_template"}
+    else:
+        plan["kind"] = "none"
+
+    data.credits[workspace_id] = data.credits.get(workspace_id, 0) - 1
+    return None, plan
+
+
+def _send_followup(job: dict, plan: dict, credentials=None) -> dict | None:
+    agent_id = job["agent_id"]
+    conversation_id = job["conversation_id"]
+    workspace_id = plan["workspace_id"]
+    kind = plan["kind"]
+    # The prefetched balance is only a hint; the reservation is what keeps
+    # concurrent batches from overspending the same workspace.
+    if not reserve_credits(workspace_id, 1):
+        result, _ = _skip(agent_id, conversation_id, "no_credits", {"status": "no_credits"})
+        return result
+    try:
+        if kind == "instagram_text":
+            send_instagram_text(agent_id, plan["phone"], plan["text"], credentials=credentials)
+            create_agent_message(workspace_id, conversation_id, plan["text"], "texto")
+        elif kind == "whatsapp_text":
+            send_whatsapp_text(agent_id, plan["phone"], plan["text"], credentials=credentials)
+            create_agent_message(workspace_id, conversation_id, plan["text"], "texto")
+        elif kind == "template" and plan.get("template"):
+            template = plan["template"]
+            send_whatsapp_template(
+                agent_id, plan["phone"], template["nome"], template["idioma"], credentials=credentials
+            )
+            create_agent_message(
+                workspace_id, conversation_id, f"Template follow-up: {template['nome']}", "texto"
+            )
+    except Exception:
+        release_credits(workspace_id, 1)
+        raise
 
-    consume_credits(conversation["workspace_id"], agent_id, conversation_id, None, 1)
+    consume_credits(workspace_id, agent_id, conversation_id, None, 1, reserved=True)
+    return None
 
-    state = _get_followup_state(agent_id, conversation_id) or {}
-    next_step = int(state.get("followup_step") or 0) + 1
 
-    supabase.table("agent_conversation_state").upsert(
-        {
-            "agent_id": agent_id,
-            "conversation_id": conversation_id,
-            "workspace_id": conversation["workspace_id"],
-            "followup_step": next_step,
-            "followup_at": datetime.now(timezone.utc).isoformat(),
-        },
+def _followup_state_row(job: dict, plan: dict, data: FollowupPrefetch) -> dict:
+    step = data.steps.get((job["agent_id"], job["conversation_id"]), 0)
+    return {
+        "agent_id": job["agent_id"],
+        "conversation_id": job["conversation_id"],
+        "workspace_id": plan["workspace_id"],
+        "followup_step": step + 1,
+        "followup_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def run_followup(agent_id: str, conversation_id: str, followup_id: str) -> dict:
+    job = {"agent_id": agent_id, "conversation_id": conversation_id, "followup_id": followup_id}
+    data = prefetch_followups([job])
+    result, plan = _plan_followup(job, data)
+    if result is not None:
+        return result
+
+    skipped = _send_followup(job, plan)
+    if skipped is not None:
+        return skipped
+    get_supabase_client().table("agent_conversation_state").upsert(
+        _followup_state_row(job, plan, data),
         on_conflict="agent_id,conversation_id",
     ).execute()
 
@@ -441,3 +559,196 @@ def run_followup(agent_id: str, conversation_id: str, followup_id: str) -> dict:
         followup_id,
     )
     return {"status": "sent"}
+
+
+def _queue_member(job: dict) -> str:
+    return json.dumps(
+        {
+            "agent_id": job["agent_id"],
+            "conversation_id": job["conversation_id"],
+            "followup_id": job["followup_id"],
+        },
+        sort_keys=True,
+    )
+
+
+def enqueue_followup(agent_id: str, conversation_id: str, followup_id: str, countdown: int) -> None:
+    redis = get_redis_client()
+    member = _queue_member(
+        {"agent_id": agent_id, "conversation_id": conversation_id, "followup_id": followup_id}
+    )
+    redis.zadd(FOLLOWUP_QUEUE_KEY, {member: time.time() + max(countdown, 0)})
+
+
+def claim_due_followups(limit: int) -> list[dict]:
+    """Claims due followups for FOLLOWUP_CLAIM_VISIBILITY_SECONDS. Jobs not
+    passed to ack_followups by then are claimed again by a later call."""
+    redis = get_redis_client()
+    raw_items = (
+        redis.eval(
+            _CLAIM_DUE_SCRIPT,
+            2,
+            FOLLOWUP_QUEUE_KEY,
+            FOLLOWUP_PROCESSING_KEY,
+            time.time(),
+            limit,
+            settings.followup_claim_visibility_seconds,
+        )
+        or []
+    )
+    jobs: list[dict] = []
+    invalid: list[str] = []
+    for raw in raw_items:
+        try:
+            item = json.loads(raw)
+        except Exception:
+            invalid.append(raw)
+            continue
+        if isinstance(item, dict) and item.get("agent_id") and item.get("conversation_id") and item.get("followup_id"):
+            jobs.append(item)
+        else:
+            invalid.append(raw)
+    if invalid:
+        redis.zrem(FOLLOWUP_PROCESSING_KEY, *invalid)
+    return jobs
+
+
+def ack_followups(jobs: list[dict]) -> None:
+    if jobs:
+        members = [_queue_member(job) for job in jobs]
+        pipeline = get_redis_client().pipeline(transaction=True)
+        pipeline.zrem(FOLLOWUP_PROCESSING_KEY, *members)
+        pipeline.hdel(FOLLOWUP_ATTEMPTS_KEY, *members)
+        pipeline.execute()
+
+
+def fail_followups(jobs: list[dict]) -> list[dict]:
+    """Counts a failed run for followups whose batch failed as a whole. They
+    stay claimed, so they are retried once the claim expires; those that
+    reached FOLLOWUP_MAX_ATTEMPTS are moved to the dead-letter set and
+    returned."""
+    if not jobs:
+        return []
+    redis = get_redis_client()
+    members = [_queue_member(job) for job in jobs]
+    pipeline = redis.pipeline(transaction=False)
+    for member in members:
+        pipeline.hincrby(FOLLOWUP_ATTEMPTS_KEY, member, 1)
+    attempts = pipeline.execute()
+    max_attempts = max(settings.followup_max_attempts, 1)
+    dead = [index for index, count in enumerate(attempts) if int(count) >= max_attempts]
+    if not dead:
+        return []
+    dead_members = [members[index] for index in dead]
+    now = time.time()
+    pipeline = redis.pipeline(transaction=True)
+    pipeline.zrem(FOLLOWUP_PROCESSING_KEY, *dead_members)
+    pipeline.zadd(FOLLOWUP_DEAD_KEY, {member: now for member in dead_members})
+    pipeline.hdel(FOLLOWUP_ATTEMPTS_KEY, *dead_members)
+    pipeline.execute()
+    logger.warning("followups_dead_lettered count=%s attempts=%s", len(dead_members), max_attempts)
+    return [jobs[index] for index in dead]
+
+
+def _load_send_credentials(jobs_with_plans: list[tuple[dict, dict]]) -> dict[tuple[str, str], object]:
+    credentials: dict[tuple[str, str], object] = {}
+    for job, plan in jobs_with_plans:
+        key = (job["agent_id"], "instagram" if plan["canal"] == "instagram" else "whatsapp")
+        if key in credentials or plan["kind"] == "none":
+            continue
+        try:
+            if key[1] == "instagram":
+                credentials[key] = _get_agent_instagram_credentials(job["agent_id"])
+            else:
+                credentials[key] = _get_agent_whatsapp_credentials(job["agent_id"])
+        except Exception as error:
+            credentials[key] = error
+    return credentials
+
+
+def run_followups_batch(jobs: list[dict]) -> list[dict]:
+    if not jobs:
+        return []
+    started = time.monotonic()
+    data = prefetch_followups(jobs)
+
+    results: list[dict | None] = [None] * len(jobs)
+    planned: list[tuple[int, dict, dict]] = []
+    for index, job in enumerate(jobs):
+        try:
+            result, plan = _plan_followup(job, data)
+        except Exception as error:
+            logger.exception(
+                "followup_run_failed agent_id=%s conversation_id=%s stage=plan",
+                job["agent_id"],
+                job["conversation_id"],
+            )
+            result, plan = {"status": "error", "reason": str(error)}, None
+        if result is not None:
+            results[index] = result
+        else:
+            planned.append((index, job, plan))
+
+    credentials = _load_send_credentials([(job, plan) for _, job, plan in planned])
+    semaphores: dict[str, threading.BoundedSemaphore] = {}
+    for _, job, _ in planned:
+        account_key = data.agents[job["agent_id"]].get("integration_account_id") or job["agent_id"]
+        semaphores.setdefault(
+            account_key, threading.BoundedSemaphore(max(1, settings.followup_account_concurrency))
+        )
+
+    # Keyed by (agent_id, conversation_id): one upsert cannot touch a row twice.
+    state_rows: dict[tuple[str, str], dict] = {}
+    state_lock = threading.Lock()
+
+    def send(index: int, job: dict, plan: dict) -> None:
+        channel = "instagram" if plan["canal"] == "instagram" else "whatsapp"
+        job_credentials = credentials.get((job["agent_id"], channel))
+        if isinstance(job_credentials, Exception):
+            results[index] = {"status": "error", "reason": str(job_credentials)}
+            return
+        account_key = data.agents[job["agent_id"]].get("integration_account_id") or job["agent_id"]
+        try:
+            with semaphores[account_key]:
+                skipped = _send_followup(job, plan, job_credentials)
+        except Exception as error:
+            logger.exception(
+                "followup_run_failed agent_id=%s conversation_id=%s stage=send",
+                job["agent_id"],
+                job["conversation_id"],
+            )
+            results[index] = {"status": "error", "reason": str(error)}
+            return
+        if skipped is not None:
+            results[index] = skipped
+            return
+        with state_lock:
+            state_rows[(job["agent_id"], job["conversation_id"])] = _followup_state_row(job, plan, data)
+        logger.info(
+            "followup_run_sent agent_id=%s conversation_id=%s followup_id=%s",
+            job["agent_id"],
+            job["conversation_id"],
+            job["followup_id"],
+        )
+        results[index] = {"status": "sent"}
+
+    if planned:
+        workers = max(1, min(len(planned), settings.followup_send_concurrency))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(send, index, job, plan) for index, job, plan in planned]:
+                future.result()
+
+    if state_rows:
+        get_supabase_client().table("agent_conversation_state").upsert(
+            list(state_rows.values()),
+            on_conflict="agent_id,conversation_id",
+        ).execute()
+
+    logger.info(
+        "followup_batch_done jobs=%s planned=%s sent=%s duration_ms=%s",
+        len(jobs),
+        len(planned),
+        sum(1 for result in results if result and result.get("status") == "sent"),
+        int((time.monotonic() - started) * 1000),
+    )
+    return [result or {"status": "error"} for result in results]
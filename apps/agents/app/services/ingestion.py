@@ -0,0 +1,552 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+import logging
+import mimetypes
+from pathlib import Path
+import threading
+from typing import Any, Callable
+
+import httpx
+
+from app.clients.r2_client import build_r2_key, get_r2_client
+from app.clients.supabase import get_supabase_client
+from app.clients.whatsapp_client import download_media, fetch_media_metadata
+from app.config import settings
+from app.services.message_store import message_row, upsert_messages
+from app.services.realtime import (
+    emit_attachment_created,
+    emit_conversation_updated,
+    emit_message_created,
+)
+from app.services.workspaces import get_active_workspaces
+
+logger = logging.getLogger("uvicorn.error")
+
+# Inbound messages from WhatsApp Cloud, Instagram and UAZAPI share one
+# pipeline. Each provider module is an adapter that turns its webhook payload
+# into InboundMessage records; ingest() then writes leads, conversations and
+# messages with one bulk call each, publishes realtime events once per
+# message and conversation, and downloads media concurrently (or hands it to
+# a worker) with a single attachments insert.
+LEAD_CONFLICT = "workspace_id,whatsapp_wa_id"
+CONVERSATION_CONFLICT = "workspace_id,lead_id,canal,integration_account_id"
+EXTENSION_FALLBACKS = {
+    "imagem": ".jpg",
+    "image": ".jpg",
+    "video": ".mp4",
+    "audio": ".mp3",
+    "pdf": ".pdf",
+    "file": ".pdf",
+    "document": ".pdf",
+}
+
+_http_client: httpx.Client | None = None
+_http_client_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Channel:
+    canal: str
+    canal_origem: str
+    # Lead columns the provider knows about; the others are left untouched.
+    lead_columns: tuple[str, ...] = ()
+
+
+WHATSAPP_CLOUD = Channel("whatsapp", "whatsapp", ("nome", "telefone"))
+INSTAGRAM = Channel("instagram", "instagram")
+UAZAPI = Channel("whatsapp", "whatsapp", ("nome", "telefone", "avatar_url"))
+
+
+@dataclass(frozen=True)
+class MediaRef:
+    tipo: str
+    media_id: str | None = None
+    url: str | None = None
+    filename: str | None = None
+    fallback_type: str = ""
+    # Appended to the message row id in the storage path.
+    path_tag: str = ""
+    # Send the account token with a URL download.
+    authorized: bool = False
+
+
+@dataclass(frozen=True)
+class InboundMessage:
+    workspace_id: str
+    integration_id: str | None
+    integration_account_id: str | None
+    lead_key: str
+    message_id: str | None
+    author: str
+    tipo: str
+    conteudo: str
+    created_at: str
+    lead_name: str | None = None
+    lead_phone: str | None = None
+    lead_avatar_url: str | None = None
+    sender_id: str | None = None
+    sender_name: str | None = None
+    sender_avatar_url: str | None = None
+    media: tuple[MediaRef, ...] = ()
+
+
+@dataclass(frozen=True)
+class MediaJob:
+    workspace_id: str
+    conversation_id: str
+    message_row_id: str
+    integration_id: str | None
+    integration_account_id: str | None
+    media: MediaRef
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MediaJob":
+        return cls(**{**data, "media": MediaRef(**data["media"])})
+
+
+@dataclass
+class InboundBatch:
+    records: list[InboundMessage] = field(default_factory=list)
+    integration_id: str | None = None
+    workspace_id: str | None = None
+    integration_account_id: str | None = None
+
+
+@dataclass
+class IngestResult:
+    conversation_ids: list[str] = field(default_factory=list)
+    message_ids: list[str | None] = field(default_factory=list)
+    media: list[MediaJob] = field(default_factory=list)
+    blocked: bool = False
+
+
+def parse_timestamp(value: Any) -> str:
+    """ISO timestamp from epoch seconds or milliseconds; now when missing."""
+    if value:
+        try:
+            seconds = int(value)
+            if seconds > 1_000_000_000_000:
+                seconds = int(seconds / 1000)
+            return datetime.fromtimestamp(seconds, tz=timezone.utc).isoformat()
+        except Exception:
+            pass
+    return datetime.now(timezone.utc).isoformat()
+
+
+def resolve_extension(mime_type: str | None, filename: str | None, fallback_type: str) -> str:
+    if filename:
+        suffix = Path(filename).suffix
+        if suffix:
+            return suffix
+    if mime_type:
+        guess = mimetypes.guess_extension(mime_type)
+        if guess:
+            return guess
+    return EXTENSION_FALLBACKS.get(fallback_type, ".bin")
+
+
+def account_workspace_id(integration_account: dict) -> str | None:
+    integrations = integration_account.get("integrations") or {}
+    if isinstance(integrations, list):
+        return integrations[0].get("workspace_id") if integrations else None
+    return integrations.get("workspace_id")
+
+
+def get_integration_token(
+    integration_id: str | None,
+    integration_account_id: str | None,
+) -> str | None:
+    if not integration_id and not integration_account_id:
+        return None
+    supabase = get_supabase_client()
+    if integration_account_id:
+        data = (
+            supabase.table("integration_tokens")
+            .select("access_token")
+            .eq("integration_account_id", integration_account_id)
+            .limit(1)
+            .execute()
+            .data
+            or []
+        )
+        if data:
+            return data[0].get("access_token")
+    if not integration_id:
+        return None
+    data = (
+        supabase.table("integration_tokens")
+        .select("access_token")
+        .eq("integration_id", integration_id)
+        .limit(1)
+        .execute()
+        .data
+        or []
+    )
+    return data[0].get("access_token") if data else None
+
+
+def find_active_agent(workspace_id: str, integration_account_id: str) -> str | None:
+    supabase = get_supabase_client()
+    data = (
+        supabase.table("agents")
+        .select("id")
+        .eq("workspace_id", workspace_id)
+        .eq("integration_account_id", integration_account_id)
+        .eq("status", "ativo")
+        .limit(1)
+        .execute()
+        .data
+        or []
+    )
+    return data[0]["id"] if data else None
+
+
+def dispatch_agents(
+    workspace_id: str | None,
+    integration_account_id: str | None,
+    conversation_ids: list[str],
+    enqueue: Callable[[str, str], Any],
+) -> str | None:
+    """Hands every conversation to the account's active agent; returns the
+    agent id, or None when there is nothing to run."""
+    if not workspace_id or not integration_account_id or not conversation_ids:
+        return None
+    agent_id = find_active_agent(workspace_id, integration_account_id)
+    if not agent_id:
+        return None
+    for conversation_id in conversation_ids:
+        enqueue(agent_id, conversation_id)
+    return agent_id
+
+
+def _upsert_leads(channel: Channel, records: list[InboundMessage]) -> dict[tuple[str, str], str]:
+    rows: dict[tuple[str, str], dict] = {}
+    for record in records:
+        known = {"nome": record.lead_name, "telefone": record.lead_phone, "avatar_url": record.lead_avatar_url}
+        row = {
+            "workspace_id": record.workspace_id,
+            "whatsapp_wa_id": record.lead_key,
+            "canal_origem": channel.canal_origem,
+            "status": "novo",
+        }
+        row.update({column: known[column] for column in channel.lead_columns})
+        # The latest message of a lead carries the freshest profile.
+        rows[(record.workspace_id, record.lead_key)] = row
+
+    supabase = get_supabase_client()
+    try:
+        data = supabase.table("leads").upsert(list(rows.values()), on_conflict=LEAD_CONFLICT).execute().data
+    except Exception as error:
+        # Databases without leads.avatar_url still accept the lead; any other
+        # failure is not retried.
+        if "avatar_url" not in channel.lead_columns or "avatar_url" not in str(error):
+            raise
+        for row in rows.values():
+            row.pop("avatar_url", None)
+        data = supabase.table("leads").upsert(list(rows.values()), on_conflict=LEAD_CONFLICT).execute().data
+    return {(row["workspace_id"], row["whatsapp_wa_id"]): row["id"] for row in data or []}
+
+
+def _upsert_conversations(
+    channel: Channel,
+    records: list[InboundMessage],
+    lead_ids: dict[tuple[str, str], str],
+) -> tuple[list[tuple], dict[tuple, dict]]:
+    """Conversation keys per record and the upserted rows by key; a
+    conversation's last message is the latest record in delivery order."""
+    keys = [
+        (record.workspace_id, lead_ids[(record.workspace_id, record.lead_key)], record.integration_account_id)
+        for record in records
+    ]
+    latest = dict(zip(keys, records))
+    rows = [
+        {
+            "workspace_id": workspace_id,
+            "lead_id": lead_id,
+            "integration_account_id": integration_account_id,
+            "canal": channel.canal,
+            "status": "aberta",
+            "ultima_mensagem": record.conteudo,
+            "ultima_mensagem_em": record.created_at,
+        }
+        for (workspace_id, lead_id, integration_account_id), record in latest.items()
+    ]
+    supabase = get_supabase_client()
+    data = supabase.table("conversations").upsert(rows, on_conflict=CONVERSATION_CONFLICT).execute().data or []
+    conversations = {
+        (row["workspace_id"], row["lead_id"], row.get("integration_account_id")): row for row in data
+    }
+    return keys, conversations
+
+
+def ingest(
+    channel: Channel,
+    records: list[InboundMessage],
+    process_media: bool = True,
+    notify: bool = True,
+    check_workspaces: bool = True,
+) -> IngestResult:
+    """Persists the records of one delivery. Records of expired workspaces
+    are dropped and reported as blocked. Without process_media the media is
+    returned as jobs for store_media instead of being downloaded here."""
+    result = IngestResult()
+    if not records:
+        return result
+    accepted = records
+    if check_workspaces:
+        active = get_active_workspaces([record.workspace_id for record in records])
+        accepted = [record for record in records if record.workspace_id in active]
+    result.blocked = len(accepted) < len(records)
+    if not accepted:
+        return result
+
+    lead_ids = _upsert_leads(channel, accepted)
+    keys, conversations = _upsert_conversations(channel, accepted, lead_ids)
+    conversation_ids = [conversations[key]["id"] for key in keys]
+    result.conversation_ids = list(dict.fromkeys(conversation_ids))
+    result.message_ids = upsert_messages(
+        [
+            message_row(
+                workspace_id=record.workspace_id,
+                conversation_id=conversation_id,
+                message_id=record.message_id,
+                author=record.author,
+                message_type=record.tipo,
+                content=record.conteudo,
+                created_at=record.created_at,
+                sender_id=record.sender_id,
+                sender_name=record.sender_name,
+                sender_avatar_url=record.sender_avatar_url,
+            )
+            for record, conversation_id in zip(accepted, conversation_ids)
+        ]
+    )
+
+    if notify:
+        updated: dict[str, InboundMessage] = {}
+        for record, conversation_id, message_row_id in zip(accepted, conversation_ids, result.message_ids):
+            if not message_row_id:
+                continue
+            emit_message_created(
+                record.workspace_id,
+                conversation_id,
+                {
+                    "id": message_row_id,
+                    "autor": record.author,
+                    "tipo": record.tipo,
+                    "conteudo": record.conteudo,
+                    "created_at": record.created_at,
+                    "sender_id": record.sender_id,
+                    "sender_nome": record.sender_name,
+                },
+            )
+            updated[conversation_id] = record
+        for key in dict.fromkeys(keys):
+            conversation = conversations[key]
+            record = updated.get(conversation["id"])
+            if record:
+                emit_conversation_updated(
+                    record.workspace_id,
+                    conversation["id"],
+                    {
+                        "status": conversation.get("status", "aberta"),
+                        "ultima_mensagem": record.conteudo,
+                        "ultima_mensagem_em": record.created_at,
+                    },
+                )
+
+    jobs = [
+        MediaJob(
+            workspace_id=record.workspace_id,
+            conversation_id=conversation_id,
+            message_row_id=message_row_id,
+            integration_id=record.integration_id,
+            integration_account_id=record.integration_account_id,
+            media=media,
+        )
+        for record, conversation_id, message_row_id in zip(accepted, conversation_ids, result.message_ids)
+        if message_row_id
+        for media in record.media
+    ]
+    if process_media:
+        store_media(jobs, notify=notify)
+    else:
+        result.media = jobs
+    return result
+
+
+def _get_http_client() -> httpx.Client:
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(timeout=30)
+    return _http_client
+
+
+def _storage_prefix(job: MediaJob) -> str:
+    return f"{job.workspace_id}/{job.conversation_id}/{job.message_row_id}{job.media.path_tag}"
+
+
+def _download(job: MediaJob, access_token: str | None) -> tuple[bytes, str | None, int | None]:
+    media = job.media
+    if media.media_id:
+        if not access_token:
+            raise ValueError("Missing access token for media download")
+        metadata = fetch_media_metadata(access_token, media.media_id)
+        if not metadata.get("url"):
+            raise ValueError("Media has no download URL")
+        content = download_media(access_token, metadata["url"])
+        file_size = metadata.get("file_size")
+        return content, metadata.get("mime_type"), int(file_size) if file_size else None
+    headers = {"Authorization": f"Bearer {access_token}"} if media.authorized and access_token else None
+    response = _get_http_client().get(media.url or "", headers=headers)
+    response.raise_for_status()
+    return response.content, response.headers.get("content-type"), None
+
+
+def _upload(job: MediaJob, access_token: str | None) -> dict:
+    content, mime_type, file_size = _download(job, access_token)
+    extension = resolve_extension(mime_type, job.media.filename, job.media.fallback_type or job.media.tipo)
+    storage_path = f"{_storage_prefix(job)}{extension}"
+    get_r2_client().put_object(
+        Bucket=settings.r2_bucket_inbox_attachments,
+        Key=build_r2_key("inbox-attachments", storage_path),
+        Body=content,
+        ContentType=mime_type or "application/octet-stream",
+    )
+    return {
+        "workspace_id": job.workspace_id,
+        "message_id": job.message_row_id,
+        "storage_path": storage_path,
+        "tipo": job.media.tipo,
+        "tamanho_bytes": file_size or len(content),
+    }
+
+
+def store_media(jobs: list[MediaJob], notify: bool = True) -> int:
+    """Downloads the media, uploads it to R2 and records the attachments;
+    media already stored for its message is skipped before downloading.
+    Returns how many attachments were recorded."""
+    jobs = [job for job in jobs if job.media.media_id or job.media.url]
+    if not jobs:
+        return 0
+    supabase = get_supabase_client()
+    existing = (
+        supabase.table("attachments")
+        .select("message_id, storage_path")
+        .in_("message_id", sorted({job.message_row_id for job in jobs}))
+        .execute()
+        .data
+        or []
+    )
+    stored = {(row["message_id"], (row.get("storage_path") or "").rsplit(".", 1)[0]) for row in existing}
+    pending: dict[str, MediaJob] = {}
+    for job in jobs:
+        prefix = _storage_prefix(job)
+        if (job.message_row_id, prefix) not in stored:
+            pending.setdefault(prefix, job)
+    if not pending:
+        return 0
+
+    tokens: dict[tuple[str | None, str | None], str | None] = {}
+    for job in pending.values():
+        if job.media.media_id or job.media.authorized:
+            account = (job.integration_id, job.integration_account_id)
+            if account not in tokens:
+                tokens[account] = get_integration_token(*account)
+
+    def upload(job: MediaJob) -> dict | None:
+        try:
+            return _upload(job, tokens.get((job.integration_id, job.integration_account_id)))
+        except Exception as exc:
+            logger.warning(
+                "ingestion_media_failed message_id=%s error=%s",
+                job.message_row_id,
+                exc.__class__.__name__,
+            )
+            return None
+
+    workers = max(1, min(settings.ingestion_media_concurrency, len(pending)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        uploaded = list(executor.map(upload, pending.values()))
+    rows = [row for row in uploaded if row]
+    if not rows:
+        return 0
+
+    written = supabase.table("attachments").insert(rows, returning="representation").execute().data or []
+    if notify:
+        jobs_by_path = {row["storage_path"]: job for row, job in zip(uploaded, pending.values()) if row}
+        for attachment in written:
+            job = jobs_by_path.get(attachment.get("storage_path"))
+            if not job:
+                continue
+            emit_attachment_created(
+                job.workspace_id,
+                job.conversation_id,
+                job.message_row_id,
+                {
+                    "id": attachment.get("id"),
+                    "storage_path": attachment.get("storage_path"),
+                    "tipo": attachment.get("tipo"),
+                    "tamanho_bytes": attachment.get("tamanho_bytes"),
+                },
+            )
+    return len(written)
+
+
+def load_event_payload(event_id: str) -> Any:
+    supabase = get_supabase_client()
+    event = (
+        supabase.table("webhook_events")
+        .select("id, payload")
+        .eq("id", event_id)
+        .single()
+        .execute()
+        .data
+    )
+    if not event:
+        raise ValueError("Webhook event not found")
+    return event.get("payload")
+
+
+def mark_event(event_id: str, status: str, integration_id: str | None = None) -> None:
+    payload = {"status": status, "processado_em": datetime.now(timezone.utc).isoformat()}
+    if status != "erro":
+        payload["integration_id"] = integration_id
+    get_supabase_client().table("webhook_events").update(payload).eq("id", event_id).execute()
+
+
+def ingest_event(
+    event_id: str,
+    channel: Channel,
+    build: Callable[[], InboundBatch],
+    process_media: bool = True,
+) -> dict:
+    """Runs an adapter and the pipeline for one webhook event and records
+    the outcome on webhook_events. Media left for later is returned as
+    serialized MediaJobs under "media"."""
+    try:
+        batch = build()
+        result = ingest(channel, batch.records, process_media=process_media)
+    except Exception:
+        mark_event(event_id, "erro")
+        raise
+
+    if result.blocked and not result.conversation_ids:
+        mark_event(event_id, "bloqueado", batch.integration_id)
+        return {
+            "workspace_id": batch.workspace_id,
+            "integration_account_id": batch.integration_account_id,
+            "conversation_ids": [],
+            "media": [],
+        }
+
+    mark_event(event_id, "processado", batch.integration_id)
+    return {
+        "workspace_id": batch.workspace_id,
+        "integration_account_id": batch.integration_account_id,
+        "conversation_ids": result.conversation_ids,
+        "media": [asdict(job) for job in result.media],
+    }
@@ -4,13 +4,13 @@ import hashlib
 import json
 import logging
 
-import tiktoken
 from langdetect import detect
 
 from app.clients.supabase import get_supabase_client
 from app.clients.r2_client import build_r2_key, get_r2_client
 from app.config import settings
 from app.clients.redis_client import get_redis_client
+from app.services.context_budget import count_tokens
 from app.services.embeddings import (
     embed_query_gemini,
     embed_query_openai,
@@ -46,11 +46,6 @@ def chunk_text(text: str, chunk_size: int = 1200, overlap: int = 200) -> list[st
     return chunks
 
 
-def _token_count(text: str) -> int:
-    encoder = tiktoken.get_encoding("cl100k_base")
-    return len(encoder.encode(text))
-
-
 def _qa_transform(text: str) -> str:
     prompt = (
         "Transforme o conteudo abaixo em pares de perguntas e respostas. "
@@ -140,7 +135,7 @@ def process_knowledge_file(file_id: str) -> dict:
                     "agent_id": file_row["agent_id"],
                     "file_id": file_id,
                     "content": chunk,
-                    "tokens": _token_count(chunk),
+                    "tokens": count_tokens(chunk),
                     "embedding_openai": embeddings_openai[idx],
                     "embedding_gemini": embeddings_gemini[idx],
                     "metadata": {
@@ -204,7 +199,7 @@ def ingest_conversation_text(
                 "conversation_id": conversation_id,
                 "message_id": message_id,
                 "content": chunk,
-                "tokens": _token_count(chunk),
+                "tokens": count_tokens(chunk),
                 "embedding_openai": embeddings_openai[idx],
                 "embedding_gemini": embeddings_gemini[idx],
                 "metadata": base_metadata,
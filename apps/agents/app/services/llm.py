@@ -1,25 +1,80 @@
+import threading
+
+import httpx
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 from app.config import settings
+from app.services.provider_health import ProviderHealthCallback, ProviderTarget
+
+# Clients are process-wide: building ChatOpenAI/ChatGoogleGenerativeAI per
+# call re-creates SDK clients and drops pooled connections every run.
+_clients: dict[tuple, object] = {}
+_clients_lock = threading.Lock()
+_http_client: httpx.Client | None = None
+_http_client_lock = threading.Lock()
+
+
+def _get_http_client() -> httpx.Client:
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    timeout=settings.llm_request_timeout_seconds,
+                    limits=httpx.Limits(
+                        max_connections=settings.llm_http_max_connections,
+                        max_keepalive_connections=settings.llm_http_max_keepalive,
+                    ),
+                )
+    return _http_client
+
+
+def _cached(key: tuple, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = factory()
+                _clients[key] = client
+    return client
 
 
 def build_openai(model: str, temperature: float = 0.2):
-    return ChatOpenAI(
-        api_key=settings.openai_api_key,
-        model=model,
-        temperature=temperature,
+    return _cached(
+        ("openai", model, temperature),
+        lambda: ChatOpenAI(
+            api_key=settings.openai_api_key,
+            model=model,
+            temperature=temperature,
+            http_client=_get_http_client(),
+            stream_usage=True,
+            callbacks=[ProviderHealthCallback(ProviderTarget("openai", model, "chat"))],
+        ),
     )
 
 
 def build_gemini(model: str, temperature: float = 0.2):
-    return ChatGoogleGenerativeAI(
-        google_api_key=settings.gemini_api_key,
-        model=model,
-        temperature=temperature,
+    return _cached(
+        ("gemini", model, temperature),
+        lambda: ChatGoogleGenerativeAI(
+            google_api_key=settings.gemini_api_key,
+            model=model,
+            temperature=temperature,
+            callbacks=[ProviderHealthCallback(ProviderTarget("gemini", model, "chat"))],
+        ),
     )
 
 
+def provider_name(llm) -> str:
+    if isinstance(llm, ChatGoogleGenerativeAI):
+        return "gemini"
+    if isinstance(llm, ChatOpenAI):
+        return "openai"
+    return type(llm).__name__.lower()
+
+
 def get_primary_llm():
     return build_openai("gpt-4.1-mini")
 
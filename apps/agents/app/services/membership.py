@@ -0,0 +1,136 @@
+from dataclasses import dataclass
+from functools import lru_cache
+import json
+import logging
+
+from app.clients.redis_client import get_redis_client
+from app.clients.supabase import get_supabase_client
+from app.config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# Tag and pipeline stage membership of contacts and leads, cached in Redis so
+# pause checks for runs and followups do not re-query four tables each time.
+# The CRM tools invalidate an entity when they change its tags or stages;
+# edits made outside this service are picked up when the TTL expires.
+MEMBERSHIP_KEY = "membership:{kind}:{entity_id}"
+
+
+@dataclass(frozen=True)
+class Membership:
+    tags: frozenset[str] = frozenset()
+    stages: frozenset[str] = frozenset()
+
+
+@dataclass(frozen=True)
+class PauseRules:
+    tags: frozenset[str]
+    stages: frozenset[str]
+    on_human_reply: bool
+
+    @property
+    def needs_membership(self) -> bool:
+        return bool(self.tags or self.stages)
+
+
+@lru_cache(maxsize=2048)
+def _pause_rules(tags: tuple[str, ...], stages: tuple[str, ...], on_human_reply: bool) -> PauseRules:
+    return PauseRules(frozenset(tags), frozenset(stages), on_human_reply)
+
+
+def pause_rules(agent: dict) -> PauseRules:
+    return _pause_rules(
+        tuple(sorted(str(tag) for tag in agent.get("pausar_em_tags") or [])),
+        tuple(sorted(str(stage) for stage in agent.get("pausar_em_etapas") or [])),
+        bool(agent.get("pausar_ao_responder_humano")),
+    )
+
+
+def _select_in(table: str, columns: str, column: str, values: list[str]) -> list[dict]:
+    if not values:
+        return []
+    supabase = get_supabase_client()
+    return supabase.table(table).select(columns).in_(column, values).execute().data or []
+
+
+def _load_contacts(contact_ids: list[str]) -> dict[str, dict]:
+    loaded = {contact_id: {"tags": set(), "stages": set()} for contact_id in contact_ids}
+    for row in _select_in("contact_tags", "contact_id, tag_id", "contact_id", contact_ids):
+        loaded[row["contact_id"]]["tags"].add(str(row["tag_id"]))
+    for row in _select_in("contacts", "id, pipeline_stage_id", "id", contact_ids):
+        if row.get("pipeline_stage_id"):
+            loaded[row["id"]]["stages"].add(str(row["pipeline_stage_id"]))
+    for row in _select_in("deals", "contact_id, stage_id", "contact_id", contact_ids):
+        if row.get("stage_id"):
+            loaded[row["contact_id"]]["stages"].add(str(row["stage_id"]))
+    return loaded
+
+
+def _load_leads(lead_ids: list[str]) -> dict[str, dict]:
+    loaded = {lead_id: {"tags": set(), "stages": set()} for lead_id in lead_ids}
+    for row in _select_in("lead_tags", "lead_id, tag_id", "lead_id", lead_ids):
+        loaded[row["lead_id"]]["tags"].add(str(row["tag_id"]))
+    return loaded
+
+
+def get_memberships(entities: list[tuple[str | None, str | None]]) -> dict[tuple, Membership]:
+    """Membership for each (contact_id, lead_id) pair: tags of both entities
+    and the stages of the contact and its deals. Misses are loaded with one
+    query per table for the whole batch and written back to the cache."""
+    keys = sorted(
+        {("contact", contact_id) for contact_id, _ in entities if contact_id}
+        | {("lead", lead_id) for _, lead_id in entities if lead_id}
+    )
+    cached: dict[tuple[str, str], dict] = {}
+    redis = None
+    try:
+        redis = get_redis_client()
+        raw_values = redis.mget([MEMBERSHIP_KEY.format(kind=kind, entity_id=entity_id) for kind, entity_id in keys])
+        for key, raw in zip(keys, raw_values):
+            if raw:
+                cached[key] = json.loads(raw)
+    except Exception:
+        logger.warning("membership_cache_unavailable entities=%s", len(keys))
+
+    missing_contacts = [entity_id for kind, entity_id in keys if kind == "contact" and (kind, entity_id) not in cached]
+    missing_leads = [entity_id for kind, entity_id in keys if kind == "lead" and (kind, entity_id) not in cached]
+    loaded: dict[tuple[str, str], dict] = {}
+    for contact_id, values in _load_contacts(missing_contacts).items():
+        loaded[("contact", contact_id)] = {"tags": sorted(values["tags"]), "stages": sorted(values["stages"])}
+    for lead_id, values in _load_leads(missing_leads).items():
+        loaded[("lead", lead_id)] = {"tags": sorted(values["tags"]), "stages": []}
+    if loaded and redis is not None:
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            for (kind, entity_id), values in loaded.items():
+                pipeline.set(
+                    MEMBERSHIP_KEY.format(kind=kind, entity_id=entity_id),
+                    json.dumps(values),
+                    ex=settings.membership_cache_ttl_seconds,
+                )
+            pipeline.execute()
+        except Exception:
+            pass
+    cached.update(loaded)
+
+    memberships: dict[tuple, Membership] = {}
+    for contact_id, lead_id in entities:
+        parts = [cached.get(("contact", contact_id)) or {}, cached.get(("lead", lead_id)) or {}]
+        memberships[(contact_id, lead_id)] = Membership(
+            tags=frozenset(tag for part in parts for tag in part.get("tags") or []),
+            stages=frozenset(stage for part in parts for stage in part.get("stages") or []),
+        )
+    return memberships
+
+
+def get_membership(contact_id: str | None, lead_id: str | None) -> Membership:
+    return get_memberships([(contact_id, lead_id)])[(contact_id, lead_id)]
+
+
+def invalidate_membership(kind: str, entity_id: str | None) -> None:
+    if not entity_id:
+        return
+    try:
+        get_redis_client().delete(MEMBERSHIP_KEY.format(kind=kind, entity_id=entity_id))
+    except Exception:
+        logger.warning("membership_invalidate_failed kind=%s entity_id=%s", kind, entity_id)
@@ -0,0 +1,89 @@
+from app.clients.supabase import get_supabase_client
+
+# Inbound messages from every channel land in `messages`, keyed by the
+# provider message id (whatsapp_message_id, also used for Instagram mids and
+# UAZAPI ids). Upserts ask PostgREST for the written rows, so ids come back
+# from the write itself instead of a follow-up select.
+MESSAGE_CONFLICT = "workspace_id,whatsapp_message_id"
+
+
+def message_row(
+    workspace_id: str,
+    conversation_id: str,
+    message_id: str | None,
+    author: str,
+    message_type: str,
+    content: str,
+    created_at: str,
+    sender_id: str | None = None,
+    sender_name: str | None = None,
+    sender_avatar_url: str | None = None,
+) -> dict:
+    return {
+        "workspace_id": workspace_id,
+        "conversation_id": conversation_id,
+        "whatsapp_message_id": message_id,
+        "autor": author,
+        "tipo": message_type,
+        "conteudo": content,
+        "created_at": created_at,
+        "sender_id": sender_id,
+        "sender_nome": sender_name,
+        "sender_avatar_url": sender_avatar_url,
+    }
+
+
+def upsert_messages(rows: list[dict]) -> list[str | None]:
+    """Writes the rows and returns their ids in input order. Rows sharing a
+    provider id are written once and share its id. Rows built by message_row
+    share one column set, so a whole webhook is a single call."""
+    ids: list[str | None] = [None] * len(rows)
+    first_index: dict[tuple[str, str], int] = {}
+    repeats: list[tuple[int, int]] = []
+    keyed_groups: dict[tuple, list[int]] = {}
+    unkeyed_groups: dict[tuple, list[int]] = {}
+    for index, row in enumerate(rows):
+        message_id = row.get("whatsapp_message_id")
+        if not message_id:
+            unkeyed_groups.setdefault(tuple(sorted(row)), []).append(index)
+            continue
+        key = (row["workspace_id"], message_id)
+        if key in first_index:
+            repeats.append((index, first_index[key]))
+            continue
+        first_index[key] = index
+        keyed_groups.setdefault(tuple(sorted(row)), []).append(index)
+
+    supabase = get_supabase_client()
+    for indexes in keyed_groups.values():
+        written = (
+            supabase.table("messages")
+            .upsert([rows[index] for index in indexes], on_conflict=MESSAGE_CONFLICT, returning="representation")
+            .execute()
+            .data
+            or []
+        )
+        for item in written:
+            index = first_index.get((item.get("workspace_id"), item.get("whatsapp_message_id")))
+            if index is not None:
+                ids[index] = item.get("id")
+    # Without a provider id nothing can conflict; a plain insert returns
+    # the rows in input order.
+    for indexes in unkeyed_groups.values():
+        written = (
+            supabase.table("messages")
+            .insert([rows[index] for index in indexes], returning="representation")
+            .execute()
+            .data
+            or []
+        )
+        for index, item in zip(indexes, written):
+            ids[index] = item.get("id")
+    for index, original in repeats:
+        ids[index] = ids[original]
+    return ids
+
+
+def upsert_message(**fields) -> str | None:
+    """Single-message form of upsert_messages; takes message_row's arguments."""
+    return upsert_messages([message_row(**fields)])[0]
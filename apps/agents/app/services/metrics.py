@@ -1,6 +1,58 @@
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
+import json
+import logging
 
+from redis.client import Pipeline
+
+from app.clients.redis_client import acquire_lock, get_redis_client, release_lock, renew_lock
 from app.clients.supabase import get_supabase_client
+from app.config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+METRIC_FIELDS = (
+    "mensagens_enviadas",
+    "conversas_resolvidas",
+    "leads_convertidos",
+    "credits_consumidos",
+)
+
+# Unflushed deltas live in one hash per agent/day; the dirty set lists the
+# hashes the next flush has to write to agent_metrics_daily. A flush moves
+# its batch to the processing set and hashes, and only drops them once the
+# rows are written, so a flusher that dies midway leaves the batch for the
+# next one. Before writing, the flush stores the totals it is about to write
+# in METRICS_PLANNED_KEY, and a resumed batch writes those same totals again
+# instead of adding its deltas a second time. The lock is renewed before the
+# write, and a flusher that lost it stops without writing.
+METRICS_KEY_PREFIX = "metrics:agent:"
+METRICS_DIRTY_KEY = "metrics:dirty"
+METRICS_PROCESSING_PREFIX = "metrics:processing:agent:"
+METRICS_PROCESSING_KEY = "metrics:processing"
+METRICS_PLANNED_KEY = "metrics:processing:planned"
+METRICS_FLUSH_LOCK_KEY = "metrics:flush:lock"
+METRICS_FLUSH_LOCK_SECONDS = 60
+
+# Unless an unfinished batch is waiting, moves up to ARGV[2] dirty members
+# to the processing set and renames their hashes, so increments that land
+# afterwards start a new delta. Returns [member, hgetall, ...] of the batch.
+_DRAIN_SCRIPT = """
+if redis.call('SCARD', KEYS[2]) == 0 then
+  local members = redis.call('SRANDMEMBER', KEYS[1], tonumber(ARGV[2]))
+  for _, member in ipairs(members) do
+    redis.call('SMOVE', KEYS[1], KEYS[2], member)
+    if redis.call('EXISTS', ARGV[1] .. member) == 1 then
+      redis.call('RENAME', ARGV[1] .. member, ARGV[3] .. member)
+    end
+  end
+end
+local result = {}
+for _, member in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+  table.insert(result, member)
+  table.insert(result, redis.call('HGETALL', ARGV[3] .. member))
+end
+return result
+"""
 
 
 def _metric_day():
@@ -14,46 +66,217 @@ def _safe_int(value) -> int:
         return 0
 
 
-def increment_agent_metrics(agent_id: str | None, workspace_id: str | None, deltas: dict) -> None:
+def _member(agent_id: str, day: str) -> str:
+    return f"{agent_id}:{day}"
+
+
+def _metrics_key(member: str) -> str:
+    return f"{METRICS_KEY_PREFIX}{member}"
+
+
+def _pairs_to_dict(values: list) -> dict:
+    return {values[index]: values[index + 1] for index in range(0, len(values) - 1, 2)}
+
+
+def increment_agent_metrics(
+    agent_id: str | None,
+    workspace_id: str | None,
+    deltas: dict,
+    pipeline: Pipeline | None = None,
+) -> None:
+    """Adds the deltas to today's hash. With a pipeline the commands are only
+    queued, so a caller can make them part of its own transaction."""
     if not agent_id or not workspace_id:
         return
+    increments = {field: _safe_int(deltas.get(field)) for field in METRIC_FIELDS}
+    increments = {field: value for field, value in increments.items() if value}
+    if not increments:
+        return
 
-    day = _metric_day()
-    supabase = get_supabase_client()
-    existing = (
-        supabase.table("agent_metrics_daily")
-        .select(
-            "id, mensagens_enviadas, conversas_resolvidas, leads_convertidos, credits_consumidos"
-        )
-        .eq("agent_id", agent_id)
-        .eq("data", day)
-        .limit(1)
+    member = _member(agent_id, _metric_day().isoformat())
+    key = _metrics_key(member)
+    queue = pipeline if pipeline is not None else get_redis_client().pipeline(transaction=True)
+    for field, value in increments.items():
+        queue.hincrby(key, field, value)
+    queue.hset(key, "workspace_id", workspace_id)
+    queue.sadd(METRICS_DIRTY_KEY, member)
+    if pipeline is None:
+        queue.execute()
+
+
+def _finish_batch(members: list[str]) -> None:
+    pipeline = get_redis_client().pipeline(transaction=True)
+    pipeline.delete(*[f"{METRICS_PROCESSING_PREFIX}{member}" for member in members])
+    pipeline.srem(METRICS_PROCESSING_KEY, *members)
+    pipeline.delete(METRICS_PLANNED_KEY)
+    pipeline.execute()
+
+
+def _load_daily_rows(agent_ids: list[str], days: list[str]) -> list[dict]:
+    if not agent_ids or not days:
+        return []
+    return (
+        get_supabase_client()
+        .table("agent_metrics_daily")
+        .select("id, agent_id, workspace_id, data, " + ", ".join(METRIC_FIELDS))
+        .in_("agent_id", agent_ids)
+        .in_("data", days)
         .execute()
         .data
+        or []
     )
 
-    if not existing:
-        payload = {
-            "agent_id": agent_id,
-            "workspace_id": workspace_id,
+
+def flush_agent_metrics(batch_size: int | None = None) -> dict:
+    token = acquire_lock(METRICS_FLUSH_LOCK_KEY, METRICS_FLUSH_LOCK_SECONDS)
+    if not token:
+        return {"status": "locked", "rows": 0}
+    try:
+        limit = batch_size or settings.metrics_flush_batch_size
+        raw = (
+            get_redis_client().eval(
+                _DRAIN_SCRIPT,
+                2,
+                METRICS_DIRTY_KEY,
+                METRICS_PROCESSING_KEY,
+                METRICS_KEY_PREFIX,
+                limit,
+                METRICS_PROCESSING_PREFIX,
+            )
+            or []
+        )
+        batch = {raw[index]: _pairs_to_dict(raw[index + 1]) for index in range(0, len(raw) - 1, 2)}
+        drained = {member: values for member, values in batch.items() if values}
+        if not drained:
+            if batch:
+                _finish_batch(list(batch))
+            return {"status": "idle", "rows": 0}
+
+        redis = get_redis_client()
+        keys = {tuple(member.rsplit(":", 1)): member for member in drained}
+        existing = _load_daily_rows(
+            sorted({agent_id for agent_id, _ in keys}),
+            sorted({day for _, day in keys}),
+        )
+        existing_by_key = {
+            (row["agent_id"], str(row["data"])[:10]): row for row in existing
+        }
+
+        planned_raw = redis.get(METRICS_PLANNED_KEY)
+        if planned_raw:
+            # A previous flush of this batch may have written some rows.
+            planned = json.loads(planned_raw)
+        else:
+            planned = []
+            for (agent_id, day), member in keys.items():
+                values = drained[member]
+                row = existing_by_key.get((agent_id, day))
+                payload = {
+                    "agent_id": agent_id,
+                    "workspace_id": (row or {}).get("workspace_id") or values.get("workspace_id"),
+                    "data": day,
+                }
+                for field in METRIC_FIELDS:
+                    payload[field] = _safe_int((row or {}).get(field)) + _safe_int(values.get(field))
+                planned.append(payload)
+            redis.set(METRICS_PLANNED_KEY, json.dumps(planned))
+
+        updates: list[dict] = []
+        inserts: list[dict] = []
+        for payload in planned:
+            row = existing_by_key.get((payload["agent_id"], payload["data"]))
+            if row:
+                updates.append({"id": row["id"], **payload})
+            else:
+                inserts.append(payload)
+
+        if not renew_lock(METRICS_FLUSH_LOCK_KEY, token, METRICS_FLUSH_LOCK_SECONDS):
+            logger.warning("agent_metrics_flush_lock_lost")
+            return {"status": "lock_lost", "rows": 0}
+        # The flusher is the only writer of these rows, so a plain
+        # read-add-write under the lock cannot lose increments, and writing
+        # the planned totals again is harmless. A failure leaves the batch in
+        # the processing set for the next flush.
+        supabase = get_supabase_client()
+        if updates:
+            supabase.table("agent_metrics_daily").upsert(updates).execute()
+        if inserts:
+            supabase.table("agent_metrics_daily").insert(inserts).execute()
+        _finish_batch(list(batch))
+
+        logger.info(
+            "agent_metrics_flushed rows=%s updated=%s inserted=%s",
+            len(drained),
+            len(updates),
+            len(inserts),
+        )
+        return {"status": "flushed", "rows": len(drained)}
+    finally:
+        release_lock(METRICS_FLUSH_LOCK_KEY, token)
+
+
+def get_agent_metrics_daily(
+    agent_ids: list[str],
+    start_day: date | str,
+    end_day: date | str | None = None,
+) -> list[dict]:
+    ids = sorted({agent_id for agent_id in agent_ids if agent_id})
+    if not ids:
+        return []
+    start = start_day.isoformat() if isinstance(start_day, date) else str(start_day)[:10]
+    end = end_day.isoformat() if isinstance(end_day, date) else str(end_day or start)[:10]
+
+    rows = (
+        get_supabase_client()
+        .table("agent_metrics_daily")
+        .select("agent_id, workspace_id, data, " + ", ".join(METRIC_FIELDS))
+        .in_("agent_id", ids)
+        .gte("data", start)
+        .lte("data", end)
+        .execute()
+        .data
+        or []
+    )
+    merged: dict[tuple[str, str], dict] = {}
+    for row in rows:
+        day = str(row["data"])[:10]
+        merged[(row["agent_id"], day)] = {
+            "agent_id": row["agent_id"],
+            "workspace_id": row.get("workspace_id"),
             "data": day,
-            "mensagens_enviadas": _safe_int(deltas.get("mensagens_enviadas")),
-            "conversas_resolvidas": _safe_int(deltas.get("conversas_resolvidas")),
-            "leads_convertidos": _safe_int(deltas.get("leads_convertidos")),
-            "credits_consumidos": _safe_int(deltas.get("credits_consumidos")),
+            **{field: _safe_int(row.get(field)) for field in METRIC_FIELDS},
         }
-        supabase.table("agent_metrics_daily").insert(payload).execute()
-        return
 
-    row = existing[0]
-    updates = {
-        "mensagens_enviadas": _safe_int(row.get("mensagens_enviadas"))
-        + _safe_int(deltas.get("mensagens_enviadas")),
-        "conversas_resolvidas": _safe_int(row.get("conversas_resolvidas"))
-        + _safe_int(deltas.get("conversas_resolvidas")),
-        "leads_convertidos": _safe_int(row.get("leads_convertidos"))
-        + _safe_int(deltas.get("leads_convertidos")),
-        "credits_consumidos": _safe_int(row.get("credits_consumidos"))
-        + _safe_int(deltas.get("credits_consumidos")),
-    }
-    supabase.table("agent_metrics_daily").update(updates).eq("id", row["id"]).execute()
+    redis = get_redis_client()
+    wanted = set(ids)
+    # Deltas not written yet: the dirty hashes and a batch being flushed.
+    pending_keys = [
+        (member, f"{prefix}{member}")
+        for set_key, prefix in (
+            (METRICS_DIRTY_KEY, METRICS_KEY_PREFIX),
+            (METRICS_PROCESSING_KEY, METRICS_PROCESSING_PREFIX),
+        )
+        for member in redis.smembers(set_key) or []
+        if member.rsplit(":", 1)[0] in wanted and start <= member.rsplit(":", 1)[1] <= end
+    ]
+    if pending_keys:
+        pipeline = redis.pipeline()
+        for _, key in pending_keys:
+            pipeline.hgetall(key)
+        for (member, _), values in zip(pending_keys, pipeline.execute()):
+            if not values:
+                continue
+            agent_id, day = member.rsplit(":", 1)
+            row = merged.setdefault(
+                (agent_id, day),
+                {
+                    "agent_id": agent_id,
+                    "workspace_id": values.get("workspace_id"),
+                    "data": day,
+                    **{field: 0 for field in METRIC_FIELDS},
+                },
+            )
+            for field in METRIC_FIELDS:
+                row[field] += _safe_int(values.get(field))
+
+    return sorted(merged.values(), key=lambda row: (row["data"], row["agent_id"]))
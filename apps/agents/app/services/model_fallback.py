@@ -0,0 +1,197 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import logging
+import threading
+import time
+from typing import Any, Callable
+from uuid import uuid4
+
+from app.config import settings
+from app.services.llm import provider_name
+from app.services.provider_health import CallOutcomes, is_provider_available, track_calls
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class AttemptCancelled(Exception):
+    pass
+
+
+@dataclass
+class ModelAttempt:
+    label: str
+    llm: Any
+    model: str
+    provider: str
+    hedged: bool = False
+    id: str = field(default_factory=lambda: uuid4().hex)
+    status: str = "pending"
+    error: str | None = None
+    started_at: float | None = None
+    first_token_at: float | None = None
+    finished_at: float | None = None
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+    calls: CallOutcomes = field(default_factory=CallOutcomes, repr=False)
+
+    def mark_first_token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+    def check_cancelled(self) -> None:
+        if self.cancel_event.is_set():
+            raise AttemptCancelled(self.status)
+
+    def to_record(self) -> dict:
+        def elapsed(moment: float | None) -> int | None:
+            if moment is None or self.started_at is None:
+                return None
+            return int((moment - self.started_at) * 1000)
+
+        return {
+            "rotulo": self.label,
+            "modelo": self.model,
+            "provider": self.provider,
+            "hedge": self.hedged,
+            "status": self.status,
+            "erro": self.error,
+            "latencia_ms": elapsed(self.finished_at),
+            "primeiro_token_ms": elapsed(self.first_token_at),
+        }
+
+
+def _model_name(llm, label: str) -> str:
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or label
+
+
+def run_with_fallback(
+    model_sequence: list[tuple[str, Any]],
+    call: Callable[[ModelAttempt], Any],
+    is_committed: Callable[[ModelAttempt], bool] = lambda attempt: False,
+    claim: Callable[[ModelAttempt], bool] = lambda attempt: True,
+    hedge_after_ms: int | None = None,
+    deadline_ms: int | None = None,
+) -> tuple[ModelAttempt | None, Any, list[ModelAttempt]]:
+    """Runs call(attempt) over the model sequence and returns the first
+    successful attempt, its result and every attempt made.
+
+    A model whose provider breaker is open is skipped; call outcomes are
+    reported to the health registry by the models' own callbacks. If the
+    running attempt has not produced a first token after hedge_after_ms, the
+    next model starts alongside it and the first to finish wins. An attempt
+    that passes deadline_ms is abandoned and the next model is started. Once
+    an attempt is committed (it already caused side effects) it is never
+    abandoned or replaced, and its failure ends the run. A finished attempt
+    only wins if claim(attempt) succeeds: when another attempt has already
+    committed, the result is discarded and the committed attempt decides.
+    If every provider breaker is open the sequence is tried anyway, primary
+    first, rather than failing without a single attempt."""
+    hedge_after = (settings.llm_hedge_after_ms if hedge_after_ms is None else hedge_after_ms) / 1000
+    deadline = (settings.llm_attempt_deadline_ms if deadline_ms is None else deadline_ms) / 1000
+
+    attempts: list[ModelAttempt] = []
+    queue = [
+        ModelAttempt(label=label, llm=llm, model=_model_name(llm, label), provider=provider_name(llm))
+        for label, llm in model_sequence
+    ]
+    running: dict[Future, ModelAttempt] = {}
+    ignore_breakers = not any(is_provider_available(attempt.provider) for attempt in queue)
+    if ignore_breakers and queue:
+        logger.warning(
+            "model_fallback_all_circuits_open providers=%s",
+            ",".join(attempt.provider for attempt in queue),
+        )
+    executor = ThreadPoolExecutor(max_workers=max(len(queue), 1), thread_name_prefix="model-attempt")
+
+    def run(attempt: ModelAttempt):
+        # Model callbacks register their calls with the attempt, so a
+        # deadline records the call in flight as a timeout exactly once.
+        track_calls(attempt.calls)
+        result = call(attempt)
+        attempt.check_cancelled()
+        return result
+
+    def start_next(hedged: bool = False) -> bool:
+        while queue:
+            attempt = queue.pop(0)
+            attempts.append(attempt)
+            if not ignore_breakers and not is_provider_available(attempt.provider):
+                attempt.status = "circuit_open"
+                continue
+            attempt.hedged = hedged
+            attempt.status = "running"
+            attempt.started_at = time.monotonic()
+            running[executor.submit(run, attempt)] = attempt
+            return True
+        return False
+
+    def abandon(attempt: ModelAttempt, status: str) -> None:
+        attempt.status = status
+        attempt.finished_at = attempt.finished_at or time.monotonic()
+        attempt.cancel_event.set()
+
+    try:
+        start_next()
+        while running:
+            now = time.monotonic()
+            timeouts: list[float] = []
+            for attempt in running.values():
+                if deadline > 0 and not is_committed(attempt):
+                    timeouts.append(attempt.started_at + deadline - now)
+            newest = max(running.values(), key=lambda item: item.started_at)
+            can_hedge = hedge_after > 0 and queue and newest.first_token_at is None
+            if can_hedge:
+                timeouts.append(newest.started_at + hedge_after - now)
+            timeout = max(min(timeouts), 0) if timeouts else None
+
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt = running.pop(future)
+                attempt.finished_at = time.monotonic()
+                try:
+                    result = future.result()
+                except AttemptCancelled:
+                    continue
+                except Exception as error:
+                    attempt.status = "error"
+                    attempt.error = f"{type(error).__name__}: {error}"[:300]
+                    if is_committed(attempt):
+                        for other in running.values():
+                            abandon(other, "cancelled")
+                        return None, None, attempts
+                    if not running:
+                        start_next()
+                    continue
+                if not claim(attempt):
+                    # Another attempt already acted for the run; only its
+                    # outcome can be the answer.
+                    attempt.status = "superseded"
+                    continue
+                attempt.status = "ok"
+                for other in running.values():
+                    abandon(other, "cancelled")
+                return attempt, result, attempts
+
+            if done:
+                continue
+            now = time.monotonic()
+            for future, attempt in list(running.items()):
+                if deadline > 0 and not is_committed(attempt) and now - attempt.started_at >= deadline:
+                    running.pop(future)
+                    abandon(attempt, "timeout")
+                    attempt.error = f"deadline {int(deadline * 1000)}ms"
+                    attempt.calls.abandon(TimeoutError(attempt.error))
+            if not running:
+                start_next()
+            elif can_hedge and newest.first_token_at is None and now - newest.started_at >= hedge_after:
+                if not any(is_committed(attempt) for attempt in running.values()):
+                    start_next(hedged=True)
+        return None, None, attempts
+    finally:
+        for attempt in attempts:
+            if attempt.status == "running":
+                abandon(attempt, "cancelled")
+        executor.shutdown(wait=False)
+        logger.info(
+            "model_attempts %s",
+            " ".join(f"{attempt.label}:{attempt.status}" for attempt in attempts),
+        )
@@ -0,0 +1,351 @@
+from contextvars import ContextVar
+from dataclasses import dataclass
+import logging
+import threading
+import time
+from typing import Any, Callable
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from app.clients.redis_client import get_redis_client
+from app.config import settings
+from app.services.circuit_breaker import CircuitBreaker
+
+logger = logging.getLogger("uvicorn.error")
+
+# Shared health registry: per provider/model/endpoint call counters in 10s
+# buckets, a capped list of recent latencies and an adaptive token bucket.
+# Breakers are provider-wide so an outage reroutes every model at once. Only
+# provider failures (timeouts, connection errors, 5xx) count as errors, and
+# the breaker opens on their rate in the window: a client error such as an
+# invalid request or an oversized context says nothing about the provider.
+# The error rate is per target, so the breaker remembers which target opened
+# it (TRIPPED_BY_KEY) and only a success on that target closes it: a healthy
+# endpoint answering must not put a failing one back in use.
+BUCKET_SECONDS = 10
+STATS_KEY = "health:{target}:{bucket}"
+LATENCY_KEY = "health:{target}:latency"
+BUCKET_KEY = "ratelimit:{target}"
+TRIPPED_BY_KEY = "health:{provider}:tripped_by"
+LATENCY_SAMPLES = 200
+
+# Takes one token, letting the bucket go negative so callers queue up in
+# arrival order. Returns the seconds to wait, or -1 if that exceeds ARGV[4].
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local rate = tonumber(data[3]) or tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate) - 1
+local wait = 0
+if tokens < 0 then
+  wait = -tokens / rate
+end
+if wait > tonumber(ARGV[4]) then
+  return '-1'
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+# AIMD: halve the rate on a 429, otherwise creep back towards the maximum.
+_ADJUST_RATE_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[3])
+if ARGV[1] == '1' then
+  rate = math.max(tonumber(ARGV[2]), rate * 0.5)
+else
+  rate = math.min(tonumber(ARGV[3]), rate + tonumber(ARGV[3]) * 0.02)
+end
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+
+class ProviderUnavailable(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class ProviderTarget:
+    provider: str
+    model: str
+    endpoint: str
+
+    @property
+    def key(self) -> str:
+        return f"{self.provider}:{self.model}:{self.endpoint}"
+
+
+def provider_breaker(provider: str) -> CircuitBreaker:
+    return CircuitBreaker(f"provider:{provider}")
+
+
+def _trip(breaker: CircuitBreaker, target: ProviderTarget) -> None:
+    breaker.trip()
+    get_redis_client().set(
+        TRIPPED_BY_KEY.format(provider=target.provider),
+        target.key,
+        ex=max(breaker.open_seconds, 1) * 4,
+    )
+
+
+def _close(breaker: CircuitBreaker, target: ProviderTarget) -> None:
+    redis = get_redis_client()
+    tripped_key = TRIPPED_BY_KEY.format(provider=target.provider)
+    tripped_by = redis.get(tripped_key)
+    if tripped_by and tripped_by != target.key:
+        breaker.release_probe()
+        return
+    breaker.record_success()
+    if tripped_by:
+        redis.delete(tripped_key)
+
+
+def is_provider_available(provider: str) -> bool:
+    return not provider_breaker(provider).is_open()
+
+
+def _is_rate_limited(error: BaseException) -> bool:
+    if getattr(error, "status_code", None) == 429 or getattr(error, "code", None) == 429:
+        return True
+    text = str(error).lower()
+    return "429" in text or "rate limit" in text or "resource exhausted" in text
+
+
+def _status_code(error: BaseException) -> int | None:
+    for value in (
+        getattr(error, "status_code", None),
+        getattr(error, "code", None),
+        getattr(getattr(error, "response", None), "status_code", None),
+    ):
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def _is_provider_failure(error: BaseException) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = _status_code(error)
+    if status is not None:
+        return status >= 500
+    # SDK timeout and connection errors (openai, httpx, google) by name.
+    names = {cls.__name__ for cls in type(error).__mro__}
+    return any(
+        marker in name
+        for name in names
+        for marker in ("Timeout", "Connect", "DeadlineExceeded", "ServiceUnavailable", "ServerError")
+    )
+
+
+def _acquire(target: ProviderTarget) -> None:
+    redis = get_redis_client()
+    max_wait = settings.provider_rate_limit_max_wait_ms / 1000
+    wait = float(
+        redis.eval(
+            _ACQUIRE_SCRIPT,
+            1,
+            BUCKET_KEY.format(target=target.key),
+            time.time(),
+            settings.provider_rate_limit_per_second,
+            settings.provider_rate_limit_burst,
+            max_wait,
+        )
+    )
+    if wait < 0:
+        raise ProviderUnavailable(f"{target.key} rate limited")
+    if wait > 0:
+        time.sleep(wait)
+
+
+def before_call(target: ProviderTarget) -> None:
+    if not provider_breaker(target.provider).allow():
+        raise ProviderUnavailable(f"{target.provider} circuit open")
+    try:
+        _acquire(target)
+    except ProviderUnavailable:
+        raise
+    except Exception:
+        # Redis trouble must not block provider calls.
+        return
+
+
+def _error_rate(target: ProviderTarget) -> tuple[int, int]:
+    redis = get_redis_client()
+    current = int(time.time() // BUCKET_SECONDS)
+    buckets = max(settings.circuit_failure_window_seconds // BUCKET_SECONDS, 1)
+    pipeline = redis.pipeline()
+    for bucket in range(current - buckets + 1, current + 1):
+        pipeline.hmget(STATS_KEY.format(target=target.key, bucket=bucket), "calls", "errors")
+    calls = errors = 0
+    for bucket_calls, bucket_errors in pipeline.execute():
+        calls += int(bucket_calls or 0)
+        errors += int(bucket_errors or 0)
+    return calls, errors
+
+
+def record_result(target: ProviderTarget, latency_ms: int, error: BaseException | None = None) -> None:
+    try:
+        redis = get_redis_client()
+        rate_limited = error is not None and _is_rate_limited(error)
+        failed = error is not None and not rate_limited and _is_provider_failure(error)
+        stats_key = STATS_KEY.format(target=target.key, bucket=int(time.time() // BUCKET_SECONDS))
+        latency_key = LATENCY_KEY.format(target=target.key)
+        pipeline = redis.pipeline(transaction=False)
+        pipeline.hincrby(stats_key, "calls", 1)
+        if failed:
+            pipeline.hincrby(stats_key, "errors", 1)
+        elif rate_limited:
+            pipeline.hincrby(stats_key, "rate_limited", 1)
+        elif error is not None:
+            pipeline.hincrby(stats_key, "client_errors", 1)
+        pipeline.expire(stats_key, settings.circuit_failure_window_seconds + BUCKET_SECONDS * 2)
+        pipeline.lpush(latency_key, latency_ms)
+        pipeline.ltrim(latency_key, 0, LATENCY_SAMPLES - 1)
+        pipeline.eval(
+            _ADJUST_RATE_SCRIPT,
+            1,
+            BUCKET_KEY.format(target=target.key),
+            "1" if rate_limited else "0",
+            settings.provider_rate_limit_min_per_second,
+            settings.provider_rate_limit_per_second,
+        )
+        pipeline.execute()
+
+        breaker = provider_breaker(target.provider)
+        if rate_limited:
+            # 429s are handled by slowing down, not by failing over.
+            return
+        if not failed:
+            # The provider answered, even if it rejected the request.
+            _close(breaker, target)
+            return
+        if breaker.is_half_open():
+            _trip(breaker, target)
+            return
+        calls, errors = _error_rate(target)
+        if (
+            calls >= settings.provider_error_rate_min_calls
+            and errors / calls >= settings.provider_error_rate_threshold
+        ):
+            _trip(breaker, target)
+    except Exception:
+        return
+
+
+def call_provider(target: ProviderTarget, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    before_call(target)
+    started = time.monotonic()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as error:
+        record_result(target, int((time.monotonic() - started) * 1000), error)
+        raise
+    record_result(target, int((time.monotonic() - started) * 1000))
+    return result
+
+
+def _percentile(values: list[int], percentile: float) -> int | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(percentile * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def get_provider_health(target: ProviderTarget) -> dict:
+    redis = get_redis_client()
+    calls, errors = _error_rate(target)
+    latencies = [int(value) for value in redis.lrange(LATENCY_KEY.format(target=target.key), 0, -1)]
+    rate = redis.hget(BUCKET_KEY.format(target=target.key), "rate")
+    return {
+        "target": target.key,
+        "calls": calls,
+        "errors": errors,
+        "error_rate": round(errors / calls, 4) if calls else 0.0,
+        "p50_ms": _percentile(latencies, 0.5),
+        "p95_ms": _percentile(latencies, 0.95),
+        "p99_ms": _percentile(latencies, 0.99),
+        "rate_per_second": float(rate) if rate else float(settings.provider_rate_limit_per_second),
+        "circuit_open": provider_breaker(target.provider).is_open(),
+    }
+
+
+class CallOutcomes:
+    """Provider calls started by one caller that may give up on them. abandon()
+    records each call still running as a timeout, once: its late result is
+    not recorded again when it finally arrives."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._running: dict[UUID, tuple[ProviderTarget, float]] = {}
+        self._abandoned = False
+
+    def start(self, run_id: UUID, target: ProviderTarget) -> None:
+        with self._lock:
+            if not self._abandoned:
+                self._running[run_id] = (target, time.monotonic())
+
+    def finish(self, run_id: UUID) -> float | None:
+        """Start time of a call whose outcome is still to be recorded."""
+        with self._lock:
+            entry = self._running.pop(run_id, None)
+        return entry[1] if entry else None
+
+    def abandon(self, error: BaseException) -> None:
+        with self._lock:
+            self._abandoned = True
+            running, self._running = self._running, {}
+        now = time.monotonic()
+        for target, started in running.values():
+            record_result(target, int((now - started) * 1000), error)
+
+
+# Set by the code running calls it may abandon (model attempts with a
+# deadline); ProviderHealthCallback registers the calls made in its context.
+_call_outcomes: ContextVar[CallOutcomes | None] = ContextVar("provider_call_outcomes", default=None)
+
+
+def track_calls(outcomes: CallOutcomes) -> None:
+    _call_outcomes.set(outcomes)
+
+
+class ProviderHealthCallback(BaseCallbackHandler):
+    """Attached to chat models so LangChain/LangGraph calls go through the
+    breaker and rate limiter and report their outcome."""
+
+    raise_error = True
+
+    def __init__(self, target: ProviderTarget) -> None:
+        self.target = target
+        self._started: dict[UUID, float] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs) -> None:
+        before_call(self.target)
+        outcomes = _call_outcomes.get()
+        if outcomes is not None:
+            outcomes.start(run_id, self.target)
+        else:
+            self._started[run_id] = time.monotonic()
+
+    def _finish(self, run_id: UUID) -> float | None:
+        started = self._started.pop(run_id, None)
+        outcomes = _call_outcomes.get()
+        if started is None and outcomes is not None:
+            started = outcomes.finish(run_id)
+        return started
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs) -> None:
+        started = self._finish(run_id)
+        if started is not None:
+            record_result(self.target, int((time.monotonic() - started) * 1000))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        started = self._finish(run_id)
+        if started is not None:
+            record_result(self.target, int((time.monotonic() - started) * 1000), error)
@@ -1,9 +1,17 @@
 from __future__ import annotations
 
-from typing import Any
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Any, Hashable
 from uuid import uuid4
 
-from app.clients.pusher_client import get_pusher_client
+from app.config import settings
+from app.services.realtime_transport import RealtimeTransport, build_transport
+
+logger = logging.getLogger("uvicorn.error")
 
 
 def workspace_channel(workspace_id: str) -> str:
@@ -14,10 +22,161 @@ def conversation_channel(conversation_id: str) -> str:
     return f"private-conversation-{conversation_id}"
 
 
-def _trigger(channel: str, event: str, payload: dict[str, Any]) -> None:
+class RealtimePublisher:
+    """Queues events in-process and hands them to the transport in batches
+    from a background thread. Events sharing a coalesce key while still
+    queued are merged into one; when the queue is full new events are dropped."""
+
+    def __init__(self, transport: RealtimeTransport, flush_interval: float, max_pending: int) -> None:
+        self.transport = transport
+        self._flush_interval = max(flush_interval, 0.0)
+        self._max_pending = max(max_pending, 1)
+        self._cond = threading.Condition()
+        self._pending: list[dict[str, Any]] = []
+        self._coalesced: dict[Hashable, dict[str, Any]] = {}
+        self._inflight = 0
+        self._dropped = 0
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+
+    def publish(
+        self,
+        channel: str,
+        event: str,
+        payload: dict[str, Any],
+        coalesce_key: Hashable | None = None,
+    ) -> None:
+        with self._cond:
+            self._ensure_started()
+            if coalesce_key is not None:
+                queued = self._coalesced.get(coalesce_key)
+                if queued is not None:
+                    queued["data"].update(payload)
+                    return
+            if len(self._pending) >= self._max_pending:
+                self._dropped += 1
+                if self._dropped == 1 or self._dropped % 1000 == 0:
+                    logger.warning("realtime_backpressure dropped=%s event=%s", self._dropped, event)
+                return
+            item = {"channel": channel, "name": event, "data": dict(payload)}
+            self._pending.append(item)
+            if coalesce_key is not None:
+                self._coalesced[coalesce_key] = item
+            if len(self._pending) == 1 or len(self._pending) >= self.transport.batch_limit:
+                self._cond.notify()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._thread is None or self._pid != os.getpid():
+                return not self._pending
+            self._cond.notify()
+            while self._pending or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _ensure_started(self) -> None:
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        # After a fork (Celery prefork) the parent's thread does not exist in
+        # the child, so anything queued before the fork is discarded here.
+        self._pending = []
+        self._coalesced = {}
+        self._inflight = 0
+        self._pid = pid
+        self._thread = threading.Thread(target=self._run, name="realtime-publisher", daemon=True)
+        self._thread.start()
+
+    def _take_batch(self) -> list[dict[str, Any]]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            if len(self._pending) < self.transport.batch_limit and self._flush_interval:
+                # Hold the first event briefly so bursts share a request and
+                # repeated conversation updates collapse into one.
+                self._cond.wait(self._flush_interval)
+            batch = self._pending
+            self._pending = []
+            self._coalesced = {}
+            self._inflight = len(batch)
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            limit = max(self.transport.batch_limit, 1)
+            for start in range(0, len(batch), limit):
+                chunk = batch[start : start + limit]
+                try:
+                    self.transport.send_batch(chunk)
+                except Exception as error:
+                    logger.warning(
+                        "realtime_batch_failed transport=%s events=%s error=%s",
+                        self.transport.name,
+                        len(chunk),
+                        error,
+                    )
+            with self._cond:
+                self._inflight = 0
+                self._cond.notify_all()
+
+
+_transport: RealtimeTransport | None = None
+_publisher: RealtimePublisher | None = None
+_publisher_lock = threading.Lock()
+
+
+def get_realtime_transport() -> RealtimeTransport:
+    global _transport
+    if _transport is None:
+        with _publisher_lock:
+            if _transport is None:
+                _transport = build_transport()
+    return _transport
+
+
+def set_realtime_transport(transport: RealtimeTransport | None) -> None:
+    """Swaps the transport (e.g. a RecordingTransport in tests). Events still
+    queued for the previous transport are flushed to it first."""
+    global _transport, _publisher
+    with _publisher_lock:
+        previous = _publisher
+        _transport = transport
+        _publisher = None
+    if previous is not None:
+        previous.flush()
+
+
+def get_realtime_publisher() -> RealtimePublisher:
+    global _publisher
+    if _publisher is None:
+        transport = get_realtime_transport()
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = RealtimePublisher(
+                    transport,
+                    settings.realtime_flush_interval_ms / 1000,
+                    settings.realtime_max_pending,
+                )
+                atexit.register(_publisher.flush)
+    return _publisher
+
+
+def _trigger(
+    channel: str,
+    event: str,
+    payload: dict[str, Any],
+    coalesce_key: Hashable | None = None,
+) -> None:
     try:
-        client = get_pusher_client()
-        client.trigger(channel, event, payload)
+        if settings.realtime_async_enabled:
+            get_realtime_publisher().publish(channel, event, payload, coalesce_key)
+            return
+        get_realtime_transport().send_batch([{"channel": channel, "name": event, "data": payload}])
     except Exception:
         return
 
@@ -59,7 +218,12 @@ def emit_conversation_updated(
         "conversation_id": conversation_id,
         **updates,
     }
-    _trigger(workspace_channel(workspace_id), "conversation:updated", payload)
+    _trigger(
+        workspace_channel(workspace_id),
+        "conversation:updated",
+        payload,
+        coalesce_key=("conversation:updated", conversation_id),
+    )
 
 
 def emit_tags_updated(
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+import json
+import threading
+from typing import Any
+
+from app.config import settings
+
+
+class RealtimeTransport(ABC):
+    """Delivers batches of {"channel", "name", "data"} events."""
+
+    name = "base"
+    batch_limit = 100
+
+    @abstractmethod
+    def send_batch(self, events: list[dict[str, Any]]) -> None: ...
+
+
+class PusherTransport(RealtimeTransport):
+    name = "pusher"
+    # Pusher's batch endpoint accepts at most 10 events per request.
+    batch_limit = 10
+
+    def __init__(self, client=None) -> None:
+        self._client = client
+
+    def send_batch(self, events: list[dict[str, Any]]) -> None:
+        client = self._client
+        if client is None:
+            from app.clients.pusher_client import get_pusher_client
+
+            client = get_pusher_client()
+        if len(events) == 1:
+            event = events[0]
+            client.trigger(event["channel"], event["name"], event["data"])
+            return
+        client.trigger_batch(events)
+
+
+class RedisStreamTransport(RealtimeTransport):
+    """Appends events to one capped Redis stream for the websocket gateway
+    and, optionally, publishes them on the channel name for live fan-out."""
+
+    name = "redis"
+    batch_limit = 500
+
+    def __init__(
+        self,
+        client=None,
+        stream_key: str | None = None,
+        maxlen: int | None = None,
+        publish: bool | None = None,
+    ) -> None:
+        self._client = client
+        self._stream_key = stream_key or settings.realtime_stream_key
+        self._maxlen = maxlen or settings.realtime_stream_maxlen
+        self._publish = settings.realtime_redis_publish if publish is None else publish
+
+    def send_batch(self, events: list[dict[str, Any]]) -> None:
+        client = self._client
+        if client is None:
+            from app.clients.redis_client import get_redis_client
+
+            client = get_redis_client()
+        pipeline = client.pipeline(transaction=False)
+        for event in events:
+            data = json.dumps(event["data"], ensure_ascii=False, default=str)
+            pipeline.xadd(
+                self._stream_key,
+                {"channel": event["channel"], "event": event["name"], "data": data},
+                maxlen=self._maxlen,
+                approximate=True,
+            )
+            if self._publish:
+                pipeline.publish(
+                    event["channel"],
+                    json.dumps({"event": event["name"], "data": event["data"]}, default=str),
+                )
+        pipeline.execute()
+
+
+class RecordingTransport(RealtimeTransport):
+    """Keeps every delivered event in memory; meant for tests and local runs."""
+
+    name = "recording"
+    batch_limit = 100
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.events: list[dict[str, Any]] = []
+        self.batches = 0
+
+    def send_batch(self, events: list[dict[str, Any]]) -> None:
+        with self._lock:
+            self.events.extend(events)
+            self.batches += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.events = []
+            self.batches = 0
+
+
+TRANSPORTS: dict[str, type[RealtimeTransport]] = {
+    PusherTransport.name: PusherTransport,
+    RedisStreamTransport.name: RedisStreamTransport,
+    RecordingTransport.name: RecordingTransport,
+}
+
+
+def build_transport(name: str | None = None) -> RealtimeTransport:
+    key = (name or settings.realtime_transport or PusherTransport.name).strip().lower()
+    transport_cls = TRANSPORTS.get(key)
+    if transport_cls is None:
+        raise ValueError(f"Unknown realtime transport: {key}")
+    return transport_cls()
@@ -0,0 +1,159 @@
+from dataclasses import dataclass, field
+import json
+import logging
+import threading
+import time
+
+from app.clients.redis_client import get_redis_client
+from app.clients.supabase import get_supabase_client
+from app.config import settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# WhatsApp templates of a workspace, resolved in memory for out-of-window
+# replies, the enviar_template tool and followups. The catalog is written to
+# Redis by sync_whatsapp_templates and each process keeps a short-lived copy,
+# so a send costs no database query and a rejected or unknown template is
+# refused before a credit is reserved or Graph is called.
+CATALOG_KEY = "whatsapp:templates:catalog:{workspace_id}"
+DEFAULT_CATEGORY_PRIORITY = ("utility", "transactional", "authentication", "marketing", "service")
+
+_memory: dict[str, tuple["TemplateCatalog", float]] = {}
+_memory_lock = threading.Lock()
+
+
+def _language_key(idioma: str | None) -> str:
+    return (idioma or "").strip().replace("-", "_").lower()
+
+
+@dataclass(frozen=True)
+class TemplateCatalog:
+    templates: tuple[dict, ...] = ()
+    by_id: dict[str, dict] = field(default_factory=dict)
+    by_key: dict[tuple[str, str], dict] = field(default_factory=dict)
+    default: dict | None = None
+
+    @classmethod
+    def from_rows(cls, rows: list[dict]) -> "TemplateCatalog":
+        templates = tuple(sorted(rows, key=lambda row: (row.get("nome") or "", row.get("idioma") or "")))
+        approved = [row for row in templates if is_approved(row)]
+        default = None
+        for categoria in DEFAULT_CATEGORY_PRIORITY:
+            default = next((row for row in approved if (row.get("categoria") or "").lower() == categoria), None)
+            if default:
+                break
+        return cls(
+            templates=templates,
+            by_id={str(row["id"]): row for row in templates if row.get("id")},
+            by_key={(row.get("nome") or "", _language_key(row.get("idioma"))): row for row in templates},
+            default=default or (approved[0] if approved else None),
+        )
+
+    def find(self, nome: str, idioma: str | None) -> dict | None:
+        """Template by name and language; "pt-BR" matches "pt_BR". Without a
+        language, a name with a single language is still unambiguous."""
+        template = self.by_key.get((nome, _language_key(idioma)))
+        if template or idioma:
+            return template
+        matches = [row for row in self.templates if row.get("nome") == nome]
+        return matches[0] if len(matches) == 1 else None
+
+
+def is_approved(template: dict | None) -> bool:
+    return bool(template) and (template.get("status") or "").lower() == "approved"
+
+
+def template_problem(template: dict | None) -> str | None:
+    """Why a template cannot be sent, or None if it can."""
+    if not template:
+        return "template_nao_encontrado"
+    if not is_approved(template):
+        return f"template_status_{(template.get('status') or 'desconhecido').lower()}"
+    return None
+
+
+def _load_rows(workspace_ids: list[str]) -> dict[str, list[dict]]:
+    supabase = get_supabase_client()
+    rows = (
+        supabase.table("whatsapp_templates")
+        .select("id, workspace_id, nome, idioma, categoria, status")
+        .in_("workspace_id", workspace_ids)
+        .execute()
+        .data
+        or []
+    )
+    loaded: dict[str, list[dict]] = {workspace_id: [] for workspace_id in workspace_ids}
+    for row in rows:
+        loaded.setdefault(row["workspace_id"], []).append(row)
+    return loaded
+
+
+def _remember(workspace_id: str, catalog: TemplateCatalog) -> None:
+    with _memory_lock:
+        _memory[workspace_id] = (catalog, time.monotonic() + settings.template_catalog_memory_ttl_seconds)
+
+
+def get_template_catalogs(workspace_ids: list[str]) -> dict[str, TemplateCatalog]:
+    ids = sorted({workspace_id for workspace_id in workspace_ids if workspace_id})
+    catalogs: dict[str, TemplateCatalog] = {}
+    now = time.monotonic()
+    with _memory_lock:
+        for workspace_id in ids:
+            entry = _memory.get(workspace_id)
+            if entry and entry[1] > now:
+                catalogs[workspace_id] = entry[0]
+    missing = [workspace_id for workspace_id in ids if workspace_id not in catalogs]
+    if not missing:
+        return catalogs
+
+    redis = None
+    try:
+        redis = get_redis_client()
+        raw_values = redis.mget([CATALOG_KEY.format(workspace_id=workspace_id) for workspace_id in missing])
+        for workspace_id, raw in zip(missing, raw_values):
+            if raw:
+                catalogs[workspace_id] = TemplateCatalog.from_rows(json.loads(raw))
+    except Exception:
+        logger.warning("template_catalog_cache_unavailable workspaces=%s", len(missing))
+
+    to_load = [workspace_id for workspace_id in missing if workspace_id not in catalogs]
+    if to_load:
+        loaded = _load_rows(to_load)
+        for workspace_id in to_load:
+            catalogs[workspace_id] = TemplateCatalog.from_rows(loaded.get(workspace_id) or [])
+        if redis is not None:
+            try:
+                pipeline = redis.pipeline(transaction=False)
+                for workspace_id in to_load:
+                    pipeline.set(
+                        CATALOG_KEY.format(workspace_id=workspace_id),
+                        json.dumps(loaded.get(workspace_id) or []),
+                        ex=settings.template_catalog_ttl_seconds,
+                    )
+                pipeline.execute()
+            except Exception:
+                pass
+    for workspace_id in missing:
+        _remember(workspace_id, catalogs[workspace_id])
+    return catalogs
+
+
+def get_template_catalog(workspace_id: str) -> TemplateCatalog:
+    return get_template_catalogs([workspace_id]).get(workspace_id) or TemplateCatalog()
+
+
+def refresh_template_catalog(workspace_id: str) -> TemplateCatalog:
+    """Reloads the catalog from the database and publishes it; called by the
+    template sync after it writes."""
+    rows = _load_rows([workspace_id]).get(workspace_id) or []
+    catalog = TemplateCatalog.from_rows(rows)
+    try:
+        get_redis_client().set(
+            CATALOG_KEY.format(workspace_id=workspace_id),
+            json.dumps(rows),
+            ex=settings.template_catalog_ttl_seconds,
+        )
+    except Exception:
+        logger.warning("template_catalog_publish_failed workspace_id=%s", workspace_id)
+    _remember(workspace_id, catalog)
+    return catalog
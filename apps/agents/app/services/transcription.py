@@ -4,9 +4,10 @@ import google.generativeai as genai
 
 from app.clients.openai_client import get_openai_client
 from app.config import settings
+from app.services.provider_health import ProviderTarget, call_provider
 
 
-def transcribe_audio_openai(path: Path) -> str:
+def _transcribe_openai(path: Path) -> str:
     client = get_openai_client()
     with path.open("rb") as audio_file:
         result = client.audio.transcriptions.create(
@@ -16,7 +17,7 @@ def transcribe_audio_openai(path: Path) -> str:
     return result.text
 
 
-def transcribe_audio_gemini(path: Path) -> str:
+def _transcribe_gemini(path: Path) -> str:
     genai.configure(api_key=settings.gemini_api_key)
     model = genai.GenerativeModel("gemini-2.5-flash")
     uploaded = genai.upload_file(path)
@@ -24,6 +25,16 @@ def transcribe_audio_gemini(path: Path) -> str:
     return response.text or ""
 
 
+def transcribe_audio_openai(path: Path) -> str:
+    return call_provider(ProviderTarget("openai", "whisper-1", "transcription"), _transcribe_openai, path)
+
+
+def transcribe_audio_gemini(path: Path) -> str:
+    return call_provider(
+        ProviderTarget("gemini", "gemini-2.5-flash", "transcription"), _transcribe_gemini, path
+    )
+
+
 def transcribe_audio(path: Path) -> str:
     try:
         return transcribe_audio_openai(path)
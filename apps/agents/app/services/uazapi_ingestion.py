@@ -1,17 +1,24 @@
 from __future__ import annotations
 
 from datetime import datetime, timezone
-import mimetypes
 from pathlib import Path
 from typing import Any
 import re
 
-import httpx
-
 from app.clients.supabase import get_supabase_client
-from app.clients.r2_client import build_r2_key, get_r2_client
-from app.config import settings
 from app.clients.uazapi_client import UazapiClient
+from app.services.ingestion import (
+    UAZAPI,
+    InboundBatch,
+    InboundMessage,
+    MediaRef,
+    account_workspace_id,
+    get_integration_token,
+    ingest_event,
+    load_event_payload,
+    mark_event,
+    parse_timestamp,
+)
 from app.services.workspaces import is_workspace_not_expired
 
 
@@ -44,16 +51,7 @@ def _normalize_sender(sender: str | None) -> str:
 
 
 def _parse_message_timestamp(message: dict) -> str:
-    timestamp = message.get("messageTimestamp") or message.get("timestamp")
-    if timestamp:
-        try:
-            value = int(timestamp)
-            if value > 1_000_000_000_000:
-                value = int(value / 1000)
-            return datetime.fromtimestamp(value, tz=timezone.utc).isoformat()
-        except Exception:
-            pass
-    return datetime.now(timezone.utc).isoformat()
+    return parse_timestamp(message.get("messageTimestamp") or message.get("timestamp"))
 
 
 def _get_integration_by_instance_id(instance_id: str | None) -> dict | None:
@@ -145,60 +143,6 @@ def _get_integration_by_token(instance_token: str | None) -> dict | None:
     return account_data[0] if account_data else None
 
 
-def _get_instance_token(
-    integration_id: str | None,
-    integration_account_id: str | None,
-) -> str | None:
-    if not integration_id and not integration_account_id:
-        return None
-
-    supabase = get_supabase_client()
-    if integration_account_id:
-        response = (
-            supabase.table("integration_tokens")
-            .select("access_token")
-            .eq("integration_account_id", integration_account_id)
-            .limit(1)
-            .execute()
-        )
-        data = response.data or []
-        if data:
-            return data[0].get("access_token")
-
-    if not integration_id:
-        return None
-
-    response = (
-        supabase.table("integration_tokens")
-        .select("access_token")
-        .eq("integration_id", integration_id)
-        .limit(1)
-        .execute()
-    )
-    data = response.data or []
-    return data[0].get("access_token") if data else None
-
-
-def _resolve_extension(mime_type: str | None, filename: str | None, fallback_type: str) -> str:
-    if filename:
-        suffix = Path(filename).suffix
-        if suffix:
-            return suffix
-    if mime_type:
-        guess = mimetypes.guess_extension(mime_type)
-        if guess:
-            return guess
-    if fallback_type == "imagem":
-        return ".jpg"
-    if fallback_type == "video":
-        return ".mp4"
-    if fallback_type == "audio":
-        return ".mp3"
-    if fallback_type == "pdf":
-        return ".pdf"
-    return ".bin"
-
-
 def _extract_profile_url(message: dict) -> str | None:
     return (
         message.get("profilePicUrl")
@@ -265,184 +209,6 @@ def _map_message(message: dict) -> dict:
     return {"tipo": "texto", "conteudo": text or "Mensagem recebida"}
 
 
-def _upsert_lead(
-    workspace_id: str,
-    wa_id: str,
-    name: str | None,
-    phone: str | None,
-    avatar_url: str | None = None,
-) -> dict:
-    supabase = get_supabase_client()
-    payload = {
-        "workspace_id": workspace_id,
-        "whatsapp_wa_id": wa_id,
-        "nome": name,
-        "telefone": phone,
-        "canal_origem": "whatsapp",
-        "status": "novo",
-        "avatar_url": avatar_url,
-    }
-    response = None
-    try:
-        response = (
-            supabase.table("leads")
-            .upsert(payload, on_conflict="workspace_id,whatsapp_wa_id")
-            .execute()
-        )
-    except Exception:
-        if avatar_url:
-            payload.pop("avatar_url", None)
-            response = (
-                supabase.table("leads")
-                .upsert(payload, on_conflict="workspace_id,whatsapp_wa_id")
-                .execute()
-            )
-        else:
-            raise
-
-    if response is not None and getattr(response, "error", None):
-        error_text = str(getattr(response, "error", ""))
-        if avatar_url and "avatar_url" in error_text:
-            payload.pop("avatar_url", None)
-            response = (
-                supabase.table("leads")
-                .upsert(payload, on_conflict="workspace_id,whatsapp_wa_id")
-                .execute()
-            )
-    data = response.data or {}
-    if isinstance(data, list):
-        return data[0] if data else {}
-    return data
-
-
-def _upsert_conversation(
-    workspace_id: str,
-    lead_id: str,
-    integration_account_id: str | None,
-    last_message: str,
-    last_at: str,
-) -> dict:
-    supabase = get_supabase_client()
-    payload = {
-        "workspace_id": workspace_id,
-        "lead_id": lead_id,
-        "integration_account_id": integration_account_id,
-        "canal": "whatsapp",
-        "status": "aberta",
-        "ultima_mensagem": last_message,
-        "ultima_mensagem_em": last_at,
-    }
-    response = (
-        supabase.table("conversations")
-        .upsert(payload, on_conflict="workspace_id,lead_id,canal,integration_account_id")
-        .execute()
-    )
-    data = response.data or {}
-    if isinstance(data, list):
-        return data[0] if data else {}
-    return data
-
-
-def _upsert_message(
-    workspace_id: str,
-    conversation_id: str,
-    message_id: str | None,
-    author: str,
-    message_type: str,
-    content: str,
-    created_at: str,
-    sender_id: str | None = None,
-    sender_name: str | None = None,
-    sender_avatar_url: str | None = None,
-) -> str | None:
-    supabase = get_supabase_client()
-    payload = {
-        "workspace_id": workspace_id,
-        "conversation_id": conversation_id,
-        "whatsapp_message_id": message_id,
-        "autor": author,
-        "tipo": message_type,
-        "conteudo": content,
-        "created_at": created_at,
-        "sender_id": sender_id,
-        "sender_nome": sender_name,
-        "sender_avatar_url": sender_avatar_url,
-    }
-    supabase.table("messages").upsert(
-        payload,
-        on_conflict="workspace_id,whatsapp_message_id",
-    ).execute()
-
-    if not message_id:
-        return None
-
-    response = (
-        supabase.table("messages")
-        .select("id")
-        .eq("workspace_id", workspace_id)
-        .eq("whatsapp_message_id", message_id)
-        .limit(1)
-        .execute()
-    )
-    data = response.data or []
-    return data[0]["id"] if data else None
-
-
-def _store_attachment(
-    workspace_id: str,
-    conversation_id: str,
-    message_row_id: str | None,
-    media_url: str | None,
-    message_type: str,
-    filename: str | None,
-) -> None:
-    if not message_row_id or not media_url:
-        return
-
-    with httpx.Client(timeout=30) as client:
-        response = client.get(media_url)
-        response.raise_for_status()
-        content = response.content
-        mime_type = response.headers.get("content-type")
-
-    extension = _resolve_extension(mime_type, filename, message_type)
-    storage_path = f"{workspace_id}/{conversation_id}/{message_row_id}-{Path(media_url).name}{extension}"
-
-    r2 = get_r2_client()
-    object_key = build_r2_key("inbox-attachments", storage_path)
-    r2.put_object(
-        Bucket=settings.r2_bucket_inbox_attachments,
-        Key=object_key,
-        Body=content,
-        ContentType=mime_type or "application/octet-stream",
-    )
-
-    supabase = get_supabase_client()
-
-    existing = (
-        supabase.table("attachments")
-        .select("id")
-        .eq("message_id", message_row_id)
-        .eq("storage_path", storage_path)
-        .limit(1)
-        .execute()
-        .data
-    )
-    if existing:
-        return
-
-    tamanho = len(content)
-    supabase.table("attachments").insert(
-        {
-            "workspace_id": workspace_id,
-            "message_id": message_row_id,
-            "storage_path": storage_path,
-            "tipo": message_type,
-            "tamanho_bytes": tamanho,
-        }
-    ).execute()
-
-
 def _update_account_status(
     integration_id: str | None,
     integration_account_id: str | None,
@@ -580,20 +346,147 @@ def _find_messages_anywhere(payload: Any, depth: int = 0) -> list[dict]:
     return []
 
 
-def process_uazapi_event(event_id: str, process_media: bool = True) -> dict:
-    supabase = get_supabase_client()
-    event_response = (
-        supabase.table("webhook_events")
-        .select("id, payload")
-        .eq("id", event_id)
-        .single()
-        .execute()
+def _message_records(
+    payload: dict,
+    data: Any,
+    workspace_id: str,
+    integration_id: str | None,
+    integration_account_id: str | None,
+) -> list[InboundMessage]:
+    records: list[InboundMessage] = []
+    chat_info = payload.get("chat") if isinstance(payload.get("chat"), dict) else {}
+    chat_name = chat_info.get("name") or chat_info.get("wa_contactName")
+    chat_avatar = chat_info.get("image") or chat_info.get("imagePreview")
+    chat_is_group = bool(
+        chat_info.get("wa_isGroup")
+        or chat_info.get("isGroup")
+        or str(chat_info.get("wa_chatid", "")).endswith("@g.us")
     )
-    event = event_response.data
-    if not event:
-        raise ValueError("Webhook event not found")
+    messages = _extract_messages(data)
+    if not messages:
+        messages = _extract_messages(payload)
+    if not messages:
+        messages = _find_messages_anywhere(payload)
+    for message in messages:
+        from_me = message.get("fromMe")
+        if isinstance(message.get("key"), dict):
+            from_me = from_me or message["key"].get("fromMe")
+        if message.get("wasSentByApi"):
+            continue
+        chat_id = (
+            message.get("chatid")
+            or message.get("chatId")
+            or message.get("remoteJid")
+            or message.get("jid")
+        )
+        chat_group_id = (
+            chat_id
+            or chat_info.get("wa_chatid")
+            or chat_info.get("chatId")
+            or chat_info.get("id")
+        )
+        sender = (
+            chat_id
+            or message.get("sender_pn")
+            or message.get("sender")
+            or message.get("sender_lid")
+            or message.get("owner")
+            or message.get("from")
+        )
+        if not sender and isinstance(message.get("key"), dict):
+            sender = message["key"].get("remoteJid") or message["key"].get("participant")
+
+        message_is_group = bool(
+            message.get("isGroup")
+            or message.get("wa_isGroup")
+            or str(chat_group_id or "").endswith("@g.us")
+        )
+        is_group = message_is_group or chat_is_group
+        wa_id_source = (
+            chat_group_id
+            if is_group and chat_group_id
+            else (str(sender) if sender is not None else None)
+        )
+        wa_id = _normalize_sender(wa_id_source)
+        if not wa_id:
+            continue
+        name = (
+            (chat_name if is_group else None)
+            or message.get("groupName")
+            or message.get("senderName")
+            or message.get("wa_contactName")
+            or message.get("pushName")
+            or message.get("name")
+        )
+        sender_name = (
+            message.get("senderName")
+            or message.get("wa_contactName")
+            or message.get("pushName")
+            or message.get("name")
+        )
+        sender_id_raw = (
+            message.get("participant")
+            or (message.get("key") or {}).get("participant")
+            or message.get("sender")
+            or message.get("sender_pn")
+            or message.get("from")
+            or sender
+            or wa_id
+        )
+        sender_id = _normalize_sender(sender_id_raw) if sender_id_raw else None
+        phone_source = (
+            message.get("sender_pn")
+            or message.get("sender")
+            or message.get("from")
+            or wa_id
+        )
+        if is_group and chat_group_id:
+            phone_source = chat_group_id
+
+        mapped = _map_message(message)
+        profile_url = _extract_profile_url(message)
+        media_url = mapped.get("media_url")
+        media = ()
+        if media_url:
+            media = (
+                MediaRef(
+                    tipo=mapped.get("media_tipo") or mapped["tipo"],
+                    url=media_url,
+                    filename=mapped.get("filename"),
+                    path_tag=f"-{Path(media_url).name}",
+                ),
+            )
+        records.append(
+            InboundMessage(
+                workspace_id=workspace_id,
+                integration_id=integration_id,
+                integration_account_id=integration_account_id,
+                lead_key=wa_id,
+                message_id=(
+                    message.get("messageid")
+                    or message.get("messageId")
+                    or message.get("message_id")
+                    or message.get("id")
+                    or (message.get("key") or {}).get("id")
+                ),
+                author="equipe" if from_me else "contato",
+                tipo=mapped["tipo"],
+                conteudo=mapped["conteudo"],
+                created_at=_parse_message_timestamp(message),
+                lead_name=name,
+                lead_phone=_normalize_sender(phone_source),
+                lead_avatar_url=(chat_avatar if is_group else None) or profile_url,
+                sender_id=sender_id if is_group else None,
+                sender_name=sender_name if is_group else name,
+                sender_avatar_url=profile_url if is_group else None,
+                media=media,
+            )
+        )
+    return records
 
-    payload = _safe_payload(event.get("payload"))
+
+def process_uazapi_event(event_id: str, process_media: bool = True) -> dict:
+    payload = _safe_payload(load_event_payload(event_id))
     instance_value = payload.get("instance")
     instance_id: str | None = None
     if isinstance(instance_value, dict):
@@ -625,226 +518,39 @@ def process_uazapi_event(event_id: str, process_media: bool = True) -> dict:
     if not integration_account:
         integration_account = _get_integration_by_token(payload.get("token"))
     if not integration_account:
-        supabase.table("webhook_events").update(
-            {
-                "status": "erro",
-                "processado_em": datetime.now(timezone.utc).isoformat(),
-            }
-        ).eq("id", event_id).execute()
+        mark_event(event_id, "erro")
         return {"workspace_id": None, "integration_account_id": None, "conversation_ids": []}
 
     integration_id = integration_account.get("integration_id")
     integration_account_id = integration_account.get("id")
-    integrations = integration_account.get("integrations") or {}
-    if isinstance(integrations, list):
-        workspace_id = integrations[0].get("workspace_id") if integrations else None
-    else:
-        workspace_id = integrations.get("workspace_id")
-
+    workspace_id = account_workspace_id(integration_account)
     if not workspace_id:
         return {"workspace_id": None, "integration_account_id": integration_account_id, "conversation_ids": []}
 
-    if not is_workspace_not_expired(workspace_id):
-        supabase.table("webhook_events").update(
-            {
-                "status": "bloqueado",
-                "processado_em": datetime.now(timezone.utc).isoformat(),
-                "integration_id": integration_id,
-            }
-        ).eq("id", event_id).execute()
-        return {
-            "workspace_id": workspace_id,
-            "integration_account_id": integration_account_id,
-            "conversation_ids": [],
-        }
-
-    instance_token = _get_instance_token(integration_id, integration_account_id)
-
     if event_type in {"connection", "status"}:
-        _refresh_instance_status(integration_id, integration_account_id, instance_token)
-        supabase.table("webhook_events").update(
-            {
-                "status": "processado",
-                "processado_em": datetime.now(timezone.utc).isoformat(),
-                "integration_id": integration_id,
-            }
-        ).eq("id", event_id).execute()
+        if not is_workspace_not_expired(workspace_id):
+            mark_event(event_id, "bloqueado", integration_id)
+        else:
+            _refresh_instance_status(
+                integration_id,
+                integration_account_id,
+                get_integration_token(integration_id, integration_account_id),
+            )
+            mark_event(event_id, "processado", integration_id)
         return {
             "workspace_id": workspace_id,
             "integration_account_id": integration_account_id,
             "conversation_ids": [],
         }
 
-    conversation_ids: list[str] = []
-    chat_info = payload.get("chat") if isinstance(payload.get("chat"), dict) else {}
-    chat_name = chat_info.get("name") or chat_info.get("wa_contactName")
-    chat_avatar = chat_info.get("image") or chat_info.get("imagePreview")
-    chat_is_group = bool(
-        chat_info.get("wa_isGroup")
-        or chat_info.get("isGroup")
-        or str(chat_info.get("wa_chatid", "")).endswith("@g.us")
+    return ingest_event(
+        event_id,
+        UAZAPI,
+        lambda: InboundBatch(
+            records=_message_records(payload, data, workspace_id, integration_id, integration_account_id),
+            integration_id=integration_id,
+            workspace_id=workspace_id,
+            integration_account_id=integration_account_id,
+        ),
+        process_media=process_media,
     )
-    try:
-        messages = _extract_messages(data)
-        if not messages:
-            messages = _extract_messages(payload)
-        if not messages:
-            messages = _find_messages_anywhere(payload)
-        for message in messages:
-            from_me = message.get("fromMe")
-            if isinstance(message.get("key"), dict):
-                from_me = from_me or message["key"].get("fromMe")
-            if message.get("wasSentByApi"):
-                continue
-            chat_id = (
-                message.get("chatid")
-                or message.get("chatId")
-                or message.get("remoteJid")
-                or message.get("jid")
-            )
-            chat_group_id = (
-                chat_id
-                or chat_info.get("wa_chatid")
-                or chat_info.get("chatId")
-                or chat_info.get("id")
-            )
-            sender = (
-                chat_id
-                or message.get("sender_pn")
-                or message.get("sender")
-                or message.get("sender_lid")
-                or message.get("owner")
-                or message.get("from")
-            )
-            if not sender and isinstance(message.get("key"), dict):
-                sender = message["key"].get("remoteJid") or message["key"].get("participant")
-
-            message_is_group = bool(
-                message.get("isGroup")
-                or message.get("wa_isGroup")
-                or str(chat_group_id or "").endswith("@g.us")
-            )
-            is_group = message_is_group or chat_is_group
-            wa_id_source = (
-                chat_group_id
-                if is_group and chat_group_id
-                else (str(sender) if sender is not None else None)
-            )
-            wa_id = _normalize_sender(wa_id_source)
-            if not wa_id:
-                continue
-            name = (
-                (chat_name if is_group else None)
-                or message.get("groupName")
-                or message.get("senderName")
-                or message.get("wa_contactName")
-                or message.get("pushName")
-                or message.get("name")
-            )
-            sender_name = (
-                message.get("senderName")
-                or message.get("wa_contactName")
-                or message.get("pushName")
-                or message.get("name")
-            )
-            sender_id_raw = (
-                message.get("participant")
-                or (message.get("key") or {}).get("participant")
-                or message.get("sender")
-                or message.get("sender_pn")
-                or message.get("from")
-                or sender
-                or wa_id
-            )
-            sender_id = _normalize_sender(sender_id_raw) if sender_id_raw else None
-            phone_source = (
-                message.get("sender_pn")
-                or message.get("sender")
-                or message.get("from")
-                or wa_id
-            )
-            if is_group and chat_group_id:
-                phone_source = chat_group_id
-            phone = _normalize_sender(phone_source)
-
-            mapped = _map_message(message)
-            created_at = _parse_message_timestamp(message)
-
-            profile_url = _extract_profile_url(message)
-            avatar_url = (chat_avatar if is_group else None) or profile_url
-            sender_avatar_url = profile_url
-
-            lead = _upsert_lead(
-                workspace_id=workspace_id,
-                wa_id=wa_id,
-                name=name,
-                phone=phone,
-                avatar_url=avatar_url,
-            )
-
-            conversation = _upsert_conversation(
-                workspace_id=workspace_id,
-                lead_id=lead["id"],
-                integration_account_id=integration_account_id,
-                last_message=mapped["conteudo"],
-                last_at=created_at,
-            )
-
-            conversation_ids.append(conversation["id"])
-
-            author = "equipe" if from_me else "contato"
-            message_row_id = _upsert_message(
-                workspace_id=workspace_id,
-                conversation_id=conversation["id"],
-                message_id=(
-                    message.get("messageid")
-                    or message.get("messageId")
-                    or message.get("message_id")
-                    or message.get("id")
-                    or (message.get("key") or {}).get("id")
-                ),
-                author=author,
-                message_type=mapped["tipo"],
-                content=mapped["conteudo"],
-                created_at=created_at,
-                sender_id=sender_id if is_group else None,
-                sender_name=sender_name if is_group else name,
-                sender_avatar_url=sender_avatar_url if is_group else None,
-            )
-
-            media_url = mapped.get("media_url")
-            if media_url and process_media:
-                try:
-                    _store_attachment(
-                        workspace_id=workspace_id,
-                        conversation_id=conversation["id"],
-                        message_row_id=message_row_id,
-                        media_url=media_url,
-                        message_type=mapped.get("media_tipo") or mapped["tipo"],
-                        filename=mapped.get("filename"),
-                    )
-                except Exception:
-                    pass
-    except Exception:
-        supabase.table("webhook_events").update(
-            {
-                "status": "erro",
-                "processado_em": datetime.now(timezone.utc).isoformat(),
-            }
-        ).eq("id", event_id).execute()
-        raise
-
-    supabase.table("webhook_events").update(
-        {
-            "status": "processado",
-            "processado_em": datetime.now(timezone.utc).isoformat(),
-            "integration_id": integration_id,
-        }
-    ).eq("id", event_id).execute()
-
-    unique_conversations = sorted(set(conversation_ids))
-    return {
-        "workspace_id": workspace_id,
-        "integration_account_id": integration_account_id,
-        "conversation_ids": unique_conversations,
-    }
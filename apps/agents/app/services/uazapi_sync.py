@@ -1,23 +1,34 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
+import logging
+import time
 from typing import Any
 
+from app.clients.redis_client import acquire_lock, get_redis_client, release_lock, renew_lock
 from app.clients.supabase import get_supabase_client
 from app.clients.uazapi_client import UazapiClient
+from app.config import settings
+from app.services.ingestion import UAZAPI, InboundMessage, ingest
 from app.services.uazapi_ingestion import (
     _extract_messages,
     _map_message,
     _normalize_sender,
     _parse_message_timestamp,
-    _upsert_conversation,
-    _upsert_lead,
-    _upsert_message,
 )
 from app.services.workspaces import is_workspace_not_expired
 
+logger = logging.getLogger("uvicorn.error")
 
 PROVIDER_NAO_OFICIAL = "whatsapp_nao_oficial"
+# Chats already imported by an unfinished sync, so a crashed or partially
+# failed run resumes instead of starting over. Cleared when a sync finishes.
+SYNC_DONE_KEY = "uazapi:sync:done:{account_id}"
+SYNC_LOCK_KEY = "uazapi:sync:lock:{account_id}"
+SYNC_LOCK_SECONDS = 600
+CHECKPOINT_TTL_SECONDS = 7 * 86400
+PROGRESS_INTERVAL_SECONDS = 5
 
 
 def _normalize_chat_id(value: str | None) -> str | None:
@@ -178,6 +189,97 @@ def _prune_messages(conversation_id: str, limit: int = 50) -> None:
     supabase.table("messages").delete().in_("id", ids).execute()
 
 
+def _message_records(
+    workspace_id: str,
+    integration_account_id: str,
+    chat: dict,
+    chat_id: str,
+    messages: list[dict],
+) -> list[InboundMessage]:
+    """Records oldest first, so the newest message becomes the conversation's
+    last message; repeated ids are collapsed by upsert_messages."""
+    wa_id = _normalize_sender(chat_id)
+    name = _resolve_chat_name(chat)
+    avatar_url = _resolve_chat_avatar(chat)
+    records: list[InboundMessage] = []
+    for message in reversed(messages):
+        if message.get("wasSentByApi"):
+            continue
+        from_me = message.get("fromMe")
+        if isinstance(message.get("key"), dict):
+            from_me = from_me or message["key"].get("fromMe")
+        mapped = _map_message(message)
+        records.append(
+            InboundMessage(
+                workspace_id=workspace_id,
+                integration_id=None,
+                integration_account_id=integration_account_id,
+                lead_key=wa_id,
+                message_id=(
+                    message.get("messageid")
+                    or message.get("messageId")
+                    or message.get("message_id")
+                    or message.get("id")
+                    or (message.get("key") or {}).get("id")
+                ),
+                author="equipe" if from_me else "contato",
+                tipo=mapped["tipo"],
+                conteudo=mapped["conteudo"],
+                created_at=_parse_message_timestamp(message),
+                lead_name=name,
+                lead_phone=wa_id,
+                lead_avatar_url=avatar_url,
+            )
+        )
+    return records
+
+
+def _import_chat(
+    client: UazapiClient,
+    workspace_id: str,
+    integration_account_id: str,
+    chat: dict,
+    chat_id: str,
+) -> int:
+    limit = settings.uazapi_sync_messages_per_chat
+    messages_payload = client.message_find({"chatid": chat_id, "limit": limit, "offset": 0})
+    messages = _extract_messages(messages_payload)
+    if not messages:
+        messages = _extract_messages(messages_payload.get("data") if isinstance(messages_payload, dict) else {})
+    if not messages:
+        return 0
+
+    # The workspace was checked when the sync started; history is not
+    # published to the inbox and its media is not downloaded.
+    result = ingest(
+        UAZAPI,
+        _message_records(workspace_id, integration_account_id, chat, chat_id, messages),
+        process_media=False,
+        notify=False,
+        check_workspaces=False,
+    )
+    for conversation_id in result.conversation_ids:
+        _prune_messages(conversation_id, limit=limit)
+    return len({row_id for row_id in result.message_ids if row_id})
+
+
+def _checkpoint(integration_account_id: str) -> set[str]:
+    try:
+        return set(get_redis_client().smembers(SYNC_DONE_KEY.format(account_id=integration_account_id)) or [])
+    except Exception:
+        return set()
+
+
+def _mark_chat_done(integration_account_id: str, chat_id: str) -> None:
+    try:
+        redis = get_redis_client()
+        key = SYNC_DONE_KEY.format(account_id=integration_account_id)
+        redis.sadd(key, chat_id)
+        redis.expire(key, CHECKPOINT_TTL_SECONDS)
+    except Exception:
+        pass
+
+
 def _update_sync_status(
     integration_account_id: str,
     status: str,
@@ -250,94 +352,96 @@ def sync_uazapi_history(workspace_id: str, integration_account_id: str) -> dict:
     if account.get("sync_status") == "done":
         return {"status": "already_done", "chats": 0, "messages": 0}
 
+    redis = get_redis_client()
+    lock_key = SYNC_LOCK_KEY.format(account_id=integration_account_id)
+    lock_token = acquire_lock(lock_key, SYNC_LOCK_SECONDS)
+    if not lock_token:
+        return {"status": "running", "chats": 0, "messages": 0}
+
+    started = time.monotonic()
     try:
         client = UazapiClient(token)
-        chats, total_records = _list_chats(client, limit=100, max_total=100)
-        total_records = min(total_records or len(chats), len(chats))
-        _update_sync_status(
-            integration_account_id,
-            status="running",
-            total=total_records,
-            done=0,
-        )
-
-        total_messages = 0
-        for index, chat in enumerate(chats, start=1):
+        max_chats = settings.uazapi_sync_max_chats or None
+        chats, total_records = _list_chats(client, limit=100, max_total=max_chats)
+        pending: list[tuple[dict, str]] = []
+        seen: set[str] = set()
+        for chat in chats:
             chat_id = _resolve_chat_id(chat)
-            if not chat_id:
-                continue
-
-            messages_payload = client.message_find(
-                {"chatid": chat_id, "limit": 50, "offset": 0}
-            )
-            messages = _extract_messages(messages_payload)
-            if not messages:
-                messages = _extract_messages(messages_payload.get("data") if isinstance(messages_payload, dict) else {})
-
-            if not messages:
-                continue
-
-            name = _resolve_chat_name(chat)
-            wa_id = _normalize_sender(chat_id)
-            lead = _upsert_lead(
-                workspace_id=workspace_id,
-                wa_id=wa_id,
-                name=name,
-                phone=_normalize_sender(wa_id),
-                avatar_url=_resolve_chat_avatar(chat),
-            )
-
-            newest = messages[0]
-            mapped_newest = _map_message(newest)
-            last_at = _parse_message_timestamp(newest)
-            last_text = mapped_newest["conteudo"]
-
-            conversation = _upsert_conversation(
-                workspace_id=workspace_id,
-                lead_id=lead["id"],
-                integration_account_id=integration_account_id,
-                last_message=last_text,
-                last_at=last_at,
-            )
+            if chat_id and chat_id not in seen:
+                seen.add(chat_id)
+                pending.append((chat, chat_id))
+        total_records = len(pending)
+
+        # A previous run that crashed or failed some chats left their ids in
+        # the checkpoint; those are not fetched again.
+        completed = _checkpoint(integration_account_id) & seen
+        pending = [(chat, chat_id) for chat, chat_id in pending if chat_id not in completed]
+        done = len(completed)
+        _update_sync_status(integration_account_id, status="running", total=total_records, done=done)
 
-            for message in reversed(messages):
-                from_me = message.get("fromMe")
-                if isinstance(message.get("key"), dict):
-                    from_me = from_me or message["key"].get("fromMe")
-                if message.get("wasSentByApi"):
+        total_messages = 0
+        failed: list[str] = []
+        last_report = time.monotonic()
+        workers = max(min(settings.uazapi_sync_concurrency, len(pending)), 1)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="uazapi-sync") as executor:
+            futures = {
+                executor.submit(_import_chat, client, workspace_id, integration_account_id, chat, chat_id): chat_id
+                for chat, chat_id in pending
+            }
+            for future in as_completed(futures):
+                chat_id = futures[future]
+                try:
+                    total_messages += future.result()
+                except Exception as error:
+                    failed.append(chat_id)
+                    logger.warning(
+                        "uazapi_sync_chat_failed account_id=%s chat_id=%s error=%s",
+                        integration_account_id,
+                        chat_id,
+                        error,
+                    )
                     continue
-
-                author = "equipe" if from_me else "contato"
-                mapped = _map_message(message)
-                created_at = _parse_message_timestamp(message)
-
-                _upsert_message(
-                    workspace_id=workspace_id,
-                    conversation_id=conversation["id"],
-                    message_id=(
-                        message.get("messageid")
-                        or message.get("messageId")
-                        or message.get("message_id")
-                        or message.get("id")
-                        or (message.get("key") or {}).get("id")
-                    ),
-                    author=author,
-                    message_type=mapped["tipo"],
-                    content=mapped["conteudo"],
-                    created_at=created_at,
-                )
-
-                total_messages += 1
-
-            _prune_messages(conversation["id"], limit=50)
-
-            if index == total_records or index % 10 == 0:
-                _update_sync_status(
-                    integration_account_id,
-                    status="running",
-                    total=total_records,
-                    done=index,
-                )
+                _mark_chat_done(integration_account_id, chat_id)
+                done += 1
+                if not renew_lock(lock_key, lock_token, SYNC_LOCK_SECONDS):
+                    # The lock expired and another run may own it now; the
+                    # checkpoint keeps this run's progress either way.
+                    logger.warning("uazapi_sync_lock_lost account_id=%s", integration_account_id)
+                now = time.monotonic()
+                if done == total_records or now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                    last_report = now
+                    _update_sync_status(integration_account_id, status="running", total=total_records, done=done)
+                    elapsed = max(now - started, 0.001)
+                    logger.info(
+                        "uazapi_sync_progress account_id=%s done=%s total=%s messages=%s chats_per_s=%.2f messages_per_s=%.1f",
+                        integration_account_id,
+                        done,
+                        total_records,
+                        total_messages,
+                        (done - len(completed)) / elapsed,
+                        total_messages / elapsed,
+                    )
+
+        elapsed = max(time.monotonic() - started, 0.001)
+        summary = {
+            "chats": total_records,
+            "messages": total_messages,
+            "resumed": len(completed),
+            "failed": len(failed),
+            "elapsed_ms": int(elapsed * 1000),
+            "chats_per_second": round((done - len(completed)) / elapsed, 2),
+            "messages_per_second": round(total_messages / elapsed, 1),
+        }
+        if failed:
+            _update_sync_status(
+                integration_account_id,
+                status="erro",
+                total=total_records,
+                done=done,
+                error=f"{len(failed)} conversas falharam; a proxima sincronizacao retoma de onde parou",
+                finished=True,
+            )
+            return {"status": "partial", **summary}
 
         _update_sync_status(
             integration_account_id,
@@ -346,7 +450,9 @@ def sync_uazapi_history(workspace_id: str, integration_account_id: str) -> dict:
             done=total_records,
             finished=True,
         )
-        return {"status": "ok", "chats": len(chats), "messages": total_messages}
+        redis.delete(SYNC_DONE_KEY.format(account_id=integration_account_id))
+        logger.info("uazapi_sync_done account_id=%s %s", integration_account_id, summary)
+        return {"status": "ok", **summary}
     except Exception as exc:
         _update_sync_status(
             integration_account_id,
@@ -355,3 +461,5 @@ def sync_uazapi_history(workspace_id: str, integration_account_id: str) -> dict:
             finished=True,
         )
         raise
+    finally:
+        release_lock(lock_key, lock_token)
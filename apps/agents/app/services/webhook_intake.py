@@ -0,0 +1,228 @@
+import time
+from typing import Any, Callable
+import zlib
+
+from redis.exceptions import ResponseError
+
+from app.clients.redis_client import get_redis_client
+from app.clients.supabase import get_supabase_client
+from app.config import settings
+from app.services.ingestion import dispatch_agents
+from app.services.whatsapp_ingestion import process_whatsapp_event
+
+# WhatsApp webhook intake over Redis streams. The endpoint only appends the
+# event id to INTAKE_STREAM. A router moves ids, in arrival order, to one of
+# N partition streams chosen by (phone_number_id, sender), so every event of
+# a conversation lands in the same partition. A partition is drained by one
+# lock holder at a time, oldest entry first, which keeps a conversation's
+# events in order while different conversations are ingested in parallel.
+INTAKE_STREAM = "webhooks:whatsapp:intake"
+PARTITION_STREAM = "webhooks:whatsapp:partition:{partition}"
+PARTITION_LOCK_KEY = "webhooks:whatsapp:partition:lock:{partition}"
+# Partitions with new entries, popped by idle workers.
+READY_KEY = "webhooks:whatsapp:ready"
+ROUTER_LOCK_KEY = "webhooks:whatsapp:router:lock"
+ATTEMPTS_KEY = "webhooks:whatsapp:attempts"
+# Events whose webhook_events row could not be read yet (the insert is not
+# visible to the router), scored by when to route them again. Without the
+# payload there is no partition, so they wait here instead of blocking the
+# router, up to WEBHOOK_INTAKE_MAX_ATTEMPTS rounds before being routed anyway.
+ROUTE_RETRY_KEY = "webhooks:whatsapp:route_retry"
+ROUTE_ATTEMPTS_KEY = "webhooks:whatsapp:route_attempts"
+ROUTER_GROUP = "router"
+INGESTION_GROUP = "ingestion"
+
+_groups: set[tuple[str, str]] = set()
+
+
+def enqueue_event(event_id: str) -> str:
+    """Records the event for the workers; a single XADD, whatever the payload."""
+    return get_redis_client().xadd(
+        INTAKE_STREAM,
+        {"event_id": event_id},
+        maxlen=settings.webhook_intake_stream_maxlen,
+        approximate=True,
+    )
+
+
+def ingest_whatsapp_event(
+    event_id: str,
+    enqueue_agent: Callable[[str, str], Any],
+    enqueue_media: Callable[[str, list[dict]], Any],
+) -> dict:
+    """Ingests an event without its media, hands conversations to the
+    active agent and leaves media downloads to enqueue_media."""
+    result = process_whatsapp_event(event_id, process_media=False)
+    dispatch_agents(
+        result.get("workspace_id"),
+        result.get("integration_account_id"),
+        result.get("conversation_ids") or [],
+        enqueue_agent,
+    )
+    if result.get("media"):
+        enqueue_media(event_id, result["media"])
+    return result
+
+
+def partition_for(payload: dict | None) -> int:
+    """Partition of the conversation an event belongs to: the receiving
+    number and the sender of its first message or status."""
+    key = ""
+    entries = (payload or {}).get("entry")
+    for entry in entries if isinstance(entries, list) else []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            messages = value.get("messages") or []
+            statuses = value.get("statuses") or []
+            sender = (messages[0].get("from") if messages else None) or (
+                statuses[0].get("recipient_id") if statuses else None
+            )
+            key = f"{(value.get('metadata') or {}).get('phone_number_id') or ''}:{sender or ''}"
+            break
+        if key:
+            break
+    return zlib.crc32(key.encode()) % max(settings.webhook_intake_partitions, 1)
+
+
+def _ensure_group(stream: str, group: str) -> None:
+    if (stream, group) in _groups:
+        return
+    try:
+        get_redis_client().xgroup_create(stream, group, id="0", mkstream=True)
+    except ResponseError as exc:
+        if "BUSYGROUP" not in str(exc):
+            raise
+    _groups.add((stream, group))
+
+
+def _read(stream: str, group: str, consumer: str, count: int, block_ms: int | None = None) -> list[tuple[str, str | None]]:
+    """Entries delivered to the consumer but not acknowledged first, then
+    new ones; a crashed reader's entries are retried before anything newer."""
+    _ensure_group(stream, group)
+    redis = get_redis_client()
+    for start, block in (("0", None), (">", block_ms)):
+        response = redis.xreadgroup(group, consumer, {stream: start}, count=count, block=block)
+        entries = [
+            (entry_id, (fields or {}).get("event_id"))
+            for _, items in response or []
+            for entry_id, fields in items
+        ]
+        if entries:
+            return entries
+    return []
+
+
+def _load_payloads(event_ids: list[str]) -> dict[str, dict]:
+    rows = (
+        get_supabase_client()
+        .table("webhook_events")
+        .select("id, payload")
+        .in_("id", event_ids)
+        .execute()
+        .data
+        or []
+    )
+    return {row["id"]: row.get("payload") if isinstance(row.get("payload"), dict) else {} for row in rows}
+
+
+def _requeue_due_retries() -> None:
+    redis = get_redis_client()
+    due = redis.zrangebyscore(ROUTE_RETRY_KEY, "-inf", time.time())
+    if not due:
+        return
+    pipeline = redis.pipeline(transaction=True)
+    for event_id in due:
+        pipeline.xadd(
+            INTAKE_STREAM,
+            {"event_id": event_id},
+            maxlen=settings.webhook_intake_stream_maxlen,
+            approximate=True,
+        )
+    pipeline.zrem(ROUTE_RETRY_KEY, *due)
+    pipeline.execute()
+
+
+def route_events(block_ms: int | None = None) -> int:
+    """Moves a batch of intake entries to their partition streams in one
+    transaction, so an entry is never both routed and still pending. An
+    event whose row is missing is set aside in ROUTE_RETRY_KEY and routed
+    once it can be read."""
+    _requeue_due_retries()
+    entries = _read(INTAKE_STREAM, ROUTER_GROUP, "router", settings.webhook_intake_batch_size, block_ms)
+    if not entries:
+        return 0
+    payloads = _load_payloads(sorted({event_id for _, event_id in entries if event_id}))
+    redis = get_redis_client()
+    missing = sorted({event_id for _, event_id in entries if event_id and event_id not in payloads})
+    attempts: dict[str, int] = {}
+    if missing:
+        counter = redis.pipeline(transaction=False)
+        for event_id in missing:
+            counter.hincrby(ROUTE_ATTEMPTS_KEY, event_id, 1)
+        attempts = dict(zip(missing, (int(value) for value in counter.execute())))
+    pipeline = redis.pipeline(transaction=True)
+    partitions: list[int] = []
+    retry_at = time.time() + settings.webhook_intake_retry_seconds
+    for _, event_id in entries:
+        if not event_id:
+            continue
+        if attempts.get(event_id, 0) and attempts[event_id] < settings.webhook_intake_max_attempts:
+            pipeline.zadd(ROUTE_RETRY_KEY, {event_id: retry_at})
+            continue
+        # Past its last attempt an event without a row is routed anyway;
+        # ingestion then records it as failed.
+        partition = partition_for(payloads.get(event_id))
+        pipeline.xadd(
+            PARTITION_STREAM.format(partition=partition),
+            {"event_id": event_id},
+            maxlen=settings.webhook_intake_stream_maxlen,
+            approximate=True,
+        )
+        pipeline.hdel(ROUTE_ATTEMPTS_KEY, event_id)
+        if partition not in partitions:
+            partitions.append(partition)
+    entry_ids = [entry_id for entry_id, _ in entries]
+    pipeline.xack(INTAKE_STREAM, ROUTER_GROUP, *entry_ids)
+    pipeline.xdel(INTAKE_STREAM, *entry_ids)
+    if partitions:
+        pipeline.lpush(READY_KEY, *partitions)
+    pipeline.execute()
+    return len(entry_ids)
+
+
+def read_partition(partition: int) -> list[tuple[str, str | None]]:
+    # One named consumer per partition: whoever holds the lock resumes the
+    # previous holder's unacknowledged entries.
+    return _read(
+        PARTITION_STREAM.format(partition=partition),
+        INGESTION_GROUP,
+        f"partition-{partition}",
+        settings.webhook_intake_batch_size,
+    )
+
+
+def ack_partition_entry(partition: int, entry_id: str, event_id: str | None) -> None:
+    stream = PARTITION_STREAM.format(partition=partition)
+    pipeline = get_redis_client().pipeline(transaction=True)
+    pipeline.xack(stream, INGESTION_GROUP, entry_id)
+    pipeline.xdel(stream, entry_id)
+    if event_id:
+        pipeline.hdel(ATTEMPTS_KEY, event_id)
+    pipeline.execute()
+
+
+def record_attempt(event_id: str) -> int:
+    return int(get_redis_client().hincrby(ATTEMPTS_KEY, event_id, 1))
+
+
+def partition_backlog(partition: int) -> int:
+    return int(get_redis_client().xlen(PARTITION_STREAM.format(partition=partition)))
+
+
+def notify_partition(partition: int) -> None:
+    get_redis_client().lpush(READY_KEY, partition)
+
+
+def next_ready_partition(timeout_seconds: int) -> int | None:
+    item = get_redis_client().brpop(READY_KEY, timeout=timeout_seconds)
+    return int(item[1]) if item else None
@@ -1,10 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
 from typing import Any
 
 import httpx
 
+from app.clients.redis_client import acquire_lock, get_redis_client, release_lock
 from app.clients.supabase import get_supabase_client
 from app.config import settings
-from app.services.workspaces import is_workspace_not_expired
+from app.services.template_catalog import refresh_template_catalog
+from app.services.workspaces import get_active_workspaces, is_workspace_not_expired
+
+logger = logging.getLogger("uvicorn.error")
+
+TEMPLATE_COLUMNS = "nome, categoria, idioma, status"
+# Last template list read from each WABA, shared by every workspace on it
+# for one interval; scheduled syncs also take a short per-WABA lock while
+# they fetch, so concurrent callers do not hit Graph for the same list.
+WABA_TEMPLATES_KEY = "whatsapp:templates:waba:{waba_id}"
+WABA_LOCK_KEY = "whatsapp:templates:waba:lock:{waba_id}"
+WABA_LOCK_SECONDS = 60
+# Hash of the catalog last written for a workspace; an identical fetch skips
+# the database entirely. Expires daily so edits made elsewhere are repaired.
+CATALOG_HASH_KEY = "whatsapp:templates:hash:{workspace_id}"
+CATALOG_HASH_TTL_SECONDS = 86400
 
 
 def _list_templates(access_token: str, waba_id: str) -> list[dict]:
@@ -40,7 +60,127 @@ def _list_templates(access_token: str, waba_id: str) -> list[dict]:
     return [tpl for tpl in templates if tpl.get("nome") and tpl.get("idioma")]
 
 
-def sync_whatsapp_templates(workspace_id: str, integration_account_id: str | None = None) -> dict:
+def _account_access_token(account: dict) -> str | None:
+    supabase = get_supabase_client()
+    for column, value in (("integration_account_id", account.get("id")), ("integration_id", account.get("integration_id"))):
+        if not value:
+            continue
+        tokens = (
+            supabase.table("integration_tokens")
+            .select("access_token")
+            .eq(column, value)
+            .limit(1)
+            .execute()
+            .data
+            or []
+        )
+        if tokens and tokens[0].get("access_token"):
+            return tokens[0]["access_token"]
+    return None
+
+
+def _fetch_account_templates(account: dict, scheduled: bool) -> list[dict] | None:
+    """Templates of the account's WABA, or None when they could not be read.
+    Scheduled syncs read a WABA at most once per interval across the fleet:
+    the first caller fetches and shares the list through Redis, later callers
+    (other workspaces on the same WABA, overlapping runs) reuse it."""
+    waba_id = account.get("waba_id") or account.get("business_account_id")
+    if not account.get("integration_id") or not waba_id:
+        return None
+    redis = get_redis_client()
+    waba_key = WABA_TEMPLATES_KEY.format(waba_id=waba_id)
+    lock_key = WABA_LOCK_KEY.format(waba_id=waba_id)
+    token = None
+    if scheduled:
+        raw = redis.get(waba_key)
+        if raw:
+            return json.loads(raw)
+        token = acquire_lock(lock_key, WABA_LOCK_SECONDS)
+        if not token:
+            return None
+    try:
+        access_token = _account_access_token(account)
+        if not access_token:
+            return None
+        templates = _list_templates(access_token, waba_id)
+        redis.set(waba_key, json.dumps(templates), ex=settings.whatsapp_template_waba_interval_seconds)
+        return templates
+    finally:
+        # Released on failure too, so the next scheduled run retries the WABA.
+        if token:
+            release_lock(lock_key, token)
+
+
+def _template_row(workspace_id: str, template: dict) -> dict:
+    return {
+        "workspace_id": workspace_id,
+        "nome": template.get("nome"),
+        "categoria": template.get("categoria") or "",
+        "idioma": template.get("idioma") or "",
+        "status": template.get("status") or "",
+    }
+
+
+def _catalog_hash(rows: list[dict]) -> str:
+    payload = sorted((row["nome"], row["idioma"], row["categoria"], row["status"]) for row in rows)
+    return hashlib.sha1(json.dumps(payload).encode("utf-8")).hexdigest()
+
+
+def _apply_diff(workspace_id: str, rows: list[dict], complete: bool) -> dict:
+    """Writes only what changed. New and changed templates are written
+    before removed ones are deleted, so a reader never sees the catalog
+    without a template that still exists. Removals are only applied when
+    every account was read, since a missing account would look like all of
+    its templates were deleted."""
+    supabase = get_supabase_client()
+    existing = (
+        supabase.table("whatsapp_templates")
+        .select(f"id, {TEMPLATE_COLUMNS}")
+        .eq("workspace_id", workspace_id)
+        .execute()
+        .data
+        or []
+    )
+    existing_by_key: dict[tuple, dict] = {}
+    duplicates: list[str] = []
+    for row in existing:
+        key = (row.get("nome"), row.get("idioma"))
+        if key in existing_by_key:
+            duplicates.append(row["id"])
+        else:
+            existing_by_key[key] = row
+    wanted_keys = {(row["nome"], row["idioma"]) for row in rows}
+
+    inserts = [row for row in rows if (row["nome"], row["idioma"]) not in existing_by_key]
+    updates = [
+        (existing_by_key[(row["nome"], row["idioma"])]["id"], row)
+        for row in rows
+        if (row["nome"], row["idioma"]) in existing_by_key
+        and any(
+            (existing_by_key[(row["nome"], row["idioma"])].get(column) or "") != row[column]
+            for column in ("categoria", "status")
+        )
+    ]
+    deletes = duplicates + (
+        [row["id"] for key, row in existing_by_key.items() if key not in wanted_keys] if complete else []
+    )
+
+    if inserts:
+        supabase.table("whatsapp_templates").insert(inserts).execute()
+    for template_id, row in updates:
+        supabase.table("whatsapp_templates").update(
+            {"categoria": row["categoria"], "status": row["status"]}
+        ).eq("id", template_id).execute()
+    if deletes:
+        supabase.table("whatsapp_templates").delete().in_("id", deletes).execute()
+    return {"inserted": len(inserts), "updated": len(updates), "deleted": len(deletes)}
+
+
+def sync_whatsapp_templates(
+    workspace_id: str,
+    integration_account_id: str | None = None,
+    scheduled: bool = False,
+) -> dict:
     supabase = get_supabase_client()
     if not is_workspace_not_expired(workspace_id):
         return {"status": "blocked", "templates": 0}
@@ -55,60 +195,75 @@ def sync_whatsapp_templates(workspace_id: str, integration_account_id: str | Non
         accounts_query = accounts_query.eq("id", integration_account_id)
 
     accounts = accounts_query.execute().data or []
+    accounts = [account for account in accounts if (account.get("provider") or "whatsapp_oficial") == "whatsapp_oficial"]
     if not accounts:
         return {"status": "no_accounts", "templates": 0}
 
-    templates_by_key: dict[str, dict] = {}
+    fetched: list[list[dict] | None] = [None] * len(accounts)
+    workers = max(min(len(accounts), settings.whatsapp_template_sync_concurrency), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_fetch_account_templates, account, scheduled): index
+            for index, account in enumerate(accounts)
+        }
+        for future, index in futures.items():
+            try:
+                fetched[index] = future.result()
+            except Exception as error:
+                logger.warning(
+                    "whatsapp_templates_fetch_failed workspace_id=%s account_id=%s error=%s",
+                    workspace_id,
+                    accounts[index].get("id"),
+                    error,
+                )
 
-    for account in accounts:
-        integration_id = account.get("integration_id")
-        provider = account.get("provider") or "whatsapp_oficial"
-        if provider != "whatsapp_oficial":
-            continue
-        waba_id = account.get("waba_id") or account.get("business_account_id")
-        if not integration_id or not waba_id:
-            continue
+    templates_by_key: dict[str, dict] = {}
+    for templates in fetched:
+        for template in templates or []:
+            templates_by_key[f"{template.get('nome')}::{template.get('idioma')}"] = template
+    rows = [_template_row(workspace_id, template) for template in templates_by_key.values()]
+    complete = not integration_account_id and all(templates is not None for templates in fetched)
+    if not complete and not rows:
+        return {"status": "skipped", "templates": 0}
 
-        token_response = (
-            supabase.table("integration_tokens")
-            .select("access_token")
-            .eq("integration_account_id", account.get("id"))
-            .limit(1)
-            .execute()
-        )
-        tokens = token_response.data or []
-        access_token = tokens[0].get("access_token") if tokens else None
-        if not access_token:
-            token_response = (
-                supabase.table("integration_tokens")
-                .select("access_token")
-                .eq("integration_id", integration_id)
-                .limit(1)
-                .execute()
-            )
-            tokens = token_response.data or []
-            access_token = tokens[0].get("access_token") if tokens else None
-        if not access_token:
-            continue
+    redis = get_redis_client()
+    hash_key = CATALOG_HASH_KEY.format(workspace_id=workspace_id)
+    catalog_hash = _catalog_hash(rows)
+    if complete and redis.get(hash_key) == catalog_hash:
+        return {"status": "unchanged", "templates": len(rows)}
 
-        templates = _list_templates(access_token, waba_id)
-        for template in templates:
-            key = f"{template.get('nome')}::{template.get('idioma')}"
-            templates_by_key[key] = template
-
-    templates_payload = [
-        {
-            "workspace_id": workspace_id,
-            "nome": template.get("nome"),
-            "categoria": template.get("categoria") or "",
-            "idioma": template.get("idioma") or "",
-            "status": template.get("status") or "",
-        }
-        for template in templates_by_key.values()
-    ]
+    changes = _apply_diff(workspace_id, rows, complete)
+    refresh_template_catalog(workspace_id)
+    if complete:
+        redis.set(hash_key, catalog_hash, ex=CATALOG_HASH_TTL_SECONDS)
+    else:
+        redis.delete(hash_key)
+    logger.info(
+        "whatsapp_templates_synced workspace_id=%s templates=%s inserted=%s updated=%s deleted=%s complete=%s",
+        workspace_id,
+        len(rows),
+        changes["inserted"],
+        changes["updated"],
+        changes["deleted"],
+        complete,
+    )
+    return {"status": "ok", "templates": len(rows), **changes}
 
-    supabase.table("whatsapp_templates").delete().eq("workspace_id", workspace_id).execute()
-    if templates_payload:
-        supabase.table("whatsapp_templates").insert(templates_payload).execute()
 
-    return {"status": "ok", "templates": len(templates_payload)}
+def list_template_sync_workspaces() -> list[str]:
+    """Workspaces with an official WhatsApp account, for the scheduled sync."""
+    supabase = get_supabase_client()
+    accounts = (
+        supabase.table("integration_accounts")
+        .select("provider, integrations!inner(workspace_id, canal)")
+        .eq("integrations.canal", "whatsapp")
+        .execute()
+        .data
+        or []
+    )
+    workspace_ids = {
+        (account.get("integrations") or {}).get("workspace_id")
+        for account in accounts
+        if (account.get("provider") or "whatsapp_oficial") == "whatsapp_oficial"
+    }
+    return sorted(get_active_workspaces([workspace_id for workspace_id in workspace_ids if workspace_id]))
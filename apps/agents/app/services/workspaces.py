@@ -3,6 +3,16 @@ from datetime import datetime, timezone
 from app.clients.supabase import get_supabase_client
 
 
+def _is_trial_active(trial_ends_at) -> bool:
+    if not trial_ends_at:
+        return True
+    try:
+        ends_at = datetime.fromisoformat(str(trial_ends_at).replace("Z", "+00:00"))
+    except Exception:
+        return False
+    return ends_at >= datetime.now(timezone.utc)
+
+
 def is_workspace_not_expired(workspace_id: str | None) -> bool:
     if not workspace_id:
         return False
@@ -15,11 +25,20 @@ def is_workspace_not_expired(workspace_id: str | None) -> bool:
         .execute()
     )
     data = response.data or {}
-    trial_ends_at = data.get("trial_ends_at")
-    if not trial_ends_at:
-        return True
-    try:
-        ends_at = datetime.fromisoformat(str(trial_ends_at).replace("Z", "+00:00"))
-    except Exception:
-        return False
-    return ends_at >= datetime.now(timezone.utc)
+    return _is_trial_active(data.get("trial_ends_at"))
+
+
+def get_active_workspaces(workspace_ids: list[str]) -> set[str]:
+    ids = sorted({workspace_id for workspace_id in workspace_ids if workspace_id})
+    if not ids:
+        return set()
+    supabase = get_supabase_client()
+    rows = (
+        supabase.table("workspaces")
+        .select("id, trial_ends_at")
+        .in_("id", ids)
+        .execute()
+        .data
+        or []
+    )
+    return {row["id"] for row in rows if _is_trial_active(row.get("trial_ends_at"))}
@@ -1,17 +1,23 @@
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+import json
+from zoneinfo import ZoneInfo
 
 from app.clients.calendar_client import (
     create_event,
     delete_event,
     get_event,
     query_freebusy,
-    refresh_access_token,
     update_event,
 )
+from app.clients.redis_client import get_redis_client
 from app.clients.supabase import get_supabase_client
+from app.config import settings
+from app.services.availability import SlotOptions, find_free_slots, working_windows
+from app.services.calendar_tokens import call_with_token
 
 
-def _resolve_calendar(agent_id: str, calendar_id: str | None = None) -> tuple[str, str]:
+def _resolve_calendar(agent_id: str, calendar_id: str | None = None) -> dict:
     supabase = get_supabase_client()
     query = supabase.table("agent_calendar_links").select("calendar_id, integration_id").eq("agent_id", agent_id)
     if calendar_id:
@@ -19,42 +25,7 @@ def _resolve_calendar(agent_id: str, calendar_id: str | None = None) -> tuple[st
     link = query.limit(1).single().execute().data
     if not link:
         raise ValueError("Agent has no calendar configured")
-
-    tokens = (
-        supabase.table("calendar_tokens")
-        .select("access_token, refresh_token, expires_at")
-        .eq("integration_id", link["integration_id"])
-        .single()
-        .execute()
-        .data
-    )
-    if not tokens:
-        raise ValueError("Calendar tokens not found")
-
-    access_token = tokens.get("access_token")
-    refresh_token = tokens.get("refresh_token")
-    expires_at = tokens.get("expires_at")
-
-    if expires_at:
-        expires_at_dt = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
-        if expires_at_dt <= datetime.now(timezone.utc) and refresh_token:
-            refreshed = refresh_access_token(refresh_token)
-            access_token = refreshed.get("access_token")
-            expires_in = refreshed.get("expires_in")
-            new_expires_at = None
-            if expires_in:
-                new_expires_at = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(seconds=int(expires_in))
-            supabase.table("calendar_tokens").update(
-                {
-                    "access_token": access_token,
-                    "expires_at": new_expires_at.isoformat() if new_expires_at else None,
-                }
-            ).eq("integration_id", link["integration_id"]).execute()
-
-    if not access_token:
-        raise ValueError("Calendar access token missing")
-
-    return access_token, link["calendar_id"]
+    return link
 
 
 def _resolve_calendars(agent_id: str, calendar_ids: list[str] | None = None) -> list[dict]:
@@ -72,46 +43,6 @@ def _resolve_calendars(agent_id: str, calendar_ids: list[str] | None = None) ->
     return links
 
 
-def _resolve_access_token(integration_id: str) -> str:
-    supabase = get_supabase_client()
-    tokens = (
-        supabase.table("calendar_tokens")
-        .select("access_token, refresh_token, expires_at")
-        .eq("integration_id", integration_id)
-        .single()
-        .execute()
-        .data
-    )
-    if not tokens:
-        raise ValueError("Calendar tokens not found")
-
-    access_token = tokens.get("access_token")
-    refresh_token = tokens.get("refresh_token")
-    expires_at = tokens.get("expires_at")
-
-    if expires_at:
-        expires_at_dt = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
-        if expires_at_dt <= datetime.now(timezone.utc) and refresh_token:
-            refreshed = refresh_access_token(refresh_token)
-            access_token = refreshed.get("access_token")
-            expires_in = refreshed.get("expires_in")
-            new_expires_at = None
-            if expires_in:
-                new_expires_at = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(
-                    seconds=int(expires_in)
-                )
-            supabase.table("calendar_tokens").update(
-                {
-                    "access_token": access_token,
-                    "expires_at": new_expires_at.isoformat() if new_expires_at else None,
-                }
-            ).eq("integration_id", integration_id).execute()
-
-    if not access_token:
-        raise ValueError("Calendar access token missing")
-    return access_token
-
-
 def _parse_rfc3339(value: str) -> datetime:
     normalized = value.strip().replace("Z", "+00:00")
     dt = datetime.fromisoformat(normalized)
@@ -120,6 +51,38 @@ def _parse_rfc3339(value: str) -> datetime:
     return dt
 
 
+# Business hours used when the agent's horario is "comercial": Monday to
+# Friday, 09:00-18:00 in the agent timezone, as minutes since midnight.
+BUSINESS_HOURS = {weekday: [(9 * 60, 18 * 60)] for weekday in range(5)}
+
+# Busy intervals per calendar and UTC day, so repeated availability questions
+# within the TTL skip Google. Our own event tools drop a calendar's days.
+BUSY_KEY = "calendar:busy:{calendar_id}:{day}"
+BUSY_DAYS_KEY = "calendar:busy:days:{calendar_id}"
+FREEBUSY_MAX_CALENDARS = 50
+# Round-robin position per agent, so team scheduling spreads new meetings
+# across calendars between conversations, not only within one answer.
+ROTATION_KEY = "calendar:rotation:{agent_id}"
+
+
+def working_hours_for(horario: str | None) -> dict[int, list[tuple[int, int]]] | None:
+    return BUSINESS_HOURS if (horario or "comercial") == "comercial" else None
+
+
+def _next_rotation(agent_id: str) -> int:
+    try:
+        return int(get_redis_client().incr(ROTATION_KEY.format(agent_id=agent_id)))
+    except Exception:
+        return 0
+
+
+def _zone(time_zone: str | None):
+    try:
+        return ZoneInfo(time_zone) if time_zone else timezone.utc
+    except Exception:
+        return timezone.utc
+
+
 def _merge_intervals(intervals: list[tuple[datetime, datetime]]) -> list[tuple[datetime, datetime]]:
     if not intervals:
         return []
@@ -134,26 +97,99 @@ def _merge_intervals(intervals: list[tuple[datetime, datetime]]) -> list[tuple[d
     return merged
 
 
-def _find_slots(
-    window_start: datetime,
-    window_end: datetime,
-    busy: list[tuple[datetime, datetime]],
-    duration: timedelta,
-    limit: int,
-) -> list[tuple[datetime, datetime]]:
-    slots: list[tuple[datetime, datetime]] = []
-    cursor = window_start
-    for b_start, b_end in busy:
-        if cursor + duration <= b_start:
-            slots.append((cursor, cursor + duration))
-            if len(slots) >= limit:
-                return slots
-        cursor = max(cursor, b_end)
-        if cursor >= window_end:
-            return slots
-    if cursor + duration <= window_end and len(slots) < limit:
-        slots.append((cursor, cursor + duration))
-    return slots
+def _utc_days(start: datetime, end: datetime) -> list[date]:
+    days = []
+    day = start.astimezone(timezone.utc).date()
+    last_day = (end.astimezone(timezone.utc) - timedelta(microseconds=1)).date()
+    while day <= last_day:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def _day_bounds(day: date) -> tuple[datetime, datetime]:
+    start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def _cached_busy(calendar_ids: list[str], days: list[date]) -> dict[str, list[tuple[datetime, datetime]]]:
+    """Busy intervals of the calendars whose every requested day is cached."""
+    keys = [(calendar_id, day) for calendar_id in calendar_ids for day in days]
+    try:
+        raw_values = get_redis_client().mget(
+            [BUSY_KEY.format(calendar_id=calendar_id, day=day.isoformat()) for calendar_id, day in keys]
+        )
+    except Exception:
+        return {}
+    found: dict[str, list[tuple[datetime, datetime]]] = {}
+    missing: set[str] = set()
+    for (calendar_id, _), raw in zip(keys, raw_values):
+        if raw is None:
+            missing.add(calendar_id)
+            continue
+        intervals = found.setdefault(calendar_id, [])
+        for start, end in json.loads(raw):
+            intervals.append((_parse_rfc3339(start), _parse_rfc3339(end)))
+    return {calendar_id: intervals for calendar_id, intervals in found.items() if calendar_id not in missing}
+
+
+def _store_busy(calendar_id: str, days: list[date], intervals: list[tuple[datetime, datetime]]) -> None:
+    ttl = settings.calendar_busy_cache_ttl_seconds
+    try:
+        pipeline = get_redis_client().pipeline(transaction=False)
+        index_key = BUSY_DAYS_KEY.format(calendar_id=calendar_id)
+        for day in days:
+            day_start, day_end = _day_bounds(day)
+            clipped = [
+                [max(start, day_start).isoformat(), min(end, day_end).isoformat()]
+                for start, end in intervals
+                if start < day_end and end > day_start
+            ]
+            key = BUSY_KEY.format(calendar_id=calendar_id, day=day.isoformat())
+            pipeline.set(key, json.dumps(clipped), ex=ttl)
+            pipeline.sadd(index_key, key)
+        pipeline.expire(index_key, ttl)
+        pipeline.execute()
+    except Exception:
+        return
+
+
+def invalidate_busy_cache(calendar_id: str) -> None:
+    try:
+        redis = get_redis_client()
+        index_key = BUSY_DAYS_KEY.format(calendar_id=calendar_id)
+        keys = list(redis.smembers(index_key) or [])
+        redis.delete(index_key, *keys)
+    except Exception:
+        return
+
+
+def _fetch_busy(
+    integration_id: str,
+    calendar_ids: list[str],
+    start: datetime,
+    end: datetime,
+) -> tuple[dict[str, list[tuple[datetime, datetime]]], list[dict]]:
+    busy: dict[str, list[tuple[datetime, datetime]]] = {}
+    errors: list[dict] = []
+    for offset in range(0, len(calendar_ids), FREEBUSY_MAX_CALENDARS):
+        chunk = calendar_ids[offset : offset + FREEBUSY_MAX_CALENDARS]
+        response = call_with_token(
+            integration_id,
+            lambda access_token: query_freebusy(access_token, start.isoformat(), end.isoformat(), chunk, "UTC"),
+        )
+        for cal_id, data in (response.get("calendars") or {}).items():
+            if data.get("errors"):
+                errors.append({"calendar_id": cal_id, "errors": data.get("errors")})
+                continue
+            intervals = []
+            for item in data.get("busy") or []:
+                try:
+                    intervals.append((_parse_rfc3339(item.get("start")), _parse_rfc3339(item.get("end"))))
+                except Exception:
+                    continue
+            busy[cal_id] = intervals
+    return busy, errors
 
 
 def get_calendar_availability(
@@ -164,54 +200,101 @@ def get_calendar_availability(
     time_zone: str | None = None,
     duration_minutes: int | None = None,
     max_suggestions: int = 5,
+    working_hours: dict[int, list[tuple[int, int]]] | None = None,
+    step_minutes: int | None = None,
+    buffer_minutes: int = 0,
+    minimum_notice_minutes: int = 0,
+    any_calendar: bool = False,
+    rotation: int | None = None,
 ) -> dict:
     links = _resolve_calendars(agent_id, calendar_ids)
+    window_start = _parse_rfc3339(time_min)
+    window_end = _parse_rfc3339(time_max)
+    days = _utc_days(window_start, window_end)
+
+    calendar_intervals = _cached_busy([link["calendar_id"] for link in links], days)
     by_integration: dict[str, list[str]] = {}
     for link in links:
-        by_integration.setdefault(link["integration_id"], []).append(link["calendar_id"])
+        if link["calendar_id"] not in calendar_intervals:
+            by_integration.setdefault(link["integration_id"], []).append(link["calendar_id"])
 
-    busy_intervals: list[tuple[datetime, datetime]] = []
-    calendar_busy: dict[str, list[dict]] = {}
     errors: list[dict] = []
-
-    for integration_id, calendars in by_integration.items():
-        access_token = _resolve_access_token(integration_id)
-        response = query_freebusy(access_token, time_min, time_max, calendars, time_zone)
-        calendars_resp = response.get("calendars") or {}
-        for cal_id, data in calendars_resp.items():
-            if data.get("errors"):
-                errors.append({"calendar_id": cal_id, "errors": data.get("errors")})
-            busy = data.get("busy") or []
-            calendar_busy[cal_id] = busy
-            for item in busy:
+    failures: list[Exception] = []
+    if by_integration:
+        # Whole UTC days are fetched so the result can be cached per day.
+        fetch_start, fetch_end = _day_bounds(days[0])[0], _day_bounds(days[-1])[1]
+        workers = min(len(by_integration), settings.calendar_freebusy_concurrency)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {
+                executor.submit(_fetch_busy, integration_id, calendars, fetch_start, fetch_end): integration_id
+                for integration_id, calendars in by_integration.items()
+            }
+            for future, integration_id in futures.items():
                 try:
-                    start_dt = _parse_rfc3339(item.get("start"))
-                    end_dt = _parse_rfc3339(item.get("end"))
-                except Exception:
+                    fetched, fetch_errors = future.result()
+                except Exception as error:
+                    failures.append(error)
+                    errors.extend(
+                        {"calendar_id": cal_id, "errors": [{"reason": str(error)}]}
+                        for cal_id in by_integration[integration_id]
+                    )
                     continue
-                busy_intervals.append((start_dt, end_dt))
+                errors.extend(fetch_errors)
+                for cal_id, intervals in fetched.items():
+                    _store_busy(cal_id, days, intervals)
+                    calendar_intervals[cal_id] = intervals
 
-    merged_busy = _merge_intervals(busy_intervals)
-    window_start = _parse_rfc3339(time_min)
-    window_end = _parse_rfc3339(time_max)
+    # A calendar that could not be read is not free: with none read the
+    # fetch error is raised, and "all" mode offers no slot without it.
+    unread = [link["calendar_id"] for link in links if link["calendar_id"] not in calendar_intervals]
+    if failures and not calendar_intervals:
+        raise failures[0]
 
-    has_conflict = any(
-        not (end <= window_start or start >= window_end) for start, end in merged_busy
-    )
+    calendar_busy: dict[str, list[dict]] = {}
+    busy_intervals: list[tuple[datetime, datetime]] = []
+    for cal_id, intervals in calendar_intervals.items():
+        in_window = [
+            (max(start, window_start), min(end, window_end))
+            for start, end in intervals
+            if start < window_end and end > window_start
+        ]
+        calendar_busy[cal_id] = [{"start": start.isoformat(), "end": end.isoformat()} for start, end in in_window]
+        busy_intervals.extend(in_window)
+
+    merged_busy = _merge_intervals(busy_intervals)
+    has_conflict = bool(merged_busy)
 
     suggestions: list[dict] = []
-    if duration_minutes and duration_minutes > 0:
-        duration = timedelta(minutes=int(duration_minutes))
-        slots = _find_slots(window_start, window_end, merged_busy, duration, max_suggestions)
-        suggestions = [
-            {"start": start.isoformat(), "end": end.isoformat()} for start, end in slots
-        ]
+    if duration_minutes and duration_minutes > 0 and (any_calendar or not unread):
+        zone = _zone(time_zone)
+        options = SlotOptions(
+            duration_minutes=int(duration_minutes),
+            step_minutes=step_minutes,
+            buffer_before_minutes=buffer_minutes,
+            buffer_after_minutes=buffer_minutes,
+            minimum_notice_minutes=minimum_notice_minutes,
+            mode="any" if any_calendar else "all",
+            round_robin=any_calendar,
+            rotation=rotation if rotation is not None else _next_rotation(agent_id) if any_calendar else 0,
+            limit=max_suggestions,
+        )
+        slots = find_free_slots(
+            calendar_intervals,
+            working_windows(window_start, window_end, working_hours, zone),
+            zone,
+            options,
+        )
+        for slot in slots:
+            suggestion = {"start": slot.start.astimezone(zone).isoformat(), "end": slot.end.astimezone(zone).isoformat()}
+            if slot.assigned_calendar_id:
+                suggestion["calendar_id"] = slot.assigned_calendar_id
+            suggestions.append(suggestion)
 
     return {
         "timeMin": time_min,
         "timeMax": time_max,
         "timeZone": time_zone,
-        "available": not has_conflict,
+        "available": not has_conflict and not unread,
         "busy": [{"start": s.isoformat(), "end": e.isoformat()} for s, e in merged_busy],
         "calendars": calendar_busy,
         "errors": errors,
@@ -220,20 +303,37 @@ def get_calendar_availability(
 
 
 def create_calendar_event(agent_id: str, payload: dict, calendar_id: str | None = None) -> dict:
-    access_token, calendar_id_resolved = _resolve_calendar(agent_id, calendar_id)
-    return create_event(access_token, calendar_id_resolved, payload)
+    link = _resolve_calendar(agent_id, calendar_id)
+    event = call_with_token(
+        link["integration_id"],
+        lambda access_token: create_event(access_token, link["calendar_id"], payload),
+    )
+    invalidate_busy_cache(link["calendar_id"])
+    return event
 
 
 def update_calendar_event(agent_id: str, event_id: str, payload: dict, calendar_id: str | None = None) -> dict:
-    access_token, calendar_id_resolved = _resolve_calendar(agent_id, calendar_id)
-    return update_event(access_token, calendar_id_resolved, event_id, payload)
+    link = _resolve_calendar(agent_id, calendar_id)
+    event = call_with_token(
+        link["integration_id"],
+        lambda access_token: update_event(access_token, link["calendar_id"], event_id, payload),
+    )
+    invalidate_busy_cache(link["calendar_id"])
+    return event
 
 
 def delete_calendar_event(agent_id: str, event_id: str, calendar_id: str | None = None) -> None:
-    access_token, calendar_id_resolved = _resolve_calendar(agent_id, calendar_id)
-    delete_event(access_token, calendar_id_resolved, event_id)
+    link = _resolve_calendar(agent_id, calendar_id)
+    call_with_token(
+        link["integration_id"],
+        lambda access_token: delete_event(access_token, link["calendar_id"], event_id),
+    )
+    invalidate_busy_cache(link["calendar_id"])
 
 
 def get_calendar_event(agent_id: str, event_id: str, calendar_id: str | None = None) -> dict:
-    access_token, calendar_id_resolved = _resolve_calendar(agent_id, calendar_id)
-    return get_event(access_token, calendar_id_resolved, event_id)
+    link = _resolve_calendar(agent_id, calendar_id)
+    return call_with_token(
+        link["integration_id"],
+        lambda access_token: get_event(access_token, link["calendar_id"], event_id),
+    )
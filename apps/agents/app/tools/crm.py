@@ -1,4 +1,5 @@
 from app.clients.supabase import get_supabase_client
+from app.services.membership import invalidate_membership
 
 
 def create_lead(
@@ -70,6 +71,7 @@ def create_contact(
 def update_contact(contact_id: str, values: dict) -> None:
     supabase = get_supabase_client()
     supabase.table("contacts").update(values).eq("id", contact_id).execute()
+    invalidate_membership("contact", contact_id)
 
 
 def create_deal(
@@ -96,20 +98,29 @@ def create_deal(
         "titulo": titulo,
     }
     result = supabase.table("deals").insert(payload).execute()
+    invalidate_membership("contact", contact_id)
     data = result.data or {}
     if isinstance(data, list):
         return data[0] if data else {}
     return data
 
 
+def _invalidate_deal_contacts(rows: list[dict] | None) -> None:
+    for row in rows or []:
+        invalidate_membership("contact", row.get("contact_id"))
+
+
 def update_deal(deal_id: str, values: dict) -> None:
     supabase = get_supabase_client()
-    supabase.table("deals").update(values).eq("id", deal_id).execute()
+    result = supabase.table("deals").update(values).eq("id", deal_id).execute()
+    if "stage_id" in values or "contact_id" in values:
+        _invalidate_deal_contacts(result.data)
 
 
 def move_deal_stage(deal_id: str, stage_id: str) -> None:
     supabase = get_supabase_client()
-    supabase.table("deals").update({"stage_id": stage_id}).eq("id", deal_id).execute()
+    result = supabase.table("deals").update({"stage_id": stage_id}).eq("id", deal_id).execute()
+    _invalidate_deal_contacts(result.data)
 
 
 def apply_tag(entity_type: str, entity_id: str, tag_id: str, workspace_id: str) -> None:
@@ -124,6 +135,7 @@ def apply_tag(entity_type: str, entity_id: str, tag_id: str, workspace_id: str)
         raise ValueError("Unsupported entity type for tags")
 
     supabase.table(table).upsert(payload, on_conflict="lead_id,tag_id" if entity_type == "lead" else "contact_id,tag_id").execute()
+    invalidate_membership(entity_type, entity_id)
 
 
 def set_custom_field_value(entity_type: str, entity_id: str, field_id: str, workspace_id: str, value: dict) -> None:
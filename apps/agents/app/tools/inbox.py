@@ -106,8 +106,13 @@ def _get_agent_instagram_credentials(agent_id: str) -> tuple[str, str]:
     return token_data["access_token"], account_data["identificador"]
 
 
-def send_whatsapp_text(agent_id: str, to: str, text: str) -> dict:
-    account, access_token = _get_agent_whatsapp_credentials(agent_id)
+def send_whatsapp_text(
+    agent_id: str,
+    to: str,
+    text: str,
+    credentials: tuple[dict, str | None] | None = None,
+) -> dict:
+    account, access_token = credentials or _get_agent_whatsapp_credentials(agent_id)
     provider = account.get("provider") or "whatsapp_oficial"
     if provider == "whatsapp_baileys":
         client = BaileysClient(account["id"])
@@ -123,8 +128,13 @@ def send_whatsapp_text(agent_id: str, to: str, text: str) -> dict:
     return client.send_text(to=to, body=text)
 
 
-def send_instagram_text(agent_id: str, to: str, text: str) -> dict:
-    access_token, instagram_id = _get_agent_instagram_credentials(agent_id)
+def send_instagram_text(
+    agent_id: str,
+    to: str,
+    text: str,
+    credentials: tuple[str, str] | None = None,
+) -> dict:
+    access_token, instagram_id = credentials or _get_agent_instagram_credentials(agent_id)
     client = InstagramClient(access_token, instagram_id)
     return client.send_text(to=to, body=text)
 
@@ -135,8 +145,9 @@ def send_whatsapp_template(
     template_name: str,
     language_code: str,
     components: list[dict] | None = None,
+    credentials: tuple[dict, str | None] | None = None,
 ) -> dict:
-    account, access_token = _get_agent_whatsapp_credentials(agent_id)
+    account, access_token = credentials or _get_agent_whatsapp_credentials(agent_id)
     provider = account.get("provider") or "whatsapp_oficial"
     if provider == "whatsapp_baileys":
         raise ValueError("Templates indisponiveis para WhatsApp Baileys")
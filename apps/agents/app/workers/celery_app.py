@@ -35,4 +35,26 @@ celery_app.conf.update(
         "socket_timeout": 30,
         "retry_on_timeout": True,
     },
+    beat_schedule={
+        "run-due-followups": {
+            "task": "app.workers.tasks.run_due_followups_task",
+            "schedule": float(settings.followup_batch_interval_seconds),
+        },
+        "settle-credit-ledger": {
+            "task": "app.workers.tasks.settle_credits_task",
+            "schedule": float(settings.credits_settle_interval_seconds),
+        },
+        "flush-agent-metrics": {
+            "task": "app.workers.tasks.flush_agent_metrics_task",
+            "schedule": float(settings.metrics_flush_interval_seconds),
+        },
+        "refresh-calendar-tokens": {
+            "task": "app.workers.tasks.refresh_calendar_tokens_task",
+            "schedule": float(settings.calendar_token_refresh_interval_seconds),
+        },
+        "sync-whatsapp-templates": {
+            "task": "app.workers.tasks.sync_all_whatsapp_templates_task",
+            "schedule": float(settings.whatsapp_template_sync_interval_seconds),
+        },
+    },
 )
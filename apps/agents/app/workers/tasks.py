@@ -2,28 +2,40 @@ import json
 import logging
 from datetime import datetime, timedelta, timezone
 
-from app.clients.supabase import get_supabase_client
 from app.clients.redis_client import get_redis_client
+from app.config import settings
 from app.services.agent_runner import run_agent
-from app.services.conversation import get_messages
-from app.services.followups import run_followup, schedule_followups
+from app.services.calendar_tokens import refresh_expiring_tokens
+from app.services.conversation import get_author_timestamps, get_conversation
+from app.services.conversation_summary import summarize_aged_out_messages
+from app.services.credits import settle_credit_ledger
+from app.services.followups import (
+    ack_followups,
+    claim_due_followups,
+    enqueue_followup,
+    fail_followups,
+    run_followup,
+    run_followups_batch,
+    schedule_followups,
+)
+from app.services.ingestion import MediaJob, dispatch_agents, store_media
 from app.services.knowledge import process_knowledge_file
+from app.services.metrics import flush_agent_metrics
 from app.services.whatsapp_ingestion import process_whatsapp_event
 from app.services.instagram_ingestion import process_instagram_event
 from app.services.uazapi_ingestion import process_uazapi_event
 from app.services.uazapi_sync import sync_uazapi_history
-from app.services.whatsapp_templates import sync_whatsapp_templates
+from app.services.whatsapp_templates import list_template_sync_workspaces, sync_whatsapp_templates
 from app.workers.celery_app import celery_app
 
 logger = logging.getLogger("celery")
 
 
-def _seconds_until_window_expired(messages: list[dict]) -> int:
-    last_contact = next((m for m in reversed(messages) if m.get("autor") == "contato"), None)
-    if not last_contact:
+def _seconds_until_window_expired(last_contact_at: str | None) -> int:
+    if not last_contact_at:
         return 0
     try:
-        last_at = datetime.fromisoformat(last_contact.get("created_at").replace("Z", "+00:00"))
+        last_at = datetime.fromisoformat(last_contact_at.replace("Z", "+00:00"))
     except Exception:
         return 0
     expires_at = last_at + timedelta(hours=24)
@@ -37,38 +49,20 @@ def process_knowledge_task(file_id: str) -> dict:
     return process_knowledge_file(file_id)
 
 
-def _find_active_agent(workspace_id: str, integration_account_id: str) -> str | None:
-    supabase = get_supabase_client()
-    response = (
-        supabase.table("agents")
-        .select("id")
-        .eq("workspace_id", workspace_id)
-        .eq("integration_account_id", integration_account_id)
-        .eq("status", "ativo")
-        .limit(1)
-        .execute()
-    )
-    data = response.data or []
-    return data[0]["id"] if data else None
-
-
 @celery_app.task
 def process_whatsapp_event_task(event_id: str) -> dict:
     logger.info("task_process_whatsapp_event_start event_id=%s", event_id)
     result = process_whatsapp_event(event_id)
-    workspace_id = result.get("workspace_id")
-    integration_account_id = result.get("integration_account_id")
     conversation_ids = result.get("conversation_ids") or []
-    if not workspace_id or not integration_account_id or not conversation_ids:
-        return {"status": "no_agent"}
-
-    agent_id = _find_active_agent(workspace_id, integration_account_id)
+    agent_id = dispatch_agents(
+        result.get("workspace_id"),
+        result.get("integration_account_id"),
+        conversation_ids,
+        run_agent_task.delay,
+    )
     if not agent_id:
         return {"status": "no_agent"}
 
-    for conversation_id in conversation_ids:
-        run_agent_task.delay(agent_id, conversation_id)
-
     logger.info(
         "task_process_whatsapp_event_done event_id=%s agent_id=%s conversations=%s",
         event_id,
@@ -79,9 +73,12 @@ def process_whatsapp_event_task(event_id: str) -> dict:
 
 
 @celery_app.task
-def process_whatsapp_event_media_task(event_id: str) -> dict:
+def process_whatsapp_event_media_task(event_id: str, media: list[dict] | None = None) -> dict:
     logger.info("task_process_whatsapp_event_media_start event_id=%s", event_id)
-    return process_whatsapp_event(event_id, process_media=True)
+    if media is None:
+        return process_whatsapp_event(event_id, process_media=True)
+    stored = store_media([MediaJob.from_dict(job) for job in media])
+    return {"status": "ok", "attachments": stored}
 
 
 @celery_app.task
@@ -111,13 +108,27 @@ def process_uazapi_event_media_task(event_id: str) -> dict:
 
 
 @celery_app.task
-def sync_whatsapp_templates_task(workspace_id: str, integration_account_id: str | None = None) -> dict:
+def sync_whatsapp_templates_task(
+    workspace_id: str,
+    integration_account_id: str | None = None,
+    scheduled: bool = False,
+) -> dict:
     logger.info(
-        "task_sync_whatsapp_templates_start workspace_id=%s integration_account_id=%s",
+        "task_sync_whatsapp_templates_start workspace_id=%s integration_account_id=%s scheduled=%s",
         workspace_id,
         integration_account_id or "",
+        scheduled,
     )
-    return sync_whatsapp_templates(workspace_id, integration_account_id)
+    return sync_whatsapp_templates(workspace_id, integration_account_id, scheduled=scheduled)
+
+
+@celery_app.task
+def sync_all_whatsapp_templates_task() -> dict:
+    workspace_ids = list_template_sync_workspaces()
+    for workspace_id in workspace_ids:
+        sync_whatsapp_templates_task.delay(workspace_id, None, True)
+    logger.info("task_sync_all_whatsapp_templates workspaces=%s", len(workspace_ids))
+    return {"status": "ok", "workspaces": len(workspace_ids)}
 
 
 @celery_app.task
@@ -140,6 +151,8 @@ def run_agent_task(agent_id: str, conversation_id: str, input_text: str | None =
     )
     result = run_agent(agent_id, conversation_id, input_text)
     schedule_followups_task.delay(agent_id, conversation_id)
+    if result.get("status") == "ok":
+        summarize_conversation_task.delay(agent_id, conversation_id, result.get("summarize_until"))
     logger.info(
         "task_run_agent_done agent_id=%s conversation_id=%s status=%s",
         agent_id,
@@ -202,6 +215,8 @@ def run_agent_buffered_task(
     )
     result = run_agent(agent_id, conversation_id, input_text)
     schedule_followups_task.delay(agent_id, conversation_id)
+    if result.get("status") == "ok":
+        summarize_conversation_task.delay(agent_id, conversation_id, result.get("summarize_until"))
     logger.info(
         "task_run_agent_buffered_done agent_id=%s conversation_id=%s status=%s",
         agent_id,
@@ -217,6 +232,21 @@ def run_agent_buffered_task(
     }
 
 
+@celery_app.task
+def summarize_conversation_task(agent_id: str, conversation_id: str, until: str | None = None) -> dict:
+    result = summarize_aged_out_messages(agent_id, conversation_id, until)
+    if result.get("status") == "partial":
+        summarize_conversation_task.delay(agent_id, conversation_id, until)
+    logger.info(
+        "task_summarize_conversation_done agent_id=%s conversation_id=%s status=%s folded=%s",
+        agent_id,
+        conversation_id,
+        result.get("status"),
+        result.get("folded", 0),
+    )
+    return result
+
+
 @celery_app.task
 def run_followup_task(agent_id: str, conversation_id: str, followup_id: str) -> dict:
     logger.info(
@@ -228,6 +258,45 @@ def run_followup_task(agent_id: str, conversation_id: str, followup_id: str) ->
     return run_followup(agent_id, conversation_id, followup_id)
 
 
+@celery_app.task
+def run_due_followups_task() -> dict:
+    jobs = claim_due_followups(settings.followup_batch_size)
+    if not jobs:
+        return {"status": "idle", "claimed": 0}
+    logger.info("task_run_due_followups_start claimed=%s", len(jobs))
+    try:
+        results = run_followups_batch(jobs)
+    except Exception:
+        # The batch failed before any job ran (the shared prefetch): the
+        # jobs are retried when their claim expires, up to a limit.
+        logger.exception("task_run_due_followups_failed claimed=%s", len(jobs))
+        dead = fail_followups(jobs)
+        return {"status": "failed", "claimed": len(jobs), "dead_lettered": len(dead)}
+    ack_followups(jobs)
+    sent = sum(1 for result in results if result.get("status") == "sent")
+    logger.info(
+        "task_run_due_followups_done claimed=%s sent=%s",
+        len(jobs),
+        sent,
+    )
+    return {"status": "processed", "claimed": len(jobs), "sent": sent}
+
+
+@celery_app.task
+def settle_credits_task() -> dict:
+    return settle_credit_ledger()
+
+
+@celery_app.task
+def flush_agent_metrics_task() -> dict:
+    return flush_agent_metrics()
+
+
+@celery_app.task
+def refresh_calendar_tokens_task() -> dict:
+    return refresh_expiring_tokens()
+
+
 @celery_app.task
 def schedule_followups_task(agent_id: str, conversation_id: str) -> dict:
     logger.info(
@@ -245,10 +314,14 @@ def schedule_followups_task(agent_id: str, conversation_id: str) -> dict:
         return {"status": "no_followup"}
     countdown = int(followup["delay_minutos"]) * 60
     if followup.get("somente_fora_janela"):
-        remaining = _seconds_until_window_expired(get_messages(conversation_id))
+        authors = get_author_timestamps(agent_id, get_conversation(conversation_id))
+        remaining = _seconds_until_window_expired(authors.get("contato"))
         if remaining > countdown:
             countdown = remaining
-    run_followup_task.apply_async(args=[agent_id, conversation_id, followup["id"]], countdown=countdown)
+    if settings.followup_batch_enabled:
+        enqueue_followup(agent_id, conversation_id, followup["id"], countdown)
+    else:
+        run_followup_task.apply_async(args=[agent_id, conversation_id, followup["id"]], countdown=countdown)
     logger.info(
         "task_schedule_followups_done agent_id=%s conversation_id=%s status=scheduled followup_id=%s countdown=%s",
         agent_id,
@@ -0,0 +1,170 @@
+"""Consumer of the WhatsApp webhook intake streams.
+
+    python -m app.workers.webhook_intake
+
+Runs the router and WEBHOOK_INTAKE_WORKERS partition workers. Several
+processes can run side by side: one of them routes, and each partition is
+drained by a single worker at a time.
+"""
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from app.clients.redis_client import acquire_lock, get_redis_client, release_lock, renew_lock
+from app.config import settings
+from app.services.webhook_intake import (
+    PARTITION_LOCK_KEY,
+    ROUTER_LOCK_KEY,
+    ack_partition_entry,
+    ingest_whatsapp_event,
+    next_ready_partition,
+    notify_partition,
+    partition_backlog,
+    read_partition,
+    record_attempt,
+    route_events,
+)
+from app.workers.tasks import process_whatsapp_event_media_task, run_agent_task
+
+logger = logging.getLogger("webhook_intake")
+
+LOCK_SECONDS = 60
+ROUTER_BLOCK_MS = 1000
+# A worker with nothing to do sweeps every partition this often, which picks
+# up partitions released after a failure and any missed notification.
+SWEEP_SECONDS = 5
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner() -> str:
+    return f"{WORKER_ID}:{threading.get_ident()}"
+
+
+def drain_partition(partition: int) -> int:
+    """Ingests the partition's entries in order until it is empty. On a
+    failure the partition stays locked for WEBHOOK_INTAKE_RETRY_SECONDS and
+    the entry is retried first; after WEBHOOK_INTAKE_MAX_ATTEMPTS it is
+    dropped (the event is already marked "erro").
+
+    The lock is renewed before each event and checked again before its ack:
+    a worker whose lock expired during a slow event stops without acking, and
+    the new holder resumes from that entry."""
+    lock_key = PARTITION_LOCK_KEY.format(partition=partition)
+    token = acquire_lock(lock_key, LOCK_SECONDS)
+    if not token:
+        return 0
+    processed = 0
+    while True:
+        entries = read_partition(partition)
+        if not entries:
+            break
+        for entry_id, event_id in entries:
+            if not renew_lock(lock_key, token, LOCK_SECONDS):
+                logger.warning("webhook_intake_lock_lost partition=%s", partition)
+                return processed
+            if event_id:
+                started = time.perf_counter()
+                try:
+                    ingest_whatsapp_event(
+                        event_id, run_agent_task.delay, process_whatsapp_event_media_task.delay
+                    )
+                except Exception:
+                    attempts = record_attempt(event_id)
+                    if attempts < settings.webhook_intake_max_attempts:
+                        logger.warning(
+                            "webhook_intake_retry partition=%s event_id=%s attempt=%s",
+                            partition,
+                            event_id,
+                            attempts,
+                        )
+                        renew_lock(lock_key, token, settings.webhook_intake_retry_seconds)
+                        return processed
+                    logger.exception(
+                        "webhook_intake_dropped partition=%s event_id=%s attempts=%s",
+                        partition,
+                        event_id,
+                        attempts,
+                    )
+                else:
+                    logger.info(
+                        "webhook_intake_processed partition=%s event_id=%s ms=%.1f",
+                        partition,
+                        event_id,
+                        (time.perf_counter() - started) * 1000,
+                    )
+            if not renew_lock(lock_key, token, LOCK_SECONDS):
+                logger.warning("webhook_intake_lock_lost partition=%s event_id=%s", partition, event_id)
+                return processed
+            ack_partition_entry(partition, entry_id, event_id)
+            processed += 1
+    release_lock(lock_key, token)
+    # An entry routed while this worker was finishing found the lock taken;
+    # hand the partition back so it is not left waiting for the sweep.
+    if partition_backlog(partition):
+        notify_partition(partition)
+    return processed
+
+
+def _router_loop(stop: threading.Event) -> None:
+    redis = get_redis_client()
+    while not stop.is_set():
+        try:
+            # The router keeps its lock while it runs and renews it each round.
+            if not renew_lock(ROUTER_LOCK_KEY, _owner(), LOCK_SECONDS) and not redis.set(
+                ROUTER_LOCK_KEY, _owner(), nx=True, ex=LOCK_SECONDS
+            ):
+                stop.wait(1)
+                continue
+            route_events(block_ms=ROUTER_BLOCK_MS)
+        except Exception:
+            logger.exception("webhook_intake_router_failed")
+            stop.wait(1)
+    release_lock(ROUTER_LOCK_KEY, _owner())
+
+
+def _partition_loop(stop: threading.Event) -> None:
+    while not stop.is_set():
+        try:
+            partition = next_ready_partition(SWEEP_SECONDS)
+            if partition is not None:
+                drain_partition(partition)
+                continue
+            for partition in range(settings.webhook_intake_partitions):
+                if stop.is_set():
+                    break
+                drain_partition(partition)
+        except Exception:
+            logger.exception("webhook_intake_worker_failed")
+            stop.wait(1)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    threads = [threading.Thread(target=_router_loop, args=(stop,), name="intake-router")]
+    threads += [
+        threading.Thread(target=_partition_loop, args=(stop,), name=f"intake-worker-{index}")
+        for index in range(max(settings.webhook_intake_workers, 1))
+    ]
+    logger.info(
+        "webhook_intake_started worker=%s workers=%s partitions=%s",
+        WORKER_ID,
+        len(threads) - 1,
+        settings.webhook_intake_partitions,
+    )
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
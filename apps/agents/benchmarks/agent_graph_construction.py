@@ -0,0 +1,60 @@
+"""Measure the per-run cost of building LLM clients and the ReAct graph.
+
+    python -m benchmarks.agent_graph_construction --runs 200
+
+"uncached" rebuilds ChatOpenAI and re-compiles the graph on every run, as
+run_agent used to; "cached" goes through the process-wide clients and the
+graph cache. No model is called, only construction is timed.
+"""
+
+import argparse
+import time
+
+from langchain_openai import ChatOpenAI
+
+from app.config import settings
+from app.services.agent_runner import AgentContext, _build_agent_graph, _build_tools, _get_agent_graph
+from app.services.llm import get_primary_llm
+
+
+def _context() -> AgentContext:
+    return AgentContext(
+        agent_id="bench",
+        workspace_id="bench",
+        conversation_id="bench",
+        lead_id=None,
+        contact_id=None,
+        phone="5500000000000",
+        canal="whatsapp",
+        provider="whatsapp_oficial",
+    )
+
+
+def _uncached(runs: int) -> float:
+    started = time.perf_counter()
+    for _ in range(runs):
+        llm = ChatOpenAI(api_key=settings.openai_api_key, model="gpt-4.1-mini", temperature=0.2)
+        _build_agent_graph(llm, _build_tools(_context(), None))
+    return time.perf_counter() - started
+
+
+def _cached(runs: int) -> float:
+    started = time.perf_counter()
+    for _ in range(runs):
+        _get_agent_graph(get_primary_llm(), _build_tools(_context(), None))
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'total s':>10}{'per run ms':>12}")
+    for name, runner in (("uncached", _uncached), ("cached", _cached)):
+        elapsed = runner(args.runs)
+        print(f"{name:<10}{elapsed:>10.3f}{elapsed / args.runs * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
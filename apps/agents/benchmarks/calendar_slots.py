@@ -0,0 +1,89 @@
+"""Measure free-slot search over many calendars and days.
+
+    python -m benchmarks.calendar_slots --calendars 50 --days 30
+
+"intervals" walks the step grid and checks each start against every
+calendar's merged busy intervals in Python; "arrays" is the NumPy engine
+in app.services.availability. Both use synthetic busy data, business hours in
+America/Sao_Paulo and 30-minute slots; no calendar API is called.
+"""
+
+import argparse
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+import random
+import time
+from zoneinfo import ZoneInfo
+
+from app.services.availability import SlotOptions, find_free_slots, working_windows
+from app.tools.calendar import BUSINESS_HOURS, _merge_intervals
+
+ZONE = ZoneInfo("America/Sao_Paulo")
+
+
+def _busy(calendars: int, start: datetime, days: int, per_day: int) -> dict[str, list[tuple[datetime, datetime]]]:
+    generator = random.Random(7)
+    busy = {}
+    for index in range(calendars):
+        intervals = []
+        for day in range(days):
+            for _ in range(per_day):
+                begin = start + timedelta(days=day, minutes=generator.randrange(8 * 60, 20 * 60, 15))
+                intervals.append((begin, begin + timedelta(minutes=generator.choice((30, 45, 60, 90)))))
+        busy[f"calendar-{index}"] = intervals
+    return busy
+
+
+def _intervals(busy, windows, options: SlotOptions) -> int:
+    merged = {calendar_id: _merge_intervals(intervals) for calendar_id, intervals in busy.items()}
+    starts = {calendar_id: [start for start, _ in intervals] for calendar_id, intervals in merged.items()}
+    duration = timedelta(minutes=options.duration_minutes)
+    step = timedelta(minutes=options.step_minutes)
+    found = 0
+    for window_start, window_end in windows:
+        cursor = window_start
+        while cursor + duration <= window_end and found < options.limit:
+            free = 0
+            for calendar_id, intervals in merged.items():
+                index = bisect_right(starts[calendar_id], cursor + duration - timedelta(microseconds=1)) - 1
+                if index < 0 or intervals[index][1] <= cursor:
+                    free += 1
+            if (options.mode == "any" and free) or free == len(merged):
+                found += 1
+            cursor += step
+    return found
+
+
+def _arrays(busy, windows, options: SlotOptions, now: datetime) -> int:
+    return len(find_free_slots(busy, windows, ZONE, options, now=now))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calendars", type=int, default=50)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--events-per-day", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    window_start = datetime(2026, 3, 2, 3, tzinfo=timezone.utc)
+    window_end = window_start + timedelta(days=args.days)
+    busy = _busy(args.calendars, window_start, args.days, args.events_per_day)
+    windows = working_windows(window_start, window_end, BUSINESS_HOURS, ZONE)
+
+    print(f"{'mode':<6}{'engine':<11}{'slots':>7}{'per run ms':>12}")
+    for mode in ("all", "any"):
+        options = SlotOptions(duration_minutes=30, step_minutes=30, mode=mode, round_robin=mode == "any", limit=10000)
+        for name, runner in (
+            ("intervals", lambda: _intervals(busy, windows, options)),
+            ("arrays", lambda: _arrays(busy, windows, options, window_start)),
+        ):
+            started = time.perf_counter()
+            for _ in range(args.runs):
+                slots = runner()
+            elapsed = (time.perf_counter() - started) / args.runs
+            print(f"{mode:<6}{name:<11}{slots:>7}{elapsed * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
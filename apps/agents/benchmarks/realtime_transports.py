@@ -0,0 +1,86 @@
+"""Compare realtime throughput (events/sec) across transports.
+
+    python -m benchmarks.realtime_transports --events 5000
+    python -m benchmarks.realtime_transports --transports recording,redis,pusher
+
+Each transport is measured twice: one send per event (the synchronous path)
+and through RealtimePublisher batching. The pusher transport sends real
+events to the configured app, so it is opt-in.
+"""
+
+import argparse
+import time
+from uuid import uuid4
+
+from app.services.realtime import RealtimePublisher
+from app.services.realtime_transport import build_transport
+
+
+def _events(count: int, conversations: int) -> list[dict]:
+    events = []
+    for index in range(count):
+        conversation_id = f"bench-{index % conversations}"
+        if index % 2:
+            events.append(
+                {
+                    "channel": "private-workspace-bench",
+                    "name": "conversation:updated",
+                    "data": {"event_id": str(uuid4()), "conversation_id": conversation_id, "n": index},
+                    "coalesce_key": ("conversation:updated", conversation_id),
+                }
+            )
+        else:
+            events.append(
+                {
+                    "channel": f"private-conversation-{conversation_id}",
+                    "name": "message:created",
+                    "data": {"event_id": str(uuid4()), "conversation_id": conversation_id, "n": index},
+                    "coalesce_key": None,
+                }
+            )
+    return events
+
+
+def _run_sync(transport, events: list[dict]) -> float:
+    started = time.perf_counter()
+    for event in events:
+        transport.send_batch([{key: event[key] for key in ("channel", "name", "data")}])
+    return time.perf_counter() - started
+
+
+def _run_batched(transport, events: list[dict], flush_ms: int) -> float:
+    publisher = RealtimePublisher(transport, flush_ms / 1000, max_pending=len(events) + 1)
+    started = time.perf_counter()
+    for event in events:
+        publisher.publish(event["channel"], event["name"], event["data"], event["coalesce_key"])
+    publisher.flush(timeout=600)
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--flush-ms", type=int, default=50)
+    parser.add_argument("--transports", default="recording,redis")
+    args = parser.parse_args()
+
+    events = _events(args.events, args.conversations)
+    print(f"{'transport':<12}{'mode':<10}{'seconds':>10}{'events/s':>12}")
+    for name in [item.strip() for item in args.transports.split(",") if item.strip()]:
+        transport = build_transport(name)
+        for mode in ("sync", "batched"):
+            try:
+                if mode == "sync":
+                    elapsed = _run_sync(transport, events)
+                else:
+                    elapsed = _run_batched(transport, events, args.flush_ms)
+            except Exception as error:
+                print(f"{name:<12}{mode:<10}{'error':>10}  {error}")
+                break
+            rate = len(events) / elapsed if elapsed else float("inf")
+            print(f"{name:<12}{mode:<10}{elapsed:>10.3f}{rate:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
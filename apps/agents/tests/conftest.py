@@ -0,0 +1,175 @@
+import itertools
+import os
+
+import fakeredis
+import pytest
+
+for name in (
+    "SUPABASE_URL",
+    "SUPABASE_SERVICE_ROLE_KEY",
+    "OPENAI_API_KEY",
+    "GEMINI_API_KEY",
+    "PUSHER_APP_ID",
+    "PUSHER_KEY",
+    "PUSHER_SECRET",
+    "PUSHER_CLUSTER",
+    "R2_ACCOUNT_ID",
+    "R2_ACCESS_KEY_ID",
+    "R2_SECRET_ACCESS_KEY",
+):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+from app.clients import redis_client, supabase as supabase_client  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """The slice of the PostgREST builder the services use, over lists of
+    dicts. Upserts merge on the on_conflict columns and new rows get ids."""
+
+    def __init__(self, db: "FakeSupabase", table: str):
+        self.db = db
+        self.table = table
+        self.operation = "select"
+        self.payload = None
+        self.options: dict = {}
+        self.filters: list = []
+        self.ordering: list[tuple[str, bool]] = []
+        self.limit_count: int | None = None
+        self.offset = 0
+        self.single_row = False
+
+    def select(self, *_args, **_kwargs):
+        self.operation = "select"
+        return self
+
+    def insert(self, rows, **options):
+        self.operation, self.payload, self.options = "insert", rows, options
+        return self
+
+    def upsert(self, rows, **options):
+        self.operation, self.payload, self.options = "upsert", rows, options
+        return self
+
+    def update(self, values):
+        self.operation, self.payload = "update", values
+        return self
+
+    def delete(self):
+        self.operation = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        values = list(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] > value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] >= value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] <= value)
+        return self
+
+    def order(self, column, desc=False):
+        self.ordering.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def range(self, start, end):
+        self.offset, self.limit_count = start, end - start + 1
+        return self
+
+    def single(self):
+        self.single_row = True
+        return self
+
+    def _matches(self, row: dict) -> bool:
+        return all(check(row) for check in self.filters)
+
+    def execute(self):
+        rows = self.db.tables.setdefault(self.table, [])
+        self.db.calls.append((self.table, self.operation))
+        if self.operation == "select":
+            found = [dict(row) for row in rows if self._matches(row)]
+            for column, desc in reversed(self.ordering):
+                found.sort(key=lambda row: row.get(column) or "", reverse=desc)
+            found = found[self.offset :]
+            if self.limit_count is not None:
+                found = found[: self.limit_count]
+            if self.single_row:
+                return FakeResponse(found[0] if found else None)
+            return FakeResponse(found)
+        if self.operation == "update":
+            updated = []
+            for row in rows:
+                if self._matches(row):
+                    row.update(self.payload)
+                    updated.append(dict(row))
+            return FakeResponse(updated)
+        if self.operation == "delete":
+            self.db.tables[self.table] = [row for row in rows if not self._matches(row)]
+            return FakeResponse([])
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        # PostgREST resolves upserts on the primary key unless told otherwise.
+        conflict = [column for column in (self.options.get("on_conflict") or "id").split(",") if column]
+        if self.operation == "upsert" and conflict:
+            keys = [tuple(row.get(column) for column in conflict) for row in payload]
+            keys = [key for key in keys if any(value is not None for value in key)]
+            if len(set(keys)) != len(keys):
+                raise ValueError("ON CONFLICT DO UPDATE command cannot affect row a second time")
+        written = []
+        for item in payload:
+            existing = None
+            if self.operation == "upsert" and conflict:
+                existing = next(
+                    (row for row in rows if all(row.get(column) == item.get(column) for column in conflict)),
+                    None,
+                )
+            if existing is None:
+                existing = {"id": f"{self.table}-{next(self.db.ids)}"}
+                rows.append(existing)
+            existing.update(item)
+            written.append(dict(existing))
+        return FakeResponse(written)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables: dict[str, list[dict]] = {}
+        self.calls: list[tuple[str, str]] = []
+        self.ids = itertools.count(1)
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_client, "_client", client)
+    return client
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    client = FakeSupabase()
+    monkeypatch.setattr(supabase_client, "_client", client)
+    return client
@@ -0,0 +1,121 @@
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+import pytest
+
+from app.services import agent_runner
+from app.services.agent_runner import AgentContext, _invoke_streaming, _ParagraphSegmenter
+from app.services.model_fallback import AttemptCancelled, ModelAttempt
+
+ANSWER = "Primeiro paragrafo da resposta.\n\nSegundo paragrafo da resposta.\n\nTerceiro paragrafo."
+
+
+def test_segmenter_cuts_on_blank_lines_and_joins_short_paragraphs():
+    segmenter = _ParagraphSegmenter(10)
+
+    assert segmenter.feed("Oi!\n\nTudo bem por") == []
+    assert segmenter.feed(" aqui?\n\nSegue") == ["Oi!\n\nTudo bem por aqui?"]
+    assert segmenter.finish() == "Segue"
+    assert segmenter.finish() == ""
+
+
+class FakeGraph:
+    def __init__(self, *events):
+        self.events = events
+
+    def stream(self, inputs, config, stream_mode):
+        yield from self.events
+
+
+def _chunk(content: str = "", message_id: str = "turn-2", tool_call_chunks=None):
+    return ("messages", (AIMessageChunk(content=content, id=message_id, tool_call_chunks=tool_call_chunks or []), {"langgraph_node": "agent"}))
+
+
+def _graph(final: AIMessage, *chunks) -> FakeGraph:
+    return FakeGraph(*chunks, ("values", {"messages": [HumanMessage(content="oi"), final]}))
+
+
+@pytest.fixture
+def ctx():
+    return AgentContext(
+        agent_id="a1",
+        workspace_id="w1",
+        conversation_id="c1",
+        lead_id=None,
+        contact_id=None,
+        phone="5511999990000",
+        canal="whatsapp",
+        provider="whatsapp_oficial",
+    )
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    messages: list[str] = []
+    failing: set[str] = set()
+
+    def send(ctx, text):
+        if text in failing:
+            failing.discard(text)
+            return False
+        messages.append(text)
+        return True
+
+    monkeypatch.setattr(agent_runner, "_send_agent_text", send)
+    monkeypatch.setattr(agent_runner.settings, "agent_stream_min_segment_chars", 10)
+    return messages, failing
+
+
+def test_final_answer_is_sent_in_paragraphs(ctx, sent):
+    messages, _ = sent
+    graph = _graph(AIMessage(content=ANSWER, id="turn-2"), _chunk(ANSWER))
+
+    state, delivered = _invoke_streaming(graph, {}, ctx)
+
+    assert delivered
+    assert messages == ANSWER.split("\n\n")
+    assert ctx.streamed_segments == 3
+
+
+def test_text_before_a_tool_call_is_never_sent(ctx, sent):
+    messages, _ = sent
+    graph = _graph(
+        AIMessage(content="", id="turn-1", tool_calls=[{"name": "consultar_agenda", "args": {}, "id": "call-1"}]),
+        _chunk("Vou verificar a agenda para voce.\n\nUm momento.\n\n", message_id="turn-1"),
+        _chunk(message_id="turn-1", tool_call_chunks=[{"name": "consultar_agenda", "args": "{}", "id": "call-1", "index": 0}]),
+    )
+
+    state, delivered = _invoke_streaming(graph, {}, ctx)
+
+    assert not delivered
+    assert messages == []
+
+
+def test_a_failed_paragraph_is_resent_with_the_rest_of_the_answer(ctx, sent):
+    messages, failing = sent
+    failing.add("Segundo paragrafo da resposta.")
+    graph = _graph(AIMessage(content=ANSWER, id="turn-2"), _chunk(ANSWER))
+
+    state, delivered = _invoke_streaming(graph, {}, ctx)
+
+    assert delivered
+    assert messages == ["Primeiro paragrafo da resposta.", "Segundo paragrafo da resposta.\n\nTerceiro paragrafo."]
+
+
+def test_nothing_is_sent_when_segments_are_off_or_a_tool_already_replied(ctx, sent):
+    messages, _ = sent
+    graph = _graph(AIMessage(content=ANSWER, id="turn-2"), _chunk(ANSWER))
+
+    assert _invoke_streaming(graph, {}, ctx, send_segments=False)[1] is False
+    ctx.sent_by_tool = True
+    assert _invoke_streaming(graph, {}, ctx)[1] is False
+    assert messages == []
+
+
+def test_an_attempt_that_lost_the_run_sends_nothing(ctx, sent):
+    messages, _ = sent
+    ctx.attempt_owner = "other-attempt"
+    attempt = ModelAttempt(label="secondary", llm=None, model="m", provider="p")
+    graph = _graph(AIMessage(content=ANSWER, id="turn-2"), _chunk(ANSWER))
+
+    with pytest.raises(AttemptCancelled):
+        _invoke_streaming(graph, {}, ctx, attempt)
+    assert messages == []
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta, timezone
+import random
+from zoneinfo import ZoneInfo
+
+from app.services.availability import SlotOptions, find_free_slots, working_windows
+
+UTC = timezone.utc
+DAY = datetime(2026, 3, 2, tzinfo=UTC)
+
+
+def _at(hour: int, minute: int = 0) -> datetime:
+    return DAY + timedelta(hours=hour, minutes=minute)
+
+
+def _starts(slots) -> list[str]:
+    return [slot.start.strftime("%H:%M") for slot in slots]
+
+
+def test_busy_interval_and_buffers_block_slots():
+    busy = {"cal": [(_at(10), _at(11))]}
+    options = SlotOptions(duration_minutes=30, buffer_before_minutes=15, buffer_after_minutes=15, limit=20)
+
+    slots = find_free_slots(busy, [(_at(9), _at(12, 30))], UTC, options, now=_at(0))
+
+    assert _starts(slots) == ["09:00", "11:30", "12:00"]
+
+
+def test_minimum_notice_skips_early_slots():
+    options = SlotOptions(duration_minutes=60, minimum_notice_minutes=90, limit=3)
+
+    slots = find_free_slots({"cal": []}, [(_at(9), _at(17))], UTC, options, now=_at(9))
+
+    assert _starts(slots) == ["10:30", "11:00", "11:30"]
+
+
+def test_all_and_any_modes():
+    busy = {"a": [(_at(9), _at(10))], "b": [(_at(10), _at(11))]}
+    window = [(_at(9), _at(12))]
+
+    every = find_free_slots(busy, window, UTC, SlotOptions(duration_minutes=60, step_minutes=60), now=_at(0))
+    some = find_free_slots(
+        busy, window, UTC, SlotOptions(duration_minutes=60, step_minutes=60, mode="any"), now=_at(0)
+    )
+
+    assert _starts(every) == ["11:00"]
+    assert [(slot.start.hour, slot.calendar_ids) for slot in some] == [(9, ("b",)), (10, ("a",)), (11, ("a", "b"))]
+
+
+def test_round_robin_rotates_between_free_calendars():
+    options = SlotOptions(duration_minutes=30, mode="any", round_robin=True, rotation=1, limit=4)
+
+    slots = find_free_slots({"a": [], "b": [], "c": []}, [(_at(9), _at(12))], UTC, options, now=_at(0))
+
+    assert [slot.assigned_calendar_id for slot in slots] == ["b", "c", "a", "b"]
+
+
+def test_grid_follows_local_time_across_dst():
+    zone = ZoneInfo("America/New_York")
+    start = datetime(2026, 3, 8, 0, 0, tzinfo=zone)
+    windows = working_windows(start, start + timedelta(days=2), {6: [(9 * 60, 10 * 60)], 0: [(9 * 60, 10 * 60)]}, zone)
+    options = SlotOptions(duration_minutes=60, limit=5)
+
+    slots = find_free_slots({"cal": []}, windows, zone, options, now=start - timedelta(days=1))
+
+    assert [slot.start.astimezone(zone).strftime("%a %H:%M") for slot in slots] == ["Sun 09:00", "Mon 09:00"]
+
+
+def test_matches_a_brute_force_search():
+    generator = random.Random(7)
+    for _ in range(50):
+        calendars = {
+            name: sorted(
+                (
+                    (start := _at(8) + timedelta(minutes=generator.randrange(0, 600, 5))),
+                    start + timedelta(minutes=generator.randrange(5, 120, 5)),
+                )
+                for _ in range(generator.randrange(0, 6))
+            )
+            for name in ("a", "b", "c")
+        }
+        options = SlotOptions(
+            duration_minutes=generator.choice([15, 30, 45, 60]),
+            step_minutes=15,
+            buffer_before_minutes=generator.choice([0, 10]),
+            buffer_after_minutes=generator.choice([0, 5]),
+            mode=generator.choice(["all", "any"]),
+            limit=1000,
+        )
+        window = (_at(8), _at(18))
+
+        slots = find_free_slots(calendars, [window], UTC, options, now=_at(0))
+
+        expected = []
+        cursor = window[0]
+        length = timedelta(minutes=options.duration_minutes)
+        while cursor + length <= window[1]:
+            free = [
+                all(
+                    cursor + length + timedelta(minutes=options.buffer_after_minutes) <= start
+                    or cursor - timedelta(minutes=options.buffer_before_minutes) >= end
+                    for start, end in intervals
+                )
+                for intervals in calendars.values()
+            ]
+            if (any if options.mode == "any" else all)(free):
+                expected.append(cursor)
+            cursor += timedelta(minutes=15)
+        assert [slot.start for slot in slots] == expected
@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta, timezone
+import json
+import threading
+import time
+
+import httpx
+import pytest
+
+from app.services import calendar_tokens
+from app.services.calendar_tokens import (
+    TOKEN_KEY,
+    TOKEN_LOCK_KEY,
+    _cached,
+    _refresh,
+    call_with_token,
+    get_access_token,
+)
+
+
+def _expiry(seconds: int) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+
+@pytest.fixture
+def tokens(redis, supabase, monkeypatch):
+    monkeypatch.setattr(calendar_tokens, "_memory", {})
+    monkeypatch.setattr(calendar_tokens, "_refreshing", set())
+    monkeypatch.setattr(calendar_tokens, "LOCK_WAIT_SECONDS", 2)
+    monkeypatch.setattr(calendar_tokens.settings, "calendar_token_refresh_ahead_seconds", 300)
+    supabase.tables["calendar_tokens"] = [
+        {"integration_id": "g1", "access_token": "old", "refresh_token": "refresh", "expires_at": _expiry(3600)}
+    ]
+    renewals: list[str] = []
+
+    def refresh_access_token(refresh_token):
+        renewals.append(refresh_token)
+        return {"access_token": f"new-{len(renewals)}", "expires_in": 3600}
+
+    monkeypatch.setattr(calendar_tokens, "refresh_access_token", refresh_access_token)
+    return renewals
+
+
+def test_a_valid_token_is_served_without_renewal(tokens):
+    assert get_access_token("g1") == "old"
+    assert get_access_token("g1") == "old"
+    assert tokens == []
+
+
+def test_a_token_close_to_expiry_is_served_while_it_is_renewed(tokens, supabase):
+    supabase.tables["calendar_tokens"][0]["expires_at"] = _expiry(60)
+
+    assert get_access_token("g1") == "old"
+
+    deadline = time.monotonic() + 2
+    while calendar_tokens._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert tokens == ["refresh"]
+    assert supabase.tables["calendar_tokens"][0]["access_token"] == "new-1"
+    assert get_access_token("g1") == "new-1"
+
+
+def test_an_expired_token_waits_for_the_renewal(tokens, supabase):
+    supabase.tables["calendar_tokens"][0]["expires_at"] = _expiry(-10)
+
+    assert get_access_token("g1") == "new-1"
+
+
+def test_a_waiter_reuses_the_token_another_worker_renewed(tokens, redis):
+    redis.set(TOKEN_LOCK_KEY.format(integration_id="g1"), "other-worker", ex=30)
+
+    def other_worker_finishes():
+        time.sleep(0.3)
+        redis.set(
+            TOKEN_KEY.format(integration_id="g1"),
+            json.dumps({"access_token": "from-other", "expires_at": time.time() + 3600}),
+        )
+
+    threading.Thread(target=other_worker_finishes).start()
+
+    assert _refresh("g1") == "from-other"
+    assert tokens == []
+
+
+def test_a_refresh_does_not_release_a_lock_it_no_longer_owns(tokens, redis, monkeypatch):
+    lock_key = TOKEN_LOCK_KEY.format(integration_id="g1")
+
+    def slow_refresh(refresh_token):
+        # The lock expired during the call and another worker took it.
+        redis.set(lock_key, "other-worker")
+        return {"access_token": "new", "expires_in": 3600}
+
+    monkeypatch.setattr(calendar_tokens, "refresh_access_token", slow_refresh)
+
+    assert _refresh("g1", force=True) == "new"
+    assert redis.get(lock_key) == "other-worker"
+
+
+def test_a_401_renews_the_token_once_and_retries(tokens):
+    seen: list[str] = []
+
+    def call(access_token):
+        seen.append(access_token)
+        if access_token == "old":
+            request = httpx.Request("GET", "https://www.googleapis.com/calendar/v3/freeBusy")
+            raise httpx.HTTPStatusError("revoked", request=request, response=httpx.Response(401, request=request))
+        return "ok"
+
+    assert call_with_token("g1", call) == "ok"
+    assert seen == ["old", "new-1"]
+
+
+def test_a_corrupt_cache_entry_is_ignored(tokens, redis):
+    redis.set(TOKEN_KEY.format(integration_id="g1"), "{not json")
+
+    assert _cached("g1") is None
+    assert get_access_token("g1") == "old"
@@ -0,0 +1,42 @@
+import pytest
+
+from app.tools import calendar
+from app.tools.calendar import get_calendar_availability
+
+WINDOW = ("2030-01-07T09:00:00+00:00", "2030-01-07T12:00:00+00:00")
+
+
+@pytest.fixture
+def links(supabase, redis, monkeypatch):
+    supabase.tables["agent_calendar_links"] = [
+        {"agent_id": "a1", "calendar_id": "ana@example.com", "integration_id": "google-ok"},
+        {"agent_id": "a1", "calendar_id": "bia@example.com", "integration_id": "google-revoked"},
+    ]
+
+    def call_with_token(integration_id, fn):
+        if integration_id == "google-revoked":
+            raise RuntimeError("token revoked")
+        return {"calendars": {"ana@example.com": {"busy": []}}}
+
+    monkeypatch.setattr(calendar, "call_with_token", call_with_token)
+    return supabase
+
+
+def test_all_mode_offers_no_slot_without_every_calendar(links):
+    result = get_calendar_availability("a1", *WINDOW, duration_minutes=30, rotation=0)
+
+    assert result["suggestions"] == []
+    assert result["available"] is False
+    assert result["errors"] == [{"calendar_id": "bia@example.com", "errors": [{"reason": "token revoked"}]}]
+
+
+def test_any_mode_only_assigns_calendars_that_were_read(links):
+    result = get_calendar_availability("a1", *WINDOW, duration_minutes=30, any_calendar=True, rotation=0)
+
+    assert result["suggestions"]
+    assert {slot["calendar_id"] for slot in result["suggestions"]} == {"ana@example.com"}
+
+
+def test_the_error_is_raised_when_no_calendar_could_be_read(links):
+    with pytest.raises(RuntimeError, match="token revoked"):
+        get_calendar_availability("a1", *WINDOW, calendar_ids=["bia@example.com"], duration_minutes=30)
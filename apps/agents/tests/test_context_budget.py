@@ -0,0 +1,52 @@
+import pytest
+
+from app.services import context_budget
+from app.services.context_budget import MESSAGE_OVERHEAD_TOKENS, message_tokens, split_history
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # The cl100k_base encoding is downloaded on first use; a word count is
+    # enough to exercise the split.
+    monkeypatch.setattr(context_budget, "count_tokens", lambda text: len(text.split()) if text else 0)
+
+
+def _messages(count: int) -> list[dict]:
+    return [{"id": f"m{index}", "conteudo": f"mensagem numero {index}"} for index in range(count)]
+
+
+def test_everything_fits():
+    messages = _messages(5)
+
+    assert split_history(messages, 10_000, 2) == (messages, [])
+
+
+def test_keeps_the_newest_messages_that_fit():
+    messages = _messages(6)
+    budget = sum(message_tokens(message) for message in messages[-3:])
+
+    recent, older = split_history(messages, budget, 1)
+
+    assert recent == messages[-3:]
+    assert older == messages[:3]
+
+
+def test_min_recent_wins_over_the_budget():
+    messages = _messages(6)
+
+    recent, older = split_history(messages, 0, 4)
+
+    assert recent == messages[-4:]
+    assert older == messages[:2]
+
+
+def test_split_is_contiguous_and_loses_nothing():
+    messages = _messages(20)
+
+    for budget in range(0, 200, 7):
+        recent, older = split_history(messages, budget, 2)
+        assert older + recent == messages
+
+
+def test_empty_content_still_costs_the_overhead():
+    assert message_tokens({"conteudo": None}) == MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,107 @@
+from postgrest.exceptions import APIError
+import pytest
+
+from app.services import conversation_summary
+from app.services.conversation_summary import _fold_batches, get_conversation_summary, summarize_aged_out_messages
+from conftest import FakeQuery
+
+
+def _message(index: int, created_at: str | None = None) -> dict:
+    return {
+        "id": f"m{index:03d}",
+        "conversation_id": "c1",
+        "autor": "contato",
+        "conteudo": f"mensagem {index}",
+        "created_at": created_at or f"2026-01-01T00:{index // 60:02d}:{index % 60:02d}+00:00",
+    }
+
+
+def test_fold_batches_never_splits_a_timestamp():
+    tied = "2026-01-01T00:00:03+00:00"
+    rows = [_message(1), _message(2), _message(3, tied), _message(4, tied), _message(5), _message(6)]
+
+    batches = list(_fold_batches([rows[:4], rows[4:]], 4))
+
+    assert [[row["id"] for row in batch] for batch in batches] == [
+        ["m001", "m002"],
+        ["m003", "m004", "m005"],
+        ["m006"],
+    ]
+
+
+def test_fold_batches_keeps_a_batch_that_is_one_timestamp():
+    tied = "2026-01-01T00:00:01+00:00"
+    rows = [_message(index, tied) for index in range(3)]
+
+    assert list(_fold_batches([rows], 3)) == [rows]
+
+
+@pytest.fixture
+def conversation(redis, supabase, monkeypatch):
+    monkeypatch.setattr(conversation_summary.settings, "agent_history_window_messages", 3)
+    monkeypatch.setattr(conversation_summary.settings, "agent_summary_batch_size", 100)
+    supabase.tables["messages"] = [_message(index) for index in range(1, 11)]
+    supabase.tables["agent_conversation_state"] = [
+        {"agent_id": "a1", "conversation_id": "c1", "resumo_conversa": "", "resumo_ate_em": None}
+    ]
+    folded: list[list[str]] = []
+
+    def summarize(previous, messages):
+        folded.append([message["id"] for message in messages])
+        return f"{previous} +{len(messages)}".strip()
+
+    monkeypatch.setattr(conversation_summary, "_summarize", summarize)
+    return folded
+
+
+def test_background_summary_folds_everything_before_the_window_from_the_watermark(supabase, conversation):
+    state = supabase.tables["agent_conversation_state"][0]
+    state["resumo_ate_em"] = _message(2)["created_at"]
+
+    result = summarize_aged_out_messages("a1", "c1")
+
+    assert conversation == [["m003", "m004", "m005", "m006", "m007"]]
+    assert result["status"] == "ok"
+    assert state["resumo_ate_em"] == _message(7)["created_at"]
+
+    assert summarize_aged_out_messages("a1", "c1")["folded"] == 0
+
+
+def test_background_summary_covers_messages_the_run_left_out_of_its_budget(supabase, conversation):
+    # The window keeps m008..m010, but the run only sent m010.
+    result = summarize_aged_out_messages("a1", "c1", until=_message(9)["created_at"])
+
+    assert conversation == [[f"m{index:03d}" for index in range(1, 10)]]
+    assert result["watermark"] == _message(9)["created_at"]
+
+
+def test_nothing_to_fold_inside_the_window(supabase, conversation, monkeypatch):
+    monkeypatch.setattr(conversation_summary.settings, "agent_history_window_messages", 50)
+
+    assert summarize_aged_out_messages("a1", "c1")["status"] == "skipped"
+    assert summarize_aged_out_messages("a1", "c1", until=_message(4)["created_at"])["folded"] == 4
+
+
+def test_a_database_without_summary_columns_runs_without_a_summary(supabase, conversation, monkeypatch):
+    execute = FakeQuery.execute
+
+    def without_columns(query):
+        if query.table == "agent_conversation_state":
+            raise APIError({"code": "42703", "message": "column agent_conversation_state.resumo_conversa does not exist"})
+        return execute(query)
+
+    monkeypatch.setattr(FakeQuery, "execute", without_columns)
+
+    assert get_conversation_summary("a1", "c1") == {"resumo": "", "ate": None, "disponivel": False}
+    assert summarize_aged_out_messages("a1", "c1") == {"status": "skipped", "reason": "no_summary_columns"}
+    assert conversation == []
+
+
+def test_other_database_errors_are_raised(supabase, monkeypatch):
+    def failing(query):
+        raise APIError({"code": "57014", "message": "canceling statement due to statement timeout"})
+
+    monkeypatch.setattr(FakeQuery, "execute", failing)
+
+    with pytest.raises(APIError):
+        get_conversation_summary("a1", "c1")
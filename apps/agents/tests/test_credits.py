@@ -0,0 +1,153 @@
+import pytest
+
+from conftest import FakeQuery
+from app.clients.redis_client import acquire_lock, release_lock
+from app.services import credits
+from app.services.credits import (
+    CARRY_KEY,
+    LEDGER_KEY,
+    PENDING_KEY,
+    PROCESSING_KEY,
+    SETTLE_LOCK_KEY,
+    SETTLE_STATE_KEY,
+    consume_credits,
+    get_remaining_credits,
+    invalidate_balance,
+    reserve_credits,
+    settle_credit_ledger,
+)
+
+
+@pytest.fixture
+def workspace(redis, supabase):
+    supabase.tables["workspace_credits"] = [{"workspace_id": "w1", "credits_total": 10, "credits_used": 0}]
+    return "w1"
+
+
+def _used(supabase) -> int:
+    return supabase.tables["workspace_credits"][0]["credits_used"]
+
+
+def test_reserve_never_goes_below_zero(workspace):
+    assert reserve_credits(workspace, 6)
+    assert not reserve_credits(workspace, 5)
+    assert get_remaining_credits(workspace) == 4
+
+
+def test_settle_moves_pending_debits_to_postgres(workspace, redis, supabase):
+    for _ in range(3):
+        consume_credits(workspace, "a1", "c1", None, 1)
+
+    result = settle_credit_ledger()
+
+    assert result == {"status": "settled", "events": 3, "workspaces": 1}
+    assert _used(supabase) == 3
+    assert int(redis.hget(PENDING_KEY, workspace)) == 0
+    assert len(supabase.tables["agent_credit_events"]) == 3
+    assert redis.llen(LEDGER_KEY) == redis.llen(PROCESSING_KEY) == 0
+    assert get_remaining_credits(workspace) == 7
+
+
+def test_failed_insert_keeps_the_batch_for_the_next_run(workspace, redis, supabase, monkeypatch):
+    consume_credits(workspace, "a1", "c1", None, 2)
+    original = supabase.table
+
+    def failing_table(name):
+        if name == "agent_credit_events":
+            raise RuntimeError("postgrest down")
+        return original(name)
+
+    monkeypatch.setattr(supabase, "table", failing_table)
+    with pytest.raises(RuntimeError):
+        settle_credit_ledger()
+    assert redis.llen(PROCESSING_KEY) == 1
+    assert int(redis.hget(PENDING_KEY, workspace)) == 2
+
+    monkeypatch.setattr(supabase, "table", original)
+    consume_credits(workspace, "a1", "c1", None, 1)
+    assert settle_credit_ledger()["events"] == 1
+    assert _used(supabase) == 2
+    assert settle_credit_ledger()["events"] == 1
+    assert _used(supabase) == 3
+    assert int(redis.hget(PENDING_KEY, workspace)) == 0
+
+
+def test_resumed_batch_is_not_inserted_or_applied_twice(workspace, redis, supabase, monkeypatch):
+    consume_credits(workspace, "a1", "c1", None, 2)
+    monkeypatch.setattr(
+        credits, "increment_agent_metrics", lambda *args, **kwargs: (_ for _ in ()).throw(RuntimeError())
+    )
+    with pytest.raises(RuntimeError):
+        settle_credit_ledger()
+    assert _used(supabase) == 2
+
+    monkeypatch.setattr(credits, "increment_agent_metrics", lambda *args, **kwargs: None)
+    # As if the settler had died between the insert and its marker.
+    redis.hdel(SETTLE_STATE_KEY, "inserted")
+    assert settle_credit_ledger()["status"] == "settled"
+    assert _used(supabase) == 2
+    assert len(supabase.tables["agent_credit_events"]) == 1
+    assert int(redis.hget(PENDING_KEY, workspace)) == 0
+    assert redis.llen(PROCESSING_KEY) == 0
+
+
+def test_conflicting_workspace_is_carried_to_the_next_run(workspace, redis, supabase, monkeypatch):
+    consume_credits(workspace, "a1", "c1", None, 2)
+    apply_credits_used = credits._apply_credits_used
+    monkeypatch.setattr(credits, "_apply_credits_used", lambda workspace_id, delta: False)
+    settle_credit_ledger()
+    assert int(redis.hget(CARRY_KEY, workspace)) == 2
+
+    monkeypatch.setattr(credits, "_apply_credits_used", apply_credits_used)
+    settle_credit_ledger()
+    assert _used(supabase) == 2
+    assert int(redis.hget(CARRY_KEY, workspace)) == 0
+    assert int(redis.hget(PENDING_KEY, workspace)) == 0
+
+
+def test_settle_skips_while_locked_and_keeps_foreign_lock(redis):
+    token = acquire_lock(SETTLE_LOCK_KEY, 60)
+    assert settle_credit_ledger()["status"] == "locked"
+    assert redis.get(SETTLE_LOCK_KEY) == token
+    assert not release_lock(SETTLE_LOCK_KEY, "other")
+    assert release_lock(SETTLE_LOCK_KEY, token)
+
+
+def test_a_settler_that_died_after_the_update_does_not_apply_it_again(workspace, redis, supabase, monkeypatch):
+    consume_credits(workspace, "a1", "c1", None, 2)
+    execute = FakeQuery.execute
+
+    def dies_after_update(query):
+        response = execute(query)
+        if query.table == "workspace_credits" and query.operation == "update":
+            raise RuntimeError("worker killed")
+        return response
+
+    monkeypatch.setattr(FakeQuery, "execute", dies_after_update)
+    with pytest.raises(RuntimeError):
+        settle_credit_ledger()
+    assert _used(supabase) == 2
+
+    monkeypatch.setattr(FakeQuery, "execute", execute)
+    assert settle_credit_ledger()["status"] == "settled"
+    assert _used(supabase) == 2
+    assert int(redis.hget(PENDING_KEY, workspace)) == 0
+
+
+def test_a_settler_that_lost_its_lock_writes_nothing(workspace, redis, supabase, monkeypatch):
+    consume_credits(workspace, "a1", "c1", None, 2)
+    monkeypatch.setattr(credits, "renew_lock", lambda key, token, ttl: False)
+
+    assert settle_credit_ledger()["status"] == "lock_lost"
+    assert _used(supabase) == 0
+    assert "agent_credit_events" not in supabase.tables
+    assert redis.llen(PROCESSING_KEY) == 1
+
+
+def test_invalidated_balance_is_reloaded_after_a_plan_change(workspace, supabase):
+    assert get_remaining_credits(workspace) == 10
+    supabase.tables["workspace_credits"][0]["credits_total"] = 30
+
+    assert get_remaining_credits(workspace) == 10
+    invalidate_balance(workspace)
+    assert get_remaining_credits(workspace) == 30
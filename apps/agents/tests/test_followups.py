@@ -0,0 +1,118 @@
+import time
+
+from app.services import followups
+from app.services.followups import (
+    FOLLOWUP_ATTEMPTS_KEY,
+    FOLLOWUP_DEAD_KEY,
+    FOLLOWUP_PROCESSING_KEY,
+    FOLLOWUP_QUEUE_KEY,
+    ack_followups,
+    claim_due_followups,
+    enqueue_followup,
+    fail_followups,
+)
+from app.workers import tasks
+
+
+def test_claim_moves_due_followups_to_processing(redis):
+    enqueue_followup("a1", "c1", "f1", 0)
+    enqueue_followup("a1", "c2", "f1", 3600)
+
+    jobs = claim_due_followups(10)
+
+    assert jobs == [{"agent_id": "a1", "conversation_id": "c1", "followup_id": "f1"}]
+    assert redis.zcard(FOLLOWUP_QUEUE_KEY) == 1
+    assert redis.zcard(FOLLOWUP_PROCESSING_KEY) == 1
+    assert claim_due_followups(10) == []
+
+
+def test_unacknowledged_claim_is_claimed_again_after_deadline(redis, monkeypatch):
+    monkeypatch.setattr(followups.settings, "followup_claim_visibility_seconds", 60)
+    enqueue_followup("a1", "c1", "f1", 0)
+    jobs = claim_due_followups(10)
+
+    later = time.time() + 61
+    monkeypatch.setattr(followups.time, "time", lambda: later)
+    assert claim_due_followups(10) == jobs
+
+    ack_followups(jobs)
+    monkeypatch.setattr(followups.time, "time", lambda: later + 61)
+    assert claim_due_followups(10) == []
+    assert redis.zcard(FOLLOWUP_PROCESSING_KEY) == 0
+
+
+def test_claim_respects_limit_across_expired_and_due(redis, monkeypatch):
+    monkeypatch.setattr(followups.settings, "followup_claim_visibility_seconds", 60)
+    enqueue_followup("a1", "c1", "f1", 0)
+    claim_due_followups(10)
+    for conversation_id in ("c2", "c3"):
+        enqueue_followup("a1", conversation_id, "f1", 0)
+
+    later = time.time() + 61
+    monkeypatch.setattr(followups.time, "time", lambda: later)
+    jobs = claim_due_followups(2)
+
+    assert [job["conversation_id"] for job in jobs] == ["c1", "c2"]
+    assert redis.zcard(FOLLOWUP_QUEUE_KEY) == 1
+
+
+def test_claim_drops_malformed_members(redis):
+    redis.zadd(FOLLOWUP_QUEUE_KEY, {"not json": 0, '{"agent_id": "a1"}': 0})
+
+    assert claim_due_followups(10) == []
+    assert redis.zcard(FOLLOWUP_PROCESSING_KEY) == 0
+
+
+def test_batch_writes_one_state_row_per_conversation(supabase, monkeypatch):
+    data = followups.FollowupPrefetch(agents={"a1": {"integration_account_id": "acc"}})
+    monkeypatch.setattr(followups, "prefetch_followups", lambda jobs: data)
+    monkeypatch.setattr(
+        followups,
+        "_plan_followup",
+        lambda job, data: (None, {"canal": "whatsapp", "kind": "text", "workspace_id": "w1"}),
+    )
+    monkeypatch.setattr(followups, "_load_send_credentials", lambda plans: {})
+    monkeypatch.setattr(followups, "_send_followup", lambda job, plan, credentials=None: None)
+    jobs = [
+        {"agent_id": "a1", "conversation_id": "c1", "followup_id": "f1"},
+        {"agent_id": "a1", "conversation_id": "c1", "followup_id": "f2"},
+        {"agent_id": "a1", "conversation_id": "c2", "followup_id": "f1"},
+    ]
+
+    results = followups.run_followups_batch(jobs)
+
+    assert [result["status"] for result in results] == ["sent", "sent", "sent"]
+    rows = supabase.tables["agent_conversation_state"]
+    assert sorted(row["conversation_id"] for row in rows) == ["c1", "c2"]
+
+
+def test_failed_prefetch_retries_the_batch_then_dead_letters_it(redis, monkeypatch):
+    monkeypatch.setattr(followups.settings, "followup_max_attempts", 2)
+    monkeypatch.setattr(followups.settings, "followup_claim_visibility_seconds", 60)
+    monkeypatch.setattr(tasks, "run_followups_batch", lambda jobs: 1 / 0)
+    enqueue_followup("a1", "c1", "f1", 0)
+    now = time.time()
+
+    assert tasks.run_due_followups_task() == {"status": "failed", "claimed": 1, "dead_lettered": 0}
+    assert redis.zcard(FOLLOWUP_PROCESSING_KEY) == 1
+    assert tasks.run_due_followups_task() == {"status": "idle", "claimed": 0}
+
+    monkeypatch.setattr(followups.time, "time", lambda: now + 61)
+    assert tasks.run_due_followups_task() == {"status": "failed", "claimed": 1, "dead_lettered": 1}
+
+    assert redis.zcard(FOLLOWUP_PROCESSING_KEY) == 0
+    assert redis.zcard(FOLLOWUP_DEAD_KEY) == 1
+    assert not redis.exists(FOLLOWUP_ATTEMPTS_KEY)
+    monkeypatch.setattr(followups.time, "time", lambda: now + 1000)
+    assert claim_due_followups(10) == []
+
+
+def test_ack_forgets_earlier_failed_attempts(redis):
+    enqueue_followup("a1", "c1", "f1", 0)
+    jobs = claim_due_followups(10)
+
+    assert fail_followups(jobs) == []
+    ack_followups(jobs)
+
+    assert not redis.exists(FOLLOWUP_ATTEMPTS_KEY)
+    assert redis.zcard(FOLLOWUP_PROCESSING_KEY) == 0
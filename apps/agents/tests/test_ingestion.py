@@ -0,0 +1,128 @@
+import pytest
+
+from conftest import FakeQuery
+from app.services import ingestion, instagram_ingestion
+from app.services.ingestion import (
+    INSTAGRAM,
+    UAZAPI,
+    InboundBatch,
+    InboundMessage,
+    IngestResult,
+    MediaJob,
+    ingest_event,
+    store_media,
+)
+
+INSTAGRAM_PAYLOAD = {
+    "entry": [
+        {
+            "messaging": [
+                {
+                    "sender": {"id": "ig-user"},
+                    "recipient": {"id": "ig-page"},
+                    "timestamp": 1_700_000_000_000,
+                    "message": {
+                        "mid": "mid-1",
+                        "attachments": [
+                            {"type": "image", "payload": {"url": "https://cdn.example/a.jpg"}},
+                            {"type": "image", "payload": {"url": "https://cdn.example/b.jpg"}},
+                        ],
+                    },
+                }
+            ]
+        }
+    ]
+}
+
+
+def test_every_instagram_attachment_is_stored(supabase, monkeypatch):
+    monkeypatch.setattr(
+        instagram_ingestion,
+        "_get_integration_by_instagram_id",
+        lambda instagram_id: {"id": "acc1", "integration_id": "int1", "integrations": {"workspace_id": "w1"}},
+    )
+    monkeypatch.setattr(ingestion, "get_integration_token", lambda *account: "token")
+    monkeypatch.setattr(
+        ingestion,
+        "_upload",
+        lambda job, token: {
+            "workspace_id": job.workspace_id,
+            "message_id": job.message_row_id,
+            "storage_path": f"{ingestion._storage_prefix(job)}.jpg",
+            "tipo": job.media.tipo,
+            "tamanho_bytes": 1,
+        },
+    )
+    (record,) = instagram_ingestion._build_batch(INSTAGRAM_PAYLOAD).records
+    jobs = [
+        MediaJob("w1", "c1", "m1", record.integration_id, record.integration_account_id, media)
+        for media in record.media
+    ]
+
+    assert store_media(jobs, notify=False) == 2
+    assert sorted(row["storage_path"] for row in supabase.tables["attachments"]) == ["w1/c1/m1-1.jpg", "w1/c1/m1.jpg"]
+    # A redelivered event finds both attachments already stored.
+    assert store_media(jobs, notify=False) == 0
+
+
+def test_ingest_event_keeps_conversations_in_arrival_order(monkeypatch):
+    marked: list[str] = []
+    monkeypatch.setattr(ingestion, "mark_event", lambda event_id, status, integration_id=None: marked.append(status))
+    monkeypatch.setattr(
+        ingestion,
+        "ingest",
+        lambda channel, records, process_media=True: IngestResult(conversation_ids=["c9", "c1", "c5"]),
+    )
+
+    result = ingest_event("e1", INSTAGRAM, lambda: InboundBatch(workspace_id="w1"))
+
+    assert result["conversation_ids"] == ["c9", "c1", "c5"]
+    assert marked == ["processado"]
+
+
+def _uazapi_lead() -> InboundMessage:
+    return InboundMessage(
+        workspace_id="w1",
+        integration_id="int1",
+        integration_account_id="acc1",
+        lead_key="5511999990000",
+        message_id="m1",
+        author="lead",
+        tipo="texto",
+        conteudo="oi",
+        created_at="2026-10-19T12:00:00+00:00",
+        lead_name="Ana",
+        lead_avatar_url="https://cdn.example/ana.jpg",
+    )
+
+
+def _failing_lead_upserts(monkeypatch, message: str) -> list[dict]:
+    execute = FakeQuery.execute
+    attempts: list[dict] = []
+
+    def fails_with_avatar(query):
+        if query.table == "leads" and query.operation == "upsert":
+            attempts.append(dict(query.payload[0]))
+            if "avatar_url" in query.payload[0]:
+                raise RuntimeError(message)
+        return execute(query)
+
+    monkeypatch.setattr(FakeQuery, "execute", fails_with_avatar)
+    return attempts
+
+
+def test_leads_are_saved_without_avatar_when_the_column_is_missing(supabase, monkeypatch):
+    attempts = _failing_lead_upserts(monkeypatch, "column leads.avatar_url does not exist")
+
+    lead_ids = ingestion._upsert_leads(UAZAPI, [_uazapi_lead()])
+
+    assert list(lead_ids) == [("w1", "5511999990000")]
+    assert "avatar_url" in attempts[0] and "avatar_url" not in attempts[1]
+
+
+def test_other_lead_errors_are_not_retried(supabase, monkeypatch):
+    attempts = _failing_lead_upserts(monkeypatch, "connection reset")
+
+    with pytest.raises(RuntimeError):
+        ingestion._upsert_leads(UAZAPI, [_uazapi_lead()])
+    assert len(attempts) == 1
@@ -0,0 +1,56 @@
+from app.services.message_store import message_row, upsert_message, upsert_messages
+from conftest import FakeQuery
+
+
+def _row(message_id, content="oi", **extra):
+    return {**message_row("w1", "c1", message_id, "contato", "texto", content, "2024-05-01T12:00:00+00:00"), **extra}
+
+
+def test_ids_come_back_in_input_order_with_repeats_collapsed(supabase):
+    supabase.tables["messages"] = [{"id": "old", **_row("wamid.2", content="antes")}]
+
+    ids = upsert_messages([_row("wamid.1"), _row("wamid.2", content="depois"), _row(None), _row("wamid.1"), _row(None)])
+
+    assert ids[1] == "old"
+    assert ids[0] == ids[3]
+    assert len({ids[0], ids[2], ids[4], "old"}) == 4
+    assert len(supabase.tables["messages"]) == 4
+    assert next(row for row in supabase.tables["messages"] if row["id"] == "old")["conteudo"] == "depois"
+
+
+def test_ids_are_mapped_by_provider_id_whatever_order_rows_return_in(supabase, monkeypatch):
+    execute = FakeQuery.execute
+
+    def reversed_upserts(query):
+        response = execute(query)
+        if query.operation == "upsert":
+            response.data = list(reversed(response.data))
+        return response
+
+    monkeypatch.setattr(FakeQuery, "execute", reversed_upserts)
+
+    ids = upsert_messages([_row("wamid.1"), _row("wamid.2"), _row("wamid.3")])
+
+    by_message = {row["whatsapp_message_id"]: row["id"] for row in supabase.tables["messages"]}
+    assert ids == [by_message["wamid.1"], by_message["wamid.2"], by_message["wamid.3"]]
+
+
+def test_rows_with_different_columns_are_written_in_separate_calls(supabase):
+    ids = upsert_messages([_row("wamid.1"), _row("wamid.2", extra_column=1), _row("wamid.3")])
+
+    assert all(ids)
+    assert supabase.calls.count(("messages", "upsert")) == 2
+
+
+def test_single_message_form(supabase):
+    row_id = upsert_message(
+        workspace_id="w1",
+        conversation_id="c1",
+        message_id="wamid.9",
+        author="contato",
+        message_type="texto",
+        content="oi",
+        created_at="2024-05-01T12:00:00+00:00",
+    )
+
+    assert row_id == supabase.tables["messages"][0]["id"]
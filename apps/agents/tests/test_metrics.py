@@ -0,0 +1,78 @@
+import pytest
+
+from app.services import metrics
+from app.services.metrics import (
+    METRICS_DIRTY_KEY,
+    METRICS_PLANNED_KEY,
+    METRICS_PROCESSING_KEY,
+    flush_agent_metrics,
+    get_agent_metrics_daily,
+    increment_agent_metrics,
+)
+
+
+@pytest.fixture
+def today(monkeypatch):
+    day = metrics.date(2026, 10, 19)
+    monkeypatch.setattr(metrics, "_metric_day", lambda: day)
+    return day.isoformat()
+
+
+def test_flush_adds_deltas_to_daily_rows(redis, supabase, today):
+    supabase.tables["agent_metrics_daily"] = [
+        {"id": "r1", "agent_id": "a1", "workspace_id": "w1", "data": today, "mensagens_enviadas": 5}
+    ]
+    increment_agent_metrics("a1", "w1", {"mensagens_enviadas": 2})
+    increment_agent_metrics("a2", "w1", {"leads_convertidos": 1})
+
+    assert flush_agent_metrics() == {"status": "flushed", "rows": 2}
+
+    rows = {row["agent_id"]: row for row in supabase.tables["agent_metrics_daily"]}
+    assert rows["a1"]["mensagens_enviadas"] == 7
+    assert rows["a2"]["leads_convertidos"] == 1
+    assert redis.scard(METRICS_DIRTY_KEY) == redis.scard(METRICS_PROCESSING_KEY) == 0
+
+
+def test_failed_flush_keeps_the_batch_and_new_deltas(redis, supabase, today, monkeypatch):
+    increment_agent_metrics("a1", "w1", {"mensagens_enviadas": 2})
+    load_daily_rows = metrics._load_daily_rows
+    monkeypatch.setattr(metrics, "_load_daily_rows", lambda agent_ids, days: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        flush_agent_metrics()
+    increment_agent_metrics("a1", "w1", {"mensagens_enviadas": 3})
+
+    assert get_agent_metrics_daily(["a1"], today)[0]["mensagens_enviadas"] == 5
+
+    monkeypatch.setattr(metrics, "_load_daily_rows", load_daily_rows)
+    assert flush_agent_metrics()["rows"] == 1
+    assert flush_agent_metrics()["rows"] == 1
+
+    assert [row["mensagens_enviadas"] for row in supabase.tables["agent_metrics_daily"]] == [5]
+    assert get_agent_metrics_daily(["a1"], today)[0]["mensagens_enviadas"] == 5
+
+
+def test_a_flush_that_died_after_writing_does_not_count_twice(redis, supabase, today, monkeypatch):
+    supabase.tables["agent_metrics_daily"] = [
+        {"id": "r1", "agent_id": "a1", "workspace_id": "w1", "data": today, "mensagens_enviadas": 5}
+    ]
+    increment_agent_metrics("a1", "w1", {"mensagens_enviadas": 2})
+    finish_batch = metrics._finish_batch
+    monkeypatch.setattr(metrics, "_finish_batch", lambda members: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        flush_agent_metrics()
+    assert supabase.tables["agent_metrics_daily"][0]["mensagens_enviadas"] == 7
+
+    monkeypatch.setattr(metrics, "_finish_batch", finish_batch)
+    assert flush_agent_metrics()["rows"] == 1
+
+    assert supabase.tables["agent_metrics_daily"][0]["mensagens_enviadas"] == 7
+    assert redis.get(METRICS_PLANNED_KEY) is None
+
+
+def test_a_flusher_that_lost_its_lock_writes_nothing(redis, supabase, today, monkeypatch):
+    increment_agent_metrics("a1", "w1", {"mensagens_enviadas": 2})
+    monkeypatch.setattr(metrics, "renew_lock", lambda key, token, ttl: False)
+
+    assert flush_agent_metrics() == {"status": "lock_lost", "rows": 0}
+    assert not supabase.tables.get("agent_metrics_daily")
+    assert redis.scard(METRICS_PROCESSING_KEY) == 1
@@ -0,0 +1,176 @@
+import threading
+import time
+from uuid import uuid4
+
+import pytest
+
+from app.services import provider_health
+from app.services.model_fallback import run_with_fallback
+from app.services.provider_health import ProviderHealthCallback, ProviderTarget, provider_breaker
+
+
+class Primary:
+    model_name = "primary-model"
+
+
+class Secondary:
+    model_name = "secondary-model"
+
+
+SEQUENCE = [("primary", Primary()), ("secondary", Secondary())]
+
+
+@pytest.fixture
+def recorded(redis, monkeypatch):
+    results: list[tuple[str, str | None]] = []
+    monkeypatch.setattr(
+        provider_health,
+        "record_result",
+        lambda target, latency_ms, error=None: results.append((target.key, type(error).__name__ if error else None)),
+    )
+    return results
+
+
+def _statuses(attempts) -> dict[str, str]:
+    return {attempt.label: attempt.status for attempt in attempts}
+
+
+def test_a_silent_attempt_is_hedged_and_the_first_answer_wins(redis):
+    def call(attempt):
+        if attempt.label == "primary":
+            attempt.cancel_event.wait(1)
+        return attempt.label
+
+    winner, result, attempts = run_with_fallback(SEQUENCE, call, hedge_after_ms=50, deadline_ms=0)
+
+    assert result == "secondary"
+    assert winner.hedged
+    assert _statuses(attempts) == {"primary": "cancelled", "secondary": "ok"}
+
+
+def test_an_attempt_with_first_tokens_is_not_hedged(redis):
+    def call(attempt):
+        attempt.mark_first_token()
+        time.sleep(0.15)
+        return attempt.label
+
+    winner, result, attempts = run_with_fallback(SEQUENCE, call, hedge_after_ms=50, deadline_ms=0)
+
+    assert result == "primary"
+    assert [attempt.label for attempt in attempts] == ["primary"]
+
+
+def test_a_hedged_answer_is_discarded_once_another_attempt_committed(redis):
+    owner: dict[str, str] = {}
+    lock = threading.Lock()
+
+    def claim(attempt):
+        with lock:
+            owner.setdefault("id", attempt.id)
+            return owner["id"] == attempt.id
+
+    def call(attempt):
+        if attempt.label == "primary":
+            # Sends a first paragraph, then keeps generating.
+            claim(attempt)
+            time.sleep(0.3)
+        return attempt.label
+
+    winner, result, attempts = run_with_fallback(
+        SEQUENCE,
+        call,
+        is_committed=lambda attempt: owner.get("id") == attempt.id,
+        claim=claim,
+        hedge_after_ms=50,
+        deadline_ms=0,
+    )
+
+    # The hedge never starts: the primary committed before the hedge delay.
+    assert result == "primary"
+    assert winner.label == "primary"
+
+    owner.clear()
+
+    def late_commit(attempt):
+        if attempt.label == "primary":
+            time.sleep(0.1)
+            claim(attempt)
+            time.sleep(0.2)
+        else:
+            # The hedge starts at 50ms and finishes after the primary committed.
+            time.sleep(0.1)
+        return attempt.label
+
+    winner, result, attempts = run_with_fallback(
+        SEQUENCE,
+        late_commit,
+        is_committed=lambda attempt: owner.get("id") == attempt.id,
+        claim=claim,
+        hedge_after_ms=50,
+        deadline_ms=0,
+    )
+
+    assert result == "primary"
+    assert _statuses(attempts) == {"primary": "ok", "secondary": "superseded"}
+
+
+def test_a_deadline_records_the_call_in_flight_once(recorded):
+    callback = ProviderHealthCallback(ProviderTarget("openai", "primary-model", "chat"))
+    finished = threading.Event()
+
+    def call(attempt):
+        if attempt.label == "primary":
+            run_id = uuid4()
+            callback.on_chat_model_start(None, [], run_id=run_id)
+            time.sleep(0.3)
+            callback.on_llm_end(None, run_id=run_id)
+            finished.set()
+        return attempt.label
+
+    winner, result, attempts = run_with_fallback(SEQUENCE, call, hedge_after_ms=0, deadline_ms=100)
+    finished.wait(1)
+
+    assert result == "secondary"
+    assert _statuses(attempts) == {"primary": "timeout", "secondary": "ok"}
+    assert recorded == [("openai:primary-model:chat", "TimeoutError")]
+
+
+def test_calls_outside_an_attempt_are_recorded_by_the_callback(recorded):
+    callback = ProviderHealthCallback(ProviderTarget("openai", "primary-model", "chat"))
+    run_id = uuid4()
+
+    callback.on_chat_model_start(None, [], run_id=run_id)
+    callback.on_llm_end(None, run_id=run_id)
+
+    assert recorded == [("openai:primary-model:chat", None)]
+
+
+def test_an_open_breaker_skips_its_provider(redis):
+    provider_breaker("primary").trip()
+
+    winner, result, attempts = run_with_fallback(SEQUENCE, lambda attempt: attempt.label, hedge_after_ms=0)
+
+    assert result == "secondary"
+    assert _statuses(attempts) == {"primary": "circuit_open", "secondary": "ok"}
+
+
+def test_with_every_breaker_open_the_primary_is_tried(redis):
+    provider_breaker("primary").trip()
+    provider_breaker("secondary").trip()
+
+    winner, result, attempts = run_with_fallback(SEQUENCE, lambda attempt: attempt.label, hedge_after_ms=0)
+
+    assert result == "primary"
+    assert _statuses(attempts) == {"primary": "ok"}
+
+
+def test_a_committed_attempt_that_fails_ends_the_run(redis):
+    def call(attempt):
+        raise RuntimeError("tool crashed")
+
+    winner, result, attempts = run_with_fallback(
+        SEQUENCE, call, is_committed=lambda attempt: True, hedge_after_ms=0, deadline_ms=0
+    )
+
+    assert winner is None
+    assert _statuses(attempts) == {"primary": "error"}
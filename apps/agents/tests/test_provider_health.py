@@ -0,0 +1,104 @@
+import pytest
+
+from app.services import provider_health
+from app.services.provider_health import (
+    ProviderTarget,
+    get_provider_health,
+    is_provider_available,
+    provider_breaker,
+    record_result,
+)
+
+TARGET = ProviderTarget("openai", "gpt-test", "chat")
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def thresholds(redis, monkeypatch):
+    monkeypatch.setattr(provider_health.settings, "provider_error_rate_min_calls", 10)
+    monkeypatch.setattr(provider_health.settings, "provider_error_rate_threshold", 0.5)
+
+
+def test_client_errors_never_open_the_provider_breaker():
+    for _ in range(20):
+        record_result(TARGET, 10, StatusError(400))
+
+    assert is_provider_available("openai")
+    health = get_provider_health(TARGET)
+    assert health["calls"] == 20
+    assert health["errors"] == 0
+
+
+def test_failures_below_min_calls_do_not_trip():
+    for _ in range(9):
+        record_result(TARGET, 10, TimeoutError("deadline"))
+
+    assert is_provider_available("openai")
+
+
+def test_provider_failure_rate_trips_the_breaker():
+    for _ in range(5):
+        record_result(TARGET, 10)
+    for error in (StatusError(503), APIConnectionError("reset"), TimeoutError("deadline"), StatusError(502), StatusError(500)):
+        record_result(TARGET, 10, error)
+
+    assert not is_provider_available("openai")
+
+
+def test_rate_limits_do_not_count_as_failures():
+    for _ in range(20):
+        record_result(TARGET, 10, StatusError(429))
+
+    assert is_provider_available("openai")
+    assert get_provider_health(TARGET)["errors"] == 0
+
+
+def test_failed_half_open_probe_reopens(monkeypatch):
+    breaker = provider_breaker("openai")
+    breaker.trip()
+    later = provider_health.time.time() + breaker.open_seconds + 1
+    monkeypatch.setattr("app.services.circuit_breaker.time.time", lambda: later)
+    assert breaker.allow()
+
+    record_result(TARGET, 10, TimeoutError("deadline"))
+
+    assert breaker.is_open()
+
+
+def _trip_on(target):
+    for _ in range(10):
+        record_result(target, 10, TimeoutError("deadline"))
+
+
+def test_success_on_another_endpoint_does_not_close_the_breaker():
+    _trip_on(TARGET)
+
+    record_result(ProviderTarget("openai", "gpt-test", "responses"), 10)
+    record_result(ProviderTarget("openai", "gpt-other", "chat"), 10, StatusError(400))
+
+    assert not is_provider_available("openai")
+
+
+def test_only_the_tripping_target_closes_a_half_open_breaker(monkeypatch):
+    _trip_on(TARGET)
+    breaker = provider_breaker("openai")
+    later = provider_health.time.time() + breaker.open_seconds + 1
+    monkeypatch.setattr("app.services.circuit_breaker.time.time", lambda: later)
+    assert breaker.allow()
+
+    record_result(ProviderTarget("openai", "gpt-test", "responses"), 10)
+    assert breaker.is_half_open()
+    assert breaker.allow()
+
+    record_result(TARGET, 10)
+    assert not breaker.is_half_open()
+    assert is_provider_available("openai")
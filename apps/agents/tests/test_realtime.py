@@ -0,0 +1,114 @@
+import pytest
+
+from app.services import realtime
+from app.services.realtime import RealtimePublisher, emit_conversation_updated, emit_message_created
+from app.services.realtime_transport import RecordingTransport
+
+# A flush interval long enough for a test to queue everything it publishes,
+# and shorter than the flush() timeout.
+HOLD = 0.5
+
+
+@pytest.fixture
+def transport():
+    return RecordingTransport()
+
+
+def test_queued_conversation_updates_are_merged(transport):
+    publisher = RealtimePublisher(transport, HOLD, 100)
+    publisher.publish("ws", "conversation:updated", {"id": "c1", "status": "aberta"}, ("u", "c1"))
+    publisher.publish("ws", "conversation:updated", {"id": "c2", "status": "aberta"}, ("u", "c2"))
+    publisher.publish("ws", "conversation:updated", {"id": "c1", "unread": 3}, ("u", "c1"))
+    publisher.publish("ws", "conversation:updated", {"id": "c1", "status": "resolvida"}, ("u", "c1"))
+
+    assert publisher.flush()
+
+    assert transport.events == [
+        {"channel": "ws", "name": "conversation:updated", "data": {"id": "c1", "status": "resolvida", "unread": 3}},
+        {"channel": "ws", "name": "conversation:updated", "data": {"id": "c2", "status": "aberta"}},
+    ]
+    assert transport.batches == 1
+
+
+def test_events_without_a_key_are_never_merged(transport):
+    publisher = RealtimePublisher(transport, HOLD, 100)
+    publisher.publish("conv", "message:created", {"id": "m1"})
+    publisher.publish("conv", "message:created", {"id": "m2"})
+
+    assert publisher.flush()
+
+    assert [event["data"]["id"] for event in transport.events] == ["m1", "m2"]
+
+
+def test_a_full_queue_drops_new_events(transport):
+    publisher = RealtimePublisher(transport, HOLD, 3)
+    for index in range(5):
+        publisher.publish("conv", "message:created", {"id": index})
+    # Merging into an event already queued still works when the queue is full.
+    publisher.publish("conv", "message:created", {"seen": True}, "first")
+
+    assert publisher.flush()
+
+    assert [event["data"]["id"] for event in transport.events] == [0, 1, 2]
+    assert publisher._dropped == 3
+
+    publisher.publish("conv", "message:created", {"id": 5})
+    assert publisher.flush()
+    assert transport.events[-1]["data"] == {"id": 5}
+
+
+def test_failed_batch_does_not_stop_the_publisher():
+    class Flaky(RecordingTransport):
+        def __init__(self):
+            super().__init__()
+            self.failures = 1
+
+        def send_batch(self, events):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("down")
+            super().send_batch(events)
+
+    transport = Flaky()
+    publisher = RealtimePublisher(transport, 0, 100)
+    publisher.publish("conv", "message:created", {"id": "lost"})
+    assert publisher.flush()
+    publisher.publish("conv", "message:created", {"id": "m2"})
+    assert publisher.flush()
+
+    assert [event["data"]["id"] for event in transport.events] == ["m2"]
+
+
+@pytest.fixture
+def module_publisher(transport, monkeypatch):
+    exit_hooks = []
+    monkeypatch.setattr(realtime.settings, "realtime_async_enabled", True)
+    monkeypatch.setattr(realtime.settings, "realtime_flush_interval_ms", int(HOLD * 1000))
+    monkeypatch.setattr(realtime.atexit, "register", exit_hooks.append)
+    monkeypatch.setattr(realtime, "_transport", transport)
+    monkeypatch.setattr(realtime, "_publisher", None)
+    return exit_hooks
+
+
+def test_queued_events_are_flushed_at_exit(transport, module_publisher):
+    emit_message_created("w1", "c1", {"id": "m1"})
+    emit_conversation_updated("w1", "c1", {"status": "aberta"})
+    assert transport.events == []
+
+    # What the interpreter runs on shutdown.
+    for hook in module_publisher:
+        hook()
+
+    assert [event["name"] for event in transport.events] == ["message:created", "conversation:updated"]
+
+
+def test_swapping_the_transport_flushes_the_previous_one(transport, module_publisher):
+    emit_message_created("w1", "c1", {"id": "m1"})
+
+    replacement = RecordingTransport()
+    realtime.set_realtime_transport(replacement)
+    emit_message_created("w1", "c1", {"id": "m2"})
+    assert realtime.get_realtime_publisher().flush()
+
+    assert [event["data"]["message"]["id"] for event in transport.events] == ["m1"]
+    assert [event["data"]["message"]["id"] for event in replacement.events] == ["m2"]
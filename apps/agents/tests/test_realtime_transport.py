@@ -0,0 +1,15 @@
+import pytest
+
+from app.services.realtime_transport import RealtimeTransport, RecordingTransport
+
+
+def test_transport_without_send_batch_fails_on_creation():
+    class Incomplete(RealtimeTransport):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_recording_transport_is_concrete():
+    assert isinstance(RecordingTransport(), RealtimeTransport)
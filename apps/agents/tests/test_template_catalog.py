@@ -0,0 +1,41 @@
+from app.services.template_catalog import TemplateCatalog, template_problem
+
+
+def _template(nome: str, idioma: str, status: str = "APPROVED", categoria: str = "UTILITY", id: str | None = None) -> dict:
+    return {"id": id or f"{nome}-{idioma}", "nome": nome, "idioma": idioma, "status": status, "categoria": categoria}
+
+
+CATALOG = TemplateCatalog.from_rows(
+    [
+        _template("boas_vindas", "pt_BR"),
+        _template("boas_vindas", "en_US"),
+        _template("lembrete", "pt_BR", status="REJECTED"),
+        _template("promo", "es", categoria="MARKETING"),
+    ]
+)
+
+
+def test_find_normalizes_the_language():
+    assert CATALOG.find("boas_vindas", "pt-BR")["id"] == "boas_vindas-pt_BR"
+    assert CATALOG.find("boas_vindas", "EN_us")["id"] == "boas_vindas-en_US"
+
+
+def test_find_without_language_needs_a_single_match():
+    assert CATALOG.find("boas_vindas", None) is None
+    assert CATALOG.find("promo", None)["id"] == "promo-es"
+
+
+def test_find_with_unknown_language_does_not_fall_back():
+    assert CATALOG.find("promo", "pt_BR") is None
+    assert CATALOG.find("inexistente", None) is None
+
+
+def test_default_prefers_approved_utility_templates():
+    assert CATALOG.default["categoria"] == "UTILITY"
+    assert TemplateCatalog.from_rows([_template("x", "pt_BR", status="PENDING")]).default is None
+
+
+def test_template_problem():
+    assert template_problem(None) == "template_nao_encontrado"
+    assert template_problem(CATALOG.find("lembrete", "pt_BR")) == "template_status_rejected"
+    assert template_problem(CATALOG.find("promo", "es")) is None
@@ -0,0 +1,88 @@
+import threading
+import time
+
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+import pytest
+
+from app.services import agent_runner
+from app.services.agent_runner import _execute_tool_calls
+
+
+@pytest.fixture
+def log(monkeypatch):
+    monkeypatch.setattr(agent_runner.settings, "agent_tool_concurrency", 4)
+    events: list[str] = []
+    lock = threading.Lock()
+
+    def record(event: str) -> None:
+        with lock:
+            events.append(event)
+
+    return record, events
+
+
+def _tools(record):
+    @tool
+    def buscar_horarios(dia: str) -> str:
+        """Busca horarios."""
+        record(f"start:{dia}")
+        time.sleep(0.05)
+        record(f"end:{dia}")
+        return f"horarios {dia}"
+
+    @tool
+    def enviar_mensagem(texto: str) -> str:
+        """Envia mensagem."""
+        record(f"send:{texto}")
+        return f"enviado {texto}"
+
+    @tool
+    def resolver_conversa() -> str:
+        """Resolve a conversa."""
+        record("resolve")
+        return "resolvida"
+
+    return {item.name: item for item in (buscar_horarios, enviar_mensagem, resolver_conversa)}
+
+
+def _state(*calls):
+    tool_calls = [
+        {"name": name, "args": args, "id": f"call-{index}", "type": "tool_call"}
+        for index, (name, args) in enumerate(calls)
+    ]
+    return {"messages": [AIMessage(content="", tool_calls=tool_calls)]}
+
+
+def test_serial_tools_run_after_the_parallel_ones_in_call_order(log):
+    record, events = log
+    state = _state(
+        ("enviar_mensagem", {"texto": "um"}),
+        ("buscar_horarios", {"dia": "seg"}),
+        ("resolver_conversa", {}),
+        ("buscar_horarios", {"dia": "ter"}),
+        ("enviar_mensagem", {"texto": "dois"}),
+    )
+
+    _execute_tool_calls(_tools(record), state, {})
+
+    assert events[-3:] == ["send:um", "resolve", "send:dois"]
+    # Both lookups were running at the same time.
+    assert {events[0], events[1]} == {"start:seg", "start:ter"}
+
+
+def test_results_keep_the_order_of_the_calls(log):
+    record, _ = log
+    state = _state(
+        ("enviar_mensagem", {"texto": "um"}),
+        ("buscar_horarios", {"dia": "seg"}),
+        ("ferramenta_inexistente", {}),
+        ("buscar_horarios", {"dia": "ter"}),
+    )
+
+    messages = _execute_tool_calls(_tools(record), state, {})["messages"]
+
+    assert [message.tool_call_id for message in messages] == ["call-0", "call-1", "call-2", "call-3"]
+    assert [message.content for message in messages[:2]] == ["enviado um", "horarios seg"]
+    assert messages[2].content.startswith("Error: ferramenta_inexistente is not a valid tool")
+    assert messages[3].content == "horarios ter"
@@ -0,0 +1,137 @@
+import threading
+
+import httpx
+import pytest
+
+from app.clients import uazapi_client
+from app.clients.uazapi_client import EndpointResolver, UazapiClient
+
+KEY = (("http://a", "http://b", "http://c"), "token-hash")
+BASE_URLS = list(KEY[0])
+
+
+@pytest.fixture
+def resolver(monkeypatch):
+    resolver = EndpointResolver()
+    monkeypatch.setattr(resolver, "_ensure_prober", lambda: None)
+    return resolver
+
+
+def test_ranking_prefers_working_then_faster_then_configured_order(resolver):
+    assert resolver.ranked(KEY, BASE_URLS) == BASE_URLS
+
+    resolver.record_success(KEY, "http://c", 50)
+    resolver.record_success(KEY, "http://b", 200)
+    assert resolver.ranked(KEY, BASE_URLS) == ["http://c", "http://b", "http://a"]
+
+    resolver.record_failure(KEY, "http://c", {"token": "t"})
+    assert resolver.ranked(KEY, BASE_URLS) == ["http://b", "http://a", "http://c"]
+
+
+def test_cooldown_doubles_and_is_capped(resolver, monkeypatch):
+    monkeypatch.setattr(uazapi_client.settings, "uazapi_endpoint_probe_interval_seconds", 30)
+    now = 1000.0
+    monkeypatch.setattr(uazapi_client.time, "monotonic", lambda: now)
+
+    cooldowns = []
+    for _ in range(6):
+        resolver.record_failure(KEY, "http://a", {})
+        cooldowns.append(resolver._stats[KEY]["http://a"].retry_at - now)
+    assert cooldowns == [30, 60, 120, 240, 480, 600]
+
+    resolver.record_success(KEY, "http://a", 10)
+    assert not resolver._stats[KEY]["http://a"].cooling(now)
+
+
+def test_headers_are_dropped_once_every_base_url_recovers(resolver):
+    resolver.record_failure(KEY, "http://a", {"Authorization": "Bearer secret"})
+    resolver.record_failure(KEY, "http://b", {"Authorization": "Bearer secret"})
+
+    resolver.record_success(KEY, "http://a", 10)
+    assert KEY in resolver._headers
+    resolver.record_success(KEY, "http://b", 10)
+    assert KEY not in resolver._headers
+
+
+def test_idle_and_excess_tokens_are_forgotten(resolver, monkeypatch):
+    monkeypatch.setattr(uazapi_client, "MAX_TRACKED_KEYS", 2)
+    now = 1000.0
+    monkeypatch.setattr(uazapi_client.time, "monotonic", lambda: now)
+    for name in ("k1", "k2", "k3"):
+        resolver.record_failure((("http://a",), name), "http://a", {"token": name})
+        now += 1
+
+    assert [key[1] for key in resolver._stats] == ["k2", "k3"]
+    assert [key[1] for key in resolver._headers] == ["k2", "k3"]
+
+    now += uazapi_client.IDLE_KEY_SECONDS
+    assert resolver._due_probes() == []
+    assert not resolver._stats and not resolver._headers
+
+
+def test_probe_thread_brings_a_base_url_back(monkeypatch):
+    monkeypatch.setattr(uazapi_client.settings, "uazapi_endpoint_probe_interval_seconds", 0.01)
+    probed = threading.Event()
+
+    def handler(request):
+        probed.set()
+        assert request.url.path == "/instance/status"
+        assert request.headers["token"] == "t"
+        return httpx.Response(200, json={})
+
+    monkeypatch.setattr(uazapi_client, "_http_client", httpx.Client(transport=httpx.MockTransport(handler)))
+    resolver = EndpointResolver()
+    resolver.record_failure(KEY, "http://a", {"token": "t"})
+
+    assert probed.wait(2)
+    resolver._prober.join(2)
+
+    assert resolver._prober is None
+    assert resolver._stats[KEY]["http://a"].consecutive_failures == 0
+    assert KEY not in resolver._headers
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    monkeypatch.setattr(uazapi_client.settings, "uazapi_base_urls", "http://a,http://b")
+    monkeypatch.setattr(uazapi_client, "_resolver", EndpointResolver())
+    monkeypatch.setattr(uazapi_client._resolver, "_ensure_prober", lambda: None)
+    seen: list[str] = []
+    statuses: dict[str, int] = {}
+
+    def handler(request):
+        seen.append(f"{request.url.host}{request.url.path}")
+        return httpx.Response(statuses.get(request.url.host, 200), json={"ok": True})
+
+    monkeypatch.setattr(uazapi_client, "_http_client", httpx.Client(transport=httpx.MockTransport(handler)))
+    return seen, statuses
+
+
+def test_send_moves_on_only_after_a_route_miss(calls):
+    seen, statuses = calls
+    statuses["a"] = 404
+
+    assert UazapiClient("t").send_text("5511", "oi") == {"ok": True}
+    assert seen == ["a/send/text", "b/send/text"]
+
+
+def test_send_is_not_repeated_after_a_server_error(calls):
+    seen, statuses = calls
+    statuses["a"] = 502
+
+    with pytest.raises(httpx.HTTPStatusError):
+        UazapiClient("t").send_text("5511", "oi")
+    assert seen == ["a/send/text"]
+
+
+def test_reads_move_on_after_a_server_error(calls):
+    seen, statuses = calls
+    statuses["a"] = 502
+
+    assert UazapiClient("t").instance_status() == {"ok": True}
+    assert seen == ["a/instance/status", "b/instance/status"]
+
+    # The failed base URL now cools down behind the one that answered.
+    seen.clear()
+    UazapiClient("t").send_text("5511", "oi")
+    assert seen == ["b/send/text"]
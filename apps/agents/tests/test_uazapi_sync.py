@@ -0,0 +1,80 @@
+import pytest
+
+from app.services import uazapi_sync
+from app.services.uazapi_sync import SYNC_DONE_KEY, SYNC_LOCK_KEY, sync_uazapi_history
+
+CHATS = [{"chatid": f"55119999900{index}@s.whatsapp.net"} for index in range(4)]
+
+
+class FakeUazapiClient:
+    def __init__(self, token):
+        self.token = token
+
+    def chat_find(self, payload):
+        return {"chats": CHATS if payload.get("offset") == 0 else []}
+
+
+@pytest.fixture
+def account(supabase, monkeypatch):
+    supabase.tables["integration_accounts"] = [
+        {
+            "id": "acc1",
+            "provider": "whatsapp_nao_oficial",
+            "sync_status": None,
+            "integrations": {"workspace_id": "w1"},
+        }
+    ]
+    supabase.tables["integration_tokens"] = [{"integration_account_id": "acc1", "access_token": "tok"}]
+    monkeypatch.setattr(uazapi_sync, "UazapiClient", FakeUazapiClient)
+    monkeypatch.setattr(uazapi_sync, "is_workspace_not_expired", lambda workspace_id: True)
+    return supabase.tables["integration_accounts"][0]
+
+
+def test_failed_chats_are_retried_and_finished_chats_are_not(redis, account, monkeypatch):
+    imported: list[str] = []
+    failing = {CHATS[1]["chatid"]}
+
+    def import_chat(client, workspace_id, account_id, chat, chat_id):
+        if chat_id in failing:
+            raise RuntimeError("timeout")
+        imported.append(chat_id)
+        return 2
+
+    monkeypatch.setattr(uazapi_sync, "_import_chat", import_chat)
+
+    first = sync_uazapi_history("w1", "acc1")
+    assert first["status"] == "partial"
+    assert first["failed"] == 1
+    assert account["sync_status"] == "erro"
+    assert redis.scard(SYNC_DONE_KEY.format(account_id="acc1")) == 3
+
+    failing.clear()
+    imported.clear()
+    second = sync_uazapi_history("w1", "acc1")
+
+    assert second["status"] == "ok"
+    assert second["resumed"] == 3
+    assert imported == [CHATS[1]["chatid"]]
+    assert account["sync_status"] == "done"
+    assert not redis.exists(SYNC_DONE_KEY.format(account_id="acc1"))
+    assert not redis.exists(SYNC_LOCK_KEY.format(account_id="acc1"))
+
+
+def test_a_run_does_not_release_a_lock_it_no_longer_owns(redis, account, monkeypatch):
+    lock_key = SYNC_LOCK_KEY.format(account_id="acc1")
+
+    def import_chat(client, workspace_id, account_id, chat, chat_id):
+        # The lock expired mid-run and another sync took it.
+        redis.set(lock_key, "other-run")
+        return 1
+
+    monkeypatch.setattr(uazapi_sync, "_import_chat", import_chat)
+
+    assert sync_uazapi_history("w1", "acc1")["status"] == "ok"
+    assert redis.get(lock_key) == "other-run"
+
+
+def test_a_held_lock_reports_running(redis, account):
+    redis.set(SYNC_LOCK_KEY.format(account_id="acc1"), "other-run")
+
+    assert sync_uazapi_history("w1", "acc1")["status"] == "running"
@@ -0,0 +1,203 @@
+import pytest
+
+from app.services import webhook_intake
+from app.services.webhook_intake import (
+    ATTEMPTS_KEY,
+    PARTITION_LOCK_KEY,
+    PARTITION_STREAM,
+    READY_KEY,
+    ROUTE_RETRY_KEY,
+    enqueue_event,
+    ingest_whatsapp_event,
+    partition_backlog,
+    partition_for,
+    route_events,
+)
+from app.workers import webhook_intake as worker
+
+
+def _payload(phone_number_id: str, sender: str) -> dict:
+    return {
+        "entry": [
+            {
+                "changes": [
+                    {"value": {"metadata": {"phone_number_id": phone_number_id}, "messages": [{"from": sender}]}}
+                ]
+            }
+        ]
+    }
+
+
+def _status_payload(phone_number_id: str, recipient: str) -> dict:
+    return {
+        "entry": [
+            {
+                "changes": [
+                    {
+                        "value": {
+                            "metadata": {"phone_number_id": phone_number_id},
+                            "statuses": [{"recipient_id": recipient}],
+                        }
+                    }
+                ]
+            }
+        ]
+    }
+
+
+@pytest.fixture
+def intake(redis, supabase, monkeypatch):
+    monkeypatch.setattr(webhook_intake, "_groups", set())
+    monkeypatch.setattr(webhook_intake.settings, "webhook_intake_partitions", 4)
+    return supabase
+
+
+def _add_events(supabase, payloads: dict[str, dict]) -> None:
+    supabase.tables["webhook_events"] = [{"id": event_id, "payload": payload} for event_id, payload in payloads.items()]
+    for event_id in payloads:
+        enqueue_event(event_id)
+
+
+def test_messages_and_statuses_of_a_conversation_share_a_partition(intake):
+    partition = partition_for(_payload("pn1", "5511999990000"))
+
+    assert partition == partition_for(_status_payload("pn1", "5511999990000"))
+    assert 0 <= partition < 4
+    assert partition_for(None) == partition_for({"entry": "invalid"})
+
+
+def test_router_keeps_arrival_order_within_a_partition(intake, redis):
+    payloads = {f"e{index}": _payload("pn1", "5511999990000") for index in range(5)}
+    _add_events(intake, payloads)
+
+    assert route_events() == 5
+
+    partition = partition_for(payloads["e0"])
+    entries = redis.xrange(PARTITION_STREAM.format(partition=partition))
+    assert [fields["event_id"] for _, fields in entries] == ["e0", "e1", "e2", "e3", "e4"]
+    assert redis.xlen(webhook_intake.INTAKE_STREAM) == 0
+    assert redis.lrange(READY_KEY, 0, -1) == [str(partition)]
+
+
+def _routed(intake, redis, count: int) -> int:
+    payloads = {f"e{index}": _payload("pn1", "5511999990000") for index in range(count)}
+    _add_events(intake, payloads)
+    route_events()
+    return partition_for(payloads["e0"])
+
+
+def test_a_failed_event_is_retried_before_anything_after_it(intake, redis, monkeypatch):
+    partition = _routed(intake, redis, 3)
+    ingested: list[str] = []
+    failures = {"e1": 1}
+
+    def ingest(event_id, *enqueue):
+        if failures.get(event_id):
+            failures[event_id] -= 1
+            raise RuntimeError("supabase timeout")
+        ingested.append(event_id)
+
+    monkeypatch.setattr(worker, "ingest_whatsapp_event", ingest)
+
+    assert worker.drain_partition(partition) == 1
+    assert ingested == ["e0"]
+    assert redis.hget(ATTEMPTS_KEY, "e1") == "1"
+    # The partition stays locked for the retry delay.
+    assert worker.drain_partition(partition) == 0
+
+    redis.delete(PARTITION_LOCK_KEY.format(partition=partition))
+    assert worker.drain_partition(partition) == 2
+    assert ingested == ["e0", "e1", "e2"]
+    assert partition_backlog(partition) == 0
+    assert not redis.hexists(ATTEMPTS_KEY, "e1")
+    assert not redis.exists(PARTITION_LOCK_KEY.format(partition=partition))
+
+
+def test_an_event_failing_every_attempt_is_dropped(intake, redis, monkeypatch):
+    partition = _routed(intake, redis, 2)
+    monkeypatch.setattr(worker.settings, "webhook_intake_max_attempts", 2)
+    ingested: list[str] = []
+
+    def ingest(event_id, *enqueue):
+        if event_id == "e0":
+            raise RuntimeError("bad payload")
+        ingested.append(event_id)
+
+    monkeypatch.setattr(worker, "ingest_whatsapp_event", ingest)
+
+    assert worker.drain_partition(partition) == 0
+    redis.delete(PARTITION_LOCK_KEY.format(partition=partition))
+    assert worker.drain_partition(partition) == 2
+    assert ingested == ["e1"]
+
+
+def test_a_worker_that_lost_its_lock_does_not_ack(intake, redis, monkeypatch):
+    partition = _routed(intake, redis, 2)
+    lock_key = PARTITION_LOCK_KEY.format(partition=partition)
+
+    def slow_ingest(event_id, *enqueue):
+        # The lock expired during the event and another worker took it.
+        redis.set(lock_key, "other-worker")
+
+    monkeypatch.setattr(worker, "ingest_whatsapp_event", slow_ingest)
+
+    assert worker.drain_partition(partition) == 0
+    assert partition_backlog(partition) == 2
+    assert redis.get(lock_key) == "other-worker"
+
+
+def test_an_event_without_its_row_is_retried_instead_of_routed(intake, redis, monkeypatch):
+    payloads = {"e0": _payload("pn1", "5511999990000")}
+    _add_events(intake, payloads)
+    enqueue_event("late")
+    now = webhook_intake.time.time()
+
+    assert route_events() == 2
+    assert redis.zrange(ROUTE_RETRY_KEY, 0, -1) == ["late"]
+    partition = partition_for(payloads["e0"])
+    assert partition_backlog(partition) == 1
+
+    intake.tables["webhook_events"].append({"id": "late", "payload": _payload("pn1", "5511999990000")})
+    assert route_events() == 0
+    monkeypatch.setattr(webhook_intake.time, "time", lambda: now + webhook_intake.settings.webhook_intake_retry_seconds + 1)
+    assert route_events() == 1
+
+    entries = redis.xrange(PARTITION_STREAM.format(partition=partition))
+    assert [fields["event_id"] for _, fields in entries] == ["e0", "late"]
+    assert redis.zcard(ROUTE_RETRY_KEY) == 0
+
+
+def test_an_event_whose_row_never_appears_is_routed_after_the_last_attempt(intake, redis, monkeypatch):
+    monkeypatch.setattr(webhook_intake.settings, "webhook_intake_max_attempts", 2)
+    monkeypatch.setattr(webhook_intake.settings, "webhook_intake_retry_seconds", 0)
+    intake.tables["webhook_events"] = []
+    enqueue_event("gone")
+
+    route_events()
+    assert redis.zrange(ROUTE_RETRY_KEY, 0, -1) == ["gone"]
+    route_events()
+
+    assert redis.zcard(ROUTE_RETRY_KEY) == 0
+    assert partition_backlog(partition_for(None)) == 1
+
+
+def test_ingest_hands_conversations_to_the_agent_and_media_to_its_queue(monkeypatch):
+    media = [{"media_id": "m1"}]
+    monkeypatch.setattr(
+        webhook_intake,
+        "process_whatsapp_event",
+        lambda event_id, process_media: {
+            "workspace_id": "w1",
+            "integration_account_id": "acc",
+            "conversation_ids": ["c1", "c2"],
+            "media": media,
+        },
+    )
+    monkeypatch.setattr("app.services.ingestion.find_active_agent", lambda workspace_id, account_id: "a1")
+    agents: list[tuple] = []
+    downloads: list[tuple] = []
+
+    ingest_whatsapp_event("e1", lambda *args: agents.append(args), lambda *args: downloads.append(args))
+
+    assert agents == [("a1", "c1"), ("a1", "c2")]
+    assert downloads == [("e1", media)]
@@ -0,0 +1,70 @@
+import pytest
+
+from app.services import whatsapp_templates
+from app.services.whatsapp_templates import WABA_LOCK_KEY, _apply_diff, _fetch_account_templates, _template_row
+
+ACCOUNT = {"id": "acc1", "integration_id": "int1", "waba_id": "waba1"}
+
+
+def _row(nome: str, idioma: str = "pt_BR", status: str = "APPROVED", categoria: str = "UTILITY") -> dict:
+    return _template_row("w1", {"nome": nome, "idioma": idioma, "status": status, "categoria": categoria})
+
+
+@pytest.fixture
+def stored(supabase):
+    supabase.tables["whatsapp_templates"] = [
+        {"id": "t1", **_row("boas_vindas")},
+        {"id": "t2", **_row("lembrete", status="PENDING")},
+        {"id": "t3", **_row("antigo")},
+        {"id": "t4", **_row("boas_vindas")},
+    ]
+    return supabase.tables
+
+
+def test_apply_diff_writes_only_changes(stored):
+    changes = _apply_diff("w1", [_row("boas_vindas"), _row("lembrete"), _row("novo")], complete=True)
+
+    assert changes == {"inserted": 1, "updated": 1, "deleted": 2}
+    by_name = {row["nome"]: row for row in stored["whatsapp_templates"]}
+    assert sorted(by_name) == ["boas_vindas", "lembrete", "novo"]
+    assert by_name["lembrete"]["status"] == "APPROVED"
+    assert by_name["boas_vindas"]["id"] == "t1"
+
+
+def test_partial_sync_keeps_templates_it_did_not_see(stored):
+    changes = _apply_diff("w1", [_row("novo")], complete=False)
+
+    assert changes == {"inserted": 1, "updated": 0, "deleted": 1}
+    assert {row["id"] for row in stored["whatsapp_templates"]} >= {"t1", "t2", "t3"}
+
+
+@pytest.fixture
+def graph(redis, monkeypatch):
+    calls = []
+    monkeypatch.setattr(whatsapp_templates, "_account_access_token", lambda account: "token")
+
+    def list_templates(access_token, waba_id):
+        calls.append(waba_id)
+        if len(calls) == 1:
+            raise RuntimeError("graph unavailable")
+        return [{"nome": "boas_vindas", "idioma": "pt_BR"}]
+
+    monkeypatch.setattr(whatsapp_templates, "_list_templates", list_templates)
+    return calls
+
+
+def test_failed_fetch_releases_the_waba_lock(redis, graph):
+    with pytest.raises(RuntimeError):
+        _fetch_account_templates(ACCOUNT, scheduled=True)
+    assert redis.get(WABA_LOCK_KEY.format(waba_id="waba1")) is None
+
+    assert _fetch_account_templates(ACCOUNT, scheduled=True) == [{"nome": "boas_vindas", "idioma": "pt_BR"}]
+    assert _fetch_account_templates(ACCOUNT, scheduled=True) == [{"nome": "boas_vindas", "idioma": "pt_BR"}]
+    assert graph == ["waba1", "waba1"]
+
+
+def test_scheduled_fetch_skips_a_waba_another_worker_is_reading(redis, graph):
+    redis.set(WABA_LOCK_KEY.format(waba_id="waba1"), "other", ex=60)
+
+    assert _fetch_account_templates(ACCOUNT, scheduled=True) is None
+    assert graph == []
@@ -2,6 +2,7 @@ import { z } from "zod";
 import { createClient } from "@supabase/supabase-js";
 import { badRequest, forbidden, serverError, unauthorized } from "@/lib/api/responses";
 import { parseJsonBody } from "@/lib/api/validation";
+import { invalidarSaldoCreditos } from "@/lib/agentes/cliente";
 import { getEnv } from "@/lib/config";
 
 export const runtime = "nodejs";
@@ -144,6 +145,7 @@ export async function POST(request: Request) {
       },
       { onConflict: "workspace_id" }
     );
+  await invalidarSaldoCreditos(membership.workspace_id);
 
   return Response.json({ workspace });
 }
@@ -1,5 +1,6 @@
 import { createClient } from "@supabase/supabase-js";
 import { badRequest, serverError, unauthorized } from "@/lib/api/responses";
+import { invalidarSaldoCreditos } from "@/lib/agentes/cliente";
 import { getEnv } from "@/lib/config";
 import { resolverPlanoEfetivo } from "@/lib/planos";
 
@@ -132,6 +133,7 @@ export async function GET(request: Request) {
       .select("credits_total, credits_used, period_start, period_end")
       .maybeSingle();
     credits = novoCredito ?? null;
+    await invalidarSaldoCreditos(membership.workspace_id);
   } else {
     const precisaAtualizarPeriodo =
       !credits.period_end ||
@@ -161,6 +163,7 @@ export async function GET(request: Request) {
         .select("credits_total, credits_used, period_start, period_end")
         .maybeSingle();
       credits = atualizado ?? credits;
+      await invalidarSaldoCreditos(membership.workspace_id);
     }
   }
 
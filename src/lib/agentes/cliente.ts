@@ -30,3 +30,25 @@ export async function dispararAgenteWhatsApp({
     body: JSON.stringify({ conversation_id: conversationId }),
   });
 }
+
+export async function invalidarSaldoCreditos(workspaceId: string) {
+  if (!baseUrl) {
+    return;
+  }
+
+  const headers: Record<string, string> = {};
+  if (apiKey) {
+    headers["X-Agents-Key"] = apiKey;
+  }
+
+  // O servico de agentes guarda o saldo em cache; sem isso, resets e trocas de
+  // plano so aparecem quando o cache expira. Falhas aqui nao bloqueiam o billing.
+  try {
+    await fetch(`${baseUrl}/workspaces/${workspaceId}/credits/invalidate`, {
+      method: "POST",
+      headers,
+    });
+  } catch {
+    // cache expira sozinho
+  }
+}